@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Compares the sysfs and lsblk device tree backends on a synthetic sysfs tree.
+
+Usage: python3 benchmarks/bench_device_enum.py [--disks N] [--partitions P] [--rounds R]
+
+Both backends read the same synthetic tree: the sysfs backend through its
+sys_root/proc_root arguments and lsblk through '--sysroot'.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import sysfs_devices  # noqa: E402
+
+
+def _write(path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content + "\n")
+
+
+def build_synthetic_tree(root: str, disks: int, partitions: int) -> None:
+    """Creates a sysroot with 'disks' SCSI disks of 'partitions' partitions each."""
+    os.makedirs(os.path.join(root, "sys", "dev", "block"), exist_ok=True)
+    _write(os.path.join(root, "proc", "self", "mountinfo"), "")
+    _write(os.path.join(root, "proc", "swaps"), "Filename Type Size Used Priority")
+
+    for d in range(disks):
+        name = f"sd{_disk_suffix(d)}"
+        major, minor = 8 + d // 16, (d % 16) * 16
+        disk_dir = os.path.join(root, "sys", "block", name)
+        _write(os.path.join(disk_dir, "dev"), f"{major}:{minor}")
+        _write(os.path.join(disk_dir, "size"), str(2 * 1024 ** 3))  # 1 TiB in sectors
+        _write(os.path.join(disk_dir, "removable"), "0")
+        _write(os.path.join(disk_dir, "ro"), "0")
+        os.makedirs(os.path.join(disk_dir, "holders"))
+        os.makedirs(os.path.join(disk_dir, "slaves"))
+        os.symlink(f"../../block/{name}", os.path.join(root, "sys", "dev", "block", f"{major}:{minor}"))
+
+        for p in range(1, partitions + 1):
+            part = f"{name}{p}"
+            part_dir = os.path.join(disk_dir, part)
+            _write(os.path.join(part_dir, "dev"), f"{major}:{minor + p}")
+            _write(os.path.join(part_dir, "size"), str(2 * 1024 ** 3 // partitions))
+            _write(os.path.join(part_dir, "partition"), str(p))
+            _write(os.path.join(part_dir, "start"), str(2048 + (p - 1) * 2 * 1024 ** 3 // partitions))
+            os.makedirs(os.path.join(part_dir, "holders"))
+            os.symlink(f"../../block/{name}/{part}",
+                       os.path.join(root, "sys", "dev", "block", f"{major}:{minor + p}"))
+
+
+def _disk_suffix(index: int) -> str:
+    """Returns the sd-style suffix for a disk index: a..z, aa..zz, ..."""
+    suffix = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        suffix = chr(ord("a") + rem) + suffix
+    return suffix
+
+
+def time_backend(label: str, func, rounds: int) -> float | None:
+    """Runs 'func' 'rounds' times and prints the average time per call."""
+    try:
+        func()  # warm-up
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func()
+        elapsed = (time.perf_counter() - start) / rounds
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"{label:<8} failed: {e}")
+        return None
+    print(f"{label:<8} {elapsed * 1000:10.2f} ms/call")
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--disks", type=int, default=1000)
+    parser.add_argument("--partitions", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        build_synthetic_tree(root, args.disks, args.partitions)
+        sys_root = os.path.join(root, "sys")
+        proc_root = os.path.join(root, "proc")
+        empty = os.path.join(root, "nonexistent")
+        print(f"Synthetic tree: {args.disks} disks x {args.partitions} partitions "
+              f"({args.disks * (args.partitions + 1)} devices)")
+
+        sysfs_time = time_backend(
+            "sysfs", lambda: sysfs_devices.read_block_devices(sys_root, proc_root, empty, empty), args.rounds)
+        lsblk_time = time_backend(
+            "lsblk", lambda: subprocess.run(
+                ["lsblk", "--sysroot", root, "-o", "NAME,SIZE,TYPE,FSTYPE,MOUNTPOINT", "--json"],
+                check=True, capture_output=True), args.rounds)
+
+        if sysfs_time and lsblk_time:
+            print(f"sysfs backend is {lsblk_time / sysfs_time:.1f}x the speed of lsblk")
+
+
+if __name__ == "__main__":
+    main()
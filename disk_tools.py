@@ -1,32 +1,23 @@
 #!/usr/bin/env python3
 
 import subprocess
-import json
 import sys
 import os
 
+from utils import disk_ops
+from modules import filesystem
+
 # Definiera sökvägen till vår mallkatalog för enkel åtkomst
 TEMPLATE_DIR = "Templates/default_template"
 
 def get_disk_info():
     """
-    Kör kommandot 'lsblk' för att hämta information om alla block-enheter.
-    Använder --json-flaggan för att få strukturerad och pålitlig output.
+    Hämtar information om alla block-enheter via utils.disk_ops, som läser
+    sysfs direkt (eller lsblk som reserv). Läser alltid om informationen
+    eftersom detta skript inte invaliderar cachen efter ändringar.
     Returnerar informationen som ett Python-objekt (dictionary).
     """
-    try:
-        command = ["lsblk", "-o", "NAME,SIZE,TYPE,FSTYPE,MOUNTPOINT", "--json"]
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=True,
-            encoding='utf-8'
-        )
-        return json.loads(result.stdout)
-    except (FileNotFoundError, subprocess.CalledProcessError, json.JSONDecodeError) as e:
-        print(f"Error getting disk info: {e}", file=sys.stderr)
-        return None
+    return disk_ops.get_disk_info(refresh=True)
 
 def display_disk_info(data):
     """
@@ -605,7 +596,7 @@ def main():
         elif main_choice == "4":
             lvm_menu()
         elif main_choice == "5":
-            print("Feature yet to be implemented")
+            filesystem.run_filesystem_menu()
         elif main_choice == "6":
             print("Exiting disk tools. Goodbye!")
             break
@@ -1,7 +1,7 @@
 import curses
 import os
-from utils import ui
-from modules import disk_analysis, partitioning, encryption, lvm
+from utils import ui, hotplug, privileged_helper
+from modules import disk_analysis, partitioning, encryption, lvm, provisioning, templates, filesystem, images
 
 # Define the path to our template directory for easy access
 TEMPLATE_DIR = "Templates/default_template"
@@ -16,9 +16,15 @@ def main_loop(stdscr: 'curses._CursesWindow'):
         "3": "Disk Encryption",
         "4": "Logical Volumes (LVM)",
         "5": "Write Filesystem",
-        "6": "Exit"
+        "6": "Provision Multiple Disks",
+        "7": "Disk Images",
+        "8": "Apply Template",
+        "9": "Exit"
     }
 
+    # Keep the cached device tree current while the menus are open
+    hotplug.start_watcher()
+
     while True:
         # Assuming get_menu_choice returns the *value* (e.g., "Disk Analysis")
         # and that it's the intended curses-based menu function.
@@ -33,10 +39,15 @@ def main_loop(stdscr: 'curses._CursesWindow'):
         elif choice == "Logical Volumes (LVM)":
             ui.display_text_viewer(stdscr, "Info", ["This module is not yet converted to curses."])
         elif choice == "Write Filesystem":
-            stdscr.clear()
-            stdscr.addstr(0, 0, "Feature yet to be implemented. Press any key to continue.")
-            stdscr.getch()
+            filesystem.run_filesystem_stage(stdscr)
+        elif choice == "Provision Multiple Disks":
+            provisioning.run_provisioning(stdscr)
+        elif choice == "Disk Images":
+            images.run_image_menu(stdscr)
+        elif choice == "Apply Template":
+            templates.run_template_apply(stdscr, TEMPLATE_DIR)
         elif choice == "Exit" or choice is None:
+            hotplug.stop_watcher()
             stdscr.clear()
             stdscr.addstr(0, 0, "Exiting. Goodbye!")
             stdscr.refresh()
@@ -48,6 +59,11 @@ def main_loop(stdscr: 'curses._CursesWindow'):
         stdscr.refresh()
 
 if __name__ == "__main__":
-    # The curses.wrapper function initializes curses, and restores the
-    # terminal to its original state after the program has finished.
-    curses.wrapper(main_loop)
+    # Escalate once, before curses owns the terminal (sudo may ask for a password)
+    privileged_helper.start()
+    try:
+        # The curses.wrapper function initializes curses, and restores the
+        # terminal to its original state after the program has finished.
+        curses.wrapper(main_loop)
+    finally:
+        privileged_helper.stop()
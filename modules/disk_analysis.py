@@ -1,5 +1,28 @@
 from utils import ui
 from utils import disk_ops
+from utils import device_cache
+from utils import hotplug
+
+def _full_output_lines() -> list[str]:
+    """Builds the disk and partition listing from the cached device tree."""
+    disk_data = disk_ops.get_disk_info() or {}
+    lines = []
+    for device in disk_data.get('blockdevices', []):
+        if device.get('type') == 'disk':
+            lines.append(f"[Disk] /dev/{device.get('name', 'N/A')} (Size: {device.get('size', 'N/A')})")
+            for part in device.get('children', []):
+                lines.append(f"  └─ [Part] /dev/{part.get('name', 'N/A')} ({part.get('size', 'N/A')}) | FS: {part.get('fstype', 'n/a')} | Mount: {part.get('mountpoint', 'n/a')}")
+    stats = device_cache.get_stats()
+    lines.append("")
+    lines.append(f"Device cache: generation {stats['generation']}, {stats['hits']} hits, {stats['misses']} misses")
+    if stats["last_invalidation"]:
+        lines.append(f"Last invalidated: {stats['last_invalidation']}")
+    return lines
+
+def _device_only_lines() -> list[str]:
+    """Builds the list of disks from the cached device tree."""
+    disk_data = disk_ops.get_disk_info() or {}
+    return [f"/dev/{dev.get('name', 'N/A')} ({dev.get('size', 'N/A')})" for dev in disk_data.get('blockdevices', []) if dev.get('type') == 'disk']
 
 def run_disk_analysis(stdscr) -> None:
     """Handles the menu for displaying disk information."""
@@ -12,24 +35,22 @@ def run_disk_analysis(stdscr) -> None:
     menu_options = {
         "1": "Full output of lsblk",
         "2": "Show devices only",
-        "3": "Back to main menu"
+        "3": "Refresh device information",
+        "4": "Back to main menu"
     }
 
     while True:
         stdscr.clear()
         choice = ui.get_menu_choice(stdscr, "Disk Analysis", menu_options)
 
+        # The viewers follow hotplug events while they are open
         if choice == "Full output of lsblk":
-            lines = []
-            for device in disk_data.get('blockdevices', []):
-                if device.get('type') == 'disk':
-                    lines.append(f"[Disk] /dev/{device.get('name', 'N/A')} (Size: {device.get('size', 'N/A')})")
-                    for part in device.get('children', []):
-                        lines.append(f"  └─ [Part] /dev/{part.get('name', 'N/A')} ({part.get('size', 'N/A')}) | FS: {part.get('fstype', 'n/a')} | Mount: {part.get('mountpoint', 'n/a')}")
-            ui.display_text_viewer(stdscr, "Full Disk and Partition Info", lines)
+            ui.display_live_text_viewer(stdscr, "Full Disk and Partition Info", _full_output_lines, hotplug.get_watcher())
         elif choice == "Show devices only":
-            lines = [f"/dev/{dev.get('name', 'N/A')} ({dev.get('size', 'N/A')})" for dev in disk_data.get('blockdevices', []) if dev.get('type') == 'disk']
-            ui.display_text_viewer(stdscr, "Disk Devices", lines)
+            ui.display_live_text_viewer(stdscr, "Disk Devices", _device_only_lines, hotplug.get_watcher())
+        elif choice == "Refresh device information":
+            disk_ops.get_disk_info(refresh=True)
+            continue
         elif choice == "Back to main menu" or choice is None:
             break
 
@@ -1,18 +1,164 @@
+import getpass
 import os
 import sys
 import subprocess
 
-from utils.disk_ops import select_partition_device
+from utils.disk_ops import select_partition_device, select_multiple_partitions, invalidate_disk_info
+from utils import crypt_tuning, luks
+from utils.scheduler import ProvisioningScheduler, Step, print_finished, run_command
 
 TEMPLATE_DIR = "Templates/default_template"
 
+# argon2 threads per PBKDF run. Every concurrent luksFormat/open also holds
+# its PBKDF memory cost while it runs.
+PBKDF_THREADS = 4
+
+
+def luks_worker_limit(jobs: int, pbkdf_memory_kib: int = crypt_tuning.MAX_PBKDF_MEMORY_KIB) -> int:
+    """
+    Returns how many PBKDF runs may execute at once: bounded by the number
+    of jobs, by CPU threads (each run uses PBKDF_THREADS) and by keeping the
+    runs' combined memory cost within half of MemAvailable.
+    """
+    by_cpu = max(1, (os.cpu_count() or 1) // PBKDF_THREADS)
+    available = crypt_tuning.mem_available_kib()
+    by_memory = max(1, available // 2 // pbkdf_memory_kib) if available else 1
+    return max(1, min(jobs, by_cpu, by_memory))
+
+
+def build_luks_steps(device: str, mapper_name: str, keyfile: str | None, passphrase: str | None,
+                     format_args: list[str] = ()) -> tuple[list[Step], list[str]]:
+    """
+    Returns the luksFormat/open steps for one partition and the commands
+    for the template. A passphrase is passed on stdin, never on the command
+    line or in the template.
+    """
+    key_args = ["--key-file", keyfile] if keyfile else []
+    key_input = None if keyfile else f"{passphrase}\n"
+    luks_format = ["sudo", "cryptsetup", "luksFormat", "--batch-mode", *format_args, *key_args, device]
+    luks_open = ["sudo", "cryptsetup", "open", *key_args, device, mapper_name]
+
+    def format_step(_):
+        run_command(luks_format, input=key_input)
+
+    def open_step(_):
+        run_command(luks_open, input=key_input)
+
+    return ([Step("luksFormat", format_step), Step("open", open_step)],
+            [" ".join(luks_format), " ".join(luks_open)])
+
+
+def _is_luks(partition: dict) -> bool:
+    """Partition filter for the picker: LUKS devices according to the cached inventory."""
+    return partition.get('fstype') == "crypto_LUKS"
+
+
+def add_key() -> None:
+    """Adds a passphrase to a free keyslot of a LUKS partition."""
+    device = select_partition_device("Select a LUKS partition to add a key to:",
+                                     include=_is_luks, annotate=luks.describe)
+    if not device:
+        print("Operation cancelled.")
+        return
+
+    try:
+        info = luks.read_luks_header(device)
+    except OSError as e:
+        info = None
+        print(f"Could not read the LUKS header of {device} ({e}); cryptsetup will pick the keyslot.")
+    key_slot_args = []
+    if info is not None:
+        print(f"\n{device}: {info.summary()}")
+        for slot, detail in sorted(info.keyslots.items()):
+            print(f"  slot {slot}: in use ({detail})")
+        if not info.free_slots:
+            print("All keyslots are in use. Remove a key before adding a new one.")
+            return
+        print(f"  free slots: {', '.join(str(slot) for slot in info.free_slots)}")
+        slot = input(f"Keyslot to use [default: {info.free_slots[0]}]: ").strip() or str(info.free_slots[0])
+        if not slot.isdigit() or int(slot) not in info.free_slots:
+            print(f'"{slot}" is not a free keyslot. Operation cancelled.')
+            return
+        key_slot_args = ["--key-slot", slot]
+
+    command = ["sudo", "cryptsetup", "luksAddKey", *key_slot_args, device]
+    try:
+        print(f"\nRunning command: {' '.join(command)}")
+        print("Enter an existing passphrase, then the new one.")
+        subprocess.run(command, check=True)
+        print(f"\nNew key added to {device}.")
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        print(f"Error adding key: {e}", file=sys.stderr)
+
+
+def batch_encrypt() -> None:
+    """Formats and opens several partitions with one passphrase or keyfile, in parallel."""
+    devices = select_multiple_partitions("Select the partitions to format with LUKS.")
+    if not devices:
+        print("No partitions selected. Operation cancelled.")
+        return
+
+    keyfile = input("Keyfile to use (empty to enter one passphrase for all): ").strip() or None
+    passphrase = None
+    if keyfile and not os.path.isfile(keyfile):
+        print(f"Keyfile '{keyfile}' not found. Operation cancelled.")
+        return
+    if not keyfile:
+        passphrase = getpass.getpass("Passphrase for all partitions: ")
+        if not passphrase or passphrase != getpass.getpass("Repeat the passphrase: "):
+            print("The passphrases are empty or do not match. Operation cancelled.")
+            return
+    prefix = input("Prefix for the mapped devices [default: crypt_]: ").strip() or "crypt_"
+
+    print("\n" + "="*60 + "\n!!! EXTREME WARNING !!!")
+    print(f"This will IRREVERSIBLY ERASE ALL DATA on {', '.join(devices)}.")
+    print("="*60)
+    if input("To confirm, type ERASE: ") != "ERASE":
+        print("Confirmation failed. Action cancelled.")
+        return
+
+    # Size the argon2 memory cost for as many parallel runs as CPU and memory allow
+    workers = luks_worker_limit(len(devices), crypt_tuning.MIN_PBKDF_MEMORY_KIB)
+    workers = luks_worker_limit(len(devices), crypt_tuning.pbkdf_memory_for(workers))
+    scheduler = ProvisioningScheduler(max_workers=workers)
+    commands = []
+    for device in devices:
+        params = crypt_tuning.tune(device, jobs=workers)
+        print(f"  {device}: {params.describe()}")
+        steps, device_commands = build_luks_steps(device, f"{prefix}{os.path.basename(device)}", keyfile,
+                                                  passphrase, params.args())
+        scheduler.add_pipeline(device, steps)
+        commands.append(f"# {device}")
+        commands.extend(device_commands)
+
+    script_path = os.path.join(TEMPLATE_DIR, "4_encrypt_device.sh")
+    try:
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        with open(script_path, "w") as f:
+            f.write("#!/bin/bash\n\n")
+            if keyfile:
+                f.write("# Batch LUKS setup with a keyfile; the partitions are independent.\n")
+            else:
+                f.write("# Batch LUKS setup; cryptsetup asks for the passphrase of each command.\n")
+            f.writelines(f"{command}\n" for command in commands)
+        os.chmod(script_path, 0o755)
+        print(f"Commands saved to '{script_path}'.")
+    except IOError as e:
+        print(f"Error writing to template file: {e}", file=sys.stderr)
+
+    print(f"\nEncrypting {len(devices)} partition(s) with {workers} parallel worker(s)...")
+    scheduler.start()
+    scheduler.watch(print_finished)
+    invalidate_disk_info("batch LUKS setup")
+
 def run_encryption_menu() -> None:
     """Handles the menu and workflow for LUKS disk encryption."""
     encryption_menu = {
         "1": "Format a partition with LUKS (ERASES DATA)",
         "2": "Open a LUKS-encrypted partition",
         "3": "Add a new key to a LUKS partition",
-        "4": "Return to main menu"
+        "4": "Format and open several partitions (batch)",
+        "5": "Return to main menu"
     }
 
     while True:
@@ -36,7 +182,9 @@ def run_encryption_menu() -> None:
             confirm = input(f"To confirm, please type the device name ('{device}'): ")
 
             if confirm == device:
-                command = ["sudo", "cryptsetup", "luksFormat", device]
+                params = crypt_tuning.tune(device)
+                print(f"Encryption parameters tuned for this host: {params.describe()}")
+                command = ["sudo", "cryptsetup", "luksFormat", *params.args(), device]
                 command_str = ' '.join(command)
                 script_path = os.path.join(TEMPLATE_DIR, "4_encrypt_device.sh")
 
@@ -60,6 +208,7 @@ def run_encryption_menu() -> None:
                     print(f"\nKör kommando: {command_str}")
                     print("Please follow the prompts to set your passphrase.")
                     subprocess.run(command, check=True)
+                    invalidate_disk_info(f"luksFormat on {device}")
                     print(f"\nSuccessfully formatted {device} with LUKS.")
 
                     # Ask if the new volume should be opened
@@ -75,6 +224,7 @@ def run_encryption_menu() -> None:
                             print(f"\nRunning command: {open_command_str}")
                             print("Please enter your passphrase to unlock.")
                             subprocess.run(open_command, check=True)
+                            invalidate_disk_info(f"cryptsetup open {device}")
                             print(f"\nSuccessfully opened {device} as /dev/mapper/{mapper_name}")
 
                             # Add the open command to the script
@@ -89,7 +239,8 @@ def run_encryption_menu() -> None:
 
         elif choice == "2":
             # Open LUKS device
-            device = select_partition_device("Select a LUKS-encrypted partition to open:")
+            device = select_partition_device("Select a LUKS-encrypted partition to open:",
+                                             include=_is_luks, annotate=luks.describe)
             if not device:
                 print("Operation cancelled.")
                 continue
@@ -104,14 +255,18 @@ def run_encryption_menu() -> None:
                 print(f"\nRunning command: {' '.join(command)}")
                 print("Please enter your passphrase when prompted.")
                 subprocess.run(command, check=True)
+                invalidate_disk_info(f"cryptsetup open {device}")
                 print(f"\nSuccessfully opened {device} as /dev/mapper/{mapper_name}")
             except (FileNotFoundError, subprocess.CalledProcessError) as e:
                 print(f"Error opening device: {e}", file=sys.stderr)
 
         elif choice == "3":
-            print("Feature yet to be implemented")
+            add_key()
 
         elif choice == "4":
+            batch_encrypt()
+
+        elif choice == "5":
             break
         else:
             print(f'"{choice}" is not a valid option.')
@@ -0,0 +1,337 @@
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass
+
+from utils import ui, disk_ops, lvm_metadata
+from utils.extents import read_io_geometry
+from utils.scheduler import ProvisioningScheduler, Step, print_finished, run_command
+from modules.provisioning import MKFS_FORCE
+
+TEMPLATE_DIR = "Templates/default_template"
+SCRIPT_NAME = "6_filesystems.sh"
+
+FILESYSTEMS = ["ext4", "xfs", "btrfs"]
+
+# Most mkfs runs at once; each one builds metadata on the CPU and streams writes
+MKFS_MAX_WORKERS = 8
+
+# ext4 block size the stride is expressed in
+EXT4_BLOCK_SIZE = 4096
+
+# lazy_init: ext4 leaves inode tables and the journal to be zeroed in the
+# background after the first mount instead of during mkfs.
+# discard: TRIM the whole device before writing the filesystem.
+PROFILES = {
+    "fast": {"lazy_init": True, "discard": False,
+             "description": "lazy inode table init, no discard (quickest mkfs)"},
+    "ssd": {"lazy_init": True, "discard": True,
+            "description": "lazy inode table init, discard the device first"},
+    "full": {"lazy_init": False, "discard": True,
+             "description": "inode tables written now, discard the device first"},
+}
+
+# Data disks of an md array, by RAID level
+_MD_DATA_DISKS = {
+    "raid0": lambda n: n,
+    "raid4": lambda n: n - 1,
+    "raid5": lambda n: n - 1,
+    "raid6": lambda n: n - 2,
+    "raid10": lambda n: n // 2,
+}
+
+
+@dataclass
+class StripeGeometry:
+    unit: int           # Bytes written to one member before moving to the next
+    width: int          # Number of data members
+    source: str         # Where the geometry came from, for the template
+
+    def describe(self) -> str:
+        return f"{self.unit // 1024}KiB x {self.width} ({self.source})"
+
+
+def _read_attr(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _split_dm_name(name: str) -> tuple[str, str] | None:
+    """Splits a device-mapper LV name ('vg-lv', with '-' in names doubled) into (vg, lv)."""
+    match = re.fullmatch(r"((?:[^-]|--)+)-((?:[^-]|--)+)", name)
+    if not match:
+        return None
+    return match.group(1).replace("--", "-"), match.group(2).replace("--", "-")
+
+
+def _lvm_geometry(kname: str, sys_root: str) -> StripeGeometry | None:
+    """Stripe geometry of an LV from its VG metadata, or None if it is not striped."""
+    dm_dir = os.path.join(sys_root, "class", "block", kname, "dm")
+    uuid = _read_attr(os.path.join(dm_dir, "uuid")) or ""
+    names = _split_dm_name(_read_attr(os.path.join(dm_dir, "name")) or "")
+    if not uuid.startswith("LVM-") or names is None:
+        return None
+    vg = lvm_metadata.get_lvm_state().vgs.get(names[0])
+    lv = vg.lvs.get(names[1]) if vg else None
+    if lv is None or not lv.segments:
+        return None
+    segment = lv.segments[0]
+    segtype = segment.get("type", "striped")
+    stripe_sectors = segment.get("stripe_size", 0)
+    if segtype == "striped":
+        width = segment.get("stripe_count", 1)
+    elif segtype in ("raid0", "raid0_meta", "raid10"):
+        width = segment.get("device_count", 1)
+        if segtype == "raid10":
+            width //= max(1, segment.get("data_copies", 2))
+    elif segtype in ("raid4", "raid5", "raid5_ls", "raid5_la", "raid5_rs", "raid5_ra", "raid6",
+                     "raid6_zr", "raid6_nr", "raid6_nc"):
+        parity = 2 if segtype.startswith("raid6") else 1
+        width = segment.get("device_count", 1) - parity
+    else:
+        return None
+    if width < 2 or not stripe_sectors:
+        return None
+    return StripeGeometry(stripe_sectors * lvm_metadata.SECTOR, width, f"LV {names[0]}/{names[1]}, {segtype}")
+
+
+def _md_geometry(kname: str, sys_root: str) -> StripeGeometry | None:
+    """Stripe geometry of an md array from sysfs, or None if it has no striping."""
+    md_dir = os.path.join(sys_root, "class", "block", kname, "md")
+    level = _read_attr(os.path.join(md_dir, "level"))
+    chunk = _read_attr(os.path.join(md_dir, "chunk_size"))
+    disks = _read_attr(os.path.join(md_dir, "raid_disks"))
+    if level not in _MD_DATA_DISKS or not (chunk and chunk.isdigit() and disks and disks.isdigit()):
+        return None
+    width = _MD_DATA_DISKS[level](int(disks))
+    if width < 2 or not int(chunk):
+        return None
+    return StripeGeometry(int(chunk), width, f"md {level}, {disks} disks")
+
+
+def stripe_geometry(device: str, sys_root: str = "/sys") -> StripeGeometry | None:
+    """
+    Returns the stripe geometry mkfs should align to: the LV's stripe or
+    raid layout from the LVM metadata, the md array's chunk size, or
+    otherwise the device's minimum/optimal I/O size when the kernel reports
+    a striped stack underneath (dm-crypt over raid, hardware RAID).
+    Returns None for plain devices.
+    """
+    kname = os.path.basename(os.path.realpath(device))
+    geometry = _lvm_geometry(kname, sys_root) or _md_geometry(kname, sys_root)
+    if geometry:
+        return geometry
+    io = read_io_geometry(device, sys_root)
+    unit, optimal = io["minimum_io_size"], io["optimal_io_size"]
+    if unit > io["physical_block_size"] and optimal > unit and optimal % unit == 0:
+        return StripeGeometry(unit, optimal // unit, "io_min/io_opt")
+    return None
+
+
+def mkfs_options(fs_type: str, geometry: StripeGeometry | None, profile: dict) -> list[str]:
+    """Returns the mkfs options for the stripe geometry and profile (without the force flags)."""
+    if fs_type == "ext4":
+        extended = [f"lazy_itable_init={int(profile['lazy_init'])}",
+                    f"lazy_journal_init={int(profile['lazy_init'])}",
+                    "discard" if profile["discard"] else "nodiscard"]
+        if geometry and geometry.unit >= EXT4_BLOCK_SIZE:
+            stride = geometry.unit // EXT4_BLOCK_SIZE
+            extended = [f"stride={stride}", f"stripe_width={stride * geometry.width}"] + extended
+        return ["-b", str(EXT4_BLOCK_SIZE), "-E", ",".join(extended)]
+    if fs_type == "xfs":
+        options = [] if profile["discard"] else ["-K"]
+        if geometry and geometry.unit % 512 == 0:
+            options += ["-d", f"su={geometry.unit // 1024}k,sw={geometry.width}"]
+        return options
+    if fs_type == "btrfs":
+        return [] if profile["discard"] else ["--nodiscard"]
+    return []
+
+
+def filesystem_targets(disk_data: dict | None) -> list[dict]:
+    """
+    Returns the devices a filesystem can be written to: unmounted
+    partitions, LUKS mappings, LVs and md arrays that nothing else is
+    stacked on. Each entry has 'path', 'size', 'type' and 'fstype'.
+    """
+    targets = []
+
+    def walk(nodes, depth):
+        for node in nodes:
+            children = node.get("children", [])
+            if depth > 0 and not children and not node.get("mountpoint") and node.get("type") != "disk" \
+                    and node.get("fstype") not in ("crypto_LUKS", "LVM2_member", "swap"):
+                path = f"/dev/mapper/{node['name']}" if node.get("type") in ("crypt", "lvm", "dm") \
+                    else f"/dev/{node['name']}"
+                if all(target["path"] != path for target in targets):
+                    targets.append({"path": path, "size": node.get("size"), "type": node.get("type"),
+                                    "fstype": node.get("fstype")})
+            walk(children, depth + 1)
+
+    walk((disk_data or {}).get("blockdevices", []), 0)
+    return targets
+
+
+@dataclass
+class FilesystemPlan:
+    device: str
+    fs_type: str
+    command: list[str]
+    geometry: StripeGeometry | None = None
+
+
+def plan_filesystem(device: str, fs_type: str, profile: dict, label: str = "") -> FilesystemPlan:
+    """Works out the mkfs command for one device."""
+    geometry = stripe_geometry(device)
+    label_args = ["-L", label] if label else []
+    command = ["sudo", f"mkfs.{fs_type}", *MKFS_FORCE.get(fs_type, []),
+               *mkfs_options(fs_type, geometry, profile), *label_args, device]
+    return FilesystemPlan(device, fs_type, command, geometry)
+
+
+def mkfs_worker_limit(jobs: int) -> int:
+    """Returns how many mkfs runs may execute at once: bounded by the jobs, CPU threads and MKFS_MAX_WORKERS."""
+    return max(1, min(jobs, os.cpu_count() or 1, MKFS_MAX_WORKERS))
+
+
+def build_scheduler(plans: list[FilesystemPlan], max_workers: int | None = None) -> ProvisioningScheduler:
+    """Queues one single-step pipeline per device; the mkfs runs are independent of each other."""
+    scheduler = ProvisioningScheduler(max_workers=mkfs_worker_limit(max_workers or len(plans)))
+    for plan in plans:
+        def mkfs_step(device, command=plan.command):
+            run_command(command)
+        scheduler.add_pipeline(plan.device, [Step("mkfs", mkfs_step)])
+    return scheduler
+
+
+def save_template(plans: list[FilesystemPlan], scheduler: ProvisioningScheduler, profile_name: str) -> str | None:
+    """Writes the mkfs commands with each device's outcome and elapsed time. Returns the script path."""
+    script_path = os.path.join(TEMPLATE_DIR, SCRIPT_NAME)
+    statuses = {status.device: status for status in scheduler.status()}
+    try:
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        with open(script_path, "w") as f:
+            f.write("#!/bin/bash\n\n")
+            f.write(f"# Filesystems written {time.strftime('%Y-%m-%d %H:%M')} with the '{profile_name}' profile.\n")
+            f.write("# The devices are independent; the commands can run in parallel.\n")
+            for plan in plans:
+                status = statuses.get(plan.device)
+                outcome = "not run"
+                if status and status.state == "done":
+                    outcome = f"done in {status.elapsed:.1f}s"
+                elif status and status.state == "failed":
+                    outcome = f"FAILED after {status.elapsed:.1f}s"
+                geometry = f", aligned to {plan.geometry.describe()}" if plan.geometry else ""
+                f.write(f"\n# {plan.device}: {outcome}{geometry}\n")
+                f.write(" ".join(plan.command) + "\n")
+        os.chmod(script_path, 0o755)
+        return script_path
+    except IOError as e:
+        print(f"Error writing to template file: {e}", file=sys.stderr)
+        return None
+
+
+def _summary(plans: list[FilesystemPlan], scheduler: ProvisioningScheduler, wall_time: float) -> list[str]:
+    lines = []
+    for status in scheduler.status():
+        result = "OK" if status.state == "done" else f"FAILED ({status.error})"
+        lines.append(f"{status.device}: {result} in {status.elapsed:.1f}s")
+    lines.append("")
+    lines.append(f"Total wall time: {wall_time:.1f}s for {len(plans)} device(s)")
+    return lines
+
+
+def run_filesystem_stage(stdscr) -> None:
+    """Curses workflow that writes filesystems to several devices in parallel."""
+    targets = filesystem_targets(disk_ops.get_disk_info())
+    if not targets:
+        ui.display_text_viewer(stdscr, "Write Filesystem", ["No unused partitions, mappings or LVs found."])
+        return
+
+    options = {t["path"]: f"{t['path']} ({t['size']}, {t['type']}, {t['fstype'] or 'empty'})" for t in targets}
+    selected = ui.get_multi_choice(stdscr, "Select devices to format (ALL DATA WILL BE ERASED)", options)
+    if not selected:
+        return
+    fs_type = ui.get_menu_choice(stdscr, "Filesystem", {str(i + 1): fs for i, fs in enumerate(FILESYSTEMS)})
+    if fs_type is None:
+        return
+    profile_name = ui.get_menu_choice(stdscr, "mkfs profile",
+                                      {str(i + 1): name for i, name in enumerate(PROFILES)})
+    if profile_name is None:
+        return
+
+    plans = [plan_filesystem(device, fs_type, PROFILES[profile_name]) for device in selected]
+    lines = [" ".join(plan.command) for plan in plans] + ["", "Type ERASE on the next screen to run these."]
+    ui.display_text_viewer(stdscr, "Write Filesystem: commands", lines)
+    stdscr.clear()
+    if ui.get_text_input(stdscr, f"Type ERASE to format {len(plans)} device(s):") != "ERASE":
+        ui.display_text_viewer(stdscr, "Write Filesystem", ["Confirmation failed. Nothing was changed."])
+        return
+
+    scheduler = build_scheduler(plans)
+    started = time.monotonic()
+    scheduler.start()
+    ui.display_progress(stdscr, f"Writing {fs_type} to {len(plans)} device(s)", scheduler)
+    wall_time = time.monotonic() - started
+    disk_ops.invalidate_disk_info("mkfs stage")
+    script_path = save_template(plans, scheduler, profile_name)
+    lines = _summary(plans, scheduler, wall_time)
+    if script_path:
+        lines.append(f"Commands and timings saved to '{script_path}'.")
+    ui.display_text_viewer(stdscr, "Write Filesystem: result", lines)
+
+
+def run_filesystem_menu() -> None:
+    """Text workflow of the filesystem stage, for the line-based tools."""
+    targets = filesystem_targets(disk_ops.get_disk_info(refresh=True))
+    if not targets:
+        print("No unused partitions, mappings or LVs found.")
+        return
+    print("\n--- Write Filesystem ---")
+    for i, target in enumerate(targets):
+        print(f"[{i + 1}] {target['path']} ({target['size']}, {target['type']}, {target['fstype'] or 'empty'})")
+    answer = input("Devices to format (numbers separated by spaces, empty to cancel): ").split()
+    selected = []
+    for entry in answer:
+        if not entry.isdigit() or not 1 <= int(entry) <= len(targets):
+            print(f'"{entry}" is not a valid option. Operation cancelled.')
+            return
+        if targets[int(entry) - 1]["path"] not in selected:
+            selected.append(targets[int(entry) - 1]["path"])
+    if not selected:
+        print("No devices selected. Operation cancelled.")
+        return
+
+    fs_type = input(f"Filesystem ({'/'.join(FILESYSTEMS)}) [default: ext4]: ").strip() or "ext4"
+    if fs_type not in FILESYSTEMS:
+        print(f'"{fs_type}" is not supported. Operation cancelled.')
+        return
+    for name, profile in PROFILES.items():
+        print(f"  {name:<6} {profile['description']}")
+    profile_name = input("Profile [default: fast]: ").strip() or "fast"
+    if profile_name not in PROFILES:
+        print(f'"{profile_name}" is not a profile. Operation cancelled.')
+        return
+
+    plans = [plan_filesystem(device, fs_type, PROFILES[profile_name]) for device in selected]
+    print("\nThe following commands will be executed in parallel:")
+    for plan in plans:
+        geometry = f"   # {plan.geometry.describe()}" if plan.geometry else ""
+        print(f"  {' '.join(plan.command)}{geometry}")
+    if input("To confirm, type ERASE: ") != "ERASE":
+        print("Confirmation failed. Action cancelled.")
+        return
+
+    scheduler = build_scheduler(plans)
+    started = time.monotonic()
+    scheduler.start()
+    scheduler.watch(print_finished)
+    print(f"Total wall time: {time.monotonic() - started:.1f}s")
+    disk_ops.invalidate_disk_info("mkfs stage")
+    script_path = save_template(plans, scheduler, profile_name)
+    if script_path:
+        print(f"Commands and timings saved to '{script_path}'.")
@@ -0,0 +1,259 @@
+import os
+
+from utils import ui, disk_ops, image_deploy, image_capture, chunk_store, verify
+from modules.filesystem import filesystem_targets
+
+
+def _in_use(node: dict) -> bool:
+    return bool(node.get("mountpoint")) or any(_in_use(child) for child in node.get("children", []))
+
+
+def _select_target(stdscr, title: str) -> str | None:
+    """Lets the user pick an unused disk, partition, LUKS mapping or LV. Returns its path."""
+    disk_data = disk_ops.get_disk_info()
+    disks = [{"path": f"/dev/{node['name']}", "size": node.get("size"), "type": "disk",
+              "fstype": node.get("fstype") or ("partitioned" if node.get("children") else None)}
+             for node in (disk_data or {}).get("blockdevices", [])
+             if node.get("type") == "disk" and not _in_use(node)]
+    targets = disks + filesystem_targets(disk_data)
+    if not targets:
+        ui.display_text_viewer(stdscr, title, ["No unused disks, partitions, mappings or LVs found."])
+        return None
+    options = {str(i + 1): f"{t['path']} ({t['size']}, {t['type']}, {t['fstype'] or 'empty'})"
+               for i, t in enumerate(targets)}
+    choice = ui.get_menu_choice(stdscr, f"{title}: select the target", options)
+    return choice.split()[0] if choice else None
+
+
+def _select_source(stdscr, title: str, allow_mounted: bool = True) -> str | None:
+    """
+    Lets the user pick a disk, partition, mapping or LV to read from.
+    Without 'allow_mounted', devices that are mounted (or have a mounted
+    partition or holder) are listed but refused. Returns its path.
+    """
+    devices = []
+    busy = set()
+
+    def walk(nodes, depth):
+        for node in nodes:
+            path = f"/dev/mapper/{node['name']}" if node.get("type") in ("crypt", "lvm", "dm") \
+                else f"/dev/{node['name']}"
+            mounted = _in_use(node)
+            if mounted:
+                busy.add(path)
+            devices.append(f"{'  ' * depth}{path} ({node.get('size')}, {node.get('type')}, "
+                           f"{node.get('fstype') or 'no signature'}{', mounted' if mounted else ''})")
+            walk(node.get("children", []), depth + 1)
+
+    walk((disk_ops.get_disk_info() or {}).get("blockdevices", []), 0)
+    if not devices:
+        ui.display_text_viewer(stdscr, title, ["No block devices found."])
+        return None
+    choice = ui.get_menu_choice(stdscr, f"{title}: select the source", {str(i + 1): d for i, d in enumerate(devices)})
+    if not choice:
+        return None
+    path = choice.split()[0]
+    if path in busy and not allow_mounted:
+        ui.display_text_viewer(stdscr, title, [
+            f"{path} is mounted (or holds a mounted filesystem).",
+            "An image of a filesystem that is being written to is not consistent.",
+            "Unmount it first, or capture an LVM snapshot of it instead."])
+        return None
+    return path
+
+
+def _offer_verify(stdscr, progress, source: str) -> None:
+    """After a successful write, offers to read the target back and check it against the source."""
+    if progress.state != "done":
+        return
+    if ui.get_confirmation(stdscr, f"Verify {progress.target} against {os.path.basename(source)} now?"):
+        ui.display_transfer(stdscr, f"Verifying {progress.target}", verify.start_verify([(progress.target, source)]),
+                            verify.format_progress)
+
+
+def verify_devices(stdscr) -> None:
+    """Reads one or more devices back and checks them against the images or manifests written to them."""
+    title = "Verify Devices"
+    jobs = []
+    while True:
+        device = _select_source(stdscr, title)
+        if not device:
+            break
+        stdscr.clear()
+        source = ui.get_text_input(stdscr, f"Image, captured image or manifest written to {device}:")
+        if not source or not os.path.isfile(source):
+            ui.display_text_viewer(stdscr, title, [f"Image '{source}' not found."])
+            continue
+        jobs.append((device, source))
+        if not ui.get_confirmation(stdscr, f"{len(jobs)} device(s) selected. Add another device?"):
+            break
+    if not jobs:
+        return
+    ui.display_transfer(stdscr, f"Verifying {len(jobs)} device(s)", verify.start_verify(jobs),
+                        verify.format_progress)
+
+
+def capture_image(stdscr) -> None:
+    """Captures a disk or LV into a chunked, compressed golden image."""
+    title = "Capture Image"
+    source = _select_source(stdscr, title, allow_mounted=False)
+    if not source:
+        return
+    compression = ui.get_menu_choice(stdscr, "Compression", {"1": "gzip", "2": "xz"})
+    if compression is None:
+        return
+    stdscr.clear()
+    output = ui.get_text_input(stdscr, "Image file to create:")
+    if not output:
+        return
+    if os.path.exists(output) and not ui.get_confirmation(stdscr, f"'{output}' exists. Overwrite it?"):
+        return
+
+    progress = image_capture.start_capture(source, output, compression)
+    ui.display_transfer(stdscr, f"Capturing {source} to {os.path.basename(output)}", progress,
+                        image_capture.format_progress)
+
+
+def deploy_image(stdscr, delta: bool = False) -> None:
+    """
+    Writes a raw or compressed image to a partition or LV and shows the
+    throughput. With 'delta', only blocks that differ on the target are written.
+    """
+    title = "Delta Deploy" if delta else "Deploy Image"
+    stdscr.clear()
+    source = ui.get_text_input(stdscr, "Image file (captured, raw, .gz, .xz or .bz2):")
+    if not source:
+        return
+    if not os.path.isfile(source):
+        ui.display_text_viewer(stdscr, title, [f"Image '{source}' not found."])
+        return
+    target = _select_target(stdscr, title)
+    if not target:
+        return
+
+    stdscr.clear()
+    if ui.get_text_input(stdscr, f"Type ERASE to overwrite {target} with {os.path.basename(source)}:") != "ERASE":
+        ui.display_text_viewer(stdscr, title, ["Confirmation failed. Nothing was changed."])
+        return
+
+    progress = image_deploy.start_deploy(source, target, delta=delta)
+    ui.display_transfer(stdscr, f"Deploying {os.path.basename(source)} to {target}", progress,
+                        image_deploy.format_progress)
+    disk_ops.invalidate_disk_info(f"image deployed to {target}")
+    _offer_verify(stdscr, progress, source)
+
+
+def store_image(stdscr) -> None:
+    """Adds an image to a template, stored as deduplicated chunks shared with the other templates."""
+    title = "Store Image in Template"
+    stdscr.clear()
+    source = ui.get_text_input(stdscr, "Image file (captured, raw, .gz, .xz or .bz2):")
+    if not source:
+        return
+    if not os.path.isfile(source):
+        ui.display_text_viewer(stdscr, title, [f"Image '{source}' not found."])
+        return
+    stdscr.clear()
+    template = ui.get_text_input(stdscr, "Template name (default_template):") or "default_template"
+    stdscr.clear()
+    name = ui.get_text_input(stdscr, "Name of the image in the template:")
+    if not name:
+        return
+    output = chunk_store.manifest_path(os.path.join(chunk_store.TEMPLATES_ROOT, template), name)
+    if os.path.exists(output) and not ui.get_confirmation(stdscr, f"'{output}' exists. Replace it?"):
+        return
+
+    progress = chunk_store.start_import(source, output)
+    ui.display_transfer(stdscr, f"Storing {os.path.basename(source)} in {template}", progress,
+                        chunk_store.format_progress)
+
+
+def deploy_stored_image(stdscr) -> None:
+    """Writes a template's stored image, reading and writing only the chunks the target lacks."""
+    title = "Deploy Template Image"
+    store = chunk_store.ChunkStore()
+    manifests = chunk_store.list_manifests()
+    if not manifests:
+        ui.display_text_viewer(stdscr, title, ["No template has a stored image yet."])
+        return
+    options = {}
+    for i, path in enumerate(manifests):
+        try:
+            missing = chunk_store.missing_chunks(chunk_store.load_manifest(path), store)
+        except image_deploy.DeployError:
+            continue
+        options[str(i + 1)] = f"{path}{f' ({missing} chunks missing)' if missing else ''}"
+    choice = ui.get_menu_choice(stdscr, f"{title}: select the image", options)
+    if not choice:
+        return
+    source = choice.split()[0]
+    target = _select_target(stdscr, title)
+    if not target:
+        return
+
+    stdscr.clear()
+    if ui.get_text_input(stdscr, f"Type ERASE to overwrite {target} with {source}:") != "ERASE":
+        ui.display_text_viewer(stdscr, title, ["Confirmation failed. Nothing was changed."])
+        return
+
+    progress = chunk_store.start_deploy(source, target)
+    ui.display_transfer(stdscr, f"Deploying {source} to {target}", progress, chunk_store.format_progress)
+    disk_ops.invalidate_disk_info(f"image deployed to {target}")
+    _offer_verify(stdscr, progress, source)
+
+
+def chunk_store_settings(stdscr) -> None:
+    """Shows how full the chunk store is and lets the user change its size limit."""
+    store = chunk_store.ChunkStore()
+    usage = store.usage()
+    stdscr.clear()
+    answer = ui.get_text_input(stdscr, f"Chunk store: {usage.chunks} chunks, {usage.bytes / 1e9:,.1f} of "
+                                       f"{usage.max_bytes / 1e9:,.1f} GB. New limit in GB (empty to keep):")
+    if not answer:
+        return
+    try:
+        limit = int(float(answer) * 1e9)
+    except ValueError:
+        ui.display_text_viewer(stdscr, "Chunk Store", [f"'{answer}' is not a number."])
+        return
+    store.set_max_bytes(limit)
+    eviction = store.evict()
+    lines = [f"Limit set to {limit / 1e9:,.1f} GB.",
+             f"{eviction.chunks} unused chunks evicted ({eviction.bytes / 1e6:,.0f} MB)."]
+    if eviction.over_bytes:
+        lines += ["", f"The store is still {eviction.over_bytes / 1e9:,.1f} GB over the limit.",
+                  "Chunks used by a template image are never evicted. These images hold the space:"]
+        lines += [f"  {path}" for path in eviction.held_by]
+    ui.display_text_viewer(stdscr, "Chunk Store", lines)
+
+
+def run_image_menu(stdscr) -> None:
+    """Menu for capturing golden images and writing them to disks."""
+    options = {
+        "1": "Deploy an image to a disk, partition or LV",
+        "2": "Re-image a disk, partition or LV, writing only changed blocks (delta)",
+        "3": "Capture a golden image from a disk or LV",
+        "4": "Store an image in a template (deduplicated chunk store)",
+        "5": "Deploy a template's stored image (writes only missing chunks)",
+        "6": "Chunk store usage and size limit",
+        "7": "Verify disks, partitions or LVs against their images",
+        "8": "Return to main menu",
+    }
+    while True:
+        choice = ui.get_menu_choice(stdscr, "Disk Images", options)
+        if choice == options["1"]:
+            deploy_image(stdscr)
+        elif choice == options["2"]:
+            deploy_image(stdscr, delta=True)
+        elif choice == options["3"]:
+            capture_image(stdscr)
+        elif choice == options["4"]:
+            store_image(stdscr)
+        elif choice == options["5"]:
+            deploy_stored_image(stdscr)
+        elif choice == options["6"]:
+            chunk_store_settings(stdscr)
+        elif choice == options["7"]:
+            verify_devices(stdscr)
+        else:
+            break
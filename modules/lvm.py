@@ -1,38 +1,31 @@
 import os
 import sys
-import subprocess
 
-from utils.disk_ops import select_partition_device
+from utils.disk_ops import select_multiple_partitions, invalidate_disk_info
+from utils import lvm_shell, lv_planner, lvm_metadata
 
 TEMPLATE_DIR = "Templates/default_template"
 
-def select_multiple_partitions(prompt: str="Select partitions to use.") -> list:
-    """
-    Allows the user to select one or more partitions from a list.
-    Returns a list of selected partition paths.
-    """
-    selected_partitions = []
-    print(f"\n{prompt}")
-
-    while True:
-        # Use the existing function to display the menu and get a selection
-        # We adapt the prompt to show what is already selected
-        current_selection_str = f" (Selected: {', '.join(selected_partitions)})" if selected_partitions else ""
-        device = select_partition_device(f"Select a partition to add{current_selection_str}.\nChoose 'Cancel' when you are done.")
-
-        if not device:  # The user chose 'Cancel', which means they are done
-            break
-
-        if device in selected_partitions:
-            print(f"{device} is already selected. Please choose another.")
-        else:
-            selected_partitions.append(device)
-            print(f"Added {device}.")
-
-    return selected_partitions
+def choose_lv_layout(proposals: list) -> 'lv_planner.Proposal | None':
+    """Lets the user pick an LV layout; the fastest proposal is the default."""
+    if len(proposals) == 1:
+        return proposals[0]
+    print("  Layout options (estimated sequential throughput):")
+    for index, proposal in enumerate(proposals, start=1):
+        print(f"  [{index}] {proposal.describe()}")
+        for note in proposal.notes:
+            print(f"        {note}")
+    choice = input("  Choose a layout [default: 1]: ").strip() or "1"
+    if not choice.isdigit() or not 1 <= int(choice) <= len(proposals):
+        print(f'  "{choice}" is not a valid option.')
+        return None
+    return proposals[int(choice) - 1]
 
 def create_lvm_setup() -> None:
-    """Guides the user through creating PV, VG, and LVs and saves the commands."""
+    """
+    Guides the user through creating PV, VG, and LVs, runs the whole plan in
+    one LVM session and saves the commands.
+    """
     all_commands = []
     script_path = os.path.join(TEMPLATE_DIR, "5_logical_volumes.sh")
 
@@ -43,20 +36,6 @@ def create_lvm_setup() -> None:
         print("No partitions selected. LVM setup cancelled.")
         return
 
-    pv_command_str = f"sudo pvcreate {' '.join(physical_volumes)}"
-    print(f"\nThe following command will be executed:\n  {pv_command_str}")
-    if not input("Proceed? (yes/no): ").lower().startswith('y'):
-        print("Operation cancelled.")
-        return
-
-    try:
-        subprocess.run(pv_command_str.split(), check=True, capture_output=True, text=True)
-        print("Physical Volumes created successfully.")
-        all_commands.append(f"# Step 1: Create Physical Volumes\n{pv_command_str}\n")
-    except subprocess.CalledProcessError as e:
-        print(f"Error creating Physical Volumes: {e.stderr}", file=sys.stderr)
-        return
-
     # --- Step 2: vgcreate ---
     print("\n--- Step 2: Create a Volume Group (VG) ---")
     vg_name = input("Enter a name for the new Volume Group (e.g., 'vg_main'): ")
@@ -64,22 +43,17 @@ def create_lvm_setup() -> None:
         print("Volume Group name cannot be empty. Operation cancelled.")
         return
 
-    vg_command_str = f"sudo vgcreate {vg_name} {' '.join(physical_volumes)}"
-    print(f"\nThe following command will be executed:\n  {vg_command_str}")
-    if not input("Proceed? (yes/no): ").lower().startswith('y'):
-        print("Operation cancelled.")
-        return
-
-    try:
-        subprocess.run(vg_command_str.split(), check=True, capture_output=True, text=True)
-        print(f"Volume Group '{vg_name}' created successfully.")
-        all_commands.append(f"# Step 2: Create Volume Group\n{vg_command_str}\n")
-    except subprocess.CalledProcessError as e:
-        print(f"Error creating Volume Group: {e.stderr}", file=sys.stderr)
-        return
+    batch = lvm_shell.LvmBatch(physical_volumes)
+    batch.pvcreate(physical_volumes)
+    batch.vgcreate(vg_name, physical_volumes)
+    planned = [
+        ("Step 1: Create Physical Volumes", f"sudo pvcreate {' '.join(physical_volumes)}"),
+        ("Step 2: Create Volume Group", f"sudo vgcreate {vg_name} {' '.join(physical_volumes)}"),
+    ]
 
     # --- Step 3: lvcreate (loop) ---
     print("\n--- Step 3: Create Logical Volumes (LVs) ---")
+    proposals = lv_planner.plan_for(physical_volumes)
     while True:
         if not input("Create a new Logical Volume? (yes/no): ").lower().startswith('y'):
             break
@@ -90,20 +64,38 @@ def create_lvm_setup() -> None:
             print("LV name and size cannot be empty. Skipping.")
             continue
 
-        size_flag = "-L" if '%' not in lv_size else "-l"
-        lv_command_str = f"sudo lvcreate {size_flag} {lv_size} -n {lv_name} {vg_name}"
-
-        print(f"  Command: {lv_command_str}")
-        if not input("  Proceed with this LV? (yes/no): ").lower().startswith('y'):
+        layout = choose_lv_layout(proposals)
+        if layout is None:
             print("  LV creation skipped.")
             continue
 
-        try:
-            subprocess.run(lv_command_str.split(), check=True, capture_output=True, text=True)
-            print(f"  Logical Volume '{lv_name}' created successfully.")
-            all_commands.append(f"# Step 3: Create Logical Volume '{lv_name}'\n{lv_command_str}\n")
-        except subprocess.CalledProcessError as e:
-            print(f"  Error creating Logical Volume: {e.stderr}", file=sys.stderr)
+        size_flag = "-L" if '%' not in lv_size else "-l"
+        options = layout.lvcreate_options()
+        batch.lvcreate(vg_name, lv_name, lv_size, *options, pvs=layout.pvs)
+        command = " ".join(["sudo", "lvcreate", *options, size_flag, lv_size, "-n", lv_name, vg_name, *layout.pvs])
+        planned.append((f"Step 3: Create Logical Volume '{lv_name}'\n# Geometry: {layout.describe()}", command))
+
+    print("\nThe following commands will be executed in one LVM session:")
+    for _, command in planned:
+        print(f"  {command}")
+    if not input("Proceed? (yes/no): ").lower().startswith('y'):
+        print("Operation cancelled.")
+        return
+
+    batch.report(vg_name)
+    results = batch.run()
+    invalidate_disk_info(f"LVM setup of {vg_name}")
+    for (comment, command), result in zip(planned, results):
+        if result.ok:
+            print(f"  OK      {command}")
+            all_commands.append(f"# {comment}\n{command}\n")
+        else:
+            print(f"  {result.status.upper():<7} {command}", file=sys.stderr)
+            for message in result.messages:
+                print(f"          {message}", file=sys.stderr)
+
+    for row in lvm_shell.lv_rows(results):
+        print(f"  LV {row.get('vg_name')}/{row.get('lv_name')}: {row.get('lv_size')}, {row.get('segtype')}")
 
     # --- Save to script ---
     if all_commands:
@@ -123,7 +115,8 @@ def run_lvm_menu() -> None:
     """Handles the menu for LVM operations."""
     lvm_options = {
         "1": "Create volumes and group",
-        "2": "Return to main menu"
+        "2": "Show LVM state",
+        "3": "Return to main menu"
     }
     while True:
         print("\n--- Logical Volume (LVM) Menu ---")
@@ -134,6 +127,9 @@ def run_lvm_menu() -> None:
         if choice == "1":
             create_lvm_setup()
         elif choice == "2":
+            print("\n--- LVM state (read from the on-disk metadata) ---")
+            print("\n".join(lvm_metadata.format_state(lvm_metadata.get_lvm_state())))
+        elif choice == "3":
             break
         else:
             print(f'"{choice}" is not a valid option.')
@@ -1,30 +1,102 @@
 import os
+import stat
 import sys
 import subprocess
 
-from utils.disk_ops import get_free_space_info, select_disk_device_curses, inspect_device
+from utils.disk_ops import get_largest_free_extent, select_disk_device_curses, inspect_device, invalidate_disk_info, \
+    get_disk_info
+from utils.extents import FreeExtentIndex, MIB, size_to_sectors
+from utils import device_cache, layout as layout_engine, privileged_helper, wipe
+from utils.disk_ops import read_partition_map
 
 TEMPLATE_DIR = "Templates/default_template"
 
 
 
-def create_partition_fullscreen(device_path: str) -> None:
+def _partition_sectors(device_path: str) -> list[tuple[int, int, int]] | None:
     """
-    Skapar en ny partition som använder 100% av det tillgängliga fria utrymmet.
+    Returns (number, start, end) of every partition in the on-disk table.
+    Reads the table natively and falls back to 'sudo parted -m print' when
+    the device is not readable by this process.
     """
-    print("\n--- Create Partition (100% of free space) ---")
-    start_sector = get_free_space_info(device_path)
-    if not start_sector:
-        print("Could not find free space to create a partition.")
-        return
+    pmap = read_partition_map(device_path)
+    if pmap is not None:
+        return [(p.number, p.start, p.end) for p in pmap.partitions]
+    command = ["sudo", "parted", "-m", "-s", device_path, "unit", "s", "print"]
+    try:
+        result = privileged_helper.run(command, check=True, capture_output=True, text=True)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return None
+    partitions = []
+    for line in result.stdout.splitlines():
+        fields = line.split(":")
+        if len(fields) > 2 and fields[0].isdigit():
+            partitions.append((int(fields[0]), int(fields[1].rstrip("s")), int(fields[2].rstrip("s"))))
+    return partitions
 
-    print(f"Detected free space starting at sector {start_sector.replace('s', '')}.")
-    fs_type = input("Enter partition type ID (e.g., ext4, linux-lvm, linux-swap) [default: ext4]: ")
-    if not fs_type:
-        fs_type = "ext4"
 
-    command_str = f"sudo parted --script {device_path} mkpart primary {fs_type} {start_sector} 100%"
+def _kernel_partition_start(device_path: str, number: int) -> int | None:
+    """Start of partition 'number' as the kernel sees it, in 512-byte sectors, or None if it has no such partition."""
+    kname = os.path.basename(os.path.realpath(device_path))
+    block_dir = os.path.join("/sys/class/block", kname)
+    try:
+        entries = os.listdir(block_dir)
+    except OSError:
+        return None
+    for entry in entries:
+        try:
+            with open(os.path.join(block_dir, entry, "partition")) as f:
+                if int(f.read().strip()) != number:
+                    continue
+            with open(os.path.join(block_dir, entry, "start")) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def _verify_partition(device_path: str, start: int, end: int) -> bool:
+    """
+    Checks that what mkpart was asked for is what landed: a partition with
+    exactly these sectors in the on-disk table, known to the kernel at the
+    same start. Prints the outcome and returns whether it matched.
+    """
+    partitions = _partition_sectors(device_path)
+    if partitions is None:
+        print(f"Could not read the partition table of {device_path} to verify it.", file=sys.stderr)
+        return False
+    match = next((p for p in partitions if p[1] == start and p[2] == end), None)
+    if match is None:
+        overlapping = [p for p in partitions if p[1] <= end and p[2] >= start]
+        found = ", ".join(f"#{n} {s}s-{e}s" for n, s, e in overlapping) or "no partition there"
+        print(f"Verification failed: expected sectors {start}s-{end}s on {device_path}, found {found}.",
+              file=sys.stderr)
+        return False
+    number = match[0]
+    if not stat.S_ISBLK(os.stat(device_path).st_mode):
+        print(f"Verified: partition {number} spans sectors {start}-{end} in the table.")
+        return True
+    pmap = read_partition_map(device_path)
+    sector_size = pmap.sector_size if pmap is not None else 512
+    kernel_start = _kernel_partition_start(device_path, number)
+    if kernel_start is None:
+        print(f"Partition {number} is in the table but the kernel has not picked it up yet "
+              f"(run 'partprobe {device_path}').", file=sys.stderr)
+        return False
+    if kernel_start * 512 != start * sector_size:
+        print(f"Partition {number}: the kernel has it at sector {kernel_start} (512-byte), the table at {start}.",
+              file=sys.stderr)
+        return False
+    print(f"Verified: partition {number} spans sectors {start}-{end} in the table and in the kernel.")
+    return True
+
 
+def _save_and_run_mkpart(device_path: str, command_str: str, start: int | None = None,
+                         end: int | None = None) -> None:
+    """
+    Saves a mkpart command to the partition template after confirmation and
+    runs it. With 'start' and 'end', the resulting table is checked too.
+    """
     print("\nThe following command will be generated:")
     print(f"  {command_str}")
 
@@ -40,21 +112,33 @@ def create_partition_fullscreen(device_path: str) -> None:
             os.makedirs(TEMPLATE_DIR, exist_ok=True)
             print(f"Directory '{TEMPLATE_DIR}' ensured.")
 
-            # 2. Write to the template file
-            with open(script_path, "a") as f:
-                f.write(f"#!/bin/bash\n\n")
-                f.write(f"# Command to create a new partition on {device_path}\n")
-                f.write(f"{command_str}\n\n")
-            print(f"Command appended to '{script_path}'.")
+            # 2. Write to the template file. The header is written once and a
+            # command already in the script is not added again, so creating
+            # the same partition twice does not make the template grow.
+            existing = ""
+            if os.path.exists(script_path):
+                with open(script_path) as f:
+                    existing = f.read()
+            if command_str in existing.splitlines():
+                print(f"Command already in '{script_path}'.")
+            else:
+                with open(script_path, "a") as f:
+                    if not existing:
+                        f.write("#!/bin/bash\n\n")
+                    f.write(f"# Command to create a new partition on {device_path}\n")
+                    f.write(f"{command_str}\n\n")
+                print(f"Command appended to '{script_path}'.")
 
             # 3. Make the script executable
             os.chmod(script_path, 0o755) # 0o755 means rwxr-xr-x
             print(f"Made script '{script_path}' executable.")
 
-            # 4. Run the command to verify
-            print("Executing command to verify...")
-            subprocess.run(command_str.split(), check=True)
-            print("\nPartition created successfully!")
+            # 4. Run the command and check what it did to the table
+            print("Executing command...")
+            privileged_helper.run(command_str.split(), check=True)
+            invalidate_disk_info(f"mkpart on {device_path}")
+            if start is None or end is None or _verify_partition(device_path, start, end):
+                print("\nPartition created successfully!")
 
         except IOError as e:
             print(f"Error writing to template file: {e}", file=sys.stderr)
@@ -64,6 +148,200 @@ def create_partition_fullscreen(device_path: str) -> None:
         print("Partition creation cancelled.")
 
 
+def _ask_fs_type() -> str:
+    fs_type = input("Enter partition type ID (e.g., ext4, linux-lvm, linux-swap) [default: ext4]: ")
+    return fs_type or "ext4"
+
+
+def create_partition_fullscreen(device_path: str) -> None:
+    """
+    Skapar en ny partition som använder hela det största fria utrymmet,
+    med start justerad efter diskens I/O-geometri.
+    """
+    print("\n--- Create Partition (100% of free space) ---")
+    index = FreeExtentIndex.for_device(device_path)
+    if index is not None:
+        allocation = index.allocate_all()
+    else:
+        # Device not readable by us: fall back to parted's view (unaligned)
+        extent = get_largest_free_extent(device_path)
+        allocation = (extent.start, extent.end) if extent else None
+    if not allocation:
+        print("Could not find free space to create a partition.")
+        return
+
+    start, end = allocation
+    print(f"Detected free space from sector {start} to {end}.")
+    fs_type = _ask_fs_type()
+    command_str = f"sudo parted --script {device_path} mkpart primary {fs_type} {start}s {end}s"
+    _save_and_run_mkpart(device_path, command_str, start, end)
+
+
+def create_partition_sized(device_path: str, unit: str) -> None:
+    """
+    Creates a partition of a given size in MiB, GiB or percent of the largest
+    free region. The start is aligned to the device's optimal I/O size and
+    physical block size, and the free region is chosen best-fit or first-fit.
+    """
+    print(f"\n--- Create Partition (size in {unit}) ---")
+    index = FreeExtentIndex.for_device(device_path)
+    if index is None:
+        print("Could not read the partition table of this device.")
+        return
+    largest_mib = index.largest() * index.sector_size / MIB
+    print(f"Largest aligned free region: {largest_mib:.1f} MiB (alignment: {index.grain} sectors)")
+
+    try:
+        amount = float(input(f"Enter size in {unit}: "))
+    except ValueError:
+        print("Invalid size. Partition creation cancelled.")
+        return
+    if amount <= 0 or (unit == "%" and amount > 100):
+        print("Size out of range. Partition creation cancelled.")
+        return
+
+    strategy = input("Placement: [b]est fit or [f]irst fit? [default: best]: ").lower()
+    strategy = "first" if strategy.startswith('f') else "best"
+
+    allocation = index.allocate(size_to_sectors(amount, unit, index), strategy)
+    if not allocation:
+        print(f"No free region is large enough for {amount:g} {unit}.")
+        return
+
+    start, end = allocation
+    print(f"Allocated sectors {start} to {end} ({(end - start + 1) * index.sector_size / MIB:.1f} MiB).")
+    fs_type = _ask_fs_type()
+    command_str = f"sudo parted --script {device_path} mkpart primary {fs_type} {start}s {end}s"
+    _save_and_run_mkpart(device_path, command_str, start, end)
+
+
+def create_layout_interactive(device_path: str) -> None:
+    """
+    Lets the user describe a complete layout (label plus all partitions) and
+    writes it to the disk in one transaction.
+    """
+    print("\n--- Define Partition Layout ---")
+    pmap = read_partition_map(device_path)
+    if pmap is None:
+        print("Could not read the partition table of this device.")
+        return
+
+    new_label = input("Create a new GPT partition table first (ERASES ALL DATA)? (yes/no): ").lower().startswith('y')
+    layout = {"device": device_path, "label": "gpt" if new_label else None, "partitions": []}
+
+    print("Add partitions. Size as e.g. 512MiB, 20GiB or 25% (of the remaining free space).")
+    print(f"Types: {', '.join(layout_engine.PARTITION_TYPES)}. Leave the size empty when done.")
+    while True:
+        size = input(f"  Partition {len(layout['partitions']) + 1} size: ").strip()
+        if not size:
+            break
+        part_type = input("  Type [default: linux]: ").strip() or "linux"
+        name = input("  Name (optional): ").strip()
+        try:
+            layout_engine.parse_size(size)
+            layout_engine.resolve_type(part_type)
+        except ValueError as e:
+            print(f"  {e}. Partition skipped.")
+            continue
+        layout["partitions"].append({"size": size, "type": part_type, "name": name})
+
+    if not layout["partitions"]:
+        print("No partitions defined. Layout cancelled.")
+        return
+
+    try:
+        planned = layout_engine.plan_layout(layout, pmap)
+    except ValueError as e:
+        print(f"Cannot use this layout: {e}")
+        return
+
+    print(f"\nPlanned layout for {device_path}:")
+    for part in planned:
+        size_mib = part["sectors"] * pmap.sector_size / MIB
+        print(f"  {layout_engine.partition_path(device_path, part['number'])}: start {part['start']}s, "
+              f"{size_mib:.1f} MiB, {part['type']} {part['name']}")
+
+    script = layout_engine.build_sfdisk_script(layout, planned, pmap.label)
+    script_path = os.path.join(TEMPLATE_DIR, "3_create_partition.sh")
+    if new_label:
+        print("\n" + "="*60 + "\n!!! EXTREME WARNING !!!")
+        print(f"This will IRREVERSIBLY ERASE ALL DATA on {device_path}.")
+        print("="*60)
+        if input(f"To confirm, please type the device name ('{device_path}'): ") != device_path:
+            print("Confirmation failed. Action cancelled.")
+            return
+    elif not input(f"\nSave to '{script_path}' and apply? (yes/no): ").lower().startswith('y'):
+        print("Layout cancelled.")
+        return
+
+    try:
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        # The template describes the whole disk, so it is rewritten, not appended to
+        with open(script_path, "w") as f:
+            f.write(layout_engine.render_template(layout, script))
+        os.chmod(script_path, 0o755)
+        print(f"Layout saved to '{script_path}'.")
+    except IOError as e:
+        print(f"Error writing to template file: {e}", file=sys.stderr)
+        return
+
+    if layout_engine.apply_layout(layout, script):
+        invalidate_disk_info(f"layout applied to {device_path}")
+        print(f"Created {len(planned)} partitions on {device_path}.")
+
+
+def _print_wipe_results(results: list) -> None:
+    for result in results:
+        if result.ok:
+            found = f", was {result.found}" if result.found else ""
+            notes = f" ({'; '.join(result.notes)})" if result.notes else ""
+            print(f"  {result.device}: cleared {result.bytes_cleared} bytes in {result.ranges} range(s), "
+                  f"{result.elapsed:.2f}s{found}{notes}")
+        else:
+            print(f"  {result.device}: FAILED ({result.error})", file=sys.stderr)
+
+
+def reset_disks(device_path: str) -> None:
+    """Wipes signatures (or discards/zeroes) on this disk and optionally others, in parallel."""
+    disk_data = get_disk_info() or {}
+    disks = [f"/dev/{dev['name']}" for dev in disk_data.get('blockdevices', []) if dev.get('type') == 'disk']
+    others = [disk for disk in disks if disk != device_path]
+    selected = [device_path]
+    if others:
+        print("\nOther disks that can be reset at the same time:")
+        for i, disk in enumerate(others):
+            print(f"[{i + 1}] {disk}")
+        for entry in input("Numbers to add, separated by spaces (empty for none): ").split():
+            if entry.isdigit() and 1 <= int(entry) <= len(others) and others[int(entry) - 1] not in selected:
+                selected.append(others[int(entry) - 1])
+            else:
+                print(f'Ignoring "{entry}".')
+
+    modes = {
+        "1": ("signatures", "Clear signatures only (partition tables, LUKS, LVM, filesystems, swap)"),
+        "2": ("discard", "Discard all blocks (SSD/thin devices) and clear signatures"),
+        "3": ("zero", "Write zeros over the WHOLE device (slow on disks without offload)"),
+    }
+    for key, (_, description) in modes.items():
+        print(f"[{key}] {description}")
+    choice = input("Your choice: ")
+    if choice not in modes:
+        print(f'"{choice}" is not a valid option.')
+        return
+    mode = modes[choice][0]
+
+    print("\n" + "="*60 + "\n!!! EXTREME WARNING !!!")
+    print(f"This will IRREVERSIBLY ERASE ALL DATA on {', '.join(selected)}.")
+    print("="*60)
+    if input("To confirm, type ERASE: ") != "ERASE":
+        print("Confirmation failed. Action cancelled.")
+        return
+    print(f"Wiping {len(selected)} disk(s) ({mode})...")
+    results = wipe.wipe(selected, mode)
+    invalidate_disk_info(f"{mode} wipe of {', '.join(selected)}")
+    _print_wipe_results(results)
+
+
 def run_partitioning() -> None:
     """Manages the workflow for partitioning a disk."""
     device_path = select_disk_device_curses("Select a disk to partition:")
@@ -71,15 +349,22 @@ def run_partitioning() -> None:
         print("Partitioning cancelled.")
         return
 
+    shown_generation = None
     while True:
         print(f"\n--- Actions for {device_path} ---")
-        inspect_device(device_path)
+        # Only show the table again when something changed since last time
+        if shown_generation != device_cache.generation():
+            inspect_device(device_path)
+            shown_generation = device_cache.generation()
 
         action_menu = {
             "1": "Create a new partition",
             "2": "Delete an existing partition",
             "3": "Create new GPT partition table (ERASES ALL DATA)",
-            "4": "Return to main menu"
+            "4": "Define and apply a complete layout",
+            "5": "Show partition table",
+            "6": "Reset disks (wipe signatures, discard or zero)",
+            "7": "Return to main menu"
         }
         print("\nWhat would you like to do on this disk?")
         for key, value in action_menu.items():
@@ -103,7 +388,8 @@ def run_partitioning() -> None:
             if create_choice == "1":
                 create_partition_fullscreen(device_path)
             elif create_choice in ["2", "3", "4"]:
-                print("Feature yet to be implemented.")
+                unit = {"2": "MiB", "3": "GiB", "4": "%"}[create_choice]
+                create_partition_sized(device_path, unit)
             elif create_choice == "5":
                 print("Cancelled partition creation.")
             else:
@@ -117,15 +403,27 @@ def run_partitioning() -> None:
             print("="*60)
             confirm = input(f"To confirm, please type the device name ('{device_path}'): ")
             if confirm == device_path:
+                # Old LUKS/LVM/filesystem headers would otherwise survive the new label
+                results = wipe.wipe([device_path], "signatures")
+                _print_wipe_results(results)
+                if not results[0].ok:
+                    continue
                 command = ["sudo", "parted", "--script", device_path, "mklabel", "gpt"]
                 try:
-                    subprocess.run(command, check=True, capture_output=True, text=True)
+                    privileged_helper.run(command, check=True, capture_output=True, text=True)
+                    invalidate_disk_info(f"mklabel on {device_path}")
                     print("GPT partition table created successfully.")
                 except subprocess.CalledProcessError as e:
                     print(f"Error creating partition table: {e.stderr}", file=sys.stderr)
             else:
                 print("Confirmation failed. Action cancelled.")
         elif action_choice == "4":
+            create_layout_interactive(device_path)
+        elif action_choice == "5":
+            inspect_device(device_path)
+        elif action_choice == "6":
+            reset_disks(device_path)
+        elif action_choice == "7":
             break
         else:
             print(f'"{action_choice}" is not a valid option.')
@@ -0,0 +1,136 @@
+import os
+import sys
+
+from utils import ui, disk_ops, privileged_helper, layout as layout_engine
+from utils.partition_table import blank_map
+from utils.scheduler import ProvisioningScheduler, Step, StepError, run_command
+
+TEMPLATE_DIR = "Templates/default_template"
+
+# Flags that make mkfs overwrite an existing signature without asking
+MKFS_FORCE = {"ext4": ["-F", "-q"], "xfs": ["-f", "-q"], "btrfs": ["-f", "-q"]}
+
+
+def build_disk_pipeline(disk: str, fs_type: str, keyfile: str | None) -> tuple[list[Step], list[str]]:
+    """
+    Builds the steps that turn one disk into a single (optionally LUKS
+    encrypted) filesystem: label + partition, udev settle, signature wipe,
+    luksFormat + open and mkfs. Returns the steps and the shell commands
+    they run, for the template scripts. The layout is planned up front, so
+    a disk whose size is unknown or too small raises StepError here.
+    """
+    layout = {"device": disk, "label": "gpt",
+              "partitions": [{"size": "100%", "type": "luks" if keyfile else "linux", "name": "data"}]}
+    # A new table replaces the old one, so only the size and sector size matter;
+    # sysfs has them without opening the disk, which needs root
+    pmap = blank_map(disk)
+    if pmap is None:
+        raise StepError(f"cannot read the size of {disk} from sysfs")
+    try:
+        script = layout_engine.build_sfdisk_script(layout, layout_engine.plan_layout(layout, pmap), pmap.label)
+    except ValueError as e:
+        raise StepError(str(e))
+
+    partition = layout_engine.partition_path(disk, 1)
+    mapper_name = f"crypt_{os.path.basename(partition)}"
+    target = f"/dev/mapper/{mapper_name}" if keyfile else partition
+
+    def partition_step(device):
+        run_command(layout_engine.sfdisk_command(layout), input=script)
+
+    def settle_step(device):
+        run_command(["sudo", "udevadm", "settle"])
+
+    def wipe_step(device):
+        run_command(["sudo", "wipefs", "--all", partition])
+
+    luks_format = ["sudo", "cryptsetup", "luksFormat", "--batch-mode", "--key-file", keyfile or "", partition]
+    luks_open = ["sudo", "cryptsetup", "open", "--key-file", keyfile or "", partition, mapper_name]
+    mkfs = ["sudo", f"mkfs.{fs_type}", *MKFS_FORCE.get(fs_type, []), target]
+
+    def luks_step(device):
+        # Format and open in one round trip to the privileged helper
+        results = privileged_helper.run_batch([(luks_format, None), (luks_open, None)])
+        if results[-1].returncode != 0:
+            raise StepError(f"'{' '.join(results[-1].args)}' failed: {results[-1].stderr.strip()}")
+
+    def mkfs_step(device):
+        run_command(mkfs)
+
+    steps = [Step("partition", partition_step), Step("settle", settle_step, ("udev",)), Step("wipe", wipe_step)]
+    commands = [layout_engine.render_commands(layout, script).rstrip("\n"),
+                f"sudo wipefs --all {partition}"]
+    if keyfile:
+        steps.append(Step("luksFormat", luks_step))
+        commands += [" ".join(luks_format), " ".join(luks_open)]
+    steps.append(Step("mkfs", mkfs_step))
+    commands.append(" ".join(mkfs))
+    return steps, commands
+
+
+def _save_template(per_disk_commands: dict) -> None:
+    """Saves the commands of a multi-disk run to a template script."""
+    script_path = os.path.join(TEMPLATE_DIR, "provision_disks.sh")
+    try:
+        os.makedirs(TEMPLATE_DIR, exist_ok=True)
+        with open(script_path, "w") as f:
+            f.write("#!/bin/bash\n\n")
+            f.write("# Multi-disk provisioning. Each disk's block runs independently of the others.\n")
+            for disk, commands in per_disk_commands.items():
+                f.write(f"\n# --- {disk} ---\n")
+                f.writelines(f"{command}\n" for command in commands)
+        os.chmod(script_path, 0o755)
+    except IOError as e:
+        print(f"Error writing to template file: {e}", file=sys.stderr)
+
+
+def run_provisioning(stdscr) -> None:
+    """Curses workflow that provisions several disks in parallel."""
+    disk_data = disk_ops.get_disk_info()
+    disks = [dev for dev in (disk_data or {}).get('blockdevices', []) if dev.get('type') == 'disk']
+    if not disks:
+        ui.display_text_viewer(stdscr, "Provisioning", ["No disks found."])
+        return
+
+    options = {f"/dev/{disk['name']}": f"/dev/{disk['name']} ({disk['size']})" for disk in disks}
+    selected = ui.get_multi_choice(stdscr, "Select disks to provision (ALL DATA WILL BE ERASED)", options)
+    if not selected:
+        return
+
+    fs_type = ui.get_menu_choice(stdscr, "Filesystem for the disks", {"1": "ext4", "2": "xfs", "3": "btrfs"})
+    if fs_type is None:
+        return
+
+    stdscr.clear()
+    keyfile = ui.get_text_input(stdscr, "LUKS keyfile (empty for no encryption):") or None
+    if keyfile and not os.path.isfile(keyfile):
+        ui.display_text_viewer(stdscr, "Provisioning", [f"Keyfile '{keyfile}' not found."])
+        return
+    workers = ui.get_text_input(stdscr, "Parallel workers [default: 4]:")
+    workers = int(workers) if workers.isdigit() and int(workers) > 0 else 4
+
+    confirm = ui.get_text_input(stdscr, f"Type ERASE to wipe {len(selected)} disk(s):")
+    if confirm != "ERASE":
+        ui.display_text_viewer(stdscr, "Provisioning", ["Confirmation failed. Nothing was changed."])
+        return
+
+    scheduler = ProvisioningScheduler(max_workers=workers)
+    per_disk_commands = {}
+    errors = []
+    for disk in selected:
+        try:
+            steps, commands = build_disk_pipeline(disk, fs_type, keyfile)
+        except StepError as e:
+            errors.append(f"{disk}: {e}")
+            continue
+        scheduler.add_pipeline(disk, steps)
+        per_disk_commands[disk] = commands
+    if errors:
+        ui.display_text_viewer(stdscr, "Provisioning: disks skipped", errors)
+    if not per_disk_commands:
+        return
+    _save_template(per_disk_commands)
+
+    scheduler.start()
+    ui.display_progress(stdscr, f"Provisioning {len(selected)} disk(s) with {workers} workers", scheduler)
+    disk_ops.invalidate_disk_info("multi-disk provisioning")
@@ -0,0 +1,117 @@
+import os
+import threading
+
+from utils import fleet, plan, remote
+
+TEMPLATE_DIR = "Templates/default_template"
+
+
+def _print_event(event: dict) -> None:
+    if event.get("event") == "op":
+        print(f"{event['status']:<10} {event['id']:<28} {event['elapsed']:6.2f}s {event['error']}", flush=True)
+
+
+def run_remote_install(template_dir: str = TEMPLATE_DIR) -> None:
+    """
+    Installs a template on another machine: the plan is checked there with
+    a dry run first, then shipped again and applied, both over one
+    multiplexed SSH connection.
+    """
+    print("\n--- Install on remote machine ---")
+    template_dir = input(f"Template directory [{template_dir}]: ") or template_dir
+    if not os.path.isdir(template_dir):
+        print(f"Template directory '{template_dir}' not found.")
+        return
+    operations = plan.load_plan(template_dir)
+    if not operations:
+        print("The template contains no operations.")
+        return
+
+    destination = input("Target machine (user@host or user@host:port): ")
+    if not destination:
+        print("Remote install cancelled.")
+        return
+    host, port = remote.parse_destination(destination)
+    identity = input("SSH private key (empty for the default): ") or None
+    sudo = not input("Does this login have root already? (yes/no): ").lower().startswith('y')
+
+    mapping = {}
+    print("\nDevice names on the target (Enter keeps the name):")
+    for device in remote.plan_devices(operations):
+        answer = input(f"  {device} on {host} [{device}]: ")
+        if answer and answer != device:
+            mapping[device] = answer
+
+    transport = remote.SSHTransport(host, port, identity)
+    try:
+        print(f"\nChecking the plan on {host}...")
+        check = remote.install(transport, template_dir, mapping, sudo, dry_run=True)
+        if not check.ok:
+            print("\n".join(remote.format_result(check)))
+            return
+        print(f"{host} ({check.remote_host}) accepted {len(check.results)} operation(s):")
+        for op in check.results:
+            print(f"  {op['command']}")
+
+        print("\n" + "=" * 60 + "\n!!! WARNING !!!")
+        print(f"This will run the operations above on {host} ({check.remote_host}) and can ERASE its disks.")
+        print("=" * 60)
+        if input("To confirm, type ERASE: ") != "ERASE":
+            print("Confirmation failed. Remote install cancelled.")
+            return
+        result = remote.install(transport, template_dir, mapping, sudo, progress=_print_event)
+    finally:
+        transport.close()
+
+    lines = remote.format_result(result)
+    print("-------------------------------------------------")
+    print("\n".join([lines[0]] + lines[1 + len(result.results):]))
+
+
+def run_fleet_install(template_dir: str = TEMPLATE_DIR) -> None:
+    """
+    Installs a template on every host of an inventory (and/or on simulated
+    hosts backed by loop devices), several at a time, and prints a table of
+    per-host step timings.
+    """
+    print("\n--- Install on many machines (fleet) ---")
+    template_dir = input(f"Template directory [{template_dir}]: ") or template_dir
+    if not os.path.isdir(template_dir):
+        print(f"Template directory '{template_dir}' not found.")
+        return
+    inventory = input("Inventory file (JSON or one user@host per line, empty for none): ")
+    try:
+        hosts = fleet.load_inventory(inventory) if inventory else []
+        simulated = input("Simulated hosts on loop devices to add [0]: ") or "0"
+        hosts += fleet.simulated_hosts(int(simulated))
+        parallel = int(input(f"Hosts to install at the same time [{fleet.DEFAULT_PARALLEL}]: ")
+                       or fleet.DEFAULT_PARALLEL)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+    if not hosts:
+        print("No hosts to install.")
+        return
+
+    print(f"\n{len(hosts)} host(s):")
+    for host in hosts:
+        mapping = ", ".join(f"{k}={v}" for k, v in host.mapping.items())
+        print(f"  {host.name:<16} {host.address or 'simulated (loop devices)'}  {mapping}")
+    print("\n" + "=" * 60 + "\n!!! WARNING !!!")
+    print(f"This will apply {template_dir} to ALL {len(hosts)} host(s) and can ERASE their disks.")
+    print("=" * 60)
+    if input("To confirm, type ERASE: ") != "ERASE":
+        print("Confirmation failed. Fleet install cancelled.")
+        return
+
+    print_lock = threading.Lock()
+
+    def progress(host, event: dict) -> None:
+        if event.get("event") == "op":
+            with print_lock:
+                print(f"{host.name:<16} {event['status']:<10} {event['id']:<28} {event['elapsed']:6.2f}s "
+                      f"{event['error']}", flush=True)
+
+    results = fleet.install_fleet(hosts, template_dir, parallel, progress=progress)
+    print("-------------------------------------------------")
+    print("\n".join(fleet.summary_table(results)))
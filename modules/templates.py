@@ -0,0 +1,89 @@
+import curses
+import os
+
+from utils import ui, disk_ops, plan, reconcile
+
+TEMPLATE_DIR = "Templates/default_template"
+
+
+def _plan_lines(operations: list, applied: set) -> list[str]:
+    """Describes each operation, whether it is already applied and what it waits for."""
+    lines = []
+    for op in operations:
+        state = "applied" if op.fingerprint in applied else "pending"
+        lines.append(f"[{state}] {op.id}" + (f"  (after {', '.join(op.deps)})" if op.deps else ""))
+        lines.append(f"    {op.command_line()}")
+    return lines
+
+
+def _print_result(result: dict) -> None:
+    print(f"{result['status']:<10} {result['id']:<28} {result['elapsed']:6.2f}s {result['error']}")
+
+
+def _change_lines(changes: list) -> list[str]:
+    """Describes which operations are already satisfied by the disks and which would run."""
+    lines = [f"{sum(status == 'change' for _, status, _ in changes)} of {len(changes)} operation(s) need to run.", ""]
+    unknown = sum(status == "unknown" for _, status, _ in changes)
+    if unknown:
+        lines[1:1] = [f"{unknown} operation(s) cannot be checked and will be blocked."]
+    for op, status, reason in changes:
+        lines.append(f"[{'ok' if status == 'satisfied' else status}] {op.id}" + (f"  ({reason})" if reason else ""))
+        lines.append(f"    {op.command_line()}")
+    return lines
+
+
+def run_template_apply(stdscr, template_dir: str = TEMPLATE_DIR) -> None:
+    """
+    Shows the template as a dependency-ordered plan and applies it.
+    Incremental mode runs the operations that changed since the last
+    successful apply; reconcile mode runs those whose result is missing on
+    the disks.
+    """
+    if not os.path.isdir(template_dir):
+        ui.display_text_viewer(stdscr, "Apply Template", [f"Template directory '{template_dir}' not found."])
+        return
+
+    operations = plan.load_plan(template_dir)
+    if not operations:
+        ui.display_text_viewer(stdscr, "Apply Template", ["The template contains no operations."])
+        return
+
+    mode = ui.get_menu_choice(stdscr, f"Apply {template_dir}", {
+        "1": "Incremental (run operations changed since the last apply)",
+        "2": "Reconcile (compare with the live disks, run only what is missing)",
+    })
+    if mode is None:
+        return
+    reconciling = mode.startswith("Reconcile")
+
+    force = False
+    if reconciling:
+        changes = reconcile.preview(operations)
+        ui.display_text_viewer(stdscr, f"Changes needed for {template_dir}", _change_lines(changes))
+        if not any(status == "change" for _, status, _ in changes):
+            return
+        stdscr.clear()
+        if not ui.get_confirmation(stdscr, "Apply the missing changes?"):
+            return
+    else:
+        applied = plan.load_state(template_dir, operations)
+        ui.display_text_viewer(stdscr, f"Plan for {template_dir}", _plan_lines(operations, applied))
+        stdscr.clear()
+        if not ui.get_confirmation(stdscr, "Apply the pending operations?"):
+            return
+        force = ui.get_confirmation(stdscr, "Re-run operations that are already applied?")
+
+    # Leave curses so passphrase prompts and progress are visible
+    curses.endwin()
+    print(f"\n--- Applying {template_dir} ---")
+    if reconciling:
+        results = reconcile.reconcile(operations, template_dir, progress=_print_result)
+    else:
+        results = plan.execute(operations, template_dir, force=force, progress=_print_result)
+    disk_ops.invalidate_disk_info(f"template {template_dir} applied")
+
+    failed = [r for r in results if r["status"] in ("failed", "blocked")]
+    print("-------------------------------------------------")
+    print(f"{len(results) - len(failed)} of {len(results)} operations OK.")
+    input("Press Enter to return...")
+    stdscr.refresh()
@@ -1,6 +1,8 @@
 import subprocess
 # 'sys' behövs inte om du inte använder det, så vi kan ta bort den importen.
 
+from modules.remote_install import run_remote_install, run_fleet_install
+
 def run_disk_tools():
     """Kör disk_tools.py och hanterar eventuella fel."""
     print("Starting disk utility...")
@@ -60,7 +62,8 @@ if main_choice == "1":
     # Definiera alternativen för den andra menyn
     machine_menu_options = {
         "1": "Install on local machine",
-        "2": "Install on remote machine"
+        "2": "Install on remote machine",
+        "3": "Install on many machines (fleet)"
     }
     machine_choice = get_confirmed_choice("New install", machine_menu_options)
     
@@ -68,7 +71,9 @@ if main_choice == "1":
         print("Preparing to install on local machine...")
         run_disk_tools()
     elif machine_choice == "2":
-        print("Feature yet to be implemented")
+        run_remote_install()
+    elif machine_choice == "3":
+        run_fleet_install()
         
 elif main_choice == "2":
     print("Edit installation Template")
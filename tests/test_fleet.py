@@ -0,0 +1,204 @@
+"""
+Tests for fleet installs (utils.fleet): inventories, the retry rule of
+install_host (with remote.install stubbed out) and the summary table.
+
+Usage: python3 -m pytest tests/test_fleet.py
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import fleet, remote  # noqa: E402
+
+
+def test_load_json_inventory_merges_defaults(tmp_path):
+    path = tmp_path / "hosts.json"
+    path.write_text(json.dumps({
+        "defaults": {"timeout": 600, "retries": 3, "map": {"/dev/sdb": "/dev/nvme0n1", "/dev/sdc": "/dev/nvme1n1"}},
+        "hosts": [{"name": "r1-01", "address": "root@10.0.0.11"},
+                  {"name": "r1-02", "address": "root@10.0.0.12:2222", "retries": 0, "map": {"/dev/sdb": "/dev/sda"}},
+                  {"name": "sim-1", "simulate": True}]}))
+    first, second, simulated = fleet.load_inventory(str(path))
+
+    assert (first.address, first.port, first.timeout, first.retries) == ("root@10.0.0.11", None, 600, 3)
+    assert first.sudo
+    assert first.mapping == {"/dev/sdb": "/dev/nvme0n1", "/dev/sdc": "/dev/nvme1n1"}
+    assert (second.address, second.port, second.retries) == ("root@10.0.0.12", 2222, 0)
+    assert second.mapping == {"/dev/sdb": "/dev/sda", "/dev/sdc": "/dev/nvme1n1"}
+    assert simulated.simulate and not simulated.sudo
+
+
+def test_load_text_inventory(tmp_path):
+    path = tmp_path / "hosts.txt"
+    path.write_text("# rack 1\n"
+                    "root@10.0.0.11\n"
+                    "\n"
+                    "admin@10.0.0.12:2222 /dev/sdb=/dev/vda  # virtual machine\n")
+    first, second = fleet.load_inventory(str(path))
+
+    assert (first.name, first.address, first.port, first.mapping) == ("root@10.0.0.11", "root@10.0.0.11", None, {})
+    assert (second.address, second.port, second.mapping) == ("admin@10.0.0.12", 2222, {"/dev/sdb": "/dev/vda"})
+    assert second.retries == fleet.DEFAULT_RETRIES
+
+
+@pytest.mark.parametrize("name, text", [
+    ("hosts.txt", "root@10.0.0.11\nroot@10.0.0.11 /dev/sdb=/dev/sdc\n"),
+    ("hosts.json", json.dumps({"hosts": [{"name": "a", "address": "x@1"}, {"name": "a", "address": "x@2"}]})),
+])
+def test_duplicate_host_names_are_refused(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    with pytest.raises(ValueError, match="duplicate host names"):
+        fleet.load_inventory(str(path))
+
+
+@pytest.fixture
+def stub_install(monkeypatch):
+    """Replaces remote.install with one returning the queued RemoteResults in turn."""
+    outcomes, calls = [], []
+
+    def install(transport, template_dir, mapping, sudo, workers, dry_run, progress, timeout, names):
+        calls.append(dry_run)
+        return outcomes.pop(0)
+
+    monkeypatch.setattr(fleet.remote, "install", install)
+    monkeypatch.setattr(fleet.remote, "SSHTransport", lambda *args: remote.LocalTransport())
+    monkeypatch.setattr(fleet, "RETRY_DELAY", 0)
+    return outcomes, calls
+
+
+def _outcome(ok=False, started=False, bundle_bytes=1000, error="") -> remote.RemoteResult:
+    return remote.RemoteResult("host", ok=ok, started=started, bundle_bytes=bundle_bytes, error=error)
+
+
+def test_retries_failures_before_the_plan_started(stub_install):
+    outcomes, calls = stub_install
+    outcomes += [_outcome(error="ssh: connection refused"), _outcome(error="sudo: a password is required"),
+                 _outcome(ok=True, started=True)]
+    result = fleet.install_host(fleet.Host("h", "root@h", retries=2), "tpl")
+
+    assert result.ok and result.attempts == 3 and len(calls) == 3
+    assert result.errors == ["ssh: connection refused", "sudo: a password is required"]
+
+
+def test_gives_up_after_the_retries(stub_install):
+    outcomes, calls = stub_install
+    outcomes += [_outcome(error="refused")] * 2
+    result = fleet.install_host(fleet.Host("h", "root@h", retries=1), "tpl")
+
+    assert not result.ok and result.attempts == 2 and result.error == "refused"
+
+
+def test_no_retry_once_the_plan_started(stub_install):
+    outcomes, calls = stub_install
+    outcomes += [_outcome(started=True, error="1 operation(s) failed, the first: op2"), _outcome(ok=True)]
+    result = fleet.install_host(fleet.Host("h", "root@h", retries=3), "tpl")
+
+    assert not result.ok and result.attempts == 1 and len(calls) == 1
+    assert "not retried" in result.error
+
+
+def test_dry_run_is_retried_even_after_start(stub_install):
+    outcomes, calls = stub_install
+    outcomes += [_outcome(started=True, error="connection reset"), _outcome(ok=True, started=True)]
+    result = fleet.install_host(fleet.Host("h", "root@h", retries=1), "tpl", dry_run=True)
+
+    assert result.ok and result.attempts == 2 and calls == [True, True]
+
+
+def test_no_retry_when_the_bundle_cannot_be_built(stub_install):
+    outcomes, calls = stub_install
+    outcomes += [_outcome(bundle_bytes=0, error="cannot read /root/key: Permission denied"), _outcome(ok=True)]
+    result = fleet.install_host(fleet.Host("h", "root@h", retries=3), "tpl")
+
+    assert not result.ok and result.attempts == 1 and len(calls) == 1
+
+
+def _sysfs_device(root, kname: str, holders: list[str] = (), dm: tuple[str, str] | None = None, parent=None):
+    directory = root / "class" / "block" / kname if parent is None else root / "class" / "block" / parent / kname
+    (directory / "holders").mkdir(parents=True)
+    for holder in holders:
+        (directory / "holders" / holder).touch()
+    if dm:
+        (directory / "dm").mkdir()
+        (directory / "dm" / "name").write_text(dm[0] + "\n")
+        (directory / "dm" / "uuid").write_text(dm[1] + "\n")
+    if parent is not None:
+        (root / "class" / "block" / kname).symlink_to(directory)
+
+
+def test_release_stack_tears_down_top_down(tmp_path, monkeypatch):
+    # loop0p1 -> LUKS mapping dm-0 -> two LVs of 'my-vg' (dm-1, dm-2); loop0p2 -> a plain dm device
+    _sysfs_device(tmp_path, "loop0")
+    _sysfs_device(tmp_path, "loop0p1", ["dm-0"], parent="loop0")
+    _sysfs_device(tmp_path, "loop0p2", ["dm-3"], parent="loop0")
+    _sysfs_device(tmp_path, "dm-0", ["dm-1", "dm-2"], ("crypt_data_sim1", "CRYPT-LUKS2-1234-crypt_data_sim1"))
+    _sysfs_device(tmp_path, "dm-1", dm=("my--vg-root", "LVM-abc"))
+    _sysfs_device(tmp_path, "dm-2", dm=("my--vg-home", "LVM-abd"))
+    _sysfs_device(tmp_path, "dm-3", dm=("scratch", ""))
+    commands = []
+    monkeypatch.setattr(fleet.subprocess, "run", lambda command, **kwargs: commands.append(command))
+
+    assert fleet.device_stack("loop0", str(tmp_path)) == ["dm-1", "dm-2", "dm-0", "dm-3"]
+    fleet.release_stack("loop0", str(tmp_path))
+    assert commands == [["vgchange", "-an", "my-vg"], ["cryptsetup", "close", "crypt_data_sim1"],
+                        ["dmsetup", "remove", "scratch"]]
+
+
+def _op(op_id: str, status: str, elapsed: float) -> dict:
+    return {"id": op_id, "command": op_id, "status": status, "elapsed": elapsed, "error": ""}
+
+
+def test_summary_table():
+    results = [
+        fleet.HostResult("alpha", "root@a", ok=True, attempts=1, elapsed=30.0,
+                         results=[_op("1_part.sh:1", "applied", 2.0), _op("2_fs.sh:1", "applied", 10.0)]),
+        fleet.HostResult("beta", "root@b", ok=True, attempts=2, elapsed=50.0,
+                         results=[_op("1_part.sh:1", "applied", 4.0), _op("2_fs.sh:1", "applied", 20.0)]),
+        fleet.HostResult("gamma", "root@c", ok=False, attempts=1, elapsed=10.0, error="1 operation(s) failed",
+                         results=[_op("1_part.sh:1", "failed", 1.0), _op("2_fs.sh:1", "blocked", 0.0)]),
+    ]
+    lines = fleet.summary_table(results)
+    rows = {line.split()[0]: line.split() for line in lines if line and line.split()[0] in
+            ("alpha", "beta", "gamma", "median")}
+
+    assert lines[0].split() == ["Host", "Status", "Try", "Total", "S1", "S2"]
+    assert rows["alpha"] == ["alpha", "OK", "1", "30.0", "2.00", "10.00"]
+    assert rows["beta"] == ["beta", "OK", "2", "50.0", "4.00", "20.00"]
+    assert rows["gamma"] == ["gamma", "FAIL", "1", "10.0", "FAILED", "BLOCKE"]
+    # Failed and blocked cells do not count towards the medians
+    assert rows["median"] == ["median", "30.0", "3.00", "15.00"]
+    assert "S1: 1_part.sh:1" in lines and "S2: 2_fs.sh:1" in lines
+    assert "gamma: 1 operation(s) failed" in lines
+    assert lines[-1] == "2 of 3 host(s) installed."
+
+
+def test_summary_table_marks_missing_steps():
+    results = [fleet.HostResult("alpha", "root@a", ok=True, attempts=1, elapsed=5.0,
+                                results=[_op("op1", "applied", 1.0)]),
+               fleet.HostResult("beta", "root@b", attempts=2, elapsed=1.0, error="connection refused")]
+    lines = fleet.summary_table(results)
+    beta = next(line for line in lines if line.startswith("beta "))
+
+    assert beta.split() == ["beta", "FAIL", "2", "1.0", "-"]
+    assert "beta: connection refused" in lines
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="loop devices need root")
+def test_simulated_hosts_on_loop_devices(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    template = tmp_path / "tpl"
+    template.mkdir()
+    (template / "1_fs.sh").write_text("sudo wipefs --all /dev/sdb\nsudo mkfs.ext4 -F -q /dev/sdb\n")
+    hosts = fleet.simulated_hosts(2, disk_size=16 * 1024 ** 2)
+    results = fleet.install_fleet(hosts, str(template), parallel=2)
+
+    for result in results:
+        assert result.ok, result.error
+        assert [r["status"] for r in result.results] == ["applied", "applied"]
+        assert result.results[1]["command"].startswith("mkfs.ext4 -F -q /dev/loop")
+    assert results[0].results[1]["command"] != results[1].results[1]["command"]
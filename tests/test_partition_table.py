@@ -0,0 +1,175 @@
+"""
+Tests for the native GPT/MBR reader (utils.partition_table) on sparse
+image files built with the standard library.
+
+Usage: python3 -m pytest tests/test_partition_table.py
+"""
+import os
+import struct
+import sys
+import uuid
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.partition_table import FreeExtent, read_partition_map  # noqa: E402
+
+LINUX = "0fc63daf-8483-4772-8e79-3d69d8477de4"
+ESP = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+DISK_GUID = "5e2a7e1b-7c1e-4f0a-9d5b-1a2b3c4d5e6f"
+
+ENTRIES = 128
+ENTRY_SIZE = 128
+HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+ENTRY = struct.Struct("<16s16sQQQ72s")
+MBR_ENTRY = struct.Struct("<B3sB3sII")
+
+
+def _image(tmp_path, sectors: int, sector_size: int = 512) -> str:
+    path = str(tmp_path / "disk.img")
+    with open(path, "wb") as f:
+        f.truncate(sectors * sector_size)
+    return path
+
+
+def _write(path: str, offset: int, data: bytes) -> None:
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def _mbr(entries: list[tuple[int, int, int]]) -> bytes:
+    """A boot sector with (type, first LBA, sectors) entries."""
+    sector = bytearray(512)
+    for index, (ptype, start, sectors) in enumerate(entries):
+        MBR_ENTRY.pack_into(sector, 0x1BE + 16 * index, 0, b"\0\0\0", ptype, b"\0\0\0", start, sectors)
+    sector[510:512] = b"\x55\xaa"
+    return bytes(sector)
+
+
+def _gpt_header(my_lba: int, alternate_lba: int, entries_lba: int, first: int, last: int, entries_crc: int) -> bytes:
+    fields = [b"EFI PART", 0x10000, HEADER.size, 0, 0, my_lba, alternate_lba, first, last,
+              uuid.UUID(DISK_GUID).bytes_le, entries_lba, ENTRIES, ENTRY_SIZE, entries_crc]
+    fields[3] = zlib.crc32(HEADER.pack(*fields))
+    return HEADER.pack(*fields)
+
+
+def build_gpt(path: str, sectors: int, partitions: list[tuple[str, int, int, str]], sector_size: int = 512) -> None:
+    """Writes a protective MBR, both GPT headers and both entry arrays for (type, start, end, name) partitions."""
+    entries = bytearray(ENTRIES * ENTRY_SIZE)
+    for number, (type_guid, start, end, name) in enumerate(partitions):
+        ENTRY.pack_into(entries, number * ENTRY_SIZE, uuid.UUID(type_guid).bytes_le, uuid.uuid4().bytes_le,
+                        start, end, 0, name.encode("utf-16-le"))
+    entry_sectors = len(entries) // sector_size
+    first, last = 2 + entry_sectors, sectors - 2 - entry_sectors
+    crc = zlib.crc32(entries)
+    _write(path, 0, _mbr([(0xEE, 1, min(sectors - 1, 0xFFFFFFFF))]))
+    _write(path, sector_size, _gpt_header(1, sectors - 1, 2, first, last, crc))
+    _write(path, 2 * sector_size, bytes(entries))
+    _write(path, (sectors - 1 - entry_sectors) * sector_size, bytes(entries))
+    _write(path, (sectors - 1) * sector_size,
+           _gpt_header(sectors - 1, 1, sectors - 1 - entry_sectors, first, last, crc))
+
+
+SECTORS = 64 * 2048     # 64 MiB
+
+
+@pytest.fixture
+def gpt_image(tmp_path):
+    path = _image(tmp_path, SECTORS)
+    build_gpt(path, SECTORS, [(ESP, 2048, 20479, "EFI"), (LINUX, 40960, 100000, "root")])
+    return path
+
+
+def test_gpt_partitions_and_free_extents(gpt_image):
+    pmap = read_partition_map(gpt_image)
+    assert pmap.label == "gpt"
+    assert pmap.warnings == []
+    assert pmap.disk_uuid == DISK_GUID
+    assert (pmap.first_usable, pmap.last_usable) == (34, SECTORS - 34)
+    assert [(p.number, p.start, p.end, p.type_id, p.name) for p in pmap.partitions] == [
+        (1, 2048, 20479, ESP, "EFI"), (2, 40960, 100000, LINUX, "root")]
+    assert pmap.free == [FreeExtent(34, 2047), FreeExtent(20480, 40959), FreeExtent(100001, SECTORS - 34)]
+
+
+def test_gpt_primary_header_crc_mismatch_uses_backup(gpt_image):
+    # Change last_usable without updating the header CRC
+    _write(gpt_image, 512 + 48, struct.pack("<Q", 50000))
+    pmap = read_partition_map(gpt_image)
+    assert pmap.label == "gpt"
+    assert "Primary GPT header missing or corrupt" in pmap.warnings
+    assert "Using backup GPT header" in pmap.warnings
+    assert [p.start for p in pmap.partitions] == [2048, 40960]
+    assert pmap.last_usable == SECTORS - 34
+
+
+def test_gpt_entry_array_crc_mismatch_uses_backup(gpt_image):
+    # Corrupt the primary entry array only; the backup array is intact
+    _write(gpt_image, 2 * 512 + 32, struct.pack("<Q", 4096))
+    pmap = read_partition_map(gpt_image)
+    assert pmap.label == "gpt"
+    assert "GPT entry array CRC mismatch (header at LBA 1)" in pmap.warnings
+    assert "Using backup GPT header" in pmap.warnings
+    assert pmap.partitions[0].start == 2048
+
+
+def test_gpt_without_valid_header_has_no_label(gpt_image):
+    _write(gpt_image, 512, b"\0" * 512)
+    _write(gpt_image, (SECTORS - 1) * 512, b"\0" * 512)
+    pmap = read_partition_map(gpt_image)
+    assert pmap.label is None
+    assert "No valid GPT found" in pmap.warnings
+    assert pmap.partitions == []
+
+
+def test_gpt_4k_sector_image(tmp_path):
+    sectors = 16 * 256      # 16 MiB of 4 KiB sectors
+    path = _image(tmp_path, sectors, 4096)
+    build_gpt(path, sectors, [(LINUX, 256, 1023, "data")], sector_size=4096)
+    pmap = read_partition_map(path)
+    assert (pmap.label, pmap.sector_size, pmap.total_sectors) == ("gpt", 4096, sectors)
+    assert [(p.start, p.end) for p in pmap.partitions] == [(256, 1023)]
+    assert pmap.free == [FreeExtent(6, 255), FreeExtent(1024, sectors - 6)]
+
+
+def test_mbr_primary_extended_and_logical(tmp_path):
+    path = _image(tmp_path, SECTORS)
+    # Primary 1, then an extended container holding two logical partitions
+    _write(path, 0, _mbr([(0x83, 2048, 20480), (0x05, 30720, 40960)]))
+    _write(path, 30720 * 512, _mbr([(0x83, 2048, 8192), (0x05, 20480, 20480)]))
+    _write(path, (30720 + 20480) * 512, _mbr([(0x82, 2048, 4096)]))
+    pmap = read_partition_map(path)
+    assert pmap.label == "msdos"
+    assert [(p.number, p.start, p.end, p.type_id) for p in pmap.partitions] == [
+        (1, 2048, 22527, "0x83"), (2, 30720, 71679, "0x05"),
+        (5, 32768, 40959, "0x83"), (6, 53248, 57343, "0x82")]
+    # Logical partitions lie inside the extended one and do not split the free space
+    assert pmap.free == [FreeExtent(1, 2047), FreeExtent(22528, 30719), FreeExtent(71680, SECTORS - 1)]
+
+
+def test_mbr_broken_ebr_is_reported(tmp_path):
+    path = _image(tmp_path, SECTORS)
+    _write(path, 0, _mbr([(0x0F, 2048, 40960)]))
+    pmap = read_partition_map(path)
+    assert pmap.label == "msdos"
+    assert [p.number for p in pmap.partitions] == [1]
+    assert "Invalid EBR at sector 2048" in pmap.warnings
+
+
+def test_no_partition_table(tmp_path):
+    path = _image(tmp_path, SECTORS)
+    pmap = read_partition_map(path)
+    assert pmap.label is None
+    assert pmap.partitions == []
+    # The whole device is free, starting at sector 0
+    assert pmap.free == [FreeExtent(0, SECTORS - 1)]
+    assert pmap.largest_free().start == 0
+
+
+def test_too_small_image(tmp_path):
+    path = str(tmp_path / "tiny.img")
+    with open(path, "wb") as f:
+        f.write(b"\0" * 512)
+    assert read_partition_map(path) is None
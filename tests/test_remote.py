@@ -0,0 +1,152 @@
+"""
+Tests for remote installs (utils.remote): plan compilation, device
+mapping, and whole installs through LocalTransport, which runs the bundle
+and its agent in a subprocess on this machine.
+
+Usage: python3 -m pytest tests/test_remote.py
+"""
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import plan, remote  # noqa: E402
+
+
+def _template(path, commands: list[list[str]]) -> str:
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, plan.PLAN_FILE), "w") as f:
+        json.dump({"operations": [{"id": f"op{index + 1}", "command": argv}
+                                  for index, argv in enumerate(commands)]}, f)
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    # Plan state of the agent's runs goes to the test's directory, not ~/.cache
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+
+@pytest.mark.parametrize("path, mapping, expected", [
+    ("/dev/sdb2", {"/dev/sdb": "/dev/nvme0n1"}, "/dev/nvme0n1p2"),
+    ("/dev/sdb", {"/dev/sdb": "/dev/nvme0n1"}, "/dev/nvme0n1"),
+    ("/dev/nvme0n1p3", {"/dev/nvme0n1": "/dev/sda"}, "/dev/sda3"),
+    ("/dev/sdb2", {"/dev/sdb2": "/dev/vdc1"}, "/dev/vdc1"),
+    ("/dev/sdc1", {"/dev/sdb": "/dev/nvme0n1"}, "/dev/sdc1"),
+    ("/dev/mapper/crypt_sdb2", {"/dev/sdb": "/dev/nvme0n1"}, "/dev/mapper/crypt_sdb2"),
+])
+def test_map_device(path, mapping, expected):
+    assert remote.map_device(path, mapping) == expected
+
+
+def test_compile_plan_ships_payloads_and_maps_devices(tmp_path):
+    keyfile = tmp_path / "disk.key"
+    keyfile.write_bytes(b"secret")
+    template = _template(tmp_path / "tpl", [
+        ["sudo", "cryptsetup", "luksFormat", "--batch-mode", "--key-file", str(keyfile), "/dev/sdb2"],
+        ["sudo", "cryptsetup", "open", f"--key-file={keyfile}", "/dev/sdb2", "crypt_data"],
+        ["sudo", "mkfs.ext4", "-F", "/dev/mapper/crypt_data"],
+    ])
+    document, payloads = remote.compile_plan(plan.load_plan(template), {"/dev/sdb": "/dev/nvme0n1"})
+
+    assert len(payloads) == 1
+    (bundle_path, local), = payloads.items()
+    assert local == str(keyfile) and bundle_path.startswith(f"{remote.PAYLOAD_DIR}/")
+    shipped = f"{remote.BUNDLE_PLACEHOLDER}/{bundle_path}"
+    format_op, open_op, mkfs_op = document["operations"]
+    assert format_op["command"][-2:] == [shipped, "/dev/nvme0n1p2"]
+    assert open_op["command"][-3:] == [f"--key-file={shipped}", "/dev/nvme0n1p2", "crypt_data"]
+    assert format_op["writes"] == ["/dev/nvme0n1p2"]
+    assert mkfs_op["command"][-1] == "/dev/mapper/crypt_data"
+    assert str(keyfile) not in json.dumps(document)
+
+    with tarfile.open(fileobj=io.BytesIO(remote.build_bundle(document, payloads)), mode="r:xz") as archive:
+        names = archive.getnames()
+        assert archive.extractfile(bundle_path).read() == b"secret"
+    assert plan.PLAN_FILE in names and set(remote.AGENT_FILES) <= set(names)
+
+
+def test_namespace_names_for_hosts_sharing_a_kernel(tmp_path):
+    template = _template(tmp_path / "tpl", [
+        ["sudo", "cryptsetup", "open", "--key-file", "/dev/null", "/dev/sdb2", "crypt_data"],
+        ["sudo", "vgcreate", "my-vg", "/dev/mapper/crypt_data"],
+        ["sudo", "lvcreate", "-L", "1G", "-n", "root", "my-vg"],
+        ["sudo", "mkfs.ext4", "-F", "/dev/my-vg/root"],
+        ["sudo", "mkfs.xfs", "-f", "/dev/mapper/my--vg-root"],
+    ])
+    operations = plan.load_plan(template)
+    names = remote.namespace_names(operations, "sim1")
+    assert names == {"crypt_data": "crypt_data_sim1", "my-vg": "my-vg_sim1"}
+
+    document, _ = remote.compile_plan(operations, {"/dev/sdb": "/dev/loop3"}, names)
+    commands = [op["command"][1:] for op in document["operations"]]
+    assert commands == [
+        ["cryptsetup", "open", "--key-file", "/dev/null", "/dev/loop3p2", "crypt_data_sim1"],
+        ["vgcreate", "my-vg_sim1", "/dev/mapper/crypt_data_sim1"],
+        ["lvcreate", "-L", "1G", "-n", "root", "my-vg_sim1"],
+        ["mkfs.ext4", "-F", "/dev/my-vg_sim1/root"],
+        ["mkfs.xfs", "-f", "/dev/mapper/my--vg_sim1-root"],
+    ]
+    assert document["operations"][1]["writes"] == ["/dev/mapper/crypt_data_sim1", "vg:my-vg_sim1"]
+
+
+def test_compile_plan_refuses_interactive_operations(tmp_path):
+    template = _template(tmp_path / "tpl", [["sudo", "cryptsetup", "luksFormat", "/dev/sdb2"]])
+    with pytest.raises(remote.RemoteError, match="passphrase"):
+        remote.compile_plan(plan.load_plan(template))
+
+
+def test_dry_run_streams_planned_operations(tmp_path):
+    template = _template(tmp_path / "tpl", [["true"], ["echo", "/dev/sdb1"]])
+    events = []
+    result = remote.install(remote.LocalTransport("sim"), template, {"/dev/sdb": "/dev/vdb"}, sudo=False,
+                            dry_run=True, progress=events.append)
+
+    assert result.ok, result.error
+    assert result.started and result.remote_host
+    assert result.bundle_bytes > 0
+    assert [event["event"] for event in events] == ["start", "op", "op", "done"]
+    assert [(r["id"], r["status"], r["command"]) for r in result.results] == [
+        ("op1", "planned", "true"), ("op2", "planned", "echo /dev/vdb1")]
+
+
+def test_install_runs_operations(tmp_path):
+    marker = tmp_path / "ran"
+    template = _template(tmp_path / "tpl", [["touch", str(marker)], ["false"]])
+    result = remote.install(remote.LocalTransport(), template, sudo=False)
+
+    assert marker.exists()
+    assert not result.ok
+    assert [(r["id"], r["status"]) for r in result.results] == [("op1", "applied"), ("op2", "failed")]
+    assert "1 operation(s) failed" in result.error
+
+
+def _processes_with(argument: str) -> list[int]:
+    found = []
+    for entry in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                if argument.encode() in f.read().split(b"\0"):
+                    found.append(int(entry))
+        except (OSError, ValueError):
+            continue
+    return found
+
+
+def test_deadline_kills_running_commands(tmp_path):
+    duration = "73.25"     # Unlikely to match anything else running here
+    template = _template(tmp_path / "tpl", [["sleep", duration]])
+    started = time.monotonic()
+    result = remote.install(remote.LocalTransport(), template, sudo=False, timeout=1)
+
+    assert time.monotonic() - started < remote.DEADLINE_GRACE
+    assert not result.ok and result.started
+    assert "deadline" in result.error
+    time.sleep(0.2)
+    assert _processes_with(duration) == []
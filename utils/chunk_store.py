@@ -0,0 +1,539 @@
+import collections
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from .image_deploy import DeployError, DeployProgress, Target, iter_image, run_module_as_root
+
+# Content-addressed chunk store shared by all templates. An image is cut
+# into variable-sized chunks at content-defined boundaries, each chunk is
+# stored once as a zlib-compressed file named after the sha256 of its
+# content, and the image itself becomes a small manifest listing its chunks.
+# Templates that ship variants of the same OS image therefore share almost
+# all of their chunks, and a boundary moved by an insertion only changes
+# the chunks around it, not every chunk after it.
+#
+# Boundaries are chosen per 4 KiB block (filesystem images change in whole
+# blocks): a chunk ends after a block whose crc32 matches CUT_MASK, once it
+# has MIN_CHUNK bytes, and always at MAX_CHUNK. Chunks of zeros are listed
+# in the manifest but never stored.
+#
+# Layout: the chunks live in the user's cache directory, outside the
+# source tree, and only the manifests are part of a template:
+#
+#   ~/.cache/os_installer/chunks/config.json      size limit of the store
+#   ~/.cache/os_installer/chunks/ab/abcdef...     one chunk, zlib-compressed
+#   Templates/<template>/images/<name>.json       manifest: [offset, length, sha256 or null]
+#
+# The store is bounded: after an import the least recently used chunks
+# (oldest mtime; importing or deploying a manifest touches its chunks) are
+# evicted until it fits, but only chunks no manifest under Templates/ refers
+# to. If the referenced chunks alone exceed the limit the store stays over
+# it, and the manifests holding the space are named so the user can delete
+# an image or raise the limit.
+#
+# Deploying a manifest hashes what the target already holds first, so only
+# chunks the target lacks are read from the store and only those are
+# written. A manifest with chunks missing from the store is refused before
+# the target is opened.
+
+STORE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                         "os_installer", "chunks")
+TEMPLATES_ROOT = "Templates"
+DEFAULT_MAX_BYTES = 50 * 1024 ** 3
+
+CDC_BLOCK = 4096
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# One block in 256 ends a chunk: about 1 MiB past MIN_CHUNK on average
+CUT_MASK = 0xFF
+COMPRESSION_LEVEL = 3
+
+
+class ChunkMissing(DeployError):
+    """Raised when a manifest needs a chunk that is not (or no longer) in the store."""
+
+
+@dataclass
+class StoreUsage:
+    chunks: int
+    bytes: int
+    max_bytes: int
+
+
+@dataclass
+class Eviction:
+    chunks: int = 0
+    bytes: int = 0
+    over_bytes: int = 0                 # Still above the limit, all of it referenced by manifests
+    held_by: list[str] = field(default_factory=list)    # Those manifests, if over_bytes
+
+
+class Chunker:
+    """Cuts a stream of (offset, data) pieces into content-defined chunks."""
+
+    def __init__(self, min_size: int = MIN_CHUNK, max_size: int = MAX_CHUNK, mask: int = CUT_MASK):
+        self.min_size, self.max_size, self.mask = min_size, max_size, mask
+        self.start = 0
+        self.buf = bytearray()
+
+    def feed(self, offset: int, data: bytes):
+        """Yields the (offset, data) chunks completed by this piece. A gap before it ends the current chunk."""
+        if self.buf and self.start + len(self.buf) != offset:
+            yield from self.flush()
+        if not self.buf:
+            self.start = offset
+        view = memoryview(data)
+        consumed = position = 0
+        while position < len(view):
+            # Blocks are aligned to the image, not to the piece
+            block = view[position:position + CDC_BLOCK - (offset + position) % CDC_BLOCK]
+            position += len(block)
+            size = len(self.buf) + position - consumed
+            if size >= self.max_size or (size >= self.min_size and len(block) == CDC_BLOCK
+                                         and zlib.crc32(block) & self.mask == 0):
+                self.buf += view[consumed:position]
+                consumed = position
+                yield self.start, bytes(self.buf)
+                self.start = offset + position
+                self.buf = bytearray()
+        self.buf += view[consumed:]
+
+    def flush(self):
+        if self.buf:
+            yield self.start, bytes(self.buf)
+            self.buf = bytearray()
+
+
+class ChunkStore:
+    """The chunk files and size limit under one directory."""
+
+    def __init__(self, root: str = STORE_DIR):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest: str, data: bytes) -> int:
+        """Stores a chunk unless it is there already. Returns the bytes added to the store."""
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.utime(path)
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        packed = zlib.compress(data, COMPRESSION_LEVEL)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(packed)
+        os.replace(temp, path)
+        return len(packed)
+
+    def get(self, digest: str) -> tuple[bytes, int]:
+        """Returns a chunk's content and its stored size. Raises ChunkMissing or DeployError."""
+        path = self.path(digest)
+        try:
+            with open(path, "rb") as f:
+                packed = f.read()
+        except FileNotFoundError:
+            raise ChunkMissing(f"chunk {digest[:16]} is not in the store")
+        try:
+            data = zlib.decompress(packed)
+        except zlib.error:
+            data = b""
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise DeployError(f"chunk {digest[:16]} in the store is corrupt")
+        return data, len(packed)
+
+    def touch(self, digests) -> None:
+        """Marks chunks as recently used."""
+        for digest in digests:
+            try:
+                os.utime(self.path(digest))
+            except OSError:
+                pass
+
+    def max_bytes(self) -> int:
+        try:
+            with open(os.path.join(self.root, "config.json")) as f:
+                return int(json.load(f)["max_bytes"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return DEFAULT_MAX_BYTES
+
+    def set_max_bytes(self, max_bytes: int) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, "config.json"), "w") as f:
+            json.dump({"max_bytes": max_bytes}, f)
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """(mtime, size, digest) of every chunk in the store."""
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.name))
+        return entries
+
+    def usage(self) -> StoreUsage:
+        entries = self._entries()
+        return StoreUsage(len(entries), sum(size for _, size, _ in entries), self.max_bytes())
+
+    def evict(self, pinned=frozenset(), max_bytes: int | None = None) -> Eviction:
+        """
+        Deletes least recently used chunks until the store fits its limit.
+        Chunks in 'pinned' or referenced by any manifest of the templates
+        next to the store are never deleted.
+        """
+        max_bytes = self.max_bytes() if max_bytes is None else max_bytes
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        result = Eviction()
+        if total <= max_bytes:
+            return result
+        references = _references(os.path.dirname(os.path.abspath(self.root)))
+        for _, size, digest in entries:
+            if total - result.bytes <= max_bytes:
+                break
+            if digest in pinned or digest in references:
+                continue
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                continue
+            result.chunks += 1
+            result.bytes += size
+        result.over_bytes = max(0, total - result.bytes - max_bytes)
+        if result.over_bytes:
+            result.held_by = sorted({path for paths in references.values() for path in paths})
+        return result
+
+
+def manifest_path(template_dir: str, name: str) -> str:
+    return os.path.join(template_dir, "images", f"{name}.json")
+
+
+def load_manifest(path: str) -> dict:
+    """Reads a manifest. Raises DeployError if it is missing or not a manifest."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise DeployError(f"cannot read manifest {path}: {e}")
+    if not isinstance(manifest, dict) or "chunks" not in manifest:
+        raise DeployError(f"{path} is not an image manifest")
+    return manifest
+
+
+def list_manifests(templates_root: str = TEMPLATES_ROOT) -> list[str]:
+    """Returns the manifest paths of all templates, sorted."""
+    found = []
+    if not os.path.isdir(templates_root):
+        return found
+    for template in sorted(os.listdir(templates_root)):
+        images = os.path.join(templates_root, template, "images")
+        if template.startswith(".") or not os.path.isdir(images):
+            continue
+        found += [os.path.join(images, name) for name in sorted(os.listdir(images)) if name.endswith(".json")]
+    return found
+
+
+def _references(templates_root: str) -> dict[str, list[str]]:
+    """Maps every chunk digest used by a manifest under 'templates_root' to those manifests."""
+    references = collections.defaultdict(list)
+    for path in list_manifests(templates_root):
+        try:
+            manifest = load_manifest(path)
+        except DeployError as e:
+            print(f"Warning: {e}", file=sys.stderr)
+            continue
+        for digest in {entry[2] for entry in manifest["chunks"] if entry[2]}:
+            references[digest].append(path)
+    return references
+
+
+def missing_chunks(manifest: dict, store: ChunkStore) -> int:
+    """Number of distinct chunks of a manifest that are not in the store."""
+    return sum(1 for digest in {entry[2] for entry in manifest["chunks"] if entry[2]} if not store.has(digest))
+
+
+def import_image(source: str, output: str, progress: DeployProgress | None = None,
+                 store: ChunkStore | None = None, workers: int | None = None) -> DeployProgress:
+    """
+    Adds an image (raw, compressed or chunked) to the store and writes its
+    manifest to 'output'. bytes_written is what the store grew by,
+    bytes_skipped the bytes found in the store already (or zeros).
+    Errors are reported in the returned progress record.
+    """
+    progress = progress or DeployProgress(source, output)
+    store = store or ChunkStore()
+    workers = workers or min(8, os.cpu_count() or 1)
+    progress.update(method=f"import, content-defined chunks x {workers} threads")
+    lock = threading.Lock()
+    seen = set()
+
+    def store_chunk(data: bytes) -> str | None:
+        length = len(data)
+        if data.count(0) == length:
+            with lock:
+                progress.bytes_skipped += length
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        with lock:
+            duplicate = digest in seen
+            seen.add(digest)
+        added = 0 if duplicate else store.put(digest, data)
+        with lock:
+            if added:
+                progress.bytes_written += added
+            else:
+                progress.bytes_skipped += length
+        return digest
+
+    try:
+        chunks = []
+        pending = collections.deque()
+        end = 0
+        chunker = Chunker()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk-store") as pool:
+            def drain(limit: int) -> None:
+                while len(pending) > limit:
+                    offset, length, future = pending.popleft()
+                    chunks.append([offset, length, future.result()])
+                    progress.update(bytes_done=progress.bytes_done + length)
+
+            for offset, data in iter_image(source, progress):
+                end = max(end, offset + len(data))
+                for chunk_offset, chunk in chunker.feed(offset, data):
+                    pending.append((chunk_offset, len(chunk), pool.submit(store_chunk, chunk)))
+                drain(2 * workers)
+            for chunk_offset, chunk in chunker.flush():
+                pending.append((chunk_offset, len(chunk), pool.submit(store_chunk, chunk)))
+            drain(0)
+
+        size = max(progress.total, end)
+        manifest = {"version": 1, "source": os.path.abspath(source), "size": size,
+                    "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "chunking": {"block": CDC_BLOCK, "min": MIN_CHUNK, "max": MAX_CHUNK, "mask": CUT_MASK},
+                    "chunks": chunks}
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(manifest, f)
+        eviction = store.evict(pinned=seen)
+        progress.update(total=size, method=f"import, {len(chunks)} chunks, {len(seen)} distinct"
+                                            + (f", {eviction.chunks} unused chunks evicted "
+                                               f"({eviction.bytes / 1e6:,.0f} MB)" if eviction.chunks else "")
+                                            + (f", store {eviction.over_bytes / 1e6:,.0f} MB over its limit "
+                                               f"(held by {len(eviction.held_by)} manifests)"
+                                               if eviction.over_bytes else ""))
+        progress.finish()
+    except (OSError, EOFError, zlib.error, DeployError) as e:
+        progress.finish(str(e))
+    except Exception as e:  # Anything else (a broken pool, a bug) must still end the run, or the UI waits forever
+        progress.finish(f"unexpected error: {type(e).__name__}: {e}")
+    return progress
+
+
+def deploy_manifest(path: str, target_path: str, progress: DeployProgress | None = None,
+                    store: ChunkStore | None = None, workers: int | None = None) -> DeployProgress:
+    """
+    Writes a stored image to a partition, LV or file. Each chunk's range on
+    the target is hashed first; only chunks that differ are read from the
+    store and written. bytes_in counts the bytes read from the store.
+    """
+    progress = progress or DeployProgress(path, target_path, delta=True)
+    progress.update(delta=True)
+    store = store or ChunkStore()
+    workers = workers or min(8, os.cpu_count() or 1)
+    target = None
+    lock = threading.Lock()
+    missing = []
+
+    def account(done: int, written: int = 0, skipped: int = 0, read: int = 0) -> None:
+        with lock:
+            progress.bytes_written += written
+            progress.bytes_skipped += skipped
+            progress.update(bytes_done=progress.bytes_done + done, bytes_in=progress.bytes_in + read)
+
+    def place(entry: list) -> None:
+        offset, length, digest = entry
+        current = os.pread(target.fd, length, offset)
+        if len(current) == length:
+            if digest is None and current.count(0) == length:
+                account(length, skipped=length)
+                return
+            if digest is not None and hashlib.sha256(current).hexdigest() == digest:
+                account(length, skipped=length)
+                return
+        if digest is None:
+            if target.zero(offset, length):
+                account(length, skipped=length)
+            else:
+                target.write(bytes(length), offset)
+                account(length, written=length)
+            return
+        try:
+            data, stored = store.get(digest)
+        except ChunkMissing:
+            with lock:
+                missing.append(digest)
+            account(length)
+            return
+        target.write(data, offset)
+        account(length, written=length, read=stored)
+
+    try:
+        manifest = load_manifest(path)
+        size = manifest["size"]
+        absent = missing_chunks(manifest, store)
+        if absent:
+            # Refuse before the target is opened: a partial image is worse than the old content
+            raise ChunkMissing(f"{absent} chunks of {path} are no longer in the store; import the image again")
+        target = Target(target_path, readable=True)
+        target.check_room(size)
+        progress.update(total=size, source_size=size,
+                        method=f"chunk store, {len(manifest['chunks'])} chunks x {workers} threads")
+        store.touch({entry[2] for entry in manifest["chunks"] if entry[2]})
+
+        position = 0
+        for entry in sorted(manifest["chunks"]):
+            if entry[0] > position:
+                # Not part of the image (unallocated in a captured image): clear it only where that is cheap
+                target.zero(position, entry[0] - position)
+                account(entry[0] - position, skipped=entry[0] - position)
+            position = entry[0] + entry[1]
+        if size > position:
+            target.zero(position, size - position)
+            account(size - position, skipped=size - position)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk-deploy") as pool:
+            for future in [pool.submit(place, entry) for entry in manifest["chunks"]]:
+                future.result()
+        target.finish(size)
+        if missing:
+            raise ChunkMissing(f"{len(set(missing))} chunks disappeared from the store during the deploy; "
+                               "the target is incomplete. Import the image again.")
+        progress.finish()
+    except (OSError, zlib.error, DeployError) as e:
+        progress.finish(str(e))
+    except Exception as e:  # Anything else (a broken pool, a bug) must still end the run, or the UI waits forever
+        progress.finish(f"unexpected error: {type(e).__name__}: {e}")
+    finally:
+        if target is not None:
+            target.close()
+    return progress
+
+
+def start_import(source: str, output: str) -> DeployProgress:
+    """Starts importing an image into the store in the background."""
+    progress = DeployProgress(source, output)
+    threading.Thread(target=import_image, args=(source, output, progress), daemon=True).start()
+    return progress
+
+
+def start_deploy(path: str, target: str) -> DeployProgress:
+    """Starts deploying a stored image; targets this process cannot write are written via sudo."""
+    progress = DeployProgress(path, target, delta=True)
+    if os.access(target, os.R_OK | os.W_OK) or not os.path.exists(target):
+        worker = threading.Thread(target=deploy_manifest, args=(path, target, progress), daemon=True)
+    else:
+        worker = threading.Thread(target=run_module_as_root,
+                                  args=(progress, "utils.chunk_store",
+                                        ["--store", os.path.abspath(STORE_DIR), "deploy",
+                                         os.path.abspath(path), target]), daemon=True)
+    worker.start()
+    return progress
+
+
+def format_progress(progress: DeployProgress) -> list[str]:
+    """Returns the lines of an import or deploy progress display."""
+    bar_width = 40
+    filled = int(bar_width * progress.fraction)
+    importing = not progress.delta
+    lines = [
+        f"{'Image:   ' if importing else 'Manifest:'} {progress.source}",
+        f"{'Manifest:' if importing else 'Target:  '} {progress.target}",
+        f"Method:   {progress.method or 'starting'}",
+        "",
+        f"[{'#' * filled}{'.' * (bar_width - filled)}] {progress.fraction * 100:5.1f}%",
+        f"{progress.bytes_done / 1e6:,.0f} MB processed in {progress.elapsed:.1f}s, "
+        f"{progress.rate_mbs:,.1f} MB/s sustained",
+    ]
+    if importing:
+        lines.append(f"{progress.bytes_written / 1e6:,.0f} MB added to the store, "
+                     f"{progress.bytes_skipped / 1e6:,.0f} MB already stored or zeros")
+    else:
+        lines.append(f"{progress.bytes_written / 1e6:,.0f} MB written ({progress.bytes_in / 1e6:,.0f} MB read "
+                     f"from the store), {progress.bytes_skipped / 1e6:,.0f} MB identical on the target skipped")
+    if progress.state == "failed":
+        lines += ["", f"FAILED: {progress.error}"]
+    elif progress.state == "done":
+        lines += ["", "Done."]
+    return lines
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Store images as deduplicated chunks and deploy them.")
+    parser.add_argument("--json-progress", action="store_true", help="print progress as JSON lines")
+    parser.add_argument("--store", default=STORE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("import", help="add an image to the store and write its manifest")
+    command.add_argument("source")
+    command.add_argument("manifest")
+    command = commands.add_parser("deploy", help="write a stored image to a device")
+    command.add_argument("manifest")
+    command.add_argument("target")
+    command = commands.add_parser("status", help="show store usage and evict down to a new limit")
+    command.add_argument("--max-bytes", type=int, default=None)
+    args = parser.parse_args()
+    store = ChunkStore(args.store)
+
+    if args.command == "status":
+        if args.max_bytes is not None:
+            store.set_max_bytes(args.max_bytes)
+            eviction = store.evict()
+            if eviction.over_bytes:
+                print(f"Still {eviction.over_bytes / 1e6:,.0f} MB over the limit; the rest is used by:")
+                print("\n".join(f"  {path}" for path in eviction.held_by))
+        usage = store.usage()
+        print(f"{usage.chunks} chunks, {usage.bytes / 1e6:,.0f} of {usage.max_bytes / 1e6:,.0f} MB")
+        return
+
+    if args.command == "import":
+        progress = DeployProgress(args.source, args.manifest)
+        work, work_args = import_image, (args.source, args.manifest, progress, store)
+    else:
+        progress = DeployProgress(args.manifest, args.target, delta=True)
+        work, work_args = deploy_manifest, (args.manifest, args.target, progress, store)
+    worker = threading.Thread(target=work, args=work_args, daemon=True)
+    worker.start()
+    while worker.is_alive():
+        progress.changed.wait(0.5)
+        progress.changed.clear()
+        if args.json_progress:
+            print(json.dumps(progress.to_dict() | {"state": "running"}), flush=True)
+    if args.json_progress:
+        print(json.dumps(progress.to_dict()), flush=True)
+    else:
+        print("\n".join(format_progress(progress)))
+    sys.exit(0 if progress.state == "done" else 1)
+
+
+if __name__ == "__main__":
+    main()
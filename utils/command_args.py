@@ -0,0 +1,46 @@
+import os
+
+# Argument parsing shared by the plan executor, reconcile mode and the
+# privileged helper: all three need the tool and the positional arguments
+# (devices, VG and mapper names) of the commands the installer generates.
+# Standard library only, so it can ship in a remote install bundle.
+
+# Options of cryptsetup/LVM commands that take a separate value argument
+VALUE_OPTIONS = frozenset({
+    "-L", "-l", "-n", "-i", "-I", "-m", "-s", "-c", "-h", "-S", "--type", "--key-file", "--cipher",
+    "--key-size", "--hash", "--sector-size", "--pbkdf", "--pbkdf-memory", "--pbkdf-parallel",
+    "--iter-time", "--key-slot", "--stripes", "--stripesize", "--physicalextentsize", "--config",
+    "--reportformat", "--label", "--name", "--size", "--extents",
+})
+
+
+def strip_sudo(argv: list[str]) -> list[str]:
+    return argv[1:] if argv and argv[0] == "sudo" else argv
+
+
+def tool_args(argv: list[str]) -> tuple[str, list[str]]:
+    """Returns the tool's base name and its arguments ('sudo' left out)."""
+    args = strip_sudo(argv)
+    return (os.path.basename(args[0]), args[1:]) if args else ("", [])
+
+
+def positionals(args: list[str], value_options=VALUE_OPTIONS) -> list[str]:
+    """Returns the non-option arguments, skipping the values of 'value_options'."""
+    found = []
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+        elif arg in value_options:
+            skip_next = True
+        elif not arg.startswith("-"):
+            found.append(arg)
+    return found
+
+
+def option_value(args: list[str], *names: str) -> str | None:
+    """Returns the value following the first of 'names' in 'args', or None."""
+    for index, arg in enumerate(args[:-1]):
+        if arg in names:
+            return args[index + 1]
+    return None
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+from dataclasses import dataclass
+
+from .extents import read_io_geometry
+
+# Picks LUKS2 parameters for this host instead of cryptsetup's defaults.
+# 'cryptsetup benchmark' is run once per CPU (keyed by model name and flags)
+# and cached; the fastest acceptable cipher, a 4096-byte encryption sector
+# where the partition allows it and argon2id cost limits that keep unlock
+# time and memory bounded are derived from it.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "os_installer")
+CACHE_FILE = "crypt_benchmark.json"
+
+# Modes considered safe for disk encryption; CBC/ECB rows are ignored
+_ACCEPTABLE = re.compile(r"-(xts|adiantum)")
+# A larger key is preferred if it costs less than this fraction of speed
+_KEY_SIZE_TOLERANCE = 0.15
+# Below this, AES has no hardware support and Adiantum is the better choice
+_SLOW_AES_MIBS = 300.0
+
+UNLOCK_TIME_MS = 1000
+MAX_PBKDF_MEMORY_KIB = 1048576
+MIN_PBKDF_MEMORY_KIB = 65536
+
+_CIPHER_ROW = re.compile(r"^\s*(\S+)\s+(\d+)b\s+([\d.]+)\s+(\w)iB/s\s+([\d.]+)\s+(\w)iB/s")
+_PBKDF_ROW = re.compile(r"^(argon2i|argon2id)\s+(\d+) iterations, (\d+) memory, (\d+) parallel")
+_UNIT_FACTOR = {"K": 1 / 1024, "M": 1, "G": 1024}
+
+
+@dataclass
+class LuksParams:
+    cipher: str = "aes-xts-plain64"
+    key_size: int = 512
+    sector_size: int = 512
+    pbkdf: str = "argon2id"
+    iter_time_ms: int = UNLOCK_TIME_MS
+    memory_kib: int = MAX_PBKDF_MEMORY_KIB
+    parallel: int = 4
+    throughput_mibs: float = 0.0   # Benchmarked speed (slower direction) of the cipher, 0 if unknown
+
+    def args(self) -> list[str]:
+        """Returns the luksFormat options for these parameters."""
+        return ["--type", "luks2", "--cipher", self.cipher, "--key-size", str(self.key_size),
+                "--sector-size", str(self.sector_size), "--pbkdf", self.pbkdf,
+                "--iter-time", str(self.iter_time_ms), "--pbkdf-memory", str(self.memory_kib),
+                "--pbkdf-parallel", str(self.parallel)]
+
+    def describe(self) -> str:
+        speed = f", ~{self.throughput_mibs:.0f} MiB/s" if self.throughput_mibs else ""
+        return (f"{self.cipher} {self.key_size}-bit{speed}, {self.sector_size}-byte sectors, "
+                f"{self.pbkdf} {self.iter_time_ms} ms / {self.memory_kib // 1024} MiB / {self.parallel} threads")
+
+
+def parse_benchmark(output: str) -> dict:
+    """
+    Parses 'cryptsetup benchmark' output into
+    {'ciphers': [{'cipher', 'key_bits', 'encrypt', 'decrypt'}], 'argon2id': {...}}
+    with speeds in MiB/s.
+    """
+    result = {"ciphers": [], "argon2id": None}
+    for line in output.splitlines():
+        match = _CIPHER_ROW.match(line)
+        if match:
+            name, bits, enc, enc_unit, dec, dec_unit = match.groups()
+            result["ciphers"].append({
+                "cipher": name, "key_bits": int(bits),
+                "encrypt": float(enc) * _UNIT_FACTOR.get(enc_unit, 1),
+                "decrypt": float(dec) * _UNIT_FACTOR.get(dec_unit, 1),
+            })
+            continue
+        match = _PBKDF_ROW.match(line.strip())
+        if match and match.group(1) == "argon2id":
+            result["argon2id"] = {"iterations": int(match.group(2)), "memory_kib": int(match.group(3)),
+                                  "parallel": int(match.group(4))}
+    return result
+
+
+def cpu_key(cpuinfo_path: str = "/proc/cpuinfo") -> str:
+    """Returns a key for this CPU: a hash of its model name and feature flags."""
+    model, flags = "", ""
+    try:
+        with open(cpuinfo_path) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "model name" and not model:
+                    model = value.strip()
+                elif key in ("flags", "Features") and not flags:
+                    flags = " ".join(sorted(value.split()))
+    except OSError:
+        pass
+    return hashlib.sha256(f"{model}|{flags}".encode()).hexdigest()[:16]
+
+
+def _load_cache() -> dict:
+    try:
+        with open(os.path.join(CACHE_DIR, CACHE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache: dict) -> None:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, CACHE_FILE), "w") as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        print(f"Warning: could not save the cipher benchmark: {e}", file=sys.stderr)
+
+
+def get_benchmark(refresh: bool = False) -> dict | None:
+    """Returns this CPU's parsed benchmark, running 'cryptsetup benchmark' only if it is not cached."""
+    key = cpu_key()
+    cache = _load_cache()
+    if key in cache and not refresh:
+        return cache[key]
+    print("Benchmarking ciphers on this CPU (done once and cached)...")
+    try:
+        result = subprocess.run(["cryptsetup", "benchmark"], capture_output=True, text=True, check=True)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        print(f"Error running cryptsetup benchmark: {e}", file=sys.stderr)
+        return None
+    benchmark = parse_benchmark(result.stdout)
+    if not benchmark["ciphers"]:
+        return None
+    cache[key] = benchmark
+    _save_cache(cache)
+    return benchmark
+
+
+def choose_cipher(ciphers: list[dict]) -> dict | None:
+    """
+    Picks the fastest acceptable cipher (by the slower of encryption and
+    decryption), preferring a larger key of the same cipher when it is
+    nearly as fast. Adiantum is only chosen when AES is slow (no AES-NI).
+    """
+    candidates = [c for c in ciphers if _ACCEPTABLE.search(c["cipher"])]
+
+    def speed(entry):
+        return min(entry["encrypt"], entry["decrypt"])
+
+    aes = [c for c in candidates if c["cipher"].startswith("aes-")]
+    if aes and max(speed(c) for c in aes) >= _SLOW_AES_MIBS:
+        candidates = [c for c in candidates if "adiantum" not in c["cipher"]]
+    if not candidates:
+        return None
+    best = max(candidates, key=speed)
+    same_cipher = [c for c in candidates if c["cipher"] == best["cipher"] and
+                   speed(c) >= speed(best) * (1 - _KEY_SIZE_TOLERANCE)]
+    return max(same_cipher, key=lambda c: c["key_bits"])
+
+
+def _read_int(path: str, default: int = 0) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def sector_size_for(device_path: str, sys_root: str = "/sys") -> int:
+    """
+    Returns 4096 if the partition can use 4096-byte encryption sectors
+    (4K logical blocks, or a start and size that are 4096-byte aligned),
+    otherwise 512.
+    """
+    geometry = read_io_geometry(device_path, sys_root)
+    if geometry["logical_block_size"] >= 4096:
+        return 4096
+    class_dir = os.path.join(sys_root, "class", "block", os.path.basename(os.path.realpath(device_path)))
+    start = _read_int(os.path.join(class_dir, "start"))
+    size = _read_int(os.path.join(class_dir, "size"))
+    if size and start % 8 == 0 and size % 8 == 0:
+        return 4096
+    return 512
+
+
+def mem_available_kib(meminfo_path: str = "/proc/meminfo") -> int:
+    """Returns MemAvailable in KiB, or 0 if it cannot be read."""
+    try:
+        with open(meminfo_path) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def pbkdf_memory_for(jobs: int = 1) -> int:
+    """Returns an argon2 memory cost so 'jobs' concurrent unlocks fit in half of the available memory."""
+    available = mem_available_kib()
+    if not available:
+        return MAX_PBKDF_MEMORY_KIB
+    per_job = available // 2 // max(1, jobs)
+    return max(MIN_PBKDF_MEMORY_KIB, min(MAX_PBKDF_MEMORY_KIB, per_job))
+
+
+def tune(device_path: str, jobs: int = 1, unlock_time_ms: int = UNLOCK_TIME_MS) -> LuksParams:
+    """
+    Returns LUKS2 parameters for a partition: the benchmark's best cipher,
+    the widest supported sector size and argon2id limits for 'jobs'
+    concurrent formats/unlocks. Falls back to cryptsetup's usual choice
+    (aes-xts-plain64, 512-bit key) if the benchmark is unavailable.
+    """
+    params = LuksParams(sector_size=sector_size_for(device_path), iter_time_ms=unlock_time_ms,
+                        memory_kib=pbkdf_memory_for(jobs), parallel=min(4, os.cpu_count() or 1))
+    benchmark = get_benchmark()
+    cipher = choose_cipher(benchmark["ciphers"]) if benchmark else None
+    if cipher:
+        # The benchmark lists cipher and mode only; LUKS needs the IV generator too
+        params.cipher = f"{cipher['cipher']}-plain64"
+        params.key_size = cipher["key_bits"]
+        params.throughput_mibs = min(cipher["encrypt"], cipher["decrypt"])
+    return params
@@ -0,0 +1,87 @@
+import copy
+import threading
+
+# Process-wide snapshot of the block device inventory.
+# The loader (normally lsblk) is only run when there is no valid snapshot.
+_lock = threading.RLock()
+_snapshot = None
+_generation = 0
+_stats = {"hits": 0, "misses": 0, "invalidations": 0, "patches": 0, "last_invalidation": ""}
+
+
+def get_snapshot(loader) -> dict | None:
+    """
+    Returns the cached device inventory, calling 'loader' only on a cache miss.
+    The returned dictionary is shared between all callers and must be treated
+    as read-only. A failed load (None) is not cached.
+    """
+    global _snapshot
+    with _lock:
+        if _snapshot is not None:
+            _stats["hits"] += 1
+            return _snapshot
+
+        _stats["misses"] += 1
+        data = loader()
+        if data is not None:
+            _snapshot = data
+        return data
+
+
+def invalidate(reason: str = "") -> int:
+    """
+    Drops the cached inventory so the next lookup reloads it.
+    Must be called after every step that changes the block devices
+    (parted, cryptsetup, pvcreate, ...). 'reason' is kept as the last
+    invalidation in the stats. Returns the new generation.
+    """
+    global _snapshot, _generation
+    with _lock:
+        _snapshot = None
+        _generation += 1
+        _stats["invalidations"] += 1
+        _stats["last_invalidation"] = reason
+        return _generation
+
+
+def patch(updater):
+    """
+    Updates the cached inventory by calling 'updater(snapshot)' on a copy
+    under the cache lock. If it reports a change the copy replaces the
+    snapshot and the generation is bumped; readers holding the old snapshot
+    are never modified under their feet. Used by the hotplug watcher so a
+    single new or removed device does not require reloading everything.
+    Returns the updater's result, or None if there is no snapshot to patch.
+    """
+    global _snapshot, _generation
+    with _lock:
+        if _snapshot is None:
+            return None
+        updated = copy.deepcopy(_snapshot)
+        result = updater(updated)
+        if result:
+            _snapshot = updated
+            _generation += 1
+            _stats["patches"] += 1
+        return result
+
+
+def generation() -> int:
+    """
+    Returns the current generation counter. Callers can store it together
+    with data they derived from the inventory and compare later to see if
+    that data is stale.
+    """
+    with _lock:
+        return _generation
+
+
+def is_stale(seen_generation: int) -> bool:
+    """Returns True if the inventory has changed since 'seen_generation'."""
+    return seen_generation != generation()
+
+
+def get_stats() -> dict:
+    """Returns a copy of the hit/miss/invalidation counters and the last invalidation's reason."""
+    with _lock:
+        return dict(_stats, generation=_generation, cached=_snapshot is not None)
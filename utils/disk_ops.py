@@ -1,9 +1,53 @@
+import os
 import subprocess
 import json
 import sys
 from . import ui # Import the ui module to use its functions
+from . import device_cache
+from . import sysfs_devices
+from . import partition_table
+from . import privileged_helper
 
-def get_disk_info() -> dict | None:
+# Which backend builds the device tree: "sysfs" (no fork, falls back to
+# lsblk on failure) or "lsblk". Can be overridden with OS_INSTALLER_DISK_BACKEND.
+DISK_INFO_BACKENDS = ("sysfs", "lsblk")
+disk_info_backend = os.environ.get("OS_INSTALLER_DISK_BACKEND", "sysfs")
+
+def get_disk_info(refresh: bool = False) -> dict | None:
+    """
+    Returns information about all block devices from the process-wide
+    device cache. lsblk is only run when the cache is empty or 'refresh' is set.
+    The returned dictionary is shared and must not be modified.
+    """
+    if refresh:
+        device_cache.invalidate("refresh requested")
+    return device_cache.get_snapshot(_load_disk_info)
+
+def invalidate_disk_info(reason: str = "") -> int:
+    """
+    Marks the cached device information as stale. Call this after every
+    command that changes partitions, LUKS mappings or LVM volumes.
+    """
+    return device_cache.invalidate(reason)
+
+def set_disk_info_backend(backend: str) -> None:
+    """Selects the device tree backend at runtime and drops the cached tree."""
+    global disk_info_backend
+    if backend not in DISK_INFO_BACKENDS:
+        raise ValueError(f"Unknown disk info backend '{backend}', expected one of {DISK_INFO_BACKENDS}")
+    disk_info_backend = backend
+    device_cache.invalidate(f"backend changed to {backend}")
+
+def _load_disk_info() -> dict | None:
+    """Builds the device tree with the selected backend, falling back to lsblk."""
+    if disk_info_backend == "sysfs":
+        data = sysfs_devices.read_block_devices()
+        if data is not None:
+            return data
+        print("Falling back to lsblk for disk info.", file=sys.stderr)
+    return _load_disk_info_lsblk()
+
+def _load_disk_info_lsblk() -> dict | None:
     """
     Runs the 'lsblk' command to retrieve information about all block devices.
     Uses the --json flag to get structured and reliable output.
@@ -51,9 +95,11 @@ def select_disk_device_curses(stdscr, prompt: str="Please select a device:") ->
         return menu_values[selected_value]
     return None
 
-def select_partition_device(prompt: str="Please select a partition:") -> str | None:
+def select_partition_device(prompt: str="Please select a partition:", include=None, annotate=None) -> str | None:
     """
     Displays a menu with partitions and lets the user select one.
+    'include(partition)' can limit the list (it gets the device record),
+    'annotate(path)' can add a description to each entry.
     Returns the selected partition path (e.g. /dev/sda1).
     """
     disk_data = get_disk_info()
@@ -64,7 +110,8 @@ def select_partition_device(prompt: str="Please select a partition:") -> str | N
     for device in disk_data['blockdevices']:
         if device.get('type') == 'disk' and 'children' in device:
             for partition in device['children']:
-                available_partitions.append(partition)
+                if include is None or include(partition):
+                    available_partitions.append(partition)
 
     if not available_partitions:
         print("No partitions found.")
@@ -73,6 +120,11 @@ def select_partition_device(prompt: str="Please select a partition:") -> str | N
     partition_menu_options = {
         str(i + 1): f"/dev/{part['name']} ({part['size']})" for i, part in enumerate(available_partitions)
     }
+    if annotate is not None:
+        for key, label in partition_menu_options.items():
+            note = annotate(label.split()[0])
+            if note:
+                partition_menu_options[key] = f"{label} - {note}"
     cancel_option = str(len(partition_menu_options) + 1)
     partition_menu_options[cancel_option] = "Cancel"
 
@@ -89,44 +141,111 @@ def select_partition_device(prompt: str="Please select a partition:") -> str | N
         else:
             print(f'"{choice}" is not a valid option. Please try again.')
 
-def inspect_device(device_path: str) -> bool:
+def select_multiple_partitions(prompt: str="Select partitions to use.") -> list:
+    """
+    Allows the user to select one or more partitions from a list.
+    Returns a list of selected partition paths.
+    """
+    selected_partitions = []
+    print(f"\n{prompt}")
+
+    while True:
+        # Use the existing function to display the menu and get a selection
+        # We adapt the prompt to show what is already selected
+        current_selection_str = f" (Selected: {', '.join(selected_partitions)})" if selected_partitions else ""
+        device = select_partition_device(f"Select a partition to add{current_selection_str}.\nChoose 'Cancel' when you are done.")
+
+        if not device:  # The user chose 'Cancel', which means they are done
+            break
+
+        if device in selected_partitions:
+            print(f"{device} is already selected. Please choose another.")
+        else:
+            selected_partitions.append(device)
+            print(f"Added {device}.")
+
+    return selected_partitions
+
+def read_partition_map(device_path: str) -> partition_table.PartitionMap | None:
+    """
+    Reads the partition table natively. Returns None if the device could not
+    be read, including when this process lacks permission to open it.
+    """
+    try:
+        return partition_table.read_partition_map(device_path)
+    except PermissionError:
+        return None
+
+def describe_partitions(device_path: str) -> list[str] | None:
     """
-    Runs 'sudo parted ... print free' to show detailed partition information.
+    Returns a text description of the partitions and free space on a device.
+    Uses the native partition table reader and only falls back to
+    'sudo parted print free' when the device is not readable by this process.
     """
+    pmap = read_partition_map(device_path)
+    if pmap is not None:
+        return partition_table.format_partition_map(pmap)
+
     command = ["sudo", "parted", device_path, "print", "free"]
     try:
-        # We need to end curses temporarily to run the command and see its output
-        import curses
-        curses.endwin()
-        print(f"\n--- Detailed information for {device_path} ---")
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        print(result.stdout)
-        print("-------------------------------------------------")
-        input("Press Enter to return...")
-        # The calling function will need to re-initialize the screen
-        return True, result.stdout.splitlines()
+        result = privileged_helper.run(command, check=True, capture_output=True, text=True)
+        return result.stdout.splitlines()
     except (FileNotFoundError, subprocess.CalledProcessError) as e:
         print(f"Error inspecting device: {e}", file=sys.stderr)
+        return None
+
+def inspect_device(device_path: str) -> tuple[bool, list[str]]:
+    """
+    Shows detailed partition information (partitions and free space).
+    """
+    import curses
+    try:
+        # We need to end curses temporarily to show the output
+        curses.endwin()
+    except curses.error:
+        pass  # Not running under curses
+    print(f"\n--- Detailed information for {device_path} ---")
+    lines = describe_partitions(device_path)
+    if lines is None:
         input("Press Enter to return...")
         return False, []
+    print("\n".join(lines))
+    print("-------------------------------------------------")
+    input("Press Enter to return...")
+    # The calling function will need to re-initialize the screen
+    return True, lines
 
-def get_free_space_info(device_path: str) -> str | None:
+def get_largest_free_extent(device_path: str) -> partition_table.FreeExtent | None:
     """
-    Uses parted in machine-readable mode to find the start sector of free space.
-    Returns the start sector as a string (e.g. '12345s') or None on error.
+    Returns the largest free extent (at least 1 MiB) on the device, in sectors.
+    Falls back to parsing 'parted --machine print free' when the device is
+    not readable by this process.
     """
+    pmap = read_partition_map(device_path)
+    if pmap is not None:
+        return pmap.largest_free(min_sectors=(1024 * 1024) // pmap.sector_size)
+
     command = ["sudo", "parted", "--script", device_path, "--machine", "unit", "s", "print", "free"]
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        lines = result.stdout.strip().split('\n')
-        # The last line describing a "partition" is the free space
-        free_space_line = lines[-1]
-
-        if free_space_line:
-            parts = free_space_line.split(':')
-            # parts[1] is the start sector, already with unit 's'
-            return parts[1]
-        return None
-    except (subprocess.CalledProcessError, IndexError) as e:
+        result = privileged_helper.run(command, check=True, capture_output=True, text=True)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
         print(f"Error parsing free space for {device_path}: {e}", file=sys.stderr)
         return None
+
+    # Free regions look like '1:2048s:20479s:18432s:free;' and can be on any line
+    extents = []
+    for line in result.stdout.splitlines():
+        parts = line.rstrip(';').split(':')
+        if len(parts) >= 5 and parts[4] == "free":
+            extents.append(partition_table.FreeExtent(int(parts[1].rstrip('s')), int(parts[2].rstrip('s'))))
+    return max(extents, key=lambda extent: extent.sectors, default=None)
+
+def get_free_space_info(device_path: str) -> str | None:
+    """
+    Finds the start sector of the largest free region on the device.
+    Returns the start sector as a string (e.g. '12345s') or None on error.
+    """
+    extent = get_largest_free_extent(device_path)
+    if extent is None:
+        return None
+    return f"{extent.start}s"
@@ -0,0 +1,194 @@
+import bisect
+import math
+import os
+
+from . import partition_table
+
+# Free-space index for one disk: a sorted list of free sector intervals that
+# hands out partition ranges aligned to the device's I/O geometry.
+
+MIB = 1024 * 1024
+GIB = 1024 * MIB
+# Never align to more than this, even if a device reports a larger optimal I/O size
+_MAX_GRAIN = 64 * MIB
+
+STRATEGIES = ("best", "first")
+
+
+def _read_int(path: str, default: int = 0) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def read_io_geometry(device_path: str, sys_root: str = "/sys") -> dict:
+    """
+    Reads the I/O geometry of a block device from sysfs:
+    logical/physical block size, minimum and optimal I/O size and the
+    alignment offset. Image files and unknown devices get 512-byte defaults.
+    """
+    kname = os.path.basename(os.path.realpath(device_path))
+    class_dir = os.path.join(sys_root, "class", "block", kname)
+    queue_dir = os.path.join(class_dir, "queue")
+    if not os.path.isdir(queue_dir):
+        # Partitions have no queue directory of their own; use the parent disk's
+        queue_dir = os.path.join(os.path.dirname(os.path.realpath(class_dir)), "queue")
+
+    logical = _read_int(os.path.join(queue_dir, "logical_block_size"), 512) or 512
+    physical = _read_int(os.path.join(queue_dir, "physical_block_size"), logical) or logical
+    return {
+        "logical_block_size": logical,
+        "physical_block_size": physical,
+        "minimum_io_size": _read_int(os.path.join(queue_dir, "minimum_io_size"), physical),
+        "optimal_io_size": _read_int(os.path.join(queue_dir, "optimal_io_size")),
+        "alignment_offset": _read_int(os.path.join(class_dir, "alignment_offset")),
+    }
+
+
+def alignment_grain(geometry: dict, sector_size: int) -> tuple[int, int]:
+    """
+    Returns (grain, offset) in sectors. Partition starts are placed on
+    'offset + n * grain'. The grain is 1 MiB combined with the physical block
+    size and the optimal I/O size (RAID stripe width), as long as the latter
+    is sane (a multiple of the physical block size, at most 64 MiB).
+    """
+    grain = math.lcm(MIB, geometry["physical_block_size"])
+    optimal = geometry["optimal_io_size"]
+    if optimal and optimal % geometry["physical_block_size"] == 0 and math.lcm(grain, optimal) <= _MAX_GRAIN:
+        grain = math.lcm(grain, optimal)
+    offset = geometry["alignment_offset"] // sector_size
+    return grain // sector_size, offset
+
+
+class FreeExtentIndex:
+    """
+    Sorted, non-overlapping free intervals (inclusive sector ranges) of one
+    disk, with aligned first-fit/best-fit allocation.
+    """
+
+    def __init__(self, extents: list[tuple[int, int]], grain: int = 2048, offset: int = 0,
+                 sector_size: int = 512):
+        self.sector_size = sector_size
+        self.grain = max(1, grain)
+        self.offset = offset % self.grain
+        self._starts = []
+        self._ends = []
+        for start, end in sorted(extents):
+            self.add(start, end)
+
+    @classmethod
+    def for_device(cls, device_path: str, pmap: partition_table.PartitionMap | None = None,
+                   sys_root: str = "/sys") -> 'FreeExtentIndex | None':
+        """Builds the index from the device's partition map and sysfs geometry."""
+        if pmap is None:
+            try:
+                pmap = partition_table.read_partition_map(device_path)
+            except PermissionError:
+                return None
+        if pmap is None:
+            return None
+        grain, offset = alignment_grain(read_io_geometry(device_path, sys_root), pmap.sector_size)
+        return cls([(extent.start, extent.end) for extent in pmap.free], grain, offset, pmap.sector_size)
+
+    def extents(self) -> list[tuple[int, int]]:
+        """Returns the free intervals as (start, end) pairs, sorted by start."""
+        return list(zip(self._starts, self._ends))
+
+    def add(self, start: int, end: int) -> None:
+        """Marks an interval as free, merging it with adjacent free intervals."""
+        if end < start:
+            return
+        i = bisect.bisect_left(self._starts, start)
+        if i > 0 and self._ends[i - 1] >= start - 1:
+            i -= 1
+            start = self._starts[i]
+            end = max(end, self._ends[i])
+            del self._starts[i], self._ends[i]
+        while i < len(self._starts) and self._starts[i] <= end + 1:
+            end = max(end, self._ends[i])
+            del self._starts[i], self._ends[i]
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+
+    def _align_up(self, sector: int) -> int:
+        return sector + (self.offset - sector) % self.grain
+
+    def usable(self, start: int, end: int) -> tuple[int, int] | None:
+        """Returns the aligned part of an interval that can hold a partition."""
+        aligned = self._align_up(start)
+        return (aligned, end) if aligned <= end else None
+
+    def largest(self) -> int:
+        """Returns the size in sectors of the largest allocatable (aligned) region."""
+        sizes = []
+        for start, end in self.extents():
+            usable = self.usable(start, end)
+            if usable:
+                sizes.append(usable[1] - usable[0] + 1)
+        return max(sizes, default=0)
+
+    def allocate(self, sectors: int, strategy: str = "best") -> tuple[int, int] | None:
+        """
+        Reserves 'sectors' sectors starting on an aligned boundary.
+        The size is rounded up to whole grains when that still fits, so the
+        next partition also starts aligned. 'best' picks the smallest free
+        region that fits, 'first' the lowest one. Returns (start, end) or None.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown allocation strategy '{strategy}', expected one of {STRATEGIES}")
+        if sectors <= 0:
+            return None
+
+        choice = None
+        for start, end in self.extents():
+            usable = self.usable(start, end)
+            if usable is None or usable[1] - usable[0] + 1 < sectors:
+                continue
+            if strategy == "first":
+                choice = usable
+                break
+            if choice is None or usable[1] - usable[0] < choice[1] - choice[0]:
+                choice = usable
+        if choice is None:
+            return None
+
+        start = choice[0]
+        rounded = -(-sectors // self.grain) * self.grain
+        end = start + (rounded if start + rounded - 1 <= choice[1] else sectors) - 1
+        self.reserve(start, end)
+        return start, end
+
+    def allocate_all(self, strategy: str = "best") -> tuple[int, int] | None:
+        """Reserves the whole largest aligned free region ('100% of free space')."""
+        return self.allocate(self.largest(), strategy)
+
+    def reserve(self, start: int, end: int) -> None:
+        """Removes an interval from the free space, splitting extents as needed."""
+        i = bisect.bisect_right(self._starts, end)
+        while i > 0 and self._ends[i - 1] >= start:
+            i -= 1
+            old_start, old_end = self._starts[i], self._ends[i]
+            del self._starts[i], self._ends[i]
+            if old_end > end:
+                self._starts.insert(i, end + 1)
+                self._ends.insert(i, old_end)
+            if old_start < start:
+                self._starts.insert(i, old_start)
+                self._ends.insert(i, start - 1)
+
+
+def size_to_sectors(amount: float, unit: str, index: FreeExtentIndex) -> int:
+    """
+    Converts a size in 'MiB', 'GiB' or '%' to sectors of the indexed disk.
+    Percentages are of the largest aligned free region, since a partition
+    must be contiguous.
+    """
+    if unit == "MiB":
+        return int(amount * MIB) // index.sector_size
+    if unit == "GiB":
+        return int(amount * GIB) // index.sector_size
+    if unit == "%":
+        return int(index.largest() * amount / 100)
+    raise ValueError(f"Unknown size unit '{unit}'")
@@ -0,0 +1,364 @@
+import json
+import os
+import re
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+
+from . import plan, remote
+
+# Fleet installs: one template onto many machines at once. Every host is a
+# remote install (see utils.remote: one bundle, one multiplexed connection)
+# on a bounded worker pool, with its own timeout and a number of retries
+# with growing delays. Only attempts that failed before the agent started
+# running the plan (connection, sudo, upload) are retried: a plan that
+# stopped halfway has changed the disks, and running it again with every
+# operation forced could re-create what succeeded (mklabel, luksFormat) and
+# lose whatever a later step wrote there. The per-operation timings the
+# agents stream back are collected into one table, so a slow disk or a
+# flaky host stands out.
+#
+# The inventory is JSON:
+#
+#   {"defaults": {"timeout": 1800, "retries": 1, "sudo": true, "map": {"/dev/sdb": "/dev/nvme0n1"}},
+#    "hosts": [{"name": "r1-01", "address": "root@10.0.0.11"},
+#              {"name": "r1-02", "address": "root@10.0.0.12:2222", "map": {"/dev/sdb": "/dev/sda"}},
+#              {"name": "sim-1", "simulate": true}]}
+#
+# or plain text, one "user@host[:port] [/dev/local=/dev/remote ...]" per
+# line. A simulated host gets a loop device (backed by a sparse file) for
+# every disk the template uses and runs the bundle through LocalTransport,
+# so a fleet run can be rehearsed on one machine (needs root for losetup).
+# Simulated hosts share this machine's kernel, so the volume groups and
+# device-mapper names their plans create get the host's name as a suffix
+# (vg0 -> vg0_sim1), and whatever the plan stacked on the loop devices
+# (LVs, LUKS mappings) is deactivated before they are detached.
+
+DEFAULT_PARALLEL = 8
+DEFAULT_TIMEOUT = 30 * 60
+DEFAULT_RETRIES = 1
+RETRY_DELAY = 5.0
+SIMULATED_DISK_SIZE = 1024 ** 3
+
+
+@dataclass
+class Host:
+    name: str
+    address: str = ""
+    port: int | None = None
+    identity: str | None = None
+    mapping: dict[str, str] = field(default_factory=dict)
+    sudo: bool = True
+    timeout: float = DEFAULT_TIMEOUT
+    retries: int = DEFAULT_RETRIES
+    simulate: bool = False
+    disk_size: int = SIMULATED_DISK_SIZE
+
+
+@dataclass
+class HostResult:
+    name: str
+    address: str
+    ok: bool = False
+    attempts: int = 0
+    elapsed: float = 0.0
+    remote_host: str = ""
+    error: str = ""
+    results: list[dict] = field(default_factory=list)   # Operations of the last attempt
+    errors: list[str] = field(default_factory=list)     # One per failed attempt
+
+
+def _host_from_dict(entry: dict, defaults: dict) -> Host:
+    values = defaults | entry
+    address, port = remote.parse_destination(values.get("address", ""))
+    return Host(name=values.get("name") or address or "host", address=address, port=values.get("port", port),
+                identity=values.get("identity"), mapping=dict(defaults.get("map", {})) | entry.get("map", {}),
+                sudo=values.get("sudo", not values.get("simulate", False)),
+                timeout=values.get("timeout", DEFAULT_TIMEOUT), retries=values.get("retries", DEFAULT_RETRIES), simulate=values.get("simulate", False),
+                disk_size=values.get("disk_size", SIMULATED_DISK_SIZE))
+
+
+def load_inventory(path: str) -> list[Host]:
+    """Reads a JSON or plain-text inventory. Raises ValueError if it is malformed."""
+    with open(path) as f:
+        text = f.read()
+    if path.endswith(".json"):
+        data = json.loads(text)
+        defaults = data.get("defaults", {})
+        hosts = [_host_from_dict(entry, defaults) for entry in data.get("hosts", [])]
+    else:
+        hosts = []
+        for line in text.splitlines():
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            mapping = dict(entry.split("=", 1) for entry in fields[1:] if "=" in entry)
+            hosts.append(_host_from_dict({"address": fields[0], "map": mapping}, {}))
+    names = [host.name for host in hosts]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"duplicate host names in the inventory: {', '.join(duplicates)}")
+    return hosts
+
+
+def simulated_hosts(count: int, disk_size: int = SIMULATED_DISK_SIZE) -> list[Host]:
+    return [Host(name=f"sim-{index + 1}", simulate=True, sudo=False, disk_size=disk_size) for index in range(count)]
+
+
+class _LoopDisks:
+    """Sparse files attached as loop devices, standing in for a simulated host's disks."""
+
+    def __init__(self, host: str, devices: list[str], size: int):
+        self.directory = tempfile.mkdtemp(prefix=f"os_installer-{host}-")
+        self.loops = []
+        self.mapping = {}
+        try:
+            for index, device in enumerate(devices):
+                backing = os.path.join(self.directory, f"disk{index}.img")
+                with open(backing, "wb") as f:
+                    f.truncate(size)
+                completed = subprocess.run(["losetup", "--find", "--show", "--partscan", backing],
+                                           capture_output=True, text=True, check=True)
+                loop = completed.stdout.strip()
+                self.loops.append(loop)
+                self.mapping[device] = loop
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.close()
+            raise remote.RemoteError(f"cannot set up loop devices: {getattr(e, 'stderr', '') or e}".strip())
+
+    def close(self) -> None:
+        for loop in self.loops:
+            release_stack(os.path.basename(loop))
+            subprocess.run(["losetup", "--detach", loop], capture_output=True)
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+
+def _list_dir(path: str) -> list[str]:
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def _read_attr(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def device_stack(kname: str, sys_root: str = "/sys") -> list[str]:
+    """Kernel names of the devices stacked on a disk and its partitions (holders), topmost first."""
+    found = []
+    base = os.path.join(sys_root, "class", "block", kname)
+    for name in [kname] + [entry for entry in _list_dir(base) if entry.startswith(kname)]:
+        for holder in _list_dir(os.path.join(sys_root, "class", "block", name, "holders")):
+            for device in device_stack(holder, sys_root) + [holder]:
+                if device not in found:
+                    found.append(device)
+    return found
+
+
+def release_stack(kname: str, sys_root: str = "/sys") -> None:
+    """
+    Deactivates what a plan left on a simulated disk, top down: volume
+    groups with 'vgchange -an', LUKS mappings with 'cryptsetup close',
+    other device-mapper devices with 'dmsetup remove'.
+    """
+    done = set()
+    for device in device_stack(kname, sys_root):
+        dm_dir = os.path.join(sys_root, "class", "block", device, "dm")
+        name, uuid = _read_attr(os.path.join(dm_dir, "name")), _read_attr(os.path.join(dm_dir, "uuid"))
+        if not name:
+            continue
+        if uuid.startswith("LVM-"):
+            # dm name is <vg>-<lv> with any '-' inside the names doubled
+            vg = re.match(r"((?:[^-]|--)+)-", name)
+            command = ["vgchange", "-an", vg.group(1).replace("--", "-")] if vg else ["dmsetup", "remove", name]
+        elif uuid.startswith("CRYPT-"):
+            command = ["cryptsetup", "close", name]
+        else:
+            command = ["dmsetup", "remove", name]
+        if tuple(command) in done:
+            continue
+        done.add(tuple(command))
+        try:
+            subprocess.run(command, capture_output=True)
+        except OSError:
+            pass    # Tool not installed: nothing of its kind can be active either
+
+
+def install_host(host: Host, template_dir: str, workers: int = 4, dry_run: bool = False,
+                 progress=None) -> HostResult:
+    """
+    Installs the template on one host, retrying attempts that failed before
+    the agent started the plan after RETRY_DELAY, 2 x RETRY_DELAY, ...
+    seconds. 'progress(host, event)' gets every event the agent streams
+    back. Never raises.
+    """
+    result = HostResult(host.name, host.address or "simulated")
+    started = time.monotonic()
+    for attempt in range(host.retries + 1):
+        if attempt:
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+        result.attempts = attempt + 1
+        disks = None
+        try:
+            names = None
+            if host.simulate:
+                operations = plan.load_plan(template_dir)
+                disks = _LoopDisks(host.name, remote.plan_devices(operations), host.disk_size)
+                transport, mapping = remote.LocalTransport(host.name), disks.mapping
+                names = remote.namespace_names(operations, re.sub(r"\W", "", host.name))
+            else:
+                transport, mapping = remote.SSHTransport(host.address, host.port, host.identity), host.mapping
+        except remote.RemoteError as e:
+            result.errors.append(str(e))
+            continue
+        try:
+            outcome = remote.install(transport, template_dir, mapping, host.sudo, workers, dry_run,
+                                     (lambda event: progress(host, event)) if progress else None, host.timeout,
+                                     names)
+        finally:
+            transport.close()
+            if disks is not None:
+                disks.close()
+        result.results, result.remote_host = outcome.results, outcome.remote_host
+        if outcome.ok:
+            result.ok = True
+            break
+        result.errors.append(outcome.error)
+        if not outcome.bundle_bytes:
+            break   # The template itself could not be shipped; retrying will not help
+        if outcome.started and not dry_run:
+            result.errors[-1] += " (not retried: the plan had started on the target, check it before re-running)"
+            break
+    result.error = "" if result.ok else (result.errors[-1] if result.errors else "not attempted")
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def install_fleet(hosts: list[Host], template_dir: str, parallel: int = DEFAULT_PARALLEL, workers: int = 4,
+                  dry_run: bool = False, progress=None, on_host_done=None) -> list[HostResult]:
+    """
+    Installs the template on every host, at most 'parallel' at a time.
+    'on_host_done(result)' is called as each host finishes. Returns the
+    results in inventory order.
+    """
+    if not hosts:
+        return []
+
+    def run(host: Host) -> HostResult:
+        result = install_host(host, template_dir, workers, dry_run, progress)
+        if on_host_done:
+            on_host_done(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(parallel, len(hosts)), thread_name_prefix="fleet") as pool:
+        return list(pool.map(run, hosts))
+
+
+def summary_table(results: list[HostResult]) -> list[str]:
+    """
+    One row per host with the time of every operation (S1, S2, ... in plan
+    order, listed below the table), then the median of each column.
+    """
+    steps = []
+    for result in results:
+        for op in result.results:
+            if op["id"] not in steps:
+                steps.append(op["id"])
+    labels = [f"S{index + 1}" for index in range(len(steps))]
+    name_width = max([4] + [len(result.name) for result in results])
+    header = f"{'Host':<{name_width}}  {'Status':<6}  {'Try':>3}  {'Total':>7}  " \
+             + "  ".join(f"{label:>7}" for label in labels)
+    lines = [header, "-" * len(header)]
+    columns = {step: [] for step in steps}
+    for result in results:
+        by_id = {op["id"]: op for op in result.results}
+        cells = []
+        for step in steps:
+            op = by_id.get(step)
+            if op is None:
+                cells.append(f"{'-':>7}")
+            elif op["status"] in ("failed", "blocked"):
+                cells.append(f"{op['status'][:6].upper():>7}")
+            else:
+                cells.append(f"{op['elapsed']:7.2f}")
+                columns[step].append(op["elapsed"])
+        lines.append(f"{result.name:<{name_width}}  {'OK' if result.ok else 'FAIL':<6}  {result.attempts:>3}  "
+                     f"{result.elapsed:7.1f}  " + "  ".join(cells))
+    lines.append("-" * len(header))
+    medians = [f"{statistics.median(columns[step]):7.2f}" if columns[step] else f"{'-':>7}" for step in steps]
+    lines.append(f"{'median':<{name_width}}  {'':<6}  {'':>3}  "
+                 f"{statistics.median([r.elapsed for r in results]) if results else 0:7.1f}  " + "  ".join(medians))
+    lines.append("")
+    lines += [f"{label}: {step}" for label, step in zip(labels, steps)]
+    failed = [result for result in results if not result.ok]
+    if failed:
+        lines.append("")
+        lines += [f"{result.name}: {result.error}" for result in failed]
+    lines.append("")
+    lines.append(f"{len(results) - len(failed)} of {len(results)} host(s) installed.")
+    return lines
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Install one template on many machines at once.")
+    parser.add_argument("template_dir")
+    parser.add_argument("inventory", nargs="?", help="JSON or text inventory of hosts")
+    parser.add_argument("--simulate", type=int, default=0, metavar="N",
+                        help="add N simulated hosts backed by loop devices")
+    parser.add_argument("--disk-size", type=int, default=SIMULATED_DISK_SIZE, help="bytes per simulated disk")
+    parser.add_argument("--parallel", type=int, default=DEFAULT_PARALLEL, help="hosts installed at the same time")
+    parser.add_argument("--workers", type=int, default=4, help="parallel operations on each host")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds per attempt (overrides the inventory)")
+    parser.add_argument("--retries", type=int, default=None, help="retries per host (overrides the inventory)")
+    parser.add_argument("--dry-run", action="store_true", help="ship the plan to every host, run nothing")
+    parser.add_argument("--report", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    hosts = load_inventory(args.inventory) if args.inventory else []
+    hosts += simulated_hosts(args.simulate, args.disk_size)
+    if not hosts:
+        parser.error("no hosts: give an inventory or --simulate N")
+    for host in hosts:
+        if args.timeout is not None:
+            host.timeout = args.timeout
+        if args.retries is not None:
+            host.retries = args.retries
+
+    print_lock = threading.Lock()
+
+    def progress(host: Host, event: dict) -> None:
+        if event.get("event") == "op":
+            with print_lock:
+                print(f"{host.name:<12} {event['status']:<10} {event['id']:<28} {event['elapsed']:6.2f}s "
+                      f"{event['error']}", flush=True)
+
+    def host_done(result: HostResult) -> None:
+        with print_lock:
+            print(f"{result.name:<12} {'finished' if result.ok else 'FAILED':<10} after {result.attempts} "
+                  f"attempt(s), {result.elapsed:.1f}s {result.error}", flush=True)
+
+    results = install_fleet(hosts, args.template_dir, args.parallel, args.workers, args.dry_run, progress, host_done)
+    print()
+    print("\n".join(summary_table(results)))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+    sys.exit(0 if all(result.ok for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import os
+import struct
+
+from . import signatures
+
+# Which byte ranges of a filesystem hold data. For ext2/3/4 the block
+# bitmaps are read straight from the device; groups whose bitmap was never
+# initialised (BLOCK_UNINIT) only count their superblock backup, descriptor
+# tables and whatever bitmaps and inode tables live in them. Other
+# filesystems are reported as fully used.
+
+_EXT_SUPERBLOCK = 1024
+_EXT_MAGIC = 0xEF53
+_EXT_INCOMPAT_64BIT = 0x80
+_EXT_INCOMPAT_META_BG = 0x10
+_EXT_RO_COMPAT_SPARSE_SUPER = 0x1
+_EXT_BG_BLOCK_UNINIT = 0x2
+
+
+def merge_ranges(ranges, gap: int = 0) -> list[tuple[int, int]]:
+    """Merges (offset, length) ranges, joining ranges less than 'gap' bytes apart."""
+    merged = []
+    for start, length in sorted(ranges):
+        end = start + length
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end - start) for start, end in merged]
+
+
+def _bit_runs(bitmap: bytes, count: int):
+    """Yields (first, number) runs of set bits among the first 'count' bits (little-endian bit order)."""
+    run_start = None
+    index = 0
+    for byte_index, byte in enumerate(bitmap):
+        base = byte_index * 8
+        if base >= count:
+            break
+        if byte == 0xFF and run_start is not None:
+            continue
+        if byte == 0 and run_start is None:
+            continue
+        for bit in range(8):
+            index = base + bit
+            if index >= count:
+                break
+            if byte >> bit & 1:
+                if run_start is None:
+                    run_start = index
+            elif run_start is not None:
+                yield run_start, index - run_start
+                run_start = None
+    if run_start is not None:
+        yield run_start, min(count, len(bitmap) * 8) - run_start
+
+
+def _has_super_backup(group: int, sparse: bool) -> bool:
+    if group <= 1 or not sparse:
+        return True
+    for base in (3, 5, 7):
+        value = base
+        while value < group:
+            value *= base
+        if value == group:
+            return True
+    return False
+
+
+def ext_used_ranges(f, offset: int = 0) -> list[tuple[int, int]] | None:
+    """
+    Returns the used byte ranges of an ext2/3/4 filesystem starting at
+    'offset' in the open file 'f', relative to that offset. Returns None if
+    there is no ext superblock there or the layout is not understood.
+    """
+    f.seek(offset + _EXT_SUPERBLOCK)
+    sb = f.read(1024)
+    if len(sb) < 1024 or struct.unpack_from("<H", sb, 0x38)[0] != _EXT_MAGIC:
+        return None
+    inodes_per_group = struct.unpack_from("<I", sb, 0x28)[0]
+    blocks_lo, first_data_block, log_block_size = struct.unpack_from("<I", sb, 0x4)[0], \
+        struct.unpack_from("<I", sb, 0x14)[0], struct.unpack_from("<I", sb, 0x18)[0]
+    blocks_per_group = struct.unpack_from("<I", sb, 0x20)[0]
+    incompat, ro_compat = struct.unpack_from("<II", sb, 0x60)
+    inode_size = struct.unpack_from("<H", sb, 0x58)[0] or 128
+    reserved_gdt = struct.unpack_from("<H", sb, 0xCE)[0]
+    block_size = 1024 << log_block_size
+    is_64bit = bool(incompat & _EXT_INCOMPAT_64BIT)
+    desc_size = struct.unpack_from("<H", sb, 0xFE)[0] if is_64bit else 32
+    blocks = blocks_lo | (struct.unpack_from("<I", sb, 0x150)[0] << 32 if is_64bit else 0)
+    if not blocks_per_group or block_size > 65536 or desc_size < 32 or incompat & _EXT_INCOMPAT_META_BG:
+        return None
+    groups = (blocks - first_data_block + blocks_per_group - 1) // blocks_per_group
+    gdt_blocks = (groups * desc_size + block_size - 1) // block_size
+    inode_table_blocks = (inodes_per_group * inode_size + block_size - 1) // block_size
+    sparse = bool(ro_compat & _EXT_RO_COMPAT_SPARSE_SUPER)
+
+    f.seek(offset + (first_data_block + 1) * block_size)
+    table = f.read(groups * desc_size)
+    if len(table) < groups * desc_size:
+        return None
+
+    def field(raw: bytes, lo: int, hi: int) -> int:
+        value = struct.unpack_from("<I", raw, lo)[0]
+        if desc_size >= 64:
+            value |= struct.unpack_from("<I", raw, hi)[0] << 32
+        return value
+
+    descriptors = []
+    metadata = []       # (block, count) of bitmaps and inode tables, wherever they live
+    for group in range(groups):
+        raw = table[group * desc_size:(group + 1) * desc_size]
+        block_bitmap, inode_bitmap = field(raw, 0x0, 0x20), field(raw, 0x4, 0x24)
+        inode_table = field(raw, 0x8, 0x28)
+        flags = struct.unpack_from("<H", raw, 0x12)[0]
+        descriptors.append((block_bitmap, flags))
+        metadata += [(block_bitmap, 1), (inode_bitmap, 1), (inode_table, inode_table_blocks)]
+
+    used = []
+    for group, (block_bitmap, flags) in enumerate(descriptors):
+        group_start = first_data_block + group * blocks_per_group
+        group_blocks = min(blocks_per_group, blocks - group_start)
+        if flags & _EXT_BG_BLOCK_UNINIT:
+            if _has_super_backup(group, sparse):
+                used.append((group_start, 1 + gdt_blocks + reserved_gdt))
+            continue
+        f.seek(offset + block_bitmap * block_size)
+        bitmap = f.read(block_size)
+        for first, count in _bit_runs(bitmap, group_blocks):
+            used.append((group_start + first, count))
+    # Metadata of BLOCK_UNINIT groups is not in any bitmap; the boot block is never in one
+    used += metadata + [(0, first_data_block + 1)]
+    return merge_ranges((block * block_size, count * block_size) for block, count in used
+                        if block < blocks)
+
+
+def used_ranges(f, offset: int, length: int) -> tuple[list[tuple[int, int]], str]:
+    """
+    Returns the used ranges of the region [offset, offset + length) of an
+    open device (absolute offsets, clipped to the region) and a short
+    description of how they were found.
+    """
+    f.seek(offset)
+    head = f.read(signatures.PROBE_SIZE)
+    fstype = signatures.probe_bytes(head)
+    if fstype in ("ext2", "ext3", "ext4"):
+        try:
+            ranges = ext_used_ranges(f, offset)
+        except (OSError, struct.error):
+            ranges = None
+        if ranges is not None:
+            clipped = [(offset + start, min(count, length - start)) for start, count in ranges if start < length]
+            return clipped, f"{fstype} block bitmaps"
+    return [(offset, length)], fstype or "unknown content"
+
+
+def fd_size(f) -> int:
+    """Size of an open file or block device in bytes."""
+    return os.lseek(f.fileno(), 0, os.SEEK_END)
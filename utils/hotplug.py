@@ -0,0 +1,218 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+
+from . import device_cache
+from . import sysfs_devices
+
+# Listens for block device uevents and patches the cached device tree one
+# device at a time. The kernel's netlink uevent socket is used when
+# available; inside containers (no uevents) /dev is watched with inotify.
+# Where udev runs, its netlink group is joined instead of the kernel's:
+# udev re-broadcasts each event once it has created the device node and
+# stored its properties, while the kernel's event arrives before either
+# exists and the patched row would miss them.
+
+NETLINK_KOBJECT_UEVENT = 15
+_KERNEL_GROUP = 1
+_UDEV_GROUP = 2
+# Header of udev's netlink messages (see libudev-monitor.c): "libudev\0", a
+# big-endian magic, then the header size and the offset and length of the
+# NUL-separated properties in host byte order
+_UDEV_PREFIX = b"libudev\0"
+_UDEV_MAGIC = 0xFEEDCAFE
+_UDEV_HEADER = struct.Struct("=8sIIII")
+
+# inotify constants from <sys/inotify.h>
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_NONBLOCK = os.O_NONBLOCK
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def parse_uevent(message: bytes) -> dict:
+    """
+    Parses a kernel uevent ('add@/devices/...\\0ACTION=add\\0DEVNAME=sda1\\0...')
+    or a udev message (a libudev header, then the properties) into a
+    dictionary of its KEY=VALUE fields.
+    """
+    if message.startswith(_UDEV_PREFIX):
+        if len(message) < _UDEV_HEADER.size:
+            return {}
+        _, magic, _, offset, length = _UDEV_HEADER.unpack_from(message)
+        if socket.ntohl(magic) != _UDEV_MAGIC:
+            return {}
+        parts = message[offset:offset + length].split(b"\0")
+    else:
+        parts = message.split(b"\0")[1:]
+    fields = {}
+    for part in parts:
+        key, sep, value = part.partition(b"=")
+        if sep:
+            fields[key.decode(errors="replace")] = value.decode(errors="replace")
+    return fields
+
+
+class DeviceWatcher:
+    """
+    Background thread that keeps the device cache current. After each
+    processed event the knames of the changed rows are added to 'changed'
+    and 'wake' is set, so a curses loop can redraw just those rows.
+    """
+
+    def __init__(self, sys_root: str = "/sys", proc_root: str = "/proc",
+                 dev_root: str = "/dev", udev_root: str = "/run/udev"):
+        self.roots = dict(sys_root=sys_root, proc_root=proc_root, dev_root=dev_root, udev_root=udev_root)
+        self.wake = threading.Event()
+        self.source = None
+        self._changed = set()
+        self._changed_lock = threading.Lock()
+        self._stop_r, self._stop_w = os.pipe()
+        self._fd = None
+        self._sock = None
+        self._libc = None
+        self._thread = None
+
+    # --- Event sources ---
+
+    def _open_netlink(self) -> bool:
+        # udev's control socket exists while the daemon runs; without udev there is nothing to wait for
+        udev = os.path.exists(os.path.join(self.roots["udev_root"], "control"))
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, _UDEV_GROUP if udev else _KERNEL_GROUP))
+        except (OSError, AttributeError) as e:
+            print(f"Netlink uevents unavailable ({e}), falling back to inotify.", file=sys.stderr)
+            return False
+        self._sock = sock
+        self._fd = sock.fileno()
+        self.source = "netlink"
+        return True
+
+    def _open_inotify(self) -> bool:
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            return False
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK)
+        if fd < 0:
+            return False
+        if libc.inotify_add_watch(fd, self.roots["dev_root"].encode(), _IN_CREATE | _IN_DELETE) < 0:
+            os.close(fd)
+            return False
+        self._libc = libc
+        self._fd = fd
+        self.source = "inotify"
+        return True
+
+    def _read_events(self) -> list[tuple[str, str]]:
+        """Reads pending events from the active source as (action, kname) pairs."""
+        events = []
+        if self.source == "netlink":
+            message = self._sock.recv(16384)
+            fields = parse_uevent(message)
+            if fields.get("SUBSYSTEM") == "block" and fields.get("DEVNAME"):
+                events.append((fields.get("ACTION", "change"), os.path.basename(fields["DEVNAME"])))
+            return events
+
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + _INOTIFY_EVENT.size:offset + _INOTIFY_EVENT.size + length].rstrip(b"\0").decode()
+            offset += _INOTIFY_EVENT.size + length
+            if mask & _IN_CREATE and os.path.exists(os.path.join(self.roots["sys_root"], "class", "block", name)):
+                events.append(("add", name))
+            elif mask & _IN_DELETE:
+                events.append(("remove", name))
+        return events
+
+    # --- Thread control ---
+
+    def start(self) -> bool:
+        """Starts watching. Returns False if no event source could be opened."""
+        if not (self._open_netlink() or self._open_inotify()):
+            print("No hotplug event source available; device list will not auto-refresh.", file=sys.stderr)
+            return False
+        self._thread = threading.Thread(target=self._run, name="hotplug-watcher", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        """Stops the watcher thread and closes the event source."""
+        if self._thread is not None:
+            os.write(self._stop_w, b"x")
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+        elif self._fd is not None:
+            os.close(self._fd)
+        self._sock = self._fd = None
+
+    def _run(self) -> None:
+        while True:
+            readable, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in readable:
+                return
+            try:
+                events = self._read_events()
+            except OSError as e:
+                print(f"Error reading hotplug events: {e}", file=sys.stderr)
+                continue
+            for action, kname in events:
+                self.handle_event(action, kname)
+
+    def handle_event(self, action: str, kname: str) -> None:
+        """Patches the cached tree for one device event and wakes the UI."""
+        if action not in ("add", "remove", "change"):
+            return
+        changed = device_cache.patch(
+            lambda tree: sysfs_devices.patch_tree(tree, action, kname, **self.roots))
+        if changed:
+            with self._changed_lock:
+                self._changed.update(changed)
+            self.wake.set()
+
+    def take_changes(self) -> set[str]:
+        """Returns and clears the knames changed since the last call."""
+        with self._changed_lock:
+            changed, self._changed = self._changed, set()
+        self.wake.clear()
+        return changed
+
+
+# Module-level watcher shared by the curses application.
+_watcher = None
+
+
+def start_watcher() -> DeviceWatcher | None:
+    """Starts the shared watcher (once) and returns it, or None if unavailable."""
+    global _watcher
+    if _watcher is None:
+        watcher = DeviceWatcher()
+        if not watcher.start():
+            return None
+        _watcher = watcher
+    return _watcher
+
+
+def get_watcher() -> DeviceWatcher | None:
+    """Returns the shared watcher if it is running."""
+    return _watcher
+
+
+def stop_watcher() -> None:
+    """Stops the shared watcher."""
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
@@ -0,0 +1,302 @@
+import collections
+import errno
+import gzip
+import hashlib
+import json
+import lzma
+import multiprocessing
+import os
+import stat
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from . import fs_usage, partition_table
+from .image_deploy import DeployError, DeployProgress, run_module_as_root
+
+# Golden-image capture. A disk or LV is read in large chunks and each chunk
+# is compressed on its own (an independent gzip member or xz stream) in a
+# process pool, so capture is not limited to one core and deploy can
+# decompress chunks in parallel. Only allocated regions are read: space
+# outside the partitions and, for ext2/3/4, the blocks free in the
+# filesystem's bitmaps are left out.
+#
+# Layout of the image file:
+#
+#   MAGIC | chunk data ... | index (zlib-compressed JSON) | footer
+#
+# The footer (FOOTER_MAGIC, index offset, index length) sits at the end of
+# the file. Each index entry is [offset, length, file offset, compressed
+# length, sha256]; a compressed length of 0 marks a chunk of zeros. Ranges
+# not covered by any chunk were unallocated and hold nothing of value.
+#
+# A block device is opened exclusively (O_EXCL), which the kernel refuses
+# while it, a partition on it or a holder above it is mounted: an image of
+# a filesystem that changes during the capture would not be consistent.
+# Capture an LVM snapshot instead of a live LV.
+
+MAGIC = b"OSIMG001"
+FOOTER_MAGIC = b"OSIMGIDX"
+_FOOTER = struct.Struct("<8sQQ")
+
+CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESSION_LEVELS = {"gzip": 6, "xz": 3}
+# Unallocated gaps smaller than this are captured anyway to keep chunks large
+_MIN_GAP = 1024 * 1024
+
+
+def compress_chunk(data: bytes, compression: str, level: int) -> tuple[bytes | None, str]:
+    """Compresses one chunk (runs in a worker process). Returns (data or None for zeros, sha256)."""
+    digest = hashlib.sha256(data).hexdigest()
+    if data.count(0) == len(data):
+        return None, digest
+    if compression == "xz":
+        return lzma.compress(data, preset=level), digest
+    return gzip.compress(data, compresslevel=level, mtime=0), digest
+
+
+def decompress_chunk(data: bytes, compression: str) -> bytes:
+    if compression == "xz":
+        return lzma.decompress(data)
+    return gzip.decompress(data)
+
+
+def read_index(f) -> dict:
+    """Reads the chunk index of an open image file. Raises DeployError if it is not a chunked image."""
+    f.seek(0)
+    if f.read(len(MAGIC)) != MAGIC:
+        raise DeployError("not a chunked image")
+    f.seek(-_FOOTER.size, os.SEEK_END)
+    magic, offset, length = _FOOTER.unpack(f.read(_FOOTER.size))
+    if magic != FOOTER_MAGIC:
+        raise DeployError("chunk index footer missing (incomplete capture?)")
+    f.seek(offset)
+    try:
+        return json.loads(zlib.decompress(f.read(length)))
+    except (zlib.error, ValueError) as e:
+        raise DeployError(f"chunk index is damaged: {e}")
+
+
+def read_chunk(fd: int, entry: list, compression: str) -> bytes:
+    """Reads, decompresses and verifies one chunk of an image."""
+    offset, length, file_offset, compressed_length, digest = entry
+    if not compressed_length:
+        return bytes(length)
+    data = decompress_chunk(os.pread(fd, compressed_length, file_offset), compression)
+    if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+        raise DeployError(f"chunk at {offset} is corrupt")
+    return data
+
+
+def allocated_ranges(f, path: str, size: int) -> tuple[list[tuple[int, int]], list[str]]:
+    """
+    Returns the byte ranges of a device worth capturing and notes on how
+    each part was judged: everything except the partition table's free
+    extents, and inside ext partitions only the used blocks.
+    """
+    notes = []
+    try:
+        pmap = partition_table.read_partition_map(path)
+    except PermissionError:
+        pmap = None
+    if pmap is None or pmap.label is None:
+        ranges, how = fs_usage.used_ranges(f, 0, size)
+        notes.append(f"whole device: {how}")
+        return fs_usage.merge_ranges(ranges, _MIN_GAP), notes
+
+    sector = pmap.sector_size
+    ranges = []
+    cursor = 0
+    for extent in pmap.free:
+        if extent.start * sector > cursor:
+            ranges.append((cursor, extent.start * sector - cursor))
+        cursor = (extent.end + 1) * sector
+    if cursor < size:
+        ranges.append((cursor, size - cursor))
+
+    partitions = sorted((p for p in pmap.partitions if not (pmap.label == "msdos" and p.number > 4)),
+                        key=lambda p: p.start)
+    outside = ranges
+    ranges = []
+    for part in partitions:
+        start, length = part.start * sector, part.sectors * sector
+        if pmap.label == "msdos" and part.type_id in ("0x5", "0xf", "0x85"):
+            used, how = [(start, length)], "extended partition"
+        else:
+            used, how = fs_usage.used_ranges(f, start, length)
+        ranges += used
+        notes.append(f"partition {part.number}: {how}, {sum(n for _, n in used) * 100 // max(1, length)}% used")
+    # Keep the label, gaps that are not free extents and the backup GPT
+    for start, length in outside:
+        end = start + length
+        position = start
+        for part in partitions:
+            part_start, part_end = part.start * sector, (part.end + 1) * sector
+            if part_end <= position or part_start >= end:
+                continue
+            if part_start > position:
+                ranges.append((position, part_start - position))
+            position = max(position, part_end)
+        if position < end:
+            ranges.append((position, end - position))
+    # A partition table can claim more than the device holds (e.g. a truncated image)
+    ranges = [(start, min(length, size - start)) for start, length in ranges if start < size]
+    return fs_usage.merge_ranges(ranges, _MIN_GAP), notes
+
+
+def _chunks(ranges: list[tuple[int, int]], chunk_size: int):
+    for start, length in ranges:
+        for offset in range(start, start + length, chunk_size):
+            yield offset, min(chunk_size, start + length - offset)
+
+
+def _open_source(source: str):
+    """Opens the source read-only; block devices exclusively, so a mounted one is refused."""
+    exclusive = os.O_EXCL if stat.S_ISBLK(os.stat(source).st_mode) else 0
+    try:
+        fd = os.open(source, os.O_RDONLY | exclusive)
+    except OSError as e:
+        if e.errno == errno.EBUSY:
+            raise DeployError(f"{source} is in use (mounted, or held by LUKS/LVM/md); "
+                              "unmount it or capture a snapshot")
+        raise
+    return os.fdopen(fd, "rb", buffering=0)
+
+
+def capture(source: str, output: str, progress: DeployProgress | None = None, compression: str = "gzip",
+            workers: int | None = None, skip_unallocated: bool = True,
+            chunk_size: int = CHUNK_SIZE) -> DeployProgress:
+    """
+    Captures a disk, partition or LV into a chunked image. Returns the
+    finished progress record (bytes_written is the image size,
+    bytes_skipped the unallocated bytes); errors are reported in it.
+    """
+    progress = progress or DeployProgress(source, output)
+    level = COMPRESSION_LEVELS[compression]
+    workers = workers or os.cpu_count() or 1
+    try:
+        with _open_source(source) as f, open(output, "wb") as out:
+            size = fs_usage.fd_size(f)
+            if skip_unallocated:
+                ranges, notes = allocated_ranges(f, source, size)
+            else:
+                ranges, notes = [(0, size)], ["whole device (skipping disabled)"]
+            allocated = sum(length for _, length in ranges)
+            progress.update(method=f"capture, {compression} x {workers} processes", total=allocated,
+                            source_size=size, bytes_skipped=size - allocated)
+
+            out.write(MAGIC)
+            index = []
+            file_offset = len(MAGIC)
+            pending = collections.deque()
+            # forkserver: the installer has threads running, which a plain fork would copy mid-state
+            context = multiprocessing.get_context("forkserver")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                def drain(limit: int) -> None:
+                    nonlocal file_offset
+                    while len(pending) > limit:
+                        offset, length, future = pending.popleft()
+                        data, digest = future.result()
+                        if data is None:
+                            index.append([offset, length, 0, 0, digest])
+                        else:
+                            out.write(data)
+                            index.append([offset, length, file_offset, len(data), digest])
+                            file_offset += len(data)
+                        progress.update(bytes_done=progress.bytes_done + length, bytes_written=file_offset)
+
+                for offset, length in _chunks(ranges, chunk_size):
+                    data = os.pread(f.fileno(), length, offset)
+                    if len(data) != length:
+                        raise DeployError(f"short read at {offset}")
+                    progress.bytes_in = offset + length
+                    pending.append((offset, length, pool.submit(compress_chunk, data, compression, level)))
+                    drain(2 * workers)
+                drain(0)
+
+            meta = {"version": 1, "source": source, "size": size, "compression": compression,
+                    "chunk_size": chunk_size, "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "notes": notes, "chunks": index}
+            raw_index = zlib.compress(json.dumps(meta).encode())
+            out.write(raw_index)
+            out.write(_FOOTER.pack(FOOTER_MAGIC, file_offset, len(raw_index)))
+            progress.update(bytes_written=file_offset + len(raw_index) + _FOOTER.size)
+        owner = os.environ.get("SUDO_UID")
+        if os.geteuid() == 0 and owner:
+            # Captured via sudo: hand the image to the user who asked for it
+            os.chown(output, int(owner), int(os.environ.get("SUDO_GID", owner)))
+        progress.finish()
+    except (OSError, DeployError) as e:
+        progress.finish(str(e))
+    except Exception as e:  # Anything else (a broken pool, a bug) must still end the run, or the UI waits forever
+        progress.finish(f"unexpected error: {type(e).__name__}: {e}")
+    return progress
+
+
+def start_capture(source: str, output: str, compression: str = "gzip") -> DeployProgress:
+    """Starts a capture in the background; sources this process cannot read are captured via sudo."""
+    progress = DeployProgress(source, output)
+    if os.access(source, os.R_OK):
+        worker = threading.Thread(target=capture, args=(source, output, progress, compression), daemon=True)
+    else:
+        worker = threading.Thread(target=run_module_as_root,
+                                  args=(progress, "utils.image_capture", ["--compression", compression,
+                                                                          source, output]), daemon=True)
+    worker.start()
+    return progress
+
+
+def format_progress(progress: DeployProgress) -> list[str]:
+    """Returns the lines of a capture progress display."""
+    bar_width = 40
+    filled = int(bar_width * progress.fraction)
+    ratio = progress.bytes_written / progress.bytes_done if progress.bytes_done else 0.0
+    lines = [
+        f"Source:  {progress.source}",
+        f"Image:   {progress.target}",
+        f"Method:  {progress.method or 'scanning allocation'}",
+        "",
+        f"[{'#' * filled}{'.' * (bar_width - filled)}] {progress.fraction * 100:5.1f}%",
+        f"{progress.bytes_done / 1e6:,.0f} of {progress.total / 1e6:,.0f} MB allocated data read in "
+        f"{progress.elapsed:.1f}s, {progress.rate_mbs:,.1f} MB/s",
+        f"{progress.bytes_skipped / 1e6:,.0f} MB unallocated skipped, image {progress.bytes_written / 1e6:,.0f} MB "
+        f"({ratio:.0%} of the data read)",
+    ]
+    if progress.state == "failed":
+        lines += ["", f"FAILED: {progress.error}"]
+    elif progress.state == "done":
+        lines += ["", "Done."]
+    return lines
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Capture a disk or LV into a chunked, compressed image.")
+    parser.add_argument("--json-progress", action="store_true", help="print progress as JSON lines")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_LEVELS), default="gzip")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-skip", action="store_true", help="capture unallocated regions too")
+    parser.add_argument("source")
+    parser.add_argument("output")
+    args = parser.parse_args()
+    progress = DeployProgress(args.source, args.output)
+    worker = threading.Thread(target=capture, args=(args.source, args.output, progress, args.compression,
+                                                    args.workers, not args.no_skip), daemon=True)
+    worker.start()
+    while worker.is_alive():
+        progress.changed.wait(0.5)
+        progress.changed.clear()
+        if args.json_progress:
+            print(json.dumps(progress.to_dict() | {"state": "running"}), flush=True)
+    if args.json_progress:
+        print(json.dumps(progress.to_dict()), flush=True)
+    else:
+        print("\n".join(format_progress(progress)))
+    sys.exit(0 if progress.state == "done" else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,685 @@
+import bz2
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import gzip
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import queue
+import stat
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from . import privileged_helper
+
+# Image writer: lays a raw or compressed (gzip/xz/bz2) image of a root
+# filesystem onto a partition or LV. Compressed images are decompressed in
+# one thread into a small ring of page-aligned buffers while another thread
+# writes them out, so decompression and I/O overlap. Runs of zeros are not
+# written: on block devices they become BLKZEROOUT (offloaded/unmapped on
+# SSD and thin targets), on image files punched holes. Uncompressed images
+# are copied in the kernel with copy_file_range (or sendfile), only over
+# the source's data extents (SEEK_DATA/SEEK_HOLE).
+#
+# Delta mode re-images a target that already holds a similar filesystem:
+# the image and the target are compared block by block on a thread pool
+# (sha256 of both sides; hashlib releases the GIL) and only the blocks that
+# differ are written.
+
+BUFFER_SIZE = 4 * 1024 * 1024
+QUEUE_DEPTH = 4
+# Granularity of zero detection inside a buffer
+ZERO_GRAIN = 64 * 1024
+_ZEROS = bytes(ZERO_GRAIN)
+# Unit of comparison in delta mode
+DELTA_BLOCK = 256 * 1024
+
+BLKGETSIZE64 = 0x80081272
+BLKZEROOUT = 0x127F
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+
+COMPRESSION_MAGIC = [
+    ("gzip", b"\x1f\x8b"),
+    ("xz", b"\xfd7zXZ\x00"),
+    ("bz2", b"BZh"),
+]
+_OPENERS = {"gzip": gzip.open, "xz": lzma.open, "bz2": bz2.open}
+
+
+class DeployError(Exception):
+    """Raised when an image cannot be written to its target."""
+
+
+@dataclass
+class DeployProgress:
+    source: str
+    target: str
+    method: str = ""
+    source_size: int = 0        # Bytes of the (possibly compressed) image file
+    total: int = 0              # Bytes to write to the target, 0 if unknown until the end
+    bytes_in: int = 0           # Source bytes consumed
+    bytes_done: int = 0         # Image bytes processed (written or skipped)
+    bytes_written: int = 0
+    bytes_skipped: int = 0      # Zero runs unmapped instead of written; in delta mode, identical blocks
+    delta: bool = False
+    state: str = "running"      # running, done, failed
+    error: str = ""
+    started: float = field(default_factory=time.monotonic)
+    finished: float = 0.0
+    changed: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate_mbs(self) -> float:
+        """Sustained speed over the whole run, in MB/s of image data."""
+        return self.bytes_done / max(self.elapsed, 1e-6) / 1e6
+
+    @property
+    def fraction(self) -> float:
+        if self.total:
+            return min(1.0, self.bytes_done / self.total)
+        if self.source_size:
+            return min(1.0, self.bytes_in / self.source_size)
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in ("method", "source_size", "total", "bytes_in", "bytes_done",
+                                                    "bytes_written", "bytes_skipped", "delta", "state", "error")}
+
+    def update(self, **changes) -> None:
+        for key, value in changes.items():
+            setattr(self, key, value)
+        self.changed.set()
+
+    def finish(self, error: str = "") -> None:
+        self.update(state="failed" if error else "done", error=error, finished=time.monotonic())
+
+
+def detect_compression(path: str) -> str | None:
+    """
+    Returns 'gzip', 'xz' or 'bz2' from the file's magic bytes, 'chunked'
+    for an image made by utils.image_capture, or None for a raw image.
+    """
+    from .image_capture import MAGIC
+    with open(path, "rb") as f:
+        head = f.read(8)
+    if head == MAGIC:
+        return "chunked"
+    for name, magic in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _fd_size(fd: int) -> int:
+    st = os.fstat(fd)
+    if stat.S_ISBLK(st.st_mode):
+        buf = bytearray(8)
+        fcntl.ioctl(fd, BLKGETSIZE64, buf)
+        return int.from_bytes(buf, sys.byteorder)
+    return st.st_size
+
+
+_libc = None
+
+
+def _fallocate(fd: int, mode: int, offset: int, length: int) -> bool:
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    return _libc.fallocate(fd, mode, offset, length) == 0
+
+
+class Target:
+    """An open partition, LV or image file being written."""
+
+    def __init__(self, path: str, readable: bool = False):
+        self.path = path
+        flags = os.O_RDWR if readable else os.O_WRONLY
+        try:
+            # Block devices exclusively: a mounted or mapped target is refused, not overwritten under its users
+            flags |= os.O_EXCL if stat.S_ISBLK(os.stat(path).st_mode) else 0
+        except FileNotFoundError:
+            flags |= os.O_CREAT
+        try:
+            self.fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            if e.errno == errno.EBUSY:
+                raise DeployError(f"{path} is in use (mounted, or held by LUKS/LVM/md); unmount or close it first")
+            raise
+        st = os.fstat(self.fd)
+        self.is_block = stat.S_ISBLK(st.st_mode)
+        self.size = _fd_size(self.fd) if self.is_block else 0   # Files grow as needed
+        self.can_skip = self.is_block
+        if self.is_block:
+            kname = os.path.basename(os.path.realpath(path))
+            self.can_skip = _read_sysfs_int(kname, "write_zeroes_max_bytes") > 0
+
+    def check_room(self, end: int) -> None:
+        if self.is_block and end > self.size:
+            raise DeployError(f"image is larger than {self.path} ({self.size} bytes)")
+
+    def write(self, data, offset: int) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view, offset = view[written:], offset + written
+
+    def zero(self, offset: int, length: int) -> bool:
+        """
+        Makes a range read back as zeros without writing it: BLKZEROOUT on
+        devices with a write-zeroes offload, a punched hole in files.
+        Returns False (and does nothing) if that is not possible.
+        """
+        if length <= 0:
+            return True
+        self.check_room(offset + length)
+        if self.is_block:
+            if not self.can_skip:
+                return False
+            fcntl.ioctl(self.fd, BLKZEROOUT, offset.to_bytes(8, sys.byteorder) + length.to_bytes(8, sys.byteorder))
+            return True
+        size = os.fstat(self.fd).st_size
+        if offset >= size:
+            # Beyond the end of the file it is a hole already; extend it at the end
+            return True
+        return _fallocate(self.fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length)
+
+    def finish(self, length: int) -> None:
+        if not self.is_block and os.fstat(self.fd).st_size != length:
+            # Extends over a trailing hole, and cuts off what a longer previous image left behind
+            os.ftruncate(self.fd, length)
+        os.fsync(self.fd)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def _read_sysfs_int(kname: str, attribute: str) -> int:
+    for queue_dir in (f"/sys/class/block/{kname}/queue", f"/sys/class/block/{kname}/../queue"):
+        try:
+            with open(os.path.join(queue_dir, attribute)) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+    return 0
+
+
+class _ZeroRun:
+    """Collects adjacent zero ranges so they are unmapped with one call."""
+
+    def __init__(self, target: Target, progress: DeployProgress):
+        self.target = target
+        self.progress = progress
+        self.start = self.length = 0
+
+    def add(self, offset: int, length: int) -> None:
+        if self.length and self.start + self.length == offset:
+            self.length += length
+            return
+        self.flush()
+        self.start, self.length = offset, length
+
+    def flush(self) -> None:
+        if not self.length:
+            return
+        if self.target.zero(self.start, self.length):
+            self.progress.bytes_skipped += self.length
+        else:
+            for offset in range(self.start, self.start + self.length, ZERO_GRAIN):
+                length = min(ZERO_GRAIN, self.start + self.length - offset)
+                self.target.write(_ZEROS[:length], offset)
+            self.progress.bytes_written += self.length
+        self.length = 0
+
+
+def write_buffer(target: Target, zeros: _ZeroRun, buf, length: int, offset: int, progress: DeployProgress) -> None:
+    """Writes 'length' bytes of 'buf' at 'offset', turning zero grains into zero runs."""
+    target.check_room(offset + length)
+    data_start = None
+    for pos in range(0, length, ZERO_GRAIN):
+        piece = min(ZERO_GRAIN, length - pos)
+        if buf[pos:pos + piece] == _ZEROS[:piece]:
+            if data_start is not None:
+                target.write(memoryview(buf)[data_start:pos], offset + data_start)
+                progress.bytes_written += pos - data_start
+                data_start = None
+            zeros.add(offset + pos, piece)
+        elif data_start is None:
+            zeros.flush()
+            data_start = pos
+    if data_start is not None:
+        target.write(memoryview(buf)[data_start:length], offset + data_start)
+        progress.bytes_written += length - data_start
+
+
+def _pipeline(source, raw, progress: DeployProgress, handle) -> int:
+    """
+    Decompresses in a reader thread and hands each buffer to
+    'handle(buf, length, offset)' in this one. Buffers are page-aligned
+    anonymous mmaps passed back and forth over two queues; if 'handle'
+    returns futures, the buffer is reused only once they are done.
+    Returns the number of image bytes.
+    """
+    free = queue.Queue()
+    full = queue.Queue()
+    for _ in range(QUEUE_DEPTH):
+        free.put(mmap.mmap(-1, BUFFER_SIZE))
+    failure = []
+
+    def reader():
+        try:
+            while True:
+                buf = free.get()
+                if buf is None:
+                    return
+                length = source.readinto(buf)
+                progress.bytes_in = raw.tell()
+                full.put((buf, length))
+                if not length:
+                    return
+        except Exception as e:  # Reported by the writer side
+            failure.append(e)
+            full.put((None, 0))
+
+    thread = threading.Thread(target=reader, name="image-reader", daemon=True)
+    thread.start()
+    in_flight = collections.deque()
+    offset = 0
+    try:
+        while True:
+            buf, length = full.get()
+            if buf is None:
+                raise DeployError(f"cannot read the image: {failure[0]}")
+            if not length:
+                break
+            futures = handle(buf, length, offset) or []
+            offset += length
+            in_flight.append((buf, futures, offset))
+            # Keep one buffer free for the reader
+            while in_flight and (len(in_flight) >= QUEUE_DEPTH - 1 or all(f.done() for f in in_flight[0][1])):
+                done_buf, done_futures, done_offset = in_flight.popleft()
+                for future in done_futures:
+                    future.result()
+                progress.update(bytes_done=done_offset)
+                free.put(done_buf)
+        while in_flight:
+            _, done_futures, done_offset = in_flight.popleft()
+            for future in done_futures:
+                future.result()
+            progress.update(bytes_done=done_offset)
+    finally:
+        # Let the reader exit if the writer stopped early
+        free.put(None)
+    return offset
+
+
+class _DeltaWriter:
+    """Compares image blocks with the target on a thread pool and writes the ones that differ."""
+
+    def __init__(self, target: Target, progress: DeployProgress, pool: ThreadPoolExecutor,
+                 block_size: int = DELTA_BLOCK):
+        self.target = target
+        self.progress = progress
+        self.pool = pool
+        self.block_size = block_size
+        self._lock = threading.Lock()
+
+    def _block(self, data: memoryview, offset: int) -> None:
+        current = os.pread(self.target.fd, len(data), offset)
+        same = len(current) == len(data) and hashlib.sha256(current).digest() == hashlib.sha256(data).digest()
+        if not same:
+            self.target.write(data, offset)
+        with self._lock:
+            if same:
+                self.progress.bytes_skipped += len(data)
+            else:
+                self.progress.bytes_written += len(data)
+
+    def handle(self, buf, length: int, offset: int) -> list:
+        self.target.check_room(offset + length)
+        view = memoryview(buf)
+        return [self.pool.submit(self._block, view[pos:min(pos + self.block_size, length)], offset + pos)
+                for pos in range(0, length, self.block_size)]
+
+
+def _chunked_deploy(image, target: Target, progress: DeployProgress, delta: bool, workers: int) -> int:
+    """
+    Writes a chunked image with the chunks decompressed in parallel.
+    Unallocated gaps are zeroed only where that is cheap (Target.zero).
+    Returns the image's device size.
+    """
+    from .image_capture import read_index, read_chunk
+    index = read_index(image)
+    size, compression = index["size"], index["compression"]
+    target.check_room(size)
+    progress.update(total=size, method=f"chunked {compression}{', delta' if delta else ''} x {workers} threads")
+    lock = threading.Lock()
+
+    def account(done: int, written: int = 0, skipped: int = 0) -> None:
+        with lock:
+            progress.bytes_written += written
+            progress.bytes_skipped += skipped
+            progress.update(bytes_done=progress.bytes_done + done, bytes_in=progress.bytes_in + done)
+
+    def write_chunk(entry: list) -> None:
+        offset, length = entry[0], entry[1]
+        data = read_chunk(image.fileno(), entry, compression)
+        if delta:
+            current = os.pread(target.fd, length, offset)
+            if hashlib.sha256(current).hexdigest() == entry[4]:
+                account(length, skipped=length)
+                return
+        if not entry[3] and target.zero(offset, length):
+            account(length, skipped=length)
+            return
+        target.write(data, offset)
+        account(length, written=length)
+
+    position = 0
+    gaps = []
+    for entry in sorted(index["chunks"]):
+        if entry[0] > position:
+            gaps.append((position, entry[0] - position))
+        position = entry[0] + entry[1]
+    if size > position:
+        gaps.append((position, size - position))
+    for offset, length in gaps:
+        # Unallocated in the source: clear it if that is cheap, but never write zeros for it
+        target.zero(offset, length)
+        account(length, skipped=length)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk") as pool:
+        for future in [pool.submit(write_chunk, entry) for entry in index["chunks"]]:
+            future.result()
+    return size
+
+
+def _data_extents(fd: int, size: int):
+    """Yields (offset, length) of the data regions of a file; holes are left out."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return          # Only a hole is left
+            yield offset, size - offset     # No SEEK_DATA support: treat everything as data
+            return
+        try:
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError:
+            end = size
+        yield start, min(end, size) - start
+        offset = end
+
+
+def _kernel_copy(src_fd: int, target: Target, size: int, progress: DeployProgress) -> None:
+    """Copies a raw image with copy_file_range, falling back to sendfile and then to read/write."""
+    method = "copy_file_range"
+    zeros = _ZeroRun(target, progress)
+    position = 0
+    for start, length in _data_extents(src_fd, size):
+        if start > position:
+            zeros.add(position, start - position)
+        zeros.flush()
+        offset, end = start, start + length
+        while offset < end:
+            count = min(64 * BUFFER_SIZE, end - offset)
+            try:
+                if method == "copy_file_range":
+                    copied = os.copy_file_range(src_fd, target.fd, count, offset, offset)
+                elif method == "sendfile":
+                    os.lseek(target.fd, offset, os.SEEK_SET)
+                    copied = os.sendfile(target.fd, src_fd, offset, count)
+                else:
+                    data = os.pread(src_fd, min(count, BUFFER_SIZE), offset)
+                    write_buffer(target, zeros, data, len(data), offset, progress)
+                    zeros.flush()
+                    copied = len(data)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                method = "sendfile" if method == "copy_file_range" else "read/write"
+                progress.update(method=method)
+                continue
+            if copied == 0:
+                raise DeployError(f"unexpected end of the image at byte {offset}")
+            offset += copied
+            if method != "read/write":     # write_buffer counts its own bytes
+                progress.bytes_written += copied
+            progress.update(bytes_in=offset, bytes_done=offset)
+        position = end
+    if size > position:
+        zeros.add(position, size - position)
+    zeros.flush()
+    progress.update(bytes_in=size, bytes_done=size)
+
+
+def deploy(source: str, target_path: str, progress: DeployProgress | None = None,
+           delta: bool = False, workers: int | None = None) -> DeployProgress:
+    """
+    Writes an image to a partition, LV or file and returns the progress
+    record, finished. With 'delta', only blocks that differ from what the
+    target already holds are written. Errors are reported in the record
+    (state 'failed'), not raised.
+    """
+    progress = progress or DeployProgress(source, target_path)
+    progress.update(delta=delta)
+    target = None
+    try:
+        compression = detect_compression(source)
+        with open(source, "rb", buffering=0) as raw:
+            progress.update(source_size=_fd_size(raw.fileno()))
+            target = Target(target_path, readable=delta)
+            workers = workers or min(8, os.cpu_count() or 1)
+            if compression == "chunked":
+                length = _chunked_deploy(raw, target, progress, delta, workers)
+            elif delta:
+                progress.update(method=f"delta ({compression or 'raw'})")
+                if compression is None:
+                    progress.update(total=progress.source_size)
+                    target.check_room(progress.total)
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="delta") as pool, \
+                        (_OPENERS[compression](raw) if compression else open(source, "rb")) as stream:
+                    writer = _DeltaWriter(target, progress, pool)
+                    length = _pipeline(stream, raw if compression else stream, progress, writer.handle)
+                progress.update(total=length)
+            elif compression is None:
+                progress.update(total=progress.source_size, method="copy_file_range")
+                target.check_room(progress.total)
+                _kernel_copy(raw.fileno(), target, progress.total, progress)
+                length = progress.total
+            else:
+                progress.update(method=f"{compression} pipeline")
+                zeros = _ZeroRun(target, progress)
+
+                def write(buf, length, offset):
+                    write_buffer(target, zeros, buf, length, offset, progress)
+
+                with _OPENERS[compression](raw) as decompressed:
+                    length = _pipeline(decompressed, raw, progress, write)
+                zeros.flush()
+                progress.update(total=length)
+            target.finish(length)
+        progress.finish()
+    except (OSError, EOFError, lzma.LZMAError, zlib.error, DeployError) as e:
+        progress.finish(str(e))
+    except Exception as e:  # Anything else (a broken pool, a bug) must still end the run, or the UI waits forever
+        progress.finish(f"unexpected error: {type(e).__name__}: {e}")
+    finally:
+        if target is not None:
+            target.close()
+    return progress
+
+
+def iter_image(path: str, progress: DeployProgress | None = None):
+    """
+    Yields (offset, data) pieces of an image's content in order, for any
+    format deploy() accepts. Chunked images leave out their unallocated
+    gaps, so consecutive pieces are not always contiguous. The image's size
+    is set as the progress total where it is known up front.
+    """
+    compression = detect_compression(path)
+    with open(path, "rb", buffering=0) as raw:
+        size = _fd_size(raw.fileno())
+        if progress is not None:
+            progress.update(source_size=size)
+        if compression == "chunked":
+            from .image_capture import read_index, read_chunk
+            index = read_index(raw)
+            if progress is not None:
+                progress.update(total=index["size"])
+            for entry in sorted(index["chunks"]):
+                data = read_chunk(raw.fileno(), entry, index["compression"])
+                if progress is not None:
+                    progress.update(bytes_in=entry[2] + entry[3])
+                yield entry[0], data
+            return
+        if compression is None and progress is not None:
+            progress.update(total=size)
+        stream = _OPENERS[compression](raw) if compression else raw
+        try:
+            offset = 0
+            while data := stream.read(BUFFER_SIZE):
+                if progress is not None:
+                    progress.update(bytes_in=raw.tell())
+                yield offset, data
+                offset += len(data)
+        finally:
+            stream.close()
+
+
+def _run_with_sudo(module: str, args: list[str], on_line) -> tuple[int, str]:
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(["sudo", "-n", sys.executable, "-m", module, "--json-progress", *args],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                               cwd=package_root)
+    # Read stderr as it comes, or a child that writes a lot of it blocks on a full pipe
+    stderr = []
+    drain = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    drain.start()
+    try:
+        for line in process.stdout:
+            on_line(line)
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.wait()
+        drain.join()
+    return process.returncode, "".join(stderr)
+
+
+def run_module_as_root(progress: DeployProgress, module: str, args: list[str]) -> None:
+    """
+    Runs 'python -m <module> --json-progress <args>' as root and follows its
+    JSON progress lines into 'progress'. The job goes to the privileged
+    helper when it runs (see privileged_helper.request_job), otherwise it
+    runs under 'sudo -n': the installer has already cached the sudo
+    credentials, so this does not prompt.
+    """
+    def follow(line: str) -> None:
+        try:
+            update = json.loads(line)
+        except ValueError:
+            return
+        state = update.pop("state", "running")
+        progress.update(**update)
+        if state != "running":
+            progress.finish(update.get("error", ""))
+
+    try:
+        result = privileged_helper.request_job(module, args, follow)
+        if result is None:
+            result = _run_with_sudo(module, args, follow)
+    except OSError as e:
+        progress.finish(f"cannot run sudo: {e}")
+        return
+    except Exception as e:  # An unexpected line or a lost helper must not leave the UI waiting forever
+        progress.finish(f"unexpected error: {type(e).__name__}: {e}")
+        return
+    returncode, stderr = result
+    if progress.state == "running":
+        progress.finish(stderr.strip() or f"{module} exited with code {returncode}")
+
+
+def start_deploy(source: str, target: str, delta: bool = False) -> DeployProgress:
+    """
+    Starts writing an image in the background and returns its progress
+    record. Targets this process cannot write are written by a root child
+    process (see run_module_as_root).
+    """
+    progress = DeployProgress(source, target, delta=delta)
+    if os.access(target, os.W_OK) or not os.path.exists(target):
+        worker = threading.Thread(target=deploy, args=(source, target, progress, delta), daemon=True)
+    else:
+        args = (["--delta"] if delta else []) + [source, target]
+        worker = threading.Thread(target=run_module_as_root, args=(progress, "utils.image_deploy", args),
+                                  daemon=True)
+    worker.start()
+    return progress
+
+
+def format_progress(progress: DeployProgress) -> list[str]:
+    """Returns the lines of a progress display."""
+    bar_width = 40
+    filled = int(bar_width * progress.fraction)
+    lines = [
+        f"Image:   {progress.source}",
+        f"Target:  {progress.target}",
+        f"Method:  {progress.method or 'starting'}",
+        "",
+        f"[{'#' * filled}{'.' * (bar_width - filled)}] {progress.fraction * 100:5.1f}%",
+        f"{progress.bytes_done / 1e6:,.0f} MB processed in {progress.elapsed:.1f}s, "
+        f"{progress.rate_mbs:,.1f} MB/s sustained",
+        f"{progress.bytes_written / 1e6:,.0f} MB written, {progress.bytes_skipped / 1e6:,.0f} MB "
+        f"{'identical on the target' if progress.delta else 'of zeros'} skipped",
+    ]
+    if progress.state == "failed":
+        lines += ["", f"FAILED: {progress.error}"]
+    elif progress.state == "done":
+        lines += ["", "Done."]
+    return lines
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a raw or compressed disk image to a device.")
+    parser.add_argument("--json-progress", action="store_true", help="print progress as JSON lines")
+    parser.add_argument("--delta", action="store_true", help="only write blocks that differ from the target")
+    parser.add_argument("source")
+    parser.add_argument("target")
+    args = parser.parse_args()
+    progress = DeployProgress(args.source, args.target)
+    worker = threading.Thread(target=deploy, args=(args.source, args.target, progress, args.delta), daemon=True)
+    worker.start()
+    while worker.is_alive():
+        progress.changed.wait(0.5)
+        progress.changed.clear()
+        if args.json_progress:
+            print(json.dumps(progress.to_dict() | {"state": "running"}), flush=True)
+    if args.json_progress:
+        print(json.dumps(progress.to_dict()), flush=True)
+    else:
+        print("\n".join(format_progress(progress)))
+    sys.exit(0 if progress.state == "done" else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import re
+import subprocess
+import sys
+
+from . import partition_table, privileged_helper
+from .extents import FreeExtentIndex, alignment_grain, read_io_geometry, size_to_sectors
+
+# Whole-disk layout engine. A layout is a plain dictionary, e.g.
+#
+#   {"device": "/dev/sdb", "label": "gpt",
+#    "partitions": [{"size": "512MiB", "type": "esp", "name": "boot"},
+#                   {"size": "100%", "type": "lvm", "name": "data"}]}
+#
+# It is planned against the free-extent index and committed with a single
+# sfdisk script: one partition table write, one re-read and one udev settle
+# per disk instead of one parted run per partition.
+# 'label' may be omitted to append the partitions to the existing table,
+# whose label then decides between GPT type GUIDs and MBR type bytes.
+
+# Partition type aliases -> (GPT type GUID, MBR type byte or None if GPT only)
+PARTITION_TYPES = {
+    "linux": ("0FC63DAF-8483-4772-8E79-3D69D8477DE4", "83"),
+    "lvm": ("E6D6D379-F507-44C2-A23C-238F2A3DF928", "8e"),
+    "swap": ("0657FD6D-A4AB-43C4-84E5-0933C84B4F4F", "82"),
+    "esp": ("C12A7328-F81F-11D2-BA4B-00A0C93EC93B", "ef"),
+    "bios_grub": ("21686148-6449-6E6F-744E-656564454649", None),   # GPT only
+    "raid": ("A19D880F-05FC-4D3B-A006-743F0F84911E", "fd"),
+    "luks": ("CA7D7CCB-63ED-4C53-861C-1742536059CC", "83"),
+}
+# Names used by parted's 'mkpart' and in the menus
+_TYPE_ALIASES = {
+    "ext4": "linux", "xfs": "linux", "btrfs": "linux", "linux-lvm": "lvm",
+    "linux-swap": "swap", "uefi": "esp", "efi": "esp", "linux-raid": "raid",
+}
+
+# Primary partition slots of an MBR
+_MBR_PRIMARIES = 4
+
+_SIZE_PATTERN = re.compile(r"^\s*([0-9]*\.?[0-9]+)\s*(MiB|GiB|%)\s*$")
+
+
+def partition_path(device_path: str, number: int) -> str:
+    """Returns the device node of a partition ('/dev/sda' -> '/dev/sda1', '/dev/nvme0n1' -> '/dev/nvme0n1p1')."""
+    separator = "p" if device_path[-1].isdigit() else ""
+    return f"{device_path}{separator}{number}"
+
+
+def resolve_type(type_name: str) -> str:
+    """Maps a partition type alias ('ext4', 'linux-lvm', ...) to a PARTITION_TYPES key."""
+    key = _TYPE_ALIASES.get(type_name.lower(), type_name.lower())
+    if key not in PARTITION_TYPES:
+        raise ValueError(f"Unknown partition type '{type_name}'")
+    return key
+
+
+def parse_size(size: str) -> tuple[float, str]:
+    """Parses '512MiB', '20GiB' or '25%' into (amount, unit)."""
+    match = _SIZE_PATTERN.match(size)
+    if not match:
+        raise ValueError(f"Invalid partition size '{size}', use e.g. 512MiB, 20GiB or 25%")
+    return float(match.group(1)), match.group(2)
+
+
+def table_label(layout: dict, existing_label: str | None) -> str:
+    """
+    Returns the sfdisk label the partitions are written with: the layout's
+    own, or that of the existing table when appending ('gpt' or 'dos').
+    Raises ValueError if there is neither, or a type the label cannot hold.
+    """
+    label = layout.get("label") or {"msdos": "dos"}.get(existing_label, existing_label)
+    if not label:
+        raise ValueError(f"{layout['device']} has no partition table to append to; set a label (gpt or dos)")
+    if label != "gpt":
+        for spec in layout["partitions"]:
+            key = resolve_type(spec.get("type", "linux"))
+            if PARTITION_TYPES[key][1] is None:
+                raise ValueError(f"a {key} partition needs a GPT label, {layout['device']} is {label}")
+    return label
+
+
+def plan_layout(layout: dict, pmap: partition_table.PartitionMap, sys_root: str = "/sys") -> list[dict]:
+    """
+    Assigns aligned sector ranges to every partition in the layout.
+    With a 'label' the disk is planned as empty (a new table); without one
+    the partitions go into the free space of the existing table.
+    Returns one dictionary per partition with number, start, sectors, type
+    and name. Raises ValueError if the layout does not fit, or needs more
+    than the four primary partitions of a dos label (see also table_label()).
+    """
+    device_path = layout["device"]
+    label = table_label(layout, pmap.label)
+    sector_size = pmap.sector_size
+    grain, offset = alignment_grain(read_io_geometry(device_path, sys_root), sector_size)
+
+    if layout.get("label"):
+        # GPT keeps 33 sectors (at 512B) for the entry array at both ends
+        reserved = 1 + (16384 + sector_size - 1) // sector_size
+        first = 1 + reserved if layout["label"] == "gpt" else 1
+        last = pmap.total_sectors - 1 - (reserved if layout["label"] == "gpt" else 0)
+        index = FreeExtentIndex([(first, last)], grain, offset, sector_size)
+        used_numbers = set()
+    else:
+        index = FreeExtentIndex([(extent.start, extent.end) for extent in pmap.free], grain, offset, sector_size)
+        used_numbers = {part.number for part in pmap.partitions}
+
+    planned = []
+    number = 1
+    for spec in layout["partitions"]:
+        while number in used_numbers:
+            number += 1
+        if label == "dos" and number > _MBR_PRIMARIES:
+            # The script only writes primary partitions; logical ones would need an extended container
+            raise ValueError(f"Partition {number} does not fit in the dos table of {device_path}: it holds "
+                             f"{_MBR_PRIMARIES} primary partitions, use a gpt label for more")
+        amount, unit = parse_size(spec["size"])
+        allocation = index.allocate(size_to_sectors(amount, unit, index), spec.get("placement", "first"))
+        if allocation is None:
+            raise ValueError(f"Partition {number} ({spec['size']}) does not fit on {device_path}")
+        start, end = allocation
+        planned.append({
+            "number": number,
+            "start": start,
+            "sectors": end - start + 1,
+            "type": resolve_type(spec.get("type", "linux")),
+            "name": spec.get("name", ""),
+        })
+        used_numbers.add(number)
+    return planned
+
+
+def build_sfdisk_script(layout: dict, planned: list[dict], existing_label: str | None = None) -> str:
+    """
+    Renders planned partitions as an sfdisk input script. 'existing_label'
+    is the label of the table the partitions are appended to (without a
+    layout label). Raises ValueError like table_label().
+    """
+    label = layout.get("label")
+    gpt = table_label(layout, existing_label) == "gpt"
+    lines = []
+    if label:
+        lines.append(f"label: {label}")
+    lines.append("unit: sectors")
+    lines.append("")
+    for part in planned:
+        gpt_type, mbr_type = PARTITION_TYPES[part["type"]]
+        line = f"start={part['start']}, size={part['sectors']}, type={gpt_type if gpt else mbr_type}"
+        if gpt and part["name"]:
+            line += f", name=\"{part['name']}\""
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def sfdisk_command(layout: dict) -> list[str]:
+    """Returns the sfdisk command that applies the script to the layout's device."""
+    command = ["sudo", "sfdisk", "--quiet"]
+    if not layout.get("label"):
+        command.append("--append")
+    command.append(layout["device"])
+    return command
+
+
+def render_commands(layout: dict, script: str) -> str:
+    """Renders the sfdisk run (with the script as a here-document) and the udev settle."""
+    command = " ".join(sfdisk_command(layout))
+    return f"{command} <<'EOF'\n{script}EOF\nsudo udevadm settle\n"
+
+
+def render_template(layout: dict, script: str) -> str:
+    """Renders the whole layout as a shell script for 3_create_partition.sh."""
+    return (
+        "#!/bin/bash\n\n"
+        f"# Partition layout for {layout['device']}, written in one transaction\n"
+        f"{render_commands(layout, script)}"
+    )
+
+
+def apply_layout(layout: dict, script: str, settle: bool = True) -> bool:
+    """
+    Writes the whole partition table with one sfdisk run (which also makes
+    the kernel re-read it) and waits for udev once. Callers that provision
+    several disks can pass settle=False and call settle_udev() themselves.
+    Returns True on success.
+    """
+    try:
+        privileged_helper.run(sfdisk_command(layout), input=script, check=True, capture_output=True, text=True)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        print(f"Error applying partition layout to {layout['device']}: {getattr(e, 'stderr', None) or e}",
+              file=sys.stderr)
+        return False
+    if settle:
+        settle_udev()
+    return True
+
+
+def settle_udev() -> None:
+    """Waits until udev has processed all queued events (device nodes exist)."""
+    try:
+        privileged_helper.run(["sudo", "udevadm", "settle"], check=True, capture_output=True, text=True)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        print(f"Warning: udevadm settle failed: {e}", file=sys.stderr)
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import struct
+from dataclasses import dataclass, field
+
+# Native reader for LUKS1 and LUKS2 headers. LUKS1 keeps everything in a
+# fixed binary header; LUKS2 has a 4 KiB binary header followed by a JSON
+# metadata area, stored twice (primary and secondary copy). Reading them
+# directly tells which partitions are LUKS, their cipher and sector size
+# and which keyslots are used, without a 'cryptsetup luksDump' per device.
+
+MAGIC = b"LUKS\xba\xbe"
+MAGIC_SECONDARY = b"SKUL\xba\xbe"
+
+_LUKS1_HEADER = struct.Struct(">6sH32s32s32sII20s32sI40s")
+_LUKS1_KEYSLOT = struct.Struct(">II32sII")
+_LUKS1_SLOTS = 8
+_LUKS1_SLOT_ACTIVE = 0x00AC71F3
+_LUKS1_SECTOR = 512
+
+_LUKS2_HEADER = struct.Struct(">6sHQQ48s32s64s40s48sQ184s64s")
+_LUKS2_BINARY_SIZE = 4096
+_LUKS2_SLOTS = 32
+# Where a secondary header can start when the primary is damaged
+_LUKS2_SECONDARY_OFFSETS = [0x4000 << i for i in range(9)]
+
+
+@dataclass
+class LuksInfo:
+    device: str
+    version: int
+    uuid: str
+    label: str = ""
+    cipher: str = ""
+    key_size: int = 0           # Bits
+    sector_size: int = 512
+    data_offset: int = 0        # Bytes
+    keyslots: dict = field(default_factory=dict)   # slot number -> description (kdf, key size)
+    max_slots: int = _LUKS1_SLOTS
+    warnings: list = field(default_factory=list)
+
+    @property
+    def free_slots(self) -> list[int]:
+        return [slot for slot in range(self.max_slots) if slot not in self.keyslots]
+
+    def summary(self) -> str:
+        return (f"LUKS{self.version}, {self.cipher}, {self.key_size}-bit, {self.sector_size}B sectors, "
+                f"{len(self.keyslots)}/{self.max_slots} keyslots used")
+
+
+def _text(raw: bytes) -> str:
+    return raw.split(b"\0", 1)[0].decode("ascii", "replace")
+
+
+def parse_luks1(header: bytes, device: str = "") -> LuksInfo | None:
+    """Parses a LUKS1 header (the first 592 bytes of the device)."""
+    if len(header) < _LUKS1_HEADER.size + _LUKS1_SLOTS * _LUKS1_KEYSLOT.size:
+        return None
+    (magic, version, cipher_name, cipher_mode, _, payload_offset, key_bytes,
+     _, _, _, uuid) = _LUKS1_HEADER.unpack_from(header)
+    if magic != MAGIC or version != 1:
+        return None
+    info = LuksInfo(device, 1, _text(uuid), cipher=f"{_text(cipher_name)}-{_text(cipher_mode)}",
+                    key_size=key_bytes * 8, data_offset=payload_offset * _LUKS1_SECTOR)
+    for slot in range(_LUKS1_SLOTS):
+        active, iterations, _, _, stripes = _LUKS1_KEYSLOT.unpack_from(
+            header, _LUKS1_HEADER.size + slot * _LUKS1_KEYSLOT.size)
+        if active == _LUKS1_SLOT_ACTIVE:
+            info.keyslots[slot] = f"pbkdf2, {iterations} iterations"
+    return info
+
+
+def _luks2_header_at(f, offset: int) -> tuple[int, dict] | None:
+    """Reads and verifies one LUKS2 header copy. Returns (seqid, metadata) or None."""
+    f.seek(offset)
+    binary = f.read(_LUKS2_BINARY_SIZE)
+    if len(binary) < _LUKS2_BINARY_SIZE:
+        return None
+    (magic, version, hdr_size, seqid, label, checksum_alg, _, uuid, _, hdr_offset,
+     _, csum) = _LUKS2_HEADER.unpack_from(binary)
+    if magic not in (MAGIC, MAGIC_SECONDARY) or version != 2 or hdr_offset != offset:
+        return None
+    if not _LUKS2_BINARY_SIZE < hdr_size <= 4 * 1024 * 1024:
+        return None
+    json_area = f.read(hdr_size - _LUKS2_BINARY_SIZE)
+    if _text(checksum_alg) == "sha256":
+        # The checksum covers the whole header with the checksum field zeroed
+        csum_offset = _LUKS2_HEADER.size - 64
+        zeroed = binary[:csum_offset] + b"\0" * 64 + binary[csum_offset + 64:]
+        if hashlib.sha256(zeroed + json_area).digest() != csum[:32]:
+            return None
+    try:
+        metadata = json.loads(json_area.split(b"\0", 1)[0])
+    except ValueError:
+        return None
+    metadata["_label"] = _text(label)
+    metadata["_uuid"] = _text(uuid)
+    metadata["_hdr_size"] = hdr_size
+    return seqid, metadata
+
+
+def parse_luks2(f, device: str = "") -> LuksInfo | None:
+    """Reads a LUKS2 header from an open device, using the newest valid copy."""
+    copies = []
+    primary = _luks2_header_at(f, 0)
+    if primary:
+        copies.append(primary)
+        offsets = [primary[1]["_hdr_size"]]
+    else:
+        offsets = _LUKS2_SECONDARY_OFFSETS
+    for offset in offsets:
+        secondary = _luks2_header_at(f, offset)
+        if secondary:
+            copies.append(secondary)
+            break
+    if not copies:
+        return None
+
+    seqid, metadata = max(copies, key=lambda copy: copy[0])
+    info = LuksInfo(device, 2, metadata["_uuid"], metadata["_label"], max_slots=_LUKS2_SLOTS)
+    if len(copies) < 2:
+        info.warnings.append("only one valid header copy")
+    elif copies[0][0] != copies[1][0]:
+        info.warnings.append("header copies differ, using the newer one")
+
+    segments = metadata.get("segments", {})
+    if segments:
+        segment = segments[min(segments, key=int)]
+        info.cipher = segment.get("encryption", "")
+        info.sector_size = segment.get("sector_size", 512)
+        info.data_offset = int(segment.get("offset", 0))
+    for slot, keyslot in metadata.get("keyslots", {}).items():
+        kdf = keyslot.get("kdf", {})
+        detail = kdf.get("type", "")
+        if "memory" in kdf:
+            detail += f", {kdf['memory'] // 1024} MiB, {kdf.get('time')} iterations"
+        info.keyslots[int(slot)] = detail
+        info.key_size = info.key_size or keyslot.get("key_size", 0) * 8
+    return info
+
+
+def read_luks_header(device: str) -> LuksInfo | None:
+    """
+    Returns the LUKS header information of a device, or None if it is not
+    a LUKS device. Raises OSError (e.g. PermissionError) if it cannot be read.
+    """
+    with open(device, "rb", buffering=0) as f:
+        head = f.read(_LUKS2_BINARY_SIZE)
+        if head[:6] != MAGIC:
+            # A damaged primary LUKS2 header: the device is still LUKS if a secondary copy is intact
+            for offset in _LUKS2_SECONDARY_OFFSETS:
+                f.seek(offset)
+                if f.read(len(MAGIC_SECONDARY)) == MAGIC_SECONDARY:
+                    return parse_luks2(f, device)
+            return None
+        version = struct.unpack_from(">H", head, 6)[0]
+        if version == 1:
+            return parse_luks1(head, device)
+        if version == 2:
+            return parse_luks2(f, device)
+    return None
+
+
+def describe(device: str) -> str | None:
+    """Returns a one-line summary for menus, or None if the device is not LUKS."""
+    try:
+        info = read_luks_header(device)
+    except OSError:
+        return "LUKS (header not readable)"
+    return info.summary() if info else None
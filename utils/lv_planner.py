@@ -0,0 +1,185 @@
+import os
+from dataclasses import dataclass, field
+
+from .extents import read_io_geometry
+from .sysfs_devices import SECTOR_SIZE, human_size
+
+# Logical volume layout planner. Looks at the physical volumes of a volume
+# group in sysfs (rotational flag, size, queue depth, I/O geometry) and
+# proposes linear, striped and raid layouts with an estimate of their
+# sequential throughput, so an LV does not silently end up linear on the
+# first PV.
+
+# Rough sequential throughput per device class, in MB/s
+_CLASS_THROUGHPUT = {"hdd": 180, "ssd": 520, "nvme": 2500}
+# Below this queue depth a device cannot keep a stripe busy
+_SHALLOW_QUEUE = 4
+
+DEFAULT_STRIPE_KIB = {"hdd": 256, "ssd": 64, "nvme": 128}
+
+
+@dataclass
+class PvInfo:
+    path: str
+    disk: str               # Kernel name of the whole disk
+    device_class: str       # hdd, ssd or nvme
+    size: int               # Bytes
+    queue_depth: int
+    optimal_io_size: int    # Bytes, 0 if not reported
+
+    @property
+    def throughput(self) -> int:
+        """Estimated sequential throughput in MB/s."""
+        rate = _CLASS_THROUGHPUT[self.device_class]
+        return rate // 2 if self.queue_depth < _SHALLOW_QUEUE else rate
+
+
+@dataclass
+class Proposal:
+    name: str
+    segtype: str            # linear, striped, raid0, raid1, raid10
+    stripes: int = 1
+    stripe_kib: int = 0
+    pvs: list[str] = field(default_factory=list)
+    read_mbs: int = 0
+    write_mbs: int = 0
+    capacity: int = 0       # Largest LV this layout can hold, in bytes
+    notes: list[str] = field(default_factory=list)
+
+    def lvcreate_options(self) -> list[str]:
+        """Returns the lvcreate options for this geometry (before -L/-n)."""
+        if self.segtype == "linear":
+            return []
+        options = [] if self.segtype == "striped" else ["--type", self.segtype]
+        if self.segtype == "raid1":
+            return options + ["-m", "1"]
+        if self.segtype == "raid10":
+            return options + ["-m", "1", "-i", str(self.stripes // 2), "-I", f"{self.stripe_kib}k"]
+        return options + ["-i", str(self.stripes), "-I", f"{self.stripe_kib}k"]
+
+    def describe(self) -> str:
+        geometry = self.segtype
+        if self.segtype in ("striped", "raid0", "raid10"):
+            geometry += f", {self.stripes} PVs x {self.stripe_kib}KiB stripes"
+        elif self.segtype == "raid1":
+            geometry += f", {len(self.pvs)} mirrors"
+        return (f"{geometry}; ~{self.read_mbs} MB/s read, ~{self.write_mbs} MB/s write; "
+                f"up to {human_size(self.capacity)}")
+
+
+def _read_int(path: str, default: int = 0) -> int:
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def _backing_dir(class_dir: str, sys_root: str) -> str:
+    """
+    Follows a device-mapper device (a LUKS mapping, an LV) through its
+    slaves down to the partition or disk it sits on.
+    """
+    seen = set()
+    while os.path.isdir(os.path.join(class_dir, "dm")) and class_dir not in seen:
+        seen.add(class_dir)
+        try:
+            slaves = sorted(os.listdir(os.path.join(class_dir, "slaves")))
+        except OSError:
+            break
+        if not slaves:
+            break
+        class_dir = os.path.realpath(os.path.join(sys_root, "class", "block", slaves[0]))
+    return class_dir
+
+
+def read_pv_info(pv_path: str, sys_root: str = "/sys") -> PvInfo:
+    """
+    Reads the planner's view of one physical volume from sysfs. A PV on
+    dm-crypt is attributed to the disk underneath, so two encrypted
+    partitions of one disk count as one disk.
+    """
+    kname = os.path.basename(os.path.realpath(pv_path))
+    class_dir = os.path.realpath(os.path.join(sys_root, "class", "block", kname))
+    backing_dir = _backing_dir(class_dir, sys_root)
+    # Partitions inherit the queue properties of their disk
+    disk_dir = os.path.dirname(backing_dir) if os.path.exists(os.path.join(backing_dir, "partition")) \
+        else backing_dir
+    disk = os.path.basename(disk_dir)
+
+    rotational = _read_int(os.path.join(disk_dir, "queue", "rotational"), 1)
+    if disk.startswith("nvme"):
+        device_class = "nvme"
+    else:
+        device_class = "hdd" if rotational else "ssd"
+    queue_depth = _read_int(os.path.join(disk_dir, "device", "queue_depth")) or \
+        _read_int(os.path.join(disk_dir, "queue", "nr_requests"), 1)
+    return PvInfo(
+        path=pv_path,
+        disk=disk,
+        device_class=device_class,
+        size=_read_int(os.path.join(class_dir, "size")) * SECTOR_SIZE,
+        queue_depth=queue_depth,
+        optimal_io_size=read_io_geometry(pv_path, sys_root)["optimal_io_size"],
+    )
+
+
+def _stripe_kib(pvs: list[PvInfo]) -> int:
+    """
+    Uses the devices' optimal I/O size when they agree on one, else a
+    per-class default. lvcreate -I takes only powers of two, so an optimal
+    size like 768 KiB (a RAID set of three data disks) is rounded down.
+    """
+    optimal = {pv.optimal_io_size for pv in pvs}
+    if len(optimal) == 1 and 4096 <= min(optimal) <= 4 * 1024 * 1024:
+        kib = min(optimal) // 1024
+        return 1 << (kib.bit_length() - 1)
+    return max(DEFAULT_STRIPE_KIB[pv.device_class] for pv in pvs)
+
+
+def propose_layouts(pvs: list[PvInfo]) -> list[Proposal]:
+    """
+    Returns layout proposals for an LV over the given PVs, fastest first.
+    Striping only uses PVs on distinct disks of the same device class, since
+    two stripes on one disk, or an HDD next to an NVMe, are bound by the
+    slowest member.
+    """
+    if not pvs:
+        return []
+    proposals = [Proposal("linear", "linear", read_mbs=pvs[0].throughput,
+                          write_mbs=pvs[0].throughput, capacity=sum(pv.size for pv in pvs),
+                          notes=["extents are filled one PV after the other"])]
+
+    # The largest group of PVs on separate disks of one class
+    groups = {}
+    for pv in pvs:
+        group = groups.setdefault(pv.device_class, {})
+        group.setdefault(pv.disk, pv)
+    members = list(max(groups.values(), key=len).values())
+    notes = []
+    if len(members) < len(pvs):
+        notes.append(f"striping over {len(members)} of {len(pvs)} PVs (one per disk, one device class)")
+
+    n = len(members)
+    if n >= 2:
+        slowest = min(pv.throughput for pv in members)
+        smallest = min(pv.size for pv in members)
+        stripe = _stripe_kib(members)
+        paths = [pv.path for pv in members]
+        proposals.append(Proposal("striped", "striped", n, stripe, paths, n * slowest, n * slowest,
+                                  n * smallest, notes + ["no redundancy"]))
+        proposals.append(Proposal("raid0", "raid0", n, stripe, paths, n * slowest, n * slowest,
+                                  n * smallest, notes + ["no redundancy, managed by md-raid"]))
+        proposals.append(Proposal("raid1", "raid1", 1, 0, paths[:2], 2 * slowest, slowest,
+                                  smallest, ["survives the loss of one PV"]))
+        if n >= 4:
+            even = n - n % 2
+            proposals.append(Proposal("raid10", "raid10", even, stripe, paths[:even], even * slowest,
+                                      even // 2 * slowest, even // 2 * smallest,
+                                      ["survives the loss of one PV per mirror"]))
+    return sorted(proposals, key=lambda p: p.read_mbs + p.write_mbs, reverse=True)
+
+
+def plan_for(pv_paths: list[str], sys_root: str = "/sys") -> list[Proposal]:
+    """Reads the PVs from sysfs and returns the proposals for them."""
+    return propose_layouts([read_pv_info(path, sys_root) for path in pv_paths])
@@ -0,0 +1,358 @@
+import re
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from . import device_cache
+
+# Native reader for LVM2 on-disk metadata. Physical volumes are found by
+# their 'LABELONE' label in the first four sectors; the label points to the
+# metadata area, whose header points to the current copy of the volume
+# group's text metadata. Parsing that text gives the whole VG/PV/LV model
+# without running pvs/vgs/lvs, which rescan every device on each call.
+# Only devices the cached inventory already identifies as LVM2_member are
+# read, and the model is kept until the device cache changes.
+
+SECTOR = 512
+LABEL_SCAN_SECTORS = 4
+MDA_HEADER_SIZE = 512
+INITIAL_CRC = 0xF597A6CF
+
+_LABEL_HEADER = struct.Struct("<8sQII8s")       # id, sector, crc, offset, type
+_LABEL_ID = b"LABELONE"
+_LABEL_TYPE = b"LVM2 001"
+_DISK_LOCN = struct.Struct("<QQ")
+_MDA_HEADER = struct.Struct("<I16sIQQ")         # checksum, magic, version, start, size
+_MDA_MAGIC = b"\x20\x4c\x56\x4d\x32\x20\x78\x5b\x35\x41\x25\x72\x30\x4e\x2a\x3e"
+_RAW_LOCN = struct.Struct("<QQII")              # offset, size, checksum, flags
+_RAW_LOCN_IGNORED = 0x1
+
+# Device types that sit on top of other paths to the same PV (preferred)
+_STACKED_TYPES = {"mpath", "crypt", "dm"}
+
+
+def lvm_crc(data: bytes, initial: int = INITIAL_CRC) -> int:
+    """LVM's CRC32: the standard polynomial without the final inversion."""
+    return zlib.crc32(data, initial ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+@dataclass
+class PhysicalVolume:
+    uuid: str
+    device: str
+    vg: str = ""
+    size: int = 0           # Bytes
+    pe_start: int = 0       # Sectors
+    pe_count: int = 0
+
+
+@dataclass
+class LogicalVolume:
+    name: str
+    vg: str
+    extents: int = 0
+    size: int = 0           # Bytes
+    segments: list[dict] = field(default_factory=list)
+    status: list[str] = field(default_factory=list)
+
+    @property
+    def segtype(self) -> str:
+        types = {segment.get("type", "striped") for segment in self.segments}
+        if types == {"striped"} and any(segment.get("stripe_count", 1) > 1 for segment in self.segments):
+            return "striped"
+        return ",".join(sorted(types)) if types != {"striped"} else "linear"
+
+    @property
+    def stripes(self) -> int:
+        return max((segment.get("stripe_count", 1) for segment in self.segments), default=1)
+
+
+@dataclass
+class VolumeGroup:
+    name: str
+    uuid: str = ""
+    seqno: int = 0
+    extent_size: int = 0    # Sectors
+    pvs: dict = field(default_factory=dict)     # PV name in metadata (pv0) -> PhysicalVolume
+    lvs: dict = field(default_factory=dict)     # LV name -> LogicalVolume
+    missing: list[str] = field(default_factory=list)
+
+    @property
+    def size(self) -> int:
+        return sum(pv.pe_count for pv in self.pvs.values()) * self.extent_size * SECTOR
+
+    @property
+    def free(self) -> int:
+        used = sum(lv.extents for lv in self.lvs.values())
+        return max(0, self.size - used * self.extent_size * SECTOR)
+
+
+@dataclass
+class LvmState:
+    vgs: dict = field(default_factory=dict)     # VG name -> VolumeGroup
+    orphans: list = field(default_factory=list)  # PVs without a VG
+    unreadable: list = field(default_factory=list)
+    warnings: list = field(default_factory=list)
+
+
+# --- Text metadata ---
+
+_TOKEN = re.compile(r'\s+|#[^\n]*|"(?:[^"\\]|\\.)*"|[{}\[\]=,]|[^\s{}\[\]=,"#]+')
+
+
+def _tokens(text: str):
+    for match in _TOKEN.finditer(text):
+        token = match.group(0)
+        if token[0].isspace() or token[0] == "#":
+            continue
+        yield token
+
+
+def _value(token: str):
+    if token.startswith('"'):
+        return re.sub(r"\\(.)", r"\1", token[1:-1])
+    try:
+        return int(token)
+    except ValueError:
+        return token
+
+
+def parse_config(text: str) -> dict:
+    """Parses LVM's config/metadata syntax into nested dictionaries."""
+    tokens = list(_tokens(text))
+    position = 0
+
+    def section() -> dict:
+        nonlocal position
+        result = {}
+        while position < len(tokens) and tokens[position] != "}":
+            key = tokens[position]
+            following = tokens[position + 1] if position + 1 < len(tokens) else None
+            if following == "{":
+                position += 2
+                result[key] = section()
+                position += 1  # '}'
+            elif following == "=":
+                position += 2
+                if tokens[position] == "[":
+                    position += 1
+                    items = []
+                    while tokens[position] != "]":
+                        if tokens[position] != ",":
+                            items.append(_value(tokens[position]))
+                        position += 1
+                    position += 1
+                    result[key] = items
+                else:
+                    result[key] = _value(tokens[position])
+                    position += 1
+            else:
+                position += 1  # Stray token, skip it
+        return result
+
+    try:
+        return section()
+    except IndexError:
+        raise ValueError("truncated LVM metadata")
+
+
+# --- On-disk structures ---
+
+def read_label(head: bytes) -> tuple[str, int, list, list] | None:
+    """
+    Finds the LVM label in the first sectors of a device. Returns
+    (pv_uuid, device_size, data_areas, metadata_areas), areas as
+    (offset, size) in bytes, or None if the device is not a PV.
+    """
+    for sector in range(LABEL_SCAN_SECTORS):
+        base = sector * SECTOR
+        block = head[base:base + SECTOR]
+        if len(block) < SECTOR or block[:8] != _LABEL_ID:
+            continue
+        _, sector_xl, crc, offset, label_type = _LABEL_HEADER.unpack_from(block)
+        if label_type != _LABEL_TYPE or sector_xl != sector or lvm_crc(block[20:]) != crc:
+            continue
+        pos = base + offset
+        uuid = head[pos:pos + 32].decode("ascii", "replace")
+        device_size = struct.unpack_from("<Q", head, pos + 32)[0]
+        pos += 40
+        areas = [[], []]
+        for area in areas:
+            while pos + _DISK_LOCN.size <= len(head):
+                location = _DISK_LOCN.unpack_from(head, pos)
+                pos += _DISK_LOCN.size
+                if location == (0, 0):
+                    break
+                area.append(location)
+        formatted = "-".join(uuid[a:b] for a, b in ((0, 6), (6, 10), (10, 14), (14, 18), (18, 22),
+                                                    (22, 26), (26, 32)))
+        return formatted, device_size, areas[0], areas[1]
+    return None
+
+
+def read_metadata_text(f, area_offset: int) -> str | None:
+    """Reads the current metadata text from the metadata area at 'area_offset'."""
+    f.seek(area_offset)
+    header = f.read(MDA_HEADER_SIZE)
+    if len(header) < MDA_HEADER_SIZE:
+        return None
+    checksum, magic, _, start, size = _MDA_HEADER.unpack_from(header)
+    if magic != _MDA_MAGIC or lvm_crc(header[4:]) != checksum:
+        return None
+    offset, length, text_crc, flags = _RAW_LOCN.unpack_from(header, _MDA_HEADER.size)
+    if not length or flags & _RAW_LOCN_IGNORED:
+        return None
+    # The metadata area is a ring buffer after its header
+    first = min(length, size - offset)
+    f.seek(area_offset + offset)
+    text = f.read(first)
+    if first < length:
+        f.seek(area_offset + MDA_HEADER_SIZE)
+        text += f.read(length - first)
+    if lvm_crc(text) != text_crc:
+        return None
+    return text.rstrip(b"\0").decode("utf-8", "replace")
+
+
+def read_pv(device: str) -> tuple[PhysicalVolume, dict | None] | None:
+    """
+    Reads one PV: its label and, if it has a metadata area, the parsed VG
+    metadata. Returns None if the device has no LVM label.
+    Raises OSError if the device cannot be read.
+    """
+    with open(device, "rb", buffering=0) as f:
+        label = read_label(f.read(LABEL_SCAN_SECTORS * SECTOR + 4096))
+        if label is None:
+            return None
+        uuid, device_size, _, metadata_areas = label
+        pv = PhysicalVolume(uuid, device, size=device_size)
+        for area_offset, _ in metadata_areas:
+            text = read_metadata_text(f, area_offset)
+            if text:
+                return pv, parse_config(text)
+    return pv, None
+
+
+def _vg_from_metadata(name: str, metadata: dict) -> VolumeGroup:
+    vg = VolumeGroup(name, metadata.get("id", ""), metadata.get("seqno", 0), metadata.get("extent_size", 0))
+    for pv_name, entry in metadata.get("physical_volumes", {}).items():
+        vg.pvs[pv_name] = PhysicalVolume(entry.get("id", ""), entry.get("device", ""), name,
+                                         entry.get("dev_size", 0) * SECTOR, entry.get("pe_start", 0),
+                                         entry.get("pe_count", 0))
+    for lv_name, entry in metadata.get("logical_volumes", {}).items():
+        segments = [value for key, value in entry.items() if key.startswith("segment") and isinstance(value, dict)]
+        extents = sum(segment.get("extent_count", 0) for segment in segments)
+        vg.lvs[lv_name] = LogicalVolume(lv_name, name, extents, extents * vg.extent_size * SECTOR, segments,
+                                        entry.get("status", []))
+    return vg
+
+
+def candidate_devices(disk_data: dict | None) -> list[tuple[str, str]]:
+    """Returns (device path, device type) for every LVM2_member in a device tree."""
+    candidates = []
+
+    def walk(nodes):
+        for node in nodes:
+            if node.get("fstype") == "LVM2_member":
+                candidates.append((f"/dev/{node.get('kname', node['name'])}", node.get("type", "")))
+            walk(node.get("children", []))
+
+    walk((disk_data or {}).get("blockdevices", []))
+    return candidates
+
+
+def scan(devices: list[tuple[str, str]], max_workers: int = 16) -> LvmState:
+    """
+    Reads the labels and metadata of the given (path, type) devices in
+    parallel and assembles the VG model. A PV seen through several paths
+    (multipath) is taken from the stacked device; of several metadata
+    copies the one with the highest seqno wins.
+    """
+    state = LvmState()
+
+    def read(entry):
+        path, dev_type = entry
+        try:
+            return path, dev_type, read_pv(path), None
+        except OSError as e:
+            return path, dev_type, None, e
+
+    by_uuid = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(devices) or 1))) as executor:
+        for path, dev_type, found, error in executor.map(read, devices):
+            if error is not None:
+                state.unreadable.append(path)
+                continue
+            if found is None:
+                continue
+            pv, metadata = found
+            current = by_uuid.get(pv.uuid)
+            if current is None or (dev_type in _STACKED_TYPES and current[1] not in _STACKED_TYPES):
+                by_uuid[pv.uuid] = (pv, dev_type, metadata)
+
+    metadata_by_vg = {}
+    for pv, _, metadata in by_uuid.values():
+        for key, value in (metadata or {}).items():
+            if isinstance(value, dict) and "physical_volumes" in value:
+                if key not in metadata_by_vg or value.get("seqno", 0) > metadata_by_vg[key].get("seqno", 0):
+                    metadata_by_vg[key] = value
+
+    for name, metadata in metadata_by_vg.items():
+        vg = _vg_from_metadata(name, metadata)
+        for pv in vg.pvs.values():
+            found = by_uuid.get(pv.uuid)
+            if found:
+                pv.device = found[0].device
+            else:
+                vg.missing.append(pv.uuid)
+        state.vgs[name] = vg
+
+    in_vg = {pv.uuid for vg in state.vgs.values() for pv in vg.pvs.values()}
+    state.orphans = [pv for pv, _, _ in by_uuid.values() if pv.uuid not in in_vg]
+    return state
+
+
+_cached = None
+_cached_generation = -1
+_cache_lock = threading.Lock()
+
+
+def get_lvm_state(refresh: bool = False) -> LvmState:
+    """
+    Returns the LVM model for the devices in the cached inventory. It is
+    rebuilt only when the device cache changed (or 'refresh' is set).
+    """
+    global _cached, _cached_generation
+    from . import disk_ops
+    with _cache_lock:
+        generation = device_cache.generation()
+        if refresh or _cached is None or generation != _cached_generation:
+            _cached = scan(candidate_devices(disk_ops.get_disk_info()))
+            _cached_generation = generation
+            if _cached.unreadable:
+                _cached.warnings.append(f"{len(_cached.unreadable)} device(s) could not be read (run as root)")
+        return _cached
+
+
+def format_state(state: LvmState) -> list[str]:
+    """Renders the LVM model as text lines for the menus."""
+    from .sysfs_devices import human_size
+    lines = []
+    for vg in sorted(state.vgs.values(), key=lambda v: v.name):
+        lines.append(f"VG {vg.name}  size {human_size(vg.size)}  free {human_size(vg.free)}  "
+                     f"PVs {len(vg.pvs)}  LVs {len(vg.lvs)}  seqno {vg.seqno}")
+        for pv in vg.pvs.values():
+            lines.append(f"  PV {pv.device or '[missing]'}  {human_size(pv.pe_count * vg.extent_size * SECTOR)}")
+        for lv in sorted(vg.lvs.values(), key=lambda volume: volume.name):
+            geometry = lv.segtype + (f" x{lv.stripes}" if lv.stripes > 1 else "")
+            lines.append(f"  LV {lv.name}  {human_size(lv.size)}  {geometry}")
+        if vg.missing:
+            lines.append(f"  ! {len(vg.missing)} PV(s) missing")
+    for pv in state.orphans:
+        lines.append(f"PV {pv.device}  {human_size(pv.size)}  (not in a volume group)")
+    if not lines:
+        lines.append("No LVM physical volumes found.")
+    lines.extend(f"Warning: {warning}" for warning in state.warnings)
+    return lines
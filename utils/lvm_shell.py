@@ -0,0 +1,166 @@
+import json
+import re
+import shlex
+import sys
+from dataclasses import dataclass, field
+
+from . import privileged_helper
+
+# Batch backend for LVM. Every pvcreate/vgcreate/lvcreate fork scans all
+# block devices for LVM labels, which dominates on hosts with many LUNs.
+# A batch pipes the whole PV/VG/LV plan into one 'lvm' shell session (one
+# process, one privilege escalation), restricts scanning to the plan's
+# physical volumes with a generated device filter, and reads the outcome of
+# each command back from its JSON command log.
+
+# Report the status of every command, not only the failures
+_LOG_CONFIG = 'log { report_command_log = 1 command_log_selection = "all" }'
+_PROMPT = re.compile(r"lvm> ?")
+# What lvm prints when it was built without readline and so has no shell
+_NO_SHELL = re.compile(r"Please supply an LVM command|readline", re.IGNORECASE)
+
+
+def device_filter(devices: list[str]) -> str:
+    """Returns an lvm --config string that accepts only the given devices."""
+    accept = ", ".join(f'"a|^{re.escape(device)}$|"' for device in sorted(set(devices)))
+    patterns = f"{accept}, \"r|.*|\"" if accept else "\"r|.*|\""
+    return f"devices {{ filter = [ {patterns} ] global_filter = [ {patterns} ] }} {_LOG_CONFIG}"
+
+
+@dataclass
+class CommandResult:
+    command: str
+    status: str = "unknown"          # success, failure or unknown
+    messages: list[str] = field(default_factory=list)
+    report: dict = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "success"
+
+
+def parse_documents(output: str) -> list[dict]:
+    """Returns the JSON documents in the output of an lvm shell session, in order."""
+    decoder = json.JSONDecoder()
+    documents = []
+    text = _PROMPT.sub("", output)
+    index = text.find("{")
+    while index != -1:
+        try:
+            document, end = decoder.raw_decode(text, index)
+        except ValueError:
+            index = text.find("{", index + 1)
+            continue
+        if isinstance(document, dict):
+            documents.append(document)
+        index = text.find("{", end)
+    return documents
+
+
+def _apply_document(result: CommandResult, document: dict) -> None:
+    for entry in document.get("log", []):
+        if entry.get("log_type") == "status":
+            result.status = "success" if entry.get("log_message") == "success" else "failure"
+        elif entry.get("log_message"):
+            result.messages.append(entry["log_message"])
+    for report in document.get("report", []):
+        result.report.update(report)
+
+
+class LvmBatch:
+    """
+    Collects LVM commands for one session. The devices given to the
+    constructor are the only ones LVM scans while the batch runs.
+    """
+
+    def __init__(self, devices: list[str]):
+        self.devices = list(devices)
+        self.commands = []
+
+    def add(self, *args: str) -> None:
+        """Queues a command, e.g. add('lvcreate', '-L', '20G', '-n', 'root', 'vg0')."""
+        self.commands.append(list(args))
+
+    def pvcreate(self, devices: list[str]) -> None:
+        self.add("pvcreate", "--yes", *devices)
+
+    def vgcreate(self, vg_name: str, devices: list[str]) -> None:
+        self.add("vgcreate", vg_name, *devices)
+
+    def lvcreate(self, vg_name: str, lv_name: str, size: str, *options: str, pvs: list[str] = ()) -> None:
+        """Queues an lvcreate; 'options' carry the geometry (-i/-I, --type), 'pvs' restrict placement."""
+        size_flag = "-l" if "%" in size else "-L"
+        self.add("lvcreate", "--yes", *options, size_flag, size, "-n", lv_name, vg_name, *pvs)
+
+    def report(self, vg_name: str) -> None:
+        """Queues vgs/lvs reports of a volume group to verify the result."""
+        self.add("vgs", "--units", "b", "-o", "vg_name,pv_count,lv_count,vg_size,vg_free", vg_name)
+        self.add("lvs", "--units", "b", "-o", "vg_name,lv_name,lv_size,segtype,stripes,stripe_size", vg_name)
+
+    def _line(self, command: list[str]) -> str:
+        options = ["--reportformat", "json", "--config", device_filter(self.devices)]
+        return shlex.join(command[:1] + options + command[1:])
+
+    def script(self) -> str:
+        """Returns the session input: one command per line."""
+        return "".join(self._line(command) + "\n" for command in self.commands) + "exit\n"
+
+    def run(self) -> list[CommandResult]:
+        """
+        Runs the batch in one 'lvm' session and returns one result per
+        command. If this lvm build has no shell (no readline support), the
+        commands are run one by one, still with the device filter. Any other
+        session that produced no reports is never re-run: its commands are
+        reported as failed if the shell did not start, unknown if it did.
+        """
+        results = [CommandResult(" ".join(command)) for command in self.commands]
+        try:
+            completed = privileged_helper.run(["sudo", "lvm"], input=self.script(), capture_output=True, text=True)
+        except FileNotFoundError as e:
+            print(f"Error running lvm: {e}", file=sys.stderr)
+            return results
+
+        documents = parse_documents(completed.stdout)
+        if documents:
+            if len(documents) != len(self.commands):
+                # Never re-run a batch that already ran; the reports show what exists
+                print("Warning: lvm shell output did not match the batch, some results are unknown.",
+                      file=sys.stderr)
+            for result, document in zip(results, documents):
+                _apply_document(result, document)
+            return results
+
+        started = _PROMPT.search(completed.stdout) is not None
+        if started or not _NO_SHELL.search(completed.stderr):
+            # The session may have run some commands; running them again could apply them twice
+            error = completed.stderr.strip() or f"lvm exited with status {completed.returncode}"
+            for result in results:
+                result.status = "unknown" if started else "failure"
+                result.messages.append(error)
+            return results
+
+        for result, command in zip(results, self.commands):
+            line = shlex.split(self._line(command))
+            try:
+                single = privileged_helper.run(["sudo", "lvm"] + line, capture_output=True, text=True)
+            except FileNotFoundError as e:
+                result.messages.append(str(e))
+                result.status = "failure"
+                continue
+            for document in parse_documents(single.stdout):
+                _apply_document(result, document)
+            if result.status == "unknown":
+                result.status = "success" if single.returncode == 0 else "failure"
+            if single.returncode != 0 and single.stderr.strip():
+                result.messages.append(single.stderr.strip())
+        return results
+
+
+def lv_rows(results: list[CommandResult]) -> list[dict]:
+    """Returns the 'lv' rows of the reports in a batch's results."""
+    return [row for result in results for row in result.report.get("lv", [])]
+
+
+def vg_rows(results: list[CommandResult]) -> list[dict]:
+    """Returns the 'vg' rows of the reports in a batch's results."""
+    return [row for result in results for row in result.report.get("vg", [])]
@@ -0,0 +1,310 @@
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import sys
+import uuid
+import zlib
+from dataclasses import dataclass, field
+
+# Native reader for GPT and MBR (msdos) partition tables. The first and last
+# LBAs of the device or image file are mmapped and parsed directly, so no
+# 'parted print free' is needed to find partitions or free space.
+
+BLKSSZGET = 0x1268  # ioctl: logical sector size of a block device
+
+_MBR_ENTRIES = struct.Struct("<B3sB3sII")
+_GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+_GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+_GPT_SIGNATURE = b"EFI PART"
+
+_MBR_PROTECTIVE = 0xEE
+_MBR_EXTENDED = {0x05, 0x0F, 0x85}
+_MAX_LOGICAL = 128  # Guard against EBR loops
+
+# Window mapped at the start of the device: MBR, GPT header and entry array.
+_HEAD_WINDOW = 1024 * 1024
+
+GPT_TYPE_NAMES = {
+    "c12a7328-f81f-11d2-ba4b-00a0c93ec93b": "EFI System",
+    "21686148-6449-6e6f-744e-656564454649": "BIOS boot",
+    "0fc63daf-8483-4772-8e79-3d69d8477de4": "Linux filesystem",
+    "e6d6d379-f507-44c2-a23c-238f2a3df928": "Linux LVM",
+    "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f": "Linux swap",
+    "a19d880f-05fc-4d3b-a006-743f0f84911e": "Linux RAID",
+    "ca7d7ccb-63ed-4c53-861c-1742536059cc": "Linux LUKS",
+    "ebd0a0a2-b9e5-4433-87c0-68b6b72699c7": "Microsoft basic data",
+}
+
+
+@dataclass
+class Partition:
+    number: int
+    start: int          # First sector (inclusive)
+    end: int            # Last sector (inclusive)
+    type_id: str        # GPT type GUID or MBR type byte as hex ('0x83')
+    name: str = ""
+    uuid: str = ""
+
+    @property
+    def sectors(self) -> int:
+        return self.end - self.start + 1
+
+    @property
+    def type_name(self) -> str:
+        return GPT_TYPE_NAMES.get(self.type_id, self.type_id)
+
+
+@dataclass
+class FreeExtent:
+    start: int          # First free sector (inclusive)
+    end: int            # Last free sector (inclusive)
+
+    @property
+    def sectors(self) -> int:
+        return self.end - self.start + 1
+
+
+@dataclass
+class PartitionMap:
+    device: str
+    label: str | None           # 'gpt', 'msdos' or None (no partition table)
+    sector_size: int
+    total_sectors: int
+    first_usable: int
+    last_usable: int
+    partitions: list[Partition] = field(default_factory=list)
+    free: list[FreeExtent] = field(default_factory=list)
+    disk_uuid: str = ""
+    warnings: list[str] = field(default_factory=list)
+
+    def largest_free(self, min_sectors: int = 1) -> FreeExtent | None:
+        """Returns the largest free extent of at least 'min_sectors', or None."""
+        candidates = [extent for extent in self.free if extent.sectors >= min_sectors]
+        return max(candidates, key=lambda extent: extent.sectors, default=None)
+
+
+def _sector_size(fd: int, st: os.stat_result) -> int | None:
+    """Returns the logical sector size of a block device, or None for files."""
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    buf = bytearray(4)
+    fcntl.ioctl(fd, BLKSSZGET, buf)
+    return int.from_bytes(buf, sys.byteorder)
+
+
+def _map(fd: int, offset: int, length: int) -> bytes:
+    """mmaps 'length' bytes at 'offset' (any alignment) and returns a copy."""
+    aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with mmap.mmap(fd, length + offset - aligned, prot=mmap.PROT_READ, offset=aligned) as m:
+        return m[offset - aligned:offset - aligned + length]
+
+
+def _parse_gpt_header(raw: bytes, lba: int) -> tuple | None:
+    """Validates a GPT header (signature, CRC, own LBA) and returns its fields."""
+    if len(raw) < _GPT_HEADER.size or raw[:8] != _GPT_SIGNATURE:
+        return None
+    fields = _GPT_HEADER.unpack_from(raw)
+    header_size, header_crc, my_lba = fields[2], fields[3], fields[5]
+    if header_size < _GPT_HEADER.size or header_size > len(raw) or my_lba != lba:
+        return None
+    zeroed = raw[:16] + b"\0\0\0\0" + raw[20:header_size]
+    if zlib.crc32(zeroed) != header_crc:
+        return None
+    return fields
+
+
+def _read_gpt(fd: int, size: int, sector_size: int, pmap: PartitionMap) -> bool:
+    """Fills 'pmap' from the primary GPT, or the backup if the primary is bad."""
+    total = pmap.total_sectors
+    head = _map(fd, 0, min(size, _HEAD_WINDOW))
+    candidates = [(head[sector_size:2 * sector_size], 1, head, 0)]
+    if total > 2:
+        tail_offset = max(0, size - _HEAD_WINDOW)
+        tail = _map(fd, tail_offset, size - tail_offset)
+        last = (total - 1) * sector_size - tail_offset
+        candidates.append((tail[last:last + sector_size], total - 1, tail, tail_offset))
+
+    for index, (raw, lba, window, window_offset) in enumerate(candidates):
+        fields = _parse_gpt_header(raw, lba)
+        if fields is None:
+            if index == 0:
+                pmap.warnings.append("Primary GPT header missing or corrupt")
+            continue
+        (_, _, _, _, _, _, _, first_usable, last_usable, disk_guid,
+         entries_lba, num_entries, entry_size, entries_crc) = fields
+        entries_offset = entries_lba * sector_size - window_offset
+        entries_len = num_entries * entry_size
+        if entries_offset < 0 or entries_offset + entries_len > len(window):
+            entries = _map(fd, entries_lba * sector_size, entries_len)
+        else:
+            entries = window[entries_offset:entries_offset + entries_len]
+        if zlib.crc32(entries) != entries_crc:
+            pmap.warnings.append(f"GPT entry array CRC mismatch (header at LBA {lba})")
+            continue
+
+        pmap.label = "gpt"
+        pmap.first_usable = first_usable
+        pmap.last_usable = last_usable
+        pmap.disk_uuid = str(uuid.UUID(bytes_le=disk_guid))
+        for number in range(num_entries):
+            type_guid, part_guid, first, last, _, name = _GPT_ENTRY.unpack_from(entries, number * entry_size)
+            if type_guid == b"\0" * 16:
+                continue
+            pmap.partitions.append(Partition(
+                number=number + 1,
+                start=first,
+                end=last,
+                type_id=str(uuid.UUID(bytes_le=type_guid)),
+                name=name.decode("utf-16-le", errors="replace").rstrip("\0"),
+                uuid=str(uuid.UUID(bytes_le=part_guid)),
+            ))
+        if index == 1:
+            pmap.warnings.append("Using backup GPT header")
+        return True
+    return False
+
+
+def _read_mbr(fd: int, head: bytes, pmap: PartitionMap) -> None:
+    """Fills 'pmap' from an msdos partition table, following the EBR chain."""
+    sector_size = pmap.sector_size
+    pmap.label = "msdos"
+    pmap.first_usable = 1
+    pmap.last_usable = pmap.total_sectors - 1
+    for index in range(4):
+        _, _, ptype, _, lba_start, sectors = _MBR_ENTRIES.unpack_from(head, 0x1BE + 16 * index)
+        if ptype == 0 or sectors == 0:
+            continue
+        pmap.partitions.append(Partition(index + 1, lba_start, lba_start + sectors - 1, f"0x{ptype:02x}"))
+        if ptype not in _MBR_EXTENDED:
+            continue
+
+        # Logical partitions: each EBR describes one partition and links to the next EBR
+        ebr_lba, number = lba_start, 5
+        while ebr_lba and number < 5 + _MAX_LOGICAL:
+            ebr = _map(fd, ebr_lba * sector_size, sector_size)
+            if ebr[510:512] != b"\x55\xaa":
+                pmap.warnings.append(f"Invalid EBR at sector {ebr_lba}")
+                break
+            _, _, ltype, _, rel_start, lsectors = _MBR_ENTRIES.unpack_from(ebr, 0x1BE)
+            if ltype and lsectors:
+                start = ebr_lba + rel_start
+                pmap.partitions.append(Partition(number, start, start + lsectors - 1, f"0x{ltype:02x}"))
+                number += 1
+            _, _, next_type, _, next_rel, _ = _MBR_ENTRIES.unpack_from(ebr, 0x1CE)
+            ebr_lba = lba_start + next_rel if next_type in _MBR_EXTENDED and next_rel else 0
+
+
+def _compute_free(pmap: PartitionMap) -> None:
+    """Derives the free extents between first_usable and last_usable."""
+    cursor = pmap.first_usable
+    for part in sorted(pmap.partitions, key=lambda p: p.start):
+        # Logical partitions lie inside their extended container, which already covers them
+        if pmap.label == "msdos" and part.number > 4:
+            continue
+        if part.start > cursor:
+            pmap.free.append(FreeExtent(cursor, part.start - 1))
+        cursor = max(cursor, part.end + 1)
+    if cursor <= pmap.last_usable:
+        pmap.free.append(FreeExtent(cursor, pmap.last_usable))
+
+
+def read_partition_map(device_path: str, sector_size: int | None = None) -> PartitionMap | None:
+    """
+    Reads the partition table of a block device or image file.
+    Returns a PartitionMap with all partitions and free extents, or None on
+    error. A device without a partition table gets label None and a single
+    free extent covering the whole device.
+    Raises PermissionError so callers can fall back to a privileged tool.
+    """
+    try:
+        fd = os.open(device_path, os.O_RDONLY)
+    except PermissionError:
+        raise
+    except OSError as e:
+        print(f"Error opening {device_path}: {e}", file=sys.stderr)
+        return None
+
+    try:
+        st = os.fstat(fd)
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if size < 2 * 512:
+            print(f"Error reading {device_path}: device too small for a partition table", file=sys.stderr)
+            return None
+
+        head = _map(fd, 0, min(size, _HEAD_WINDOW))
+        if sector_size is None:
+            sector_size = _sector_size(fd, st)
+        if sector_size is None:
+            # Image file: detect 4Kn images by where the GPT header sits
+            sector_size = 4096 if head[4096:4104] == _GPT_SIGNATURE and head[512:520] != _GPT_SIGNATURE else 512
+
+        total = size // sector_size
+        pmap = PartitionMap(device_path, None, sector_size, total, 0, total - 1)
+
+        has_mbr = head[510:512] == b"\x55\xaa"
+        mbr_types = [head[0x1BE + 16 * i + 4] for i in range(4)] if has_mbr else []
+        if _MBR_PROTECTIVE in mbr_types or head[sector_size:sector_size + 8] == _GPT_SIGNATURE:
+            if not _read_gpt(fd, size, sector_size, pmap):
+                pmap.warnings.append("No valid GPT found")
+        elif has_mbr and any(mbr_types):
+            _read_mbr(fd, head, pmap)
+
+        pmap.partitions.sort(key=lambda p: p.number)
+        _compute_free(pmap)
+        return pmap
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Error reading partition table of {device_path}: {e}", file=sys.stderr)
+        return None
+    finally:
+        os.close(fd)
+
+
+def blank_map(device_path: str, sys_root: str = "/sys") -> PartitionMap | None:
+    """
+    Returns a PartitionMap without a table (label None, the whole device
+    free) sized from sysfs, for planning a new table on a disk this process
+    is not allowed to open. Returns None if sysfs does not know the device.
+    """
+    class_dir = os.path.join(sys_root, "class", "block", os.path.basename(os.path.realpath(device_path)))
+    try:
+        with open(os.path.join(class_dir, "size")) as f:
+            size = int(f.read().strip()) * 512     # sysfs counts 512-byte units whatever the sector size
+        with open(os.path.join(class_dir, "queue", "logical_block_size")) as f:
+            sector_size = int(f.read().strip()) or 512
+    except (OSError, ValueError):
+        return None
+    total = size // sector_size
+    if total < 2:
+        return None
+    pmap = PartitionMap(device_path, None, sector_size, total, 0, total - 1)
+    _compute_free(pmap)
+    return pmap
+
+
+def format_partition_map(pmap: PartitionMap) -> list[str]:
+    """Renders a partition map as text lines, similar to 'parted print free'."""
+    sector_size = pmap.sector_size
+    mib = 1024 * 1024
+
+    def to_mib(sector: int) -> str:
+        return f"{sector * sector_size / mib:.1f}MiB"
+
+    lines = [
+        f"Disk {pmap.device}: {to_mib(pmap.total_sectors)} ({pmap.total_sectors} sectors)",
+        f"Sector size: {sector_size}B",
+        f"Partition Table: {pmap.label or 'unknown'}",
+    ]
+    lines += [f"Warning: {warning}" for warning in pmap.warnings]
+    lines.append("")
+    lines.append(f"{'Number':<7}{'Start':>12}{'End':>12}{'Size':>12}  {'Type':<22}Name")
+
+    rows = [(p.start, p) for p in pmap.partitions] + [(f.start, f) for f in pmap.free]
+    for _, entry in sorted(rows, key=lambda row: row[0]):
+        start, end, size = to_mib(entry.start), to_mib(entry.end + 1), to_mib(entry.sectors)
+        if isinstance(entry, Partition):
+            lines.append(f"{entry.number:<7}{start:>12}{end:>12}{size:>12}  {entry.type_name:<22}{entry.name}")
+        else:
+            lines.append(f"{'':<7}{start:>12}{end:>12}{size:>12}  Free Space")
+    return lines
@@ -0,0 +1,424 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+from . import command_args
+
+# Plan executor for template directories. The numbered scripts
+# (3_create_partition.sh, 4_encrypt_device.sh, 5_logical_volumes.sh, ...) or
+# a structured plan.json are parsed into operations, each keyed by the
+# devices it touches. Operations that touch related devices are ordered as
+# written; everything else runs in parallel. A fingerprint of every
+# successfully applied operation is stored, so re-applying only runs
+# operations whose command, or whose upstream operations, changed.
+#
+# The state is kept outside the template (a template is copied between
+# machines) and every entry is bound to this machine's id and to the
+# identity (WWN, serial, partition table UUID) of the disks the operation
+# touches, so a copied template, a replaced disk or a wiped one runs again.
+
+STATE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                         "os_installer", "plan_state")
+PLAN_FILE = "plan.json"
+
+_SCRIPT_PATTERN = re.compile(r"^(\d+)_.*\.sh$")
+_HEREDOC_PATTERN = re.compile(r"<<-?\s*'?\"?(\w+)'?\"?\s*$")
+_PARTITION_PATTERN = re.compile(r"^(/dev/(?:nvme\d+n\d+|mmcblk\d+|loop\d+|md\d+))p\d+$|^(/dev/[a-z]+)\d+$")
+
+# Key that conflicts with everything (unknown commands are ordering barriers)
+BARRIER = "*"
+
+
+class StateUnknown(Exception):
+    """Raised by a skip() check that cannot tell whether an operation is needed."""
+
+
+@dataclass
+class Operation:
+    id: str
+    argv: list[str]
+    stdin: str | None = None
+    source: str = ""
+    reads: set = field(default_factory=set)
+    writes: set = field(default_factory=set)
+    after: list[list[str]] = field(default_factory=list)  # Follow-up commands (udev settle)
+    interactive: bool = False
+    deps: list[str] = field(default_factory=list)
+    fingerprint: str = ""
+
+    @property
+    def keys(self) -> set:
+        return self.reads | self.writes
+
+    def command_line(self) -> str:
+        return " ".join(shlex.quote(arg) for arg in self.argv)
+
+
+def parent_device(path: str) -> str | None:
+    """Returns the disk a partition path belongs to ('/dev/sdb1' -> '/dev/sdb')."""
+    match = _PARTITION_PATTERN.match(path)
+    if not match:
+        return None
+    return match.group(1) or match.group(2)
+
+
+def _related(a: str, b: str) -> bool:
+    """True if two device keys refer to the same device or a disk and its partition."""
+    return a == b or BARRIER in (a, b) or parent_device(a) == b or parent_device(b) == a
+
+
+def classify(argv: list[str]) -> tuple[set, set, bool]:
+    """
+    Derives (reads, writes, interactive) for a command. Devices are paths,
+    volume groups are 'vg:<name>'. Unknown commands get the BARRIER key.
+    """
+    args = command_args.strip_sudo(argv)
+    if not args:
+        return set(), set(), False
+    tool = os.path.basename(args[0])
+    positionals = command_args.positionals(args[1:])
+    devices = [arg for arg in positionals if arg.startswith("/dev/")]
+
+    if tool in ("sfdisk", "parted", "wipefs", "blkdiscard", "partprobe", "mkswap", "pvcreate") \
+            or tool.startswith("mkfs"):
+        return set(), set(devices), False
+    if tool == "cryptsetup" and len(positionals) >= 2:
+        action = positionals[0]
+        interactive = command_args.option_value(args, "--key-file") is None and \
+            not any(a.startswith("--key-file=") for a in args)
+        if action == "luksFormat":
+            return set(), set(devices), interactive
+        if action in ("open", "luksOpen") and len(positionals) >= 3:
+            return set(devices), {f"/dev/mapper/{positionals[2]}"}, interactive
+        return set(devices), set(devices), interactive
+    if tool == "vgcreate" and positionals:
+        return set(), {f"vg:{positionals[0]}", *devices}, False
+    if tool in ("vgextend", "vgchange", "vgremove") and positionals:
+        return set(devices), {f"vg:{positionals[0]}"}, False
+    if tool == "lvcreate" and positionals:
+        vg_name = positionals[0]
+        writes = {f"vg:{vg_name}"}
+        name = command_args.option_value(args, "-n", "--name")
+        if name:
+            writes.add(f"/dev/{vg_name}/{name}")
+        return set(devices), writes, False
+    return set(), {BARRIER}, False
+
+
+def parse_script(path: str) -> list[Operation]:
+    """Parses one template script into operations, in file order."""
+    operations = []
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    name = os.path.basename(path)
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        i += 1
+        if not line or line.startswith("#"):
+            continue
+        stdin = None
+        heredoc = _HEREDOC_PATTERN.search(line)
+        if heredoc:
+            terminator = heredoc.group(1)
+            line = line[:heredoc.start()].strip()
+            body = []
+            while i < len(lines) and lines[i].strip() != terminator:
+                body.append(lines[i])
+                i += 1
+            i += 1
+            stdin = "\n".join(body) + "\n"
+
+        argv = shlex.split(line)
+        if argv[-2:] == ["udevadm", "settle"] and operations:
+            # Settling belongs to the operation before it, not to the whole plan
+            operations[-1].after.append(argv)
+            continue
+        reads, writes, interactive = classify(argv)
+        operations.append(Operation(f"{name}:{len(operations) + 1}", argv, stdin, name, reads, writes,
+                                    interactive=interactive))
+    return operations
+
+
+def load_plan(template_dir: str) -> list[Operation]:
+    """
+    Loads the operations of a template: plan.json if present, otherwise the
+    numbered shell scripts in numeric order. Dependencies and fingerprints
+    are filled in.
+    """
+    plan_path = os.path.join(template_dir, PLAN_FILE)
+    operations = []
+    if os.path.exists(plan_path):
+        with open(plan_path) as f:
+            for index, entry in enumerate(json.load(f)["operations"]):
+                argv = entry["command"]
+                reads, writes, interactive = classify(argv)
+                operations.append(Operation(
+                    entry.get("id", f"{PLAN_FILE}:{index + 1}"), argv, entry.get("stdin"), PLAN_FILE,
+                    set(entry.get("reads", reads)), set(entry.get("writes", writes)),
+                    after=entry.get("after", []), interactive=entry.get("interactive", interactive)))
+    else:
+        scripts = []
+        for path in glob.glob(os.path.join(template_dir, "*.sh")):
+            match = _SCRIPT_PATTERN.match(os.path.basename(path))
+            if match:
+                scripts.append((int(match.group(1)), path))
+        for _, path in sorted(scripts):
+            operations.extend(parse_script(path))
+
+    link(operations)
+    return operations
+
+
+def link(operations: list[Operation]) -> None:
+    """
+    Computes each operation's dependencies (earlier operations on related
+    devices) and its fingerprint, which covers its own command and the
+    fingerprints of everything it depends on.
+    """
+    by_id = {}
+    for index, op in enumerate(operations):
+        op.deps = [earlier.id for earlier in operations[:index]
+                   if any(_related(a, b) for a in op.keys for b in earlier.keys)
+                   and (op.writes or earlier.writes)]
+        digest = hashlib.sha256(json.dumps([op.argv, op.stdin, op.after]).encode())
+        for dep in op.deps:
+            digest.update(by_id[dep].fingerprint.encode())
+        op.fingerprint = digest.hexdigest()
+        by_id[op.id] = op
+
+
+def _machine_id() -> str:
+    for path in ("/etc/machine-id", "/var/lib/dbus/machine-id"):
+        try:
+            with open(path) as f:
+                machine_id = f.read().strip()
+            if machine_id:
+                return machine_id
+        except OSError:
+            continue
+    return os.uname().nodename
+
+
+def _disk_identities(disks: set[str]) -> dict[str, str]:
+    """Maps each disk to 'wwn|serial|ptuuid' as reported by lsblk (empty if unknown)."""
+    if not disks:
+        return {}
+    try:
+        result = subprocess.run(["lsblk", "--nodeps", "--json", "-o", "PATH,WWN,SERIAL,PTUUID", *sorted(disks)],
+                                capture_output=True, text=True)
+        devices = json.loads(result.stdout or "{}").get("blockdevices", [])
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not identify {', '.join(sorted(disks))}: {e}", file=sys.stderr)
+        devices = []
+    identities = dict.fromkeys(disks, "")
+    for device in devices:
+        if device.get("path") in identities:
+            identities[device["path"]] = "|".join(device.get(key) or "" for key in ("wwn", "serial", "ptuuid"))
+    return identities
+
+
+def state_keys(operations: list[Operation]) -> dict[str, str]:
+    """
+    Returns the key each operation is remembered under: its fingerprint
+    combined with the machine id, the identity of the disks it touches and
+    the keys of its dependencies.
+    """
+    disks = {op.id: {parent_device(key) or key for key in op.keys
+                     if key.startswith("/dev/") and not key.startswith("/dev/mapper/")
+                     and (parent_device(key) or os.path.dirname(key) == "/dev")}
+             for op in operations}
+    identities = _disk_identities(set().union(*disks.values()))
+    machine_id = _machine_id()
+    keys = {}
+    for op in operations:
+        digest = hashlib.sha256(f"{machine_id}\0{op.fingerprint}".encode())
+        for disk in sorted(disks[op.id]):
+            digest.update(f"\0{disk}={identities[disk]}".encode())
+        for dep in op.deps:
+            digest.update(keys[dep].encode())
+        keys[op.id] = digest.hexdigest()
+    return keys
+
+
+def state_path(template_dir: str) -> str:
+    """The state file of a template on this machine (outside the template directory)."""
+    name = hashlib.sha256(os.path.abspath(template_dir).encode()).hexdigest()[:16]
+    return os.path.join(STATE_DIR, f"{os.path.basename(os.path.abspath(template_dir))}-{name}.json")
+
+
+def load_state(template_dir: str, operations: list[Operation]) -> set[str]:
+    """Returns the fingerprints of the operations applied successfully before, on these disks."""
+    try:
+        with open(state_path(template_dir)) as f:
+            stored = set(json.load(f).get("applied", []))
+    except (OSError, ValueError):
+        return set()
+    keys = state_keys(operations)
+    return {op.fingerprint for op in operations if keys[op.id] in stored}
+
+
+def save_state(template_dir: str, operations: list[Operation], applied: set[str]) -> None:
+    """Remembers the operations whose fingerprint is in 'applied', keyed by the disks as they are now."""
+    keys = state_keys(operations)
+    path = state_path(template_dir)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"template": os.path.abspath(template_dir),
+                       "applied": sorted(keys[op.id] for op in operations if op.fingerprint in applied)}, f, indent=2)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Warning: could not save the plan state to {path}: {e}", file=sys.stderr)
+
+
+def _run_operation(op: Operation, tty_lock: threading.Lock) -> None:
+    """Runs an operation and its follow-up commands, raising on failure."""
+    commands = [op.argv] + op.after
+    if not op.interactive and all(argv[:1] == ["sudo"] for argv in commands):
+        # One round trip to the privileged helper for the command and its settle
+        from . import privileged_helper
+        for result in privileged_helper.run_batch([(argv, op.stdin if argv is op.argv else None)
+                                                   for argv in commands]):
+            result.check_returncode()
+        return
+    for argv in commands:
+        stdin = op.stdin if argv is op.argv else None
+        if op.interactive:
+            # Passphrase prompts need the terminal, one at a time
+            with tty_lock:
+                subprocess.run(argv, input=stdin, text=True, check=True)
+        else:
+            subprocess.run(argv, input=stdin, text=True, check=True, capture_output=True)
+
+
+def execute(operations: list[Operation], template_dir: str, max_workers: int = 4,
+            force: bool = False, progress=None, skip=None) -> list[dict]:
+    """
+    Runs the plan. Ready operations (all dependencies finished) run in
+    parallel; operations whose fingerprint was already applied are marked
+    'unchanged' unless 'force' is set. 'skip(op)' may return a reason to
+    leave an operation out (used by reconcile mode); if it raises
+    StateUnknown the operation is reported 'blocked' instead of being run
+    blind. 'progress(result)' is called after each operation. Returns one
+    result dict per operation.
+    """
+    applied = set() if force else load_state(template_dir, operations)
+    succeeded = set(applied)
+    by_id = {op.id: op for op in operations}
+    pending = {op.id: set(op.deps) for op in operations}
+    dependents = {op.id: [] for op in operations}
+    for op in operations:
+        for dep in op.deps:
+            dependents[dep].append(op.id)
+
+    results = {}
+    tty_lock = threading.Lock()
+
+    def finish(op_id: str, status: str, elapsed: float = 0.0, error: str = "") -> None:
+        results[op_id] = {"id": op_id, "command": by_id[op_id].command_line(), "status": status,
+                          "elapsed": elapsed, "error": error}
+        if progress:
+            progress(results[op_id])
+
+    def timed(op: Operation) -> float:
+        start = time.monotonic()
+        _run_operation(op, tty_lock)
+        return time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plan") as executor:
+        running = {}
+        while pending or running:
+            for op_id in [i for i, deps in pending.items() if not deps]:
+                del pending[op_id]
+                op = by_id[op_id]
+                failed_deps = [d for d in op.deps if results[d]["status"] in ("failed", "blocked")]
+                reason, unknown = None, None
+                if skip and not failed_deps:
+                    try:
+                        reason = skip(op)
+                    except StateUnknown as e:
+                        unknown = str(e)
+                if failed_deps:
+                    finish(op_id, "blocked", error=f"depends on failed {failed_deps[0]}")
+                elif unknown:
+                    finish(op_id, "blocked", error=f"live state unknown: {unknown}")
+                elif op.fingerprint in applied:
+                    finish(op_id, "unchanged")
+                elif reason:
+                    finish(op_id, "satisfied", error=reason)
+                    succeeded.add(op.fingerprint)
+                else:
+                    running[executor.submit(timed, op)] = op_id
+                    continue
+                for child in dependents[op_id]:
+                    pending[child].discard(op_id)
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                op_id = running.pop(future)
+                try:
+                    finish(op_id, "applied", future.result())
+                    succeeded.add(by_id[op_id].fingerprint)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    stderr = getattr(e, "stderr", None)
+                    finish(op_id, "failed", error=(stderr or str(e)).strip())
+                except Exception as e:  # A broken helper reply or a bug fails this operation, not the run
+                    finish(op_id, "failed", error=f"{type(e).__name__}: {e}")
+                for child in dependents[op_id]:
+                    pending[child].discard(op_id)
+
+    save_state(template_dir, operations, succeeded)
+    return [results[op.id] for op in operations]
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Apply a template directory as a dependency-ordered plan.")
+    parser.add_argument("template_dir")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="re-run every operation")
+    parser.add_argument("--dry-run", action="store_true", help="only show the plan")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="check each operation against the live disk state and run only what is missing")
+    args = parser.parse_args()
+
+    operations = load_plan(args.template_dir)
+
+    def progress(result: dict) -> None:
+        print(f"{result['status']:<10} {result['id']:<28} {result['elapsed']:6.2f}s {result['error']}")
+
+    if args.reconcile:
+        from . import reconcile
+        if args.dry_run:
+            for op, status, reason in reconcile.preview(operations):
+                print(f"{op.id:<28} {status:<10} {reason}\n    {op.command_line()}")
+            return
+        results = reconcile.reconcile(operations, args.template_dir, args.workers, progress=progress)
+        sys.exit(0 if all(r["status"] not in ("failed", "blocked") for r in results) else 1)
+
+    if args.dry_run:
+        applied = load_state(args.template_dir, operations)
+        for op in operations:
+            state = "unchanged" if op.fingerprint in applied and not args.force else "pending"
+            print(f"{op.id:<28} {state:<10} after {', '.join(op.deps) or '-'}\n    {op.command_line()}")
+        return
+
+    results = execute(operations, args.template_dir, args.workers, args.force, progress=progress)
+    sys.exit(0 if all(r["status"] not in ("failed", "blocked") for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,723 @@
+import fcntl
+import json
+import os
+import re
+import shlex
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+
+from .command_args import strip_sudo
+
+# Long-lived root helper. Instead of running every mutating command through
+# 'sudo' (PAM, a fresh sudo process and its child each time), the installer
+# escalates once at startup: 'sudo python3 -m utils.privileged_helper' listens
+# on a Unix socket that only the invoking user can connect to and runs
+# allow-listed commands on its behalf. Requests and replies are JSON objects
+# with a 4-byte big-endian length prefix:
+#
+#   {"op": "ping"}
+#   {"op": "run", "argv": [...], "stdin": "..."}
+#   {"op": "batch", "commands": [{"argv": [...], "stdin": "..."}, ...]}
+#   {"op": "wipe", "devices": ["/dev/sdb", ...], "mode": "signatures"}
+#   {"op": "job", "module": "utils.image_deploy", "args": [...], "files": 1}
+#   {"op": "shutdown"}
+#
+# 'batch' runs its commands in order and stops at the first failure.
+# 'wipe' runs utils.wipe in the helper itself, on block devices only.
+# 'job' runs one of the image modules (deploy, capture, chunk store deploy,
+# verify) as 'python -m <module> --json-progress' and replies with one
+# {"line": ...} message per progress line, then {"done": true, "returncode":
+# ..., "stderr": ...}. The files it reads or writes are opened by the client
+# and passed over the socket (SCM_RIGHTS, right after the request), so the
+# job can only touch files the user could open; devices must be block devices.
+# Callers use run()/run_batch(), which fall back to plain sudo when the
+# helper cannot be started (or OS_INSTALLER_HELPER=0 is set).
+
+# Commands are checked against the shapes the installer generates, not
+# just the tool name: every option must be one the tool is used with, and
+# every positional argument must be of the expected kind. Devices must be
+# existing block devices, so a connected process cannot point mkfs or wipefs
+# at a file such as /etc/shadow. 'lvm' is either an LVM subcommand or a
+# shell session whose stdin lines are checked the same way.
+
+_LVM_VALUES = frozenset({"--reportformat", "--config", "--units", "-o", "--options"})
+_LVM_SUBCOMMANDS = {"pvcreate", "vgcreate", "lvcreate", "pvs", "vgs", "lvs"}
+_NAME = re.compile(r"^[A-Za-z0-9+_.][A-Za-z0-9+_.-]*$")     # VG, LV and mapper names
+
+
+@dataclass(frozen=True)
+class CommandShape:
+    """
+    What one tool may be run with. 'args' maps the action (the first
+    positional; None for tools without one) to the kinds of the positionals
+    that follow: 'device' (an existing block device), 'name' (VG or mapper
+    name), 'target' (either) or 'word' (a parted command word or number).
+    A trailing '*' or '+' repeats the last kind zero or one or more times.
+    """
+    flags: frozenset = frozenset()          # Options without a value
+    values: frozenset = frozenset()         # Options with a value ('-o value' or '--option=value')
+    args: dict = field(default_factory=lambda: {None: ("device",)})
+
+
+def _shape(flags=(), values=(), args=None) -> CommandShape:
+    return CommandShape(frozenset(flags), frozenset(values), args or {None: ("device",)})
+
+
+ALLOWED_COMMANDS = {
+    "parted": _shape({"-s", "--script", "-m", "--machine"}, {"-a", "--align"}, {None: ("device", "word*")}),
+    "sfdisk": _shape({"-q", "--quiet", "-J", "--json", "-a", "--append", "--no-reread", "--no-tell-kernel"},
+                     {"-w", "--wipe", "-W", "--wipe-partitions", "-X", "--label"}),
+    "wipefs": _shape({"-a", "--all", "-q", "--quiet", "-f", "--force", "-n", "--no-act"}, {"-t", "--types"},
+                     {None: ("device+",)}),
+    "partprobe": _shape({"-s", "--summary"}, (), {None: ("device*",)}),
+    "blkdiscard": _shape({"-f", "--force", "-z", "--zeroout", "-s", "--secure", "-v", "--verbose"},
+                         {"-o", "--offset", "-l", "--length", "-p", "--step"}),
+    "blkid": _shape({"-p", "--probe"}, {"-o", "--output", "-s", "--match-tag"}, {None: ("device+",)}),
+    "mkswap": _shape({"-f", "--force"}, {"-L", "--label", "-U", "--uuid"}),
+    "mkfs.ext4": _shape({"-F", "-q"}, {"-b", "-E", "-L", "-U", "-T", "-O", "-m", "-i", "-N"}),
+    "mkfs.xfs": _shape({"-f", "-q", "-K"}, {"-b", "-d", "-L", "-l", "-m", "-n", "-s", "-i"}),
+    "mkfs.btrfs": _shape({"-f", "-q", "-K", "--nodiscard"}, {"-L", "--label", "-d", "-m", "-n", "-s"}),
+    "mkfs.vfat": _shape({"-I"}, {"-F", "-n", "-s"}),
+    "cryptsetup": _shape({"-q", "--batch-mode", "-v", "--verbose", "--allow-discards"},
+                         {"--type", "-c", "--cipher", "-s", "--key-size", "-h", "--hash", "--sector-size", "--pbkdf",
+                          "--pbkdf-memory", "--pbkdf-parallel", "-i", "--iter-time", "-d", "--key-file", "-S",
+                          "--key-slot", "--label"},
+                         {"luksFormat": ("device",), "open": ("device", "name"), "luksOpen": ("device", "name"),
+                          "close": ("name",), "luksClose": ("name",), "luksAddKey": ("device",),
+                          "luksDump": ("device",), "isLuks": ("device",), "status": ("name",), "benchmark": ()}),
+    "pvcreate": _shape({"-y", "--yes", "-f", "-ff", "--force", "-q"},
+                       _LVM_VALUES | {"--dataalignment", "--metadatasize"}, {None: ("device+",)}),
+    "vgcreate": _shape({"-y", "--yes", "-q"}, _LVM_VALUES | {"-s", "--physicalextentsize"},
+                       {None: ("name", "device+")}),
+    "lvcreate": _shape({"-y", "--yes", "-q"},
+                       _LVM_VALUES | {"-L", "--size", "-l", "--extents", "-n", "--name", "-i", "--stripes", "-I",
+                                      "--stripesize", "-m", "--mirrors", "--type"},
+                       {None: ("name", "device*")}),
+    "pvs": _shape({"-a", "--all", "--noheadings", "--nosuffix"}, _LVM_VALUES | {"--separator", "-O", "--sort"},
+                  {None: ("target*",)}),
+    "vgs": _shape({"--noheadings", "--nosuffix"}, _LVM_VALUES | {"--separator", "-O", "--sort"},
+                  {None: ("target*",)}),
+    "lvs": _shape({"-a", "--all", "--noheadings", "--nosuffix"}, _LVM_VALUES | {"--separator", "-O", "--sort"},
+                  {None: ("target*",)}),
+    "lvm": _shape(args={None: ()}),
+    "udevadm": _shape((), {"-t", "--timeout"}, {"settle": (), "trigger": ()}),
+}
+# Tools are only looked up here, never in the caller's PATH
+SAFE_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+
+_HEADER = struct.Struct(">I")
+_MAX_MESSAGE = 64 * 1024 * 1024
+_START_TIMEOUT = 60.0  # Seconds to wait for sudo (including a password prompt)
+
+
+class HelperError(Exception):
+    """Raised when the helper rejects a request or the connection fails."""
+
+
+def send_message(sock: socket.socket, message: dict) -> None:
+    data = json.dumps(message).encode()
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock: socket.socket) -> dict:
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if size > _MAX_MESSAGE:
+        raise ConnectionError(f"message of {size} bytes is too large")
+    return json.loads(_recv_exact(sock, size))
+
+
+# --- Helper (root) side ---
+
+def _is_block_device(path: str) -> bool:
+    real = os.path.realpath(path)
+    try:
+        return real.startswith("/dev/") and stat.S_ISBLK(os.stat(real).st_mode)
+    except OSError:
+        return False
+
+
+def _check_positional(tool: str, kind: str, arg: str) -> None:
+    if kind == "device":
+        ok = _is_block_device(arg)
+    elif kind == "name":
+        ok = bool(_NAME.match(arg))
+    elif kind == "target":
+        ok = bool(_NAME.match(arg)) or _is_block_device(arg)
+    else:
+        ok = "/" not in arg
+    if not ok:
+        raise HelperError(f"'{arg}' is not a valid {kind} for {tool}")
+
+
+def _check_shape(tool: str, args: list[str]) -> None:
+    """Raises HelperError unless 'args' fit one of the tool's shapes."""
+    shape = ALLOWED_COMMANDS[tool]
+    positionals = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg.startswith("-") and len(arg) > 1:
+            name = arg.split("=", 1)[0]
+            if name in shape.values:
+                if "=" not in arg:
+                    index += 1
+                    if index == len(args):
+                        raise HelperError(f"option '{arg}' of {tool} needs a value")
+            elif arg not in shape.flags:
+                raise HelperError(f"option '{arg}' is not allowed for {tool}")
+        else:
+            positionals.append(arg)
+        index += 1
+
+    if None in shape.args:
+        kinds = shape.args[None]
+    elif positionals and positionals[0] in shape.args:
+        kinds = shape.args[positionals.pop(0)]
+    else:
+        raise HelperError(f"'{tool} {positionals[0] if positionals else ''}' is not allowed")
+    repeat = kinds[-1][-1] if kinds and kinds[-1][-1] in "*+" else ""
+    fixed = [kind.rstrip("*+") for kind in kinds]
+    if len(positionals) < len(fixed) - (repeat == "*") or (not repeat and len(positionals) > len(fixed)):
+        raise HelperError(f"wrong number of arguments for {tool}")
+    for position, arg in enumerate(positionals):
+        _check_positional(tool, fixed[min(position, len(fixed) - 1)], arg)
+
+
+def validate(argv, stdin: str | None = None) -> str:
+    """
+    Checks a command against the allow-list and returns the absolute path of
+    its tool. Raises HelperError for anything that is not allowed.
+    """
+    if not isinstance(argv, list) or not argv or not all(isinstance(arg, str) for arg in argv):
+        raise HelperError("argv must be a non-empty list of strings")
+    tool = argv[0]
+    if "/" in tool or tool not in ALLOWED_COMMANDS:
+        raise HelperError(f"'{tool}' is not an allowed command")
+    if tool == "lvm" and len(argv) > 1:
+        if argv[1] not in _LVM_SUBCOMMANDS:
+            raise HelperError(f"'lvm {argv[1]}' is not allowed")
+        _check_shape(argv[1], argv[2:])
+    elif tool == "lvm" and stdin:
+        # An lvm shell session: every line is a command of its own
+        for line in stdin.splitlines():
+            try:
+                words = shlex.split(line)
+            except ValueError as e:
+                raise HelperError(f"unreadable lvm shell line: {e}")
+            if not words or words in (["exit"], ["quit"]):
+                continue
+            if words[0] not in _LVM_SUBCOMMANDS:
+                raise HelperError(f"'{words[0]}' is not allowed in an lvm shell")
+            _check_shape(words[0], words[1:])
+    else:
+        _check_shape(tool, argv[1:])
+    path = shutil.which(tool, path=SAFE_PATH)
+    if path is None:
+        raise HelperError(f"{tool} not found")
+    return path
+
+
+def _execute(command: dict) -> dict:
+    argv = command.get("argv")
+    stdin = command.get("stdin")
+    if stdin is not None and not isinstance(stdin, str):
+        raise HelperError("stdin must be a string")
+    path = validate(argv, stdin)
+    # Without input, stdin must not be the helper's own: that is the installer's liveness pipe
+    stdin_args = {"input": stdin} if stdin is not None else {"stdin": subprocess.DEVNULL}
+    result = subprocess.run([path] + argv[1:], capture_output=True, text=True,
+                            env={"PATH": SAFE_PATH, "LC_ALL": "C"}, **stdin_args)
+    return {"returncode": result.returncode, "stdout": result.stdout, "stderr": result.stderr}
+
+
+def _validate_wipe(request: dict) -> tuple[list[str], str]:
+    from . import wipe
+    devices, mode = request.get("devices"), request.get("mode")
+    if mode not in wipe.MODES:
+        raise HelperError(f"unknown wipe mode '{mode}'")
+    if not isinstance(devices, list) or not devices or not all(isinstance(d, str) for d in devices):
+        raise HelperError("devices must be a non-empty list of strings")
+    for device in devices:
+        real = os.path.realpath(device)
+        if not real.startswith("/dev/") or not os.path.exists(real) or not stat.S_ISBLK(os.stat(real).st_mode):
+            raise HelperError(f"'{device}' is not a block device")
+    return devices, mode
+
+
+# Argument patterns of the jobs: literals, "device" (a block device),
+# "compression", or a file passed by the client: "in" (read), "out" (written)
+# or "dir" (a directory read through). Verify repeats its pattern per device.
+_JOBS = {
+    "utils.image_deploy": [("in", "device"), ("--delta", "in", "device")],
+    "utils.image_capture": [("--compression", "compression", "device", "out")],
+    "utils.chunk_store": [("--store", "dir", "deploy", "in", "device")],
+    "utils.verify": [("--check", "device", "in")],
+}
+_REPEATED_JOBS = {"utils.verify"}
+JOB_FILE_FLAGS = {"in": os.O_RDONLY, "out": os.O_WRONLY | os.O_CREAT | os.O_TRUNC, "dir": os.O_RDONLY | os.O_DIRECTORY}
+_MAX_JOB_FILES = 16
+
+
+def job_kinds(module: str, args: list[str]) -> list[str]:
+    """
+    Returns the kind of each argument of a job (the pattern entry it
+    matched). Raises HelperError if the arguments match no pattern.
+    """
+    if module not in _JOBS:
+        raise HelperError(f"'{module}' is not an allowed job")
+    if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+        raise HelperError("args must be a list of strings")
+    from .image_capture import COMPRESSION_LEVELS
+
+    def matches(kind: str, arg: str) -> bool:
+        if kind == "device":
+            return _is_block_device(arg)
+        if kind == "compression":
+            return arg in COMPRESSION_LEVELS
+        return kind in JOB_FILE_FLAGS or arg == kind
+
+    for pattern in _JOBS[module]:
+        if module in _REPEATED_JOBS and args and len(args) % len(pattern) == 0:
+            pattern = pattern * (len(args) // len(pattern))
+        if len(pattern) == len(args) and all(matches(kind, arg) for kind, arg in zip(pattern, args)):
+            return list(pattern)
+    raise HelperError(f"arguments {args} do not match a {module} job (devices must be block devices)")
+
+
+def _check_job_file(kind: str, fd: int) -> None:
+    # The job reopens the file as root, so the client's fd must grant the access the job needs
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    mode = os.fstat(fd).st_mode
+    if flags & getattr(os, "O_PATH", 0):
+        raise HelperError("files must be opened for reading or writing, not with O_PATH")
+    if kind == "dir" and not stat.S_ISDIR(mode):
+        raise HelperError("the store must be passed as a directory")
+    if kind != "dir" and not stat.S_ISREG(mode):
+        raise HelperError("job files must be regular files")
+    if (flags & os.O_ACCMODE) != (os.O_WRONLY if kind == "out" else os.O_RDONLY) and \
+            (flags & os.O_ACCMODE) != os.O_RDWR:
+        raise HelperError(f"an '{kind}' file must be open for {'writing' if kind == 'out' else 'reading'}")
+
+
+def _run_job(conn: socket.socket, request: dict) -> None:
+    """Runs a 'job' request, streaming its progress lines back on 'conn'."""
+    count = request.get("files")
+    fds = []
+    try:
+        if not isinstance(count, int) or not 0 <= count <= _MAX_JOB_FILES:
+            raise HelperError("files must be a small count")
+        if count:
+            # The descriptors always follow the request, so read them before any check can fail
+            _, fds, _, _ = socket.recv_fds(conn, 1, count)
+        module, args = request.get("module"), request.get("args")
+        kinds = job_kinds(module, args)
+        files = [(kind, arg) for kind, arg in zip(kinds, args) if kind in JOB_FILE_FLAGS]
+        if len(fds) != len(files):
+            raise HelperError(f"{len(files)} file(s) expected, {len(fds)} received")
+        for (kind, _), fd in zip(files, fds):
+            _check_job_file(kind, fd)
+    except HelperError as e:
+        for fd in fds:
+            os.close(fd)
+        send_message(conn, {"ok": False, "error": str(e)})
+        return
+
+    # Each file is reached through a symlink to the passed descriptor that keeps its
+    # extension (verify tells manifests by it); progress lines name the client's paths
+    job_dir = tempfile.mkdtemp(prefix="os_installer_job_")
+    argv, renames, fd_iter = [], {}, iter(fds)
+    for kind, arg in zip(kinds, args):
+        if kind in JOB_FILE_FLAGS:
+            suffix = os.path.splitext(arg)[1] if re.match(r"^\.\w{1,8}$", os.path.splitext(arg)[1]) else ""
+            link = os.path.join(job_dir, f"{len(renames)}{suffix}")
+            os.symlink(f"/proc/self/fd/{next(fd_iter)}", link)
+            renames[json.dumps(link)] = json.dumps(arg)
+            arg = link
+        argv.append(arg)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    stderr = []
+    try:
+        process = subprocess.Popen([sys.executable, "-m", module, "--json-progress", *argv],
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True, cwd=package_root, pass_fds=fds, env={"PATH": SAFE_PATH, "LC_ALL": "C"})
+        # Read stderr as it comes, or a chatty job blocks on a full pipe
+        drain = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        drain.start()
+        try:
+            for line in process.stdout:
+                for link, arg in renames.items():
+                    line = line.replace(link, arg)
+                send_message(conn, {"ok": True, "line": line})
+        except OSError:
+            # The client is gone; nobody follows the job any more
+            process.kill()
+        process.wait()
+        drain.join()
+    finally:
+        for fd in fds:
+            os.close(fd)
+        shutil.rmtree(job_dir, ignore_errors=True)
+    send_message(conn, {"ok": True, "done": True, "returncode": process.returncode, "stderr": "".join(stderr)})
+
+
+def handle_request(request: dict) -> dict:
+    """Executes one request and returns the reply."""
+    op = request.get("op") if isinstance(request, dict) else None
+    try:
+        if op == "ping":
+            return {"ok": True, "pid": os.getpid()}
+        if op == "run":
+            return {"ok": True, "results": [_execute(request)]}
+        if op == "batch":
+            commands = request.get("commands")
+            if not isinstance(commands, list):
+                raise HelperError("commands must be a list")
+            # Validate everything first so a batch is never half-rejected
+            for command in commands:
+                if not isinstance(command, dict):
+                    raise HelperError("each command must be an object")
+                stdin = command.get("stdin")
+                validate(command.get("argv"), stdin if isinstance(stdin, str) else None)
+            results = []
+            for command in commands:
+                results.append(_execute(command))
+                if results[-1]["returncode"] != 0:
+                    break
+            return {"ok": True, "results": results}
+        if op == "wipe":
+            from . import wipe
+            devices, mode = _validate_wipe(request)
+            return {"ok": True, "results": [asdict(result) for result in wipe.wipe_devices(devices, mode)]}
+        raise HelperError(f"unknown op '{op}'")
+    except HelperError as e:
+        return {"ok": False, "error": str(e)}
+
+
+def _peer_uid(conn: socket.socket) -> int:
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid
+
+
+def _serve_connection(conn: socket.socket, allowed_uid: int, stop: threading.Event) -> None:
+    with conn:
+        if _peer_uid(conn) not in (allowed_uid, 0):
+            return
+        while True:
+            try:
+                request = recv_message(conn)
+            except (ConnectionError, ValueError, OSError):
+                return
+            if isinstance(request, dict) and request.get("op") == "shutdown":
+                send_message(conn, {"ok": True})
+                stop.set()
+                return
+            if isinstance(request, dict) and request.get("op") == "job":
+                try:
+                    _run_job(conn, request)
+                except OSError:
+                    return
+                continue
+            send_message(conn, handle_request(request))
+
+
+def serve(socket_path: str, allowed_uid: int) -> None:
+    """
+    Listens on 'socket_path' until a shutdown request arrives or stdin (the
+    pipe from the installer) is closed. Only 'allowed_uid' and root may connect.
+    """
+    stop = threading.Event()
+    old_umask = os.umask(0o177)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    os.chown(socket_path, allowed_uid, -1, follow_symlinks=False)
+    server.listen(16)
+    server.settimeout(0.5)
+
+    def watch_parent():
+        # The installer holds our stdin; EOF means it is gone
+        sys.stdin.buffer.read()
+        stop.set()
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+    try:
+        while not stop.is_set():
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            threading.Thread(target=_serve_connection, args=(conn, allowed_uid, stop), daemon=True).start()
+    finally:
+        server.close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
+
+# --- Installer (client) side ---
+
+class HelperClient:
+    """Connection to a running helper. Each thread uses its own connection."""
+
+    def __init__(self, socket_path: str, process: subprocess.Popen | None = None):
+        self.socket_path = socket_path
+        self.process = process
+        self._local = threading.local()
+
+    def _connection(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def request(self, message: dict) -> dict:
+        try:
+            sock = self._connection()
+            send_message(sock, message)
+            reply = recv_message(sock)
+        except (OSError, ConnectionError, ValueError) as e:
+            self._local.sock = None
+            raise HelperError(f"helper connection failed: {e}")
+        if not reply.get("ok"):
+            raise HelperError(reply.get("error", "request failed"))
+        return reply
+
+    def close(self) -> None:
+        try:
+            self.request({"op": "shutdown"})
+        except HelperError:
+            pass
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+        try:
+            os.rmdir(os.path.dirname(self.socket_path))
+        except OSError:
+            pass
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def start() -> bool:
+    """
+    Starts the helper with a single sudo call. Returns True if it is
+    running. Call this before curses takes over the terminal, since sudo
+    may ask for a password.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return True
+        if os.environ.get("OS_INSTALLER_HELPER", "1") == "0" or os.geteuid() == 0:
+            return False
+        socket_dir = tempfile.mkdtemp(prefix="os_installer_")
+        socket_path = os.path.join(socket_dir, "helper.sock")
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        try:
+            process = subprocess.Popen(
+                ["sudo", sys.executable, "-m", "utils.privileged_helper",
+                 "--socket", socket_path, "--uid", str(os.getuid())],
+                stdin=subprocess.PIPE, cwd=package_root)
+        except FileNotFoundError as e:
+            print(f"Privileged helper not started: {e}", file=sys.stderr)
+            return False
+
+        client = HelperClient(socket_path, process)
+        deadline = time.monotonic() + _START_TIMEOUT
+        while time.monotonic() < deadline and process.poll() is None:
+            if os.path.exists(socket_path):
+                try:
+                    client.request({"op": "ping"})
+                    _client = client
+                    return True
+                except HelperError:
+                    pass
+            time.sleep(0.05)
+        print("Privileged helper did not start, falling back to sudo per command.", file=sys.stderr)
+        if process.poll() is None:
+            process.kill()
+        return False
+
+
+def stop() -> None:
+    """Shuts the helper down."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def _completed(argv: list[str], result: dict, check: bool, text: bool) -> subprocess.CompletedProcess:
+    stdout, stderr = result["stdout"], result["stderr"]
+    if not text:
+        stdout, stderr = stdout.encode(), stderr.encode()
+    completed = subprocess.CompletedProcess(argv, result["returncode"], stdout, stderr)
+    if check:
+        completed.check_returncode()
+    return completed
+
+
+def run(argv: list[str], input: str | None = None, check: bool = False, capture_output: bool = False,
+        text: bool = False, **kwargs) -> subprocess.CompletedProcess:
+    """
+    Drop-in for subprocess.run() of a 'sudo ...' command. Goes through the
+    helper when it runs, otherwise runs the command with sudo (or directly
+    as root). Output that is not captured is echoed like the command would.
+    """
+    command = strip_sudo(argv)
+    client = _client
+    if client is None:
+        if os.geteuid() == 0:
+            argv = command
+        return subprocess.run(argv, input=input, check=check, capture_output=capture_output, text=text,
+                              **kwargs)
+    try:
+        reply = client.request({"op": "run", "argv": command, "stdin": input})
+    except HelperError as e:
+        # Not on the allow-list, or the helper went away: let sudo decide
+        print(f"Privileged helper: {e}; using sudo.", file=sys.stderr)
+        return subprocess.run(argv, input=input, check=check, capture_output=capture_output, text=text,
+                              **kwargs)
+    result = reply["results"][0]
+    if not capture_output:
+        sys.stdout.write(result["stdout"])
+        sys.stderr.write(result["stderr"])
+    return _completed(command, result, check, text or "encoding" in kwargs)
+
+
+def _run_each(commands: list[tuple[list[str], str | None]]) -> list[subprocess.CompletedProcess]:
+    results = []
+    for argv, stdin in commands:
+        results.append(run(argv, input=stdin, capture_output=True, text=True))
+        if results[-1].returncode != 0:
+            break
+    return results
+
+
+def run_batch(commands: list[tuple[list[str], str | None]]) -> list[subprocess.CompletedProcess]:
+    """
+    Runs several commands in order with one round trip, stopping at the
+    first failure. Returns the results of the commands that ran; the last
+    one has a non-zero return code if a command failed.
+    """
+    client = _client
+    if client is None:
+        return _run_each(commands)
+    try:
+        reply = client.request({"op": "batch", "commands": [{"argv": strip_sudo(argv), "stdin": stdin}
+                                                            for argv, stdin in commands]})
+    except HelperError as e:
+        print(f"Privileged helper: {e}; using sudo.", file=sys.stderr)
+        return _run_each(commands)
+    return [_completed(strip_sudo(argv), result, False, True)
+            for (argv, _), result in zip(commands, reply["results"])]
+
+
+def request_wipe(devices: list[str], mode: str) -> list[dict] | None:
+    """Runs a wipe (see utils.wipe) in the helper. Returns None if the helper is not available."""
+    client = _client
+    if client is None:
+        return None
+    try:
+        return client.request({"op": "wipe", "devices": devices, "mode": mode})["results"]
+    except HelperError as e:
+        print(f"Privileged helper: {e}; using sudo.", file=sys.stderr)
+        return None
+
+
+def request_job(module: str, args: list[str], on_line) -> tuple[int, str] | None:
+    """
+    Runs a job (see _JOBS) in the helper, calling on_line() with each of its
+    progress lines. The files among 'args' are opened here, as the user.
+    Returns (returncode, stderr), or None if the helper is not available or
+    refused the job. Raises HelperError if the connection fails mid-job.
+    """
+    client = _client
+    if client is None:
+        return None
+    fds = []
+    try:
+        kinds = job_kinds(module, args)
+        for kind, arg in zip(kinds, args):
+            if kind in JOB_FILE_FLAGS:
+                fds.append(os.open(arg, JOB_FILE_FLAGS[kind], 0o644))
+    except (HelperError, OSError) as e:
+        for fd in fds:
+            os.close(fd)
+        print(f"Privileged helper: {e}; using sudo.", file=sys.stderr)
+        return None
+    # A connection of its own: the job's replies must not interleave with other requests
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(client.socket_path)
+            send_message(sock, {"op": "job", "module": module, "args": args, "files": len(fds)})
+            if fds:
+                socket.send_fds(sock, [b"\0"], fds)
+        except OSError as e:
+            print(f"Privileged helper: {e}; using sudo.", file=sys.stderr)
+            return None
+        finally:
+            for fd in fds:
+                os.close(fd)
+        started = False
+        while True:
+            try:
+                reply = recv_message(sock)
+            except (OSError, ConnectionError, ValueError) as e:
+                raise HelperError(f"helper connection failed: {e}")
+            if not reply.get("ok"):
+                if started:
+                    raise HelperError(reply.get("error", "job failed"))
+                print(f"Privileged helper: {reply.get('error')}; using sudo.", file=sys.stderr)
+                return None
+            if reply.get("done"):
+                return reply["returncode"], reply["stderr"]
+            started = True
+            on_line(reply["line"])
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Root helper for the OS installer (started by the installer).")
+    parser.add_argument("--socket", required=True)
+    parser.add_argument("--uid", type=int, required=True)
+    args = parser.parse_args()
+    if os.geteuid() != 0:
+        sys.exit("The privileged helper must run as root.")
+    serve(args.socket, args.uid)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from . import command_args, disk_ops, lvm_metadata, partition_table, plan, privileged_helper
+from .signatures import PROBE_SIZE, probe_bytes
+
+# Reconcile mode for template plans. Instead of trusting the fingerprints of
+# earlier runs, every operation is checked against the live state of the
+# disks (partition maps, LUKS headers, LVM labels and volume groups,
+# filesystem signatures) right before it would run. Operations whose result
+# already exists are skipped, so only the missing part of the template is
+# applied. The checks run when an operation becomes ready, so an operation
+# whose upstream was just re-created sees the new state, not the old one.
+# Devices this process cannot read are probed through the privileged helper
+# (sfdisk --json, blkid); if that fails too, the check raises
+# plan.StateUnknown and the operation is blocked rather than skipped or run.
+
+# Format a device ends up with after each kind of operation
+_MKFS_TYPES = {"mkswap": "swap"}
+
+
+def _normalize_type(type_id: str) -> str:
+    type_id = type_id.lower()
+    return type_id[2:] if type_id.startswith("0x") else type_id
+
+
+def parse_sfdisk_script(script: str) -> tuple[str | None, list[dict]]:
+    """Returns the label and the partitions (start, sectors, type) of an sfdisk input script."""
+    label = None
+    partitions = []
+    for line in script.splitlines():
+        line = line.strip()
+        if line.startswith("label:"):
+            label = line.split(":", 1)[1].strip()
+            continue
+        if not line.startswith("start="):
+            continue
+        fields = {}
+        for item in line.split(","):
+            key, _, value = item.strip().partition("=")
+            fields[key] = value.strip().strip('"')
+        partitions.append({"start": int(fields["start"]), "sectors": int(fields.get("size", 0)),
+                           "type": _normalize_type(fields.get("type", ""))})
+    return label, partitions
+
+
+def expected_formats(operations: list[plan.Operation]) -> dict[str, str]:
+    """Maps each device to the format the plan puts on it last (crypto_LUKS, LVM2_member, ext4, ...)."""
+    formats = {}
+    for op in operations:
+        tool, args = command_args.tool_args(op.argv)
+        devices = [arg for arg in command_args.positionals(args) if arg.startswith("/dev/")]
+        if tool == "cryptsetup" and args and "luksFormat" in args:
+            formats.update((device, "crypto_LUKS") for device in devices)
+        elif tool == "pvcreate":
+            formats.update((device, "LVM2_member") for device in devices)
+        elif tool.startswith("mkfs.") or tool in _MKFS_TYPES:
+            fs_type = _MKFS_TYPES.get(tool, tool.split(".", 1)[-1])
+            formats.update((device, fs_type) for device in devices[-1:])
+    return formats
+
+
+class LiveState:
+    """
+    Reads the state an operation is checked against. Partition maps and
+    signatures are read on every check (they are cheap and change while the
+    plan runs); the LVM report is one 'vgs'/'lvs' call that is cached until
+    an LVM operation has been applied.
+    """
+
+    def __init__(self, operations: list[plan.Operation]):
+        self.expected = expected_formats(operations)
+        self._lvm = None
+        self._lock = threading.Lock()
+
+    def invalidate_lvm(self) -> None:
+        with self._lock:
+            self._lvm = None
+
+    def lvm(self) -> dict:
+        """
+        Returns {'vgs': {vg: {...}}, 'lvs': {(vg, lv): {...}}}, read from the
+        on-disk LVM metadata, or from the vgs/lvs report when some devices
+        cannot be read by this process.
+        """
+        with self._lock:
+            if self._lvm is None:
+                native = lvm_metadata.get_lvm_state(refresh=True)
+                if not native.unreadable:
+                    self._lvm = {
+                        "vgs": {vg.name: {"vg_name": vg.name, "pv_count": len(vg.pvs)} for vg in native.vgs.values()},
+                        "lvs": {(vg.name, lv.name): {"vg_name": vg.name, "lv_name": lv.name, "lv_size": lv.size}
+                                for vg in native.vgs.values() for lv in vg.lvs.values()},
+                    }
+                    return self._lvm
+                self._lvm = {"vgs": {}, "lvs": {}}
+                for command, key in ((["sudo", "vgs", "--reportformat", "json", "--units", "b",
+                                       "-o", "vg_name,pv_count,vg_size"], "vg"),
+                                     (["sudo", "lvs", "--reportformat", "json", "--units", "b",
+                                       "-o", "vg_name,lv_name,lv_size"], "lv")):
+                    try:
+                        result = privileged_helper.run(command, capture_output=True, text=True, check=True)
+                        report = json.loads(result.stdout)["report"][0][key]
+                    except (FileNotFoundError, subprocess.CalledProcessError, ValueError, KeyError, IndexError) as e:
+                        print(f"Warning: could not read the LVM state: {e}", file=sys.stderr)
+                        continue
+                    for entry in report:
+                        if key == "vg":
+                            self._lvm["vgs"][entry["vg_name"]] = entry
+                        else:
+                            self._lvm["lvs"][(entry["vg_name"], entry["lv_name"])] = entry
+            return self._lvm
+
+    def partition_map(self, device: str) -> partition_table.PartitionMap:
+        """
+        Reads the partition map of a device, with 'sfdisk --json' as root
+        when this process cannot open it. Raises plan.StateUnknown if neither
+        works.
+        """
+        try:
+            pmap = partition_table.read_partition_map(device)
+        except PermissionError:
+            return self._privileged_partition_map(device)
+        if pmap is None:
+            raise plan.StateUnknown(f"cannot read the partition table of {device}")
+        return pmap
+
+    def _privileged_partition_map(self, device: str) -> partition_table.PartitionMap:
+        try:
+            result = privileged_helper.run(["sudo", "sfdisk", "--json", device], capture_output=True, text=True)
+        except OSError as e:
+            raise plan.StateUnknown(f"cannot read the partition table of {device}: {e}")
+        if result.returncode != 0:
+            if "does not contain a recognized partition table" in result.stderr:
+                return partition_table.PartitionMap(device, None, 512, 0, 0, 0)
+            raise plan.StateUnknown(f"cannot read the partition table of {device}: "
+                                    f"{result.stderr.strip() or f'sfdisk exited with {result.returncode}'}")
+        try:
+            table = json.loads(result.stdout)["partitiontable"]
+            label = {"dos": "msdos"}.get(table["label"], table["label"])
+            partitions = []
+            for number, entry in enumerate(table.get("partitions", []), 1):
+                type_id = entry["type"].lower()
+                if label == "msdos":
+                    type_id = f"0x{int(type_id, 16):02x}"
+                partitions.append(partition_table.Partition(number, entry["start"],
+                                                            entry["start"] + entry["size"] - 1, type_id))
+        except (ValueError, KeyError, TypeError) as e:
+            raise plan.StateUnknown(f"unexpected sfdisk output for {device}: {e}")
+        return partition_table.PartitionMap(device, label, table.get("sectorsize", 512), 0,
+                                            table.get("firstlba", 0), table.get("lastlba", 0), partitions)
+
+    def probe(self, device: str) -> str | None:
+        """
+        Returns the format signature on a device (None: no signature), with
+        'blkid -p' as root when this process cannot read it. Raises
+        plan.StateUnknown if neither works.
+        """
+        try:
+            with open(device, "rb", buffering=0) as f:
+                return probe_bytes(f.read(PROBE_SIZE))
+        except PermissionError:
+            pass
+        except OSError as e:
+            raise plan.StateUnknown(f"cannot read {device}: {e}")
+        try:
+            result = privileged_helper.run(["sudo", "blkid", "-p", "-o", "value", "-s", "TYPE", device],
+                                           capture_output=True, text=True)
+        except OSError as e:
+            raise plan.StateUnknown(f"cannot probe {device}: {e}")
+        if result.returncode == 2:
+            return None     # blkid found no signature
+        if result.returncode != 0:
+            raise plan.StateUnknown(f"cannot probe {device}: "
+                                    f"{result.stderr.strip() or f'blkid exited with {result.returncode}'}")
+        return result.stdout.strip() or None
+
+    def _partitions_match(self, device: str, label: str | None, wanted: list[dict]) -> str | None:
+        pmap = self.partition_map(device)
+        if pmap.label is None:
+            return None
+        if label and pmap.label != {"dos": "msdos"}.get(label, label):
+            return None
+        live = {(part.start, part.sectors): _normalize_type(part.type_id) for part in pmap.partitions}
+        for part in wanted:
+            live_type = live.get((part["start"], part["sectors"]))
+            if live_type is None or (part["type"] and live_type != part["type"]):
+                return None
+        if label and len(pmap.partitions) != len(wanted):
+            # A new label replaces the table; extra partitions would be removed
+            return None
+        return f"{len(wanted)} partition(s) already present on {device}"
+
+    def satisfied(self, op: plan.Operation) -> str | None:
+        """
+        Returns why an operation's result already exists, or None if it has
+        to run. Raises plan.StateUnknown if the device cannot be read.
+        """
+        tool, args = command_args.tool_args(op.argv)
+        positionals = command_args.positionals(args)
+        devices = [arg for arg in positionals if arg.startswith("/dev/")]
+
+        if tool == "sfdisk" and op.stdin and devices:
+            label, wanted = parse_sfdisk_script(op.stdin)
+            return self._partitions_match(devices[0], label, wanted)
+
+        if tool == "parted" and devices:
+            command = positionals[1:]
+            if command[:1] == ["mklabel"] and len(command) >= 2:
+                pmap = self.partition_map(devices[0])
+                if pmap.label == command[1]:
+                    return f"{devices[0]} already has a {command[1]} label"
+            elif command[:1] == ["mkpart"] and len(command) >= 3:
+                try:
+                    start, end = (int(value.rstrip("s")) for value in command[-2:] if value.endswith("s"))
+                except ValueError:
+                    return None
+                pmap = self.partition_map(devices[0])
+                if any(p.start == start and p.end == end for p in pmap.partitions):
+                    return f"partition {start}s-{end}s already exists on {devices[0]}"
+            return None
+
+        if tool == "wipefs" and devices:
+            # Wiping a device that already carries what the plan puts on it
+            # would destroy exactly what the later steps would find satisfied
+            current = self.probe(devices[0])
+            if current is None:
+                return f"{devices[0]} has no signatures"
+            if current == self.expected.get(devices[0]):
+                return f"{devices[0]} already holds the planned {current}"
+            return None
+
+        if tool == "cryptsetup" and positionals:
+            action = positionals[0]
+            if action == "luksFormat" and devices and self.probe(devices[0]) == "crypto_LUKS":
+                return f"{devices[0]} is already a LUKS device"
+            if action in ("open", "luksOpen") and len(positionals) >= 3 \
+                    and os.path.exists(f"/dev/mapper/{positionals[2]}"):
+                return f"/dev/mapper/{positionals[2]} is already open"
+            return None
+
+        if tool == "pvcreate" and devices:
+            if all(self.probe(device) == "LVM2_member" for device in devices):
+                return f"{', '.join(devices)} already initialized as physical volume(s)"
+            return None
+
+        if tool == "vgcreate" and positionals:
+            if positionals[0] in self.lvm()["vgs"]:
+                return f"volume group {positionals[0]} exists"
+            return None
+
+        if tool == "lvcreate" and positionals:
+            name = command_args.option_value(args, "-n", "--name")
+            if name and (positionals[0], name) in self.lvm()["lvs"]:
+                return f"logical volume {positionals[0]}/{name} exists"
+            return None
+
+        if (tool.startswith("mkfs.") or tool in _MKFS_TYPES) and devices:
+            fs_type = _MKFS_TYPES.get(tool, tool.split(".", 1)[-1])
+            if self.probe(devices[-1]) == fs_type:
+                return f"{devices[-1]} already contains {fs_type}"
+            return None
+
+        return None
+
+    def applied(self, result: dict, op: plan.Operation) -> None:
+        """Drops cached device and LVM state after an operation changed the disks."""
+        if result["status"] != "applied":
+            return
+        # New PV labels must show up in the inventory the LVM scan starts from
+        disk_ops.invalidate_disk_info(f"reconcile applied {op.id}")
+        if "pvcreate" in op.argv or any(key.startswith("vg:") for key in op.writes):
+            self.invalidate_lvm()
+
+
+def preview(operations: list[plan.Operation]) -> list[tuple[plan.Operation, str, str]]:
+    """
+    Checks every operation against the current state. Returns (operation,
+    status, reason) triples; status is 'satisfied', 'change' (the operation
+    would run) or 'unknown' (its device could not be read; it would be
+    blocked). Operations downstream of one that runs are reported as
+    running too, since their state will change.
+    """
+    state = LiveState(operations)
+    runs = set()
+    changes = []
+    for op in operations:
+        if runs.intersection(op.deps):
+            status, reason = "change", ""
+        else:
+            try:
+                reason = state.satisfied(op)
+                status, reason = ("satisfied", reason) if reason else ("change", "")
+            except plan.StateUnknown as e:
+                status, reason = "unknown", str(e)
+        if status != "satisfied":
+            runs.add(op.id)
+        changes.append((op, status, reason))
+    return changes
+
+
+def reconcile(operations: list[plan.Operation], template_dir: str, max_workers: int = 4,
+              progress=None) -> list[dict]:
+    """Applies only the operations whose result does not exist on the disks yet."""
+    state = LiveState(operations)
+    by_id = {op.id: op for op in operations}
+
+    def report(result: dict) -> None:
+        state.applied(result, by_id[result["id"]])
+        if progress:
+            progress(result)
+
+    return plan.execute(operations, template_dir, max_workers, force=True, progress=report,
+                        skip=state.satisfied)
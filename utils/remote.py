@@ -0,0 +1,511 @@
+import io
+import json
+import os
+import re
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+
+from . import command_args, plan
+
+# Remote installs. Instead of one SSH round trip per command, the template
+# is compiled into a plan (see utils.plan) on this machine, device paths are
+# mapped to the target's names, and the plan, every local file it refers
+# to (key files and the like) and the small agent that runs it are packed
+# into one tar.xz bundle. The bundle is piped into a single remote command,
+# which unpacks it into a temporary directory, runs the plan there with the
+# same dependency-ordered parallel executor as a local apply, and streams
+# one JSON line per finished operation back over the same connection.
+#
+# Transports only turn "run this argv on the target" into a local command:
+# SSHTransport uses one multiplexed connection (ControlMaster) for all
+# commands to a host; LocalTransport runs the same command in a subprocess
+# here, which stands in for a remote machine in tests and simulations.
+#
+# The target needs python3 (3.10 or newer) and nothing else from this repo.
+#
+# A timeout is enforced on the target: the agent gets it as --deadline, puts
+# itself in a process group of its own and, when the deadline passes, kills
+# every command in that group (mkfs, cryptsetup, ...) before it exits.
+# Killing the local ssh client alone would leave them running. The local
+# side only gives up DEADLINE_GRACE seconds later, for targets that stopped
+# answering altogether.
+
+BUNDLE_PLACEHOLDER = "@BUNDLE@"
+PAYLOAD_DIR = "payload"
+# Modules the agent needs on the target (they only use the standard library)
+AGENT_FILES = ["utils/__init__.py", "utils/command_args.py", "utils/plan.py", "utils/privileged_helper.py",
+               "utils/remote.py"]
+CONTROL_PERSIST = 120
+DEADLINE_GRACE = 30
+XZ_PRESET = 6
+
+_DEVICE_PATTERN = re.compile(r"/dev/[\w./-]+")
+
+# Runs on the target: unpacks the bundle from stdin and hands over to agent_main()
+_BOOTSTRAP = """
+import json, shutil, sys, tarfile, tempfile
+if sys.version_info < (3, 10):
+    print(json.dumps({"event": "error", "error": "python 3.10 or newer is needed on the target"}), flush=True)
+    sys.exit(2)
+bundle = tempfile.mkdtemp(prefix="os_installer-")
+try:
+    with tarfile.open(fileobj=sys.stdin.buffer, mode="r|xz") as archive:
+        archive.extractall(bundle, **({"filter": "data"} if hasattr(tarfile, "data_filter") else {}))
+    sys.path.insert(0, bundle)
+    from utils import remote
+    code = remote.agent_main(bundle, sys.argv[1:])
+finally:
+    shutil.rmtree(bundle, ignore_errors=True)
+sys.exit(code)
+"""
+
+
+class RemoteError(Exception):
+    """Raised when a plan cannot be shipped to a target (interactive steps, unreadable payloads)."""
+
+
+@dataclass
+class RemoteResult:
+    host: str
+    ok: bool = False
+    results: list[dict] = field(default_factory=list)   # One plan.execute() result per operation
+    remote_host: str = ""                               # Host name reported by the agent
+    started: bool = False                               # The agent began running the plan
+    bundle_bytes: int = 0
+    elapsed: float = 0.0
+    error: str = ""
+    log: list[str] = field(default_factory=list)        # Output that was not a progress line
+
+
+class Transport:
+    """Turns a command for the target into a local command line."""
+
+    name = "target"
+
+    def command(self, remote_argv: list[str]) -> list[str]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SSHTransport(Transport):
+    """
+    One multiplexed SSH connection per host: the first command opens a
+    master connection and later commands reuse it (no new handshake), until
+    close() or CONTROL_PERSIST seconds of idleness. BatchMode is on, so a
+    host that would ask for a password fails instead of hanging.
+    """
+
+    def __init__(self, destination: str, port: int | None = None, identity: str | None = None,
+                 options: list[str] | None = None):
+        self.name = destination
+        self.destination = destination
+        self.control_dir = tempfile.mkdtemp(prefix="os_installer-ssh-")
+        self.options = ["-o", "ControlMaster=auto", "-o", f"ControlPath={self.control_dir}/%C",
+                        "-o", f"ControlPersist={CONTROL_PERSIST}", "-o", "BatchMode=yes",
+                        "-o", "ServerAliveInterval=15"]
+        if port:
+            self.options += ["-p", str(port)]
+        if identity:
+            self.options += ["-i", identity]
+        self.options += options or []
+
+    def command(self, remote_argv: list[str]) -> list[str]:
+        return ["ssh", *self.options, self.destination, shlex.join(remote_argv)]
+
+    def close(self) -> None:
+        subprocess.run(["ssh", *self.options, "-O", "exit", self.destination], capture_output=True)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+class LocalTransport(Transport):
+    """Runs the target's commands on this machine: a stand-in for a remote host."""
+
+    def __init__(self, name: str = "localhost"):
+        self.name = name
+
+    def command(self, remote_argv: list[str]) -> list[str]:
+        return list(remote_argv)
+
+
+def parse_destination(text: str) -> tuple[str, int | None]:
+    """Splits 'user@host:port' into ('user@host', port)."""
+    host, _, port = text.rpartition(":") if re.search(r":\d+$", text) else (text, "", "")
+    return host, int(port) if port else None
+
+
+# --- Compiling the plan (this machine) ---
+
+def map_device(path: str, mapping: dict[str, str]) -> str:
+    """
+    Maps a device path to the target's name for it. Partitions follow their
+    disk: with /dev/sdb -> /dev/nvme0n1, /dev/sdb2 becomes /dev/nvme0n1p2.
+    """
+    if path in mapping:
+        return mapping[path]
+    disk = plan.parent_device(path)
+    if disk in mapping:
+        number = path[len(disk):].lstrip("p")
+        new_disk = mapping[disk]
+        return f"{new_disk}{'p' if new_disk[-1].isdigit() else ''}{number}"
+    return path
+
+
+def _map_text(text: str, mapping: dict[str, str]) -> str:
+    return _DEVICE_PATTERN.sub(lambda match: map_device(match.group(0), mapping), text) if mapping else text
+
+
+def namespace_names(operations: list[plan.Operation], suffix: str) -> dict[str, str]:
+    """
+    Returns a new name ('<name>_<suffix>') for every volume group and
+    device-mapper name the plan creates, for targets that share a kernel
+    with other targets (simulated hosts on loop devices).
+    """
+    names = {}
+    for op in operations:
+        creates_mapping = command_args.tool_args(op.argv)[0] == "cryptsetup"
+        for key in op.writes:
+            if key.startswith("vg:"):
+                names[key[len("vg:"):]] = f"{key[len('vg:'):]}_{suffix}"
+            elif key.startswith("/dev/mapper/") and creates_mapping:
+                names[key[len("/dev/mapper/"):]] = f"{key[len('/dev/mapper/'):]}_{suffix}"
+    return names
+
+
+def rename(arg: str, names: dict[str, str]) -> str:
+    """
+    Applies namespace_names() to one argument or dependency key: a bare VG
+    or mapper name, 'vg:<name>', /dev/mapper/<name>, /dev/<vg>/<lv> and
+    /dev/mapper/<vg>-<lv> (the device-mapper name of an LV).
+    """
+    if not names:
+        return arg
+    if arg in names:
+        return names[arg]
+    if arg.startswith("vg:") and arg[len("vg:"):] in names:
+        return f"vg:{names[arg[len('vg:'):]]}"
+    if arg.startswith("/dev/mapper/"):
+        name = arg[len("/dev/mapper/"):]
+        if name in names:
+            return f"/dev/mapper/{names[name]}"
+        for old, new in names.items():
+            # LVs are <vg>-<lv> in device-mapper, with any '-' in the VG name doubled
+            prefix = old.replace("-", "--") + "-"
+            if name.startswith(prefix) and not name.startswith(prefix + "-"):
+                return f"/dev/mapper/{new.replace('-', '--')}-{name[len(prefix):]}"
+        return arg
+    parts = arg.split("/")
+    if len(parts) == 4 and parts[:2] == ["", "dev"] and parts[2] in names:
+        return f"/dev/{names[parts[2]]}/{parts[3]}"
+    return arg
+
+
+def plan_devices(operations: list[plan.Operation]) -> list[str]:
+    """Device paths the plan refers to, for asking how they are named on the target."""
+    devices = set()
+    for op in operations:
+        for key in op.keys:
+            if key.startswith("/dev/") and not key.startswith("/dev/mapper/"):
+                devices.add(plan.parent_device(key) or key)
+    return sorted(devices)
+
+
+def compile_plan(operations: list[plan.Operation], mapping: dict[str, str] | None = None,
+                 names: dict[str, str] | None = None) -> tuple[dict, dict[str, str]]:
+    """
+    Turns operations into a plan.json document for the target, with device
+    paths mapped, VG and mapper names renamed by 'names' (see
+    namespace_names()) and local files replaced by their place in the
+    bundle. Returns (plan document, {bundle path: local path}). Raises
+    RemoteError for operations that need a terminal (passphrase prompts).
+    """
+    mapping, names = mapping or {}, names or {}
+    interactive = [op.id for op in operations if op.interactive]
+    if interactive:
+        raise RemoteError(f"{', '.join(interactive)} prompt for a passphrase; "
+                          "give them a --key-file to install remotely")
+    payloads = {}
+
+    def ship(arg: str) -> str:
+        prefix, value = "", arg
+        if arg.startswith("--") and "=" in arg:
+            option, value = arg.split("=", 1)
+            prefix = f"{option}="
+        if os.path.isabs(value) and not value.startswith("/dev/") and os.path.isfile(value):
+            name = f"{PAYLOAD_DIR}/{len(payloads)}_{os.path.basename(value)}"
+            payloads.setdefault(os.path.abspath(value), name)
+            return f"{prefix}{BUNDLE_PLACEHOLDER}/{payloads[os.path.abspath(value)]}"
+        return target(arg)
+
+    def target(arg: str) -> str:
+        return rename(_map_text(arg, mapping), names)
+
+    entries = []
+    for op in operations:
+        entries.append({"id": op.id, "command": [ship(arg) for arg in op.argv],
+                        "stdin": _map_text(op.stdin, mapping) if op.stdin else op.stdin,
+                        "reads": sorted(target(key) for key in op.reads),
+                        "writes": sorted(target(key) for key in op.writes),
+                        "after": [[target(arg) for arg in argv] for argv in op.after],
+                        "interactive": False})
+    return {"operations": entries}, {bundle_path: local for local, bundle_path in payloads.items()}
+
+
+def build_bundle(document: dict, payloads: dict[str, str]) -> bytes:
+    """Packs the plan, its payload files and the agent into one tar.xz archive."""
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:xz", preset=XZ_PRESET) as archive:
+        for name in AGENT_FILES:
+            archive.add(os.path.join(package_root, name), arcname=name)
+        for name, local in payloads.items():
+            try:
+                archive.add(local, arcname=name)
+            except OSError as e:
+                raise RemoteError(f"cannot read {local}: {e}")
+        raw = json.dumps(document, indent=2).encode()
+        info = tarfile.TarInfo(plan.PLAN_FILE)
+        info.size, info.mtime = len(raw), int(time.time())
+        archive.addfile(info, io.BytesIO(raw))
+    return buf.getvalue()
+
+
+# --- Running it (this machine) ---
+
+def install(transport: Transport, template_dir: str, mapping: dict[str, str] | None = None,
+            sudo: bool = True, workers: int = 4, dry_run: bool = False, progress=None,
+            timeout: float | None = None, names: dict[str, str] | None = None) -> RemoteResult:
+    """
+    Ships a template to the target and runs it there, with device paths
+    mapped by 'mapping' and VG/mapper names by 'names'. 'progress(event)' is
+    called for every line the agent streams back (events 'start', 'op',
+    'done', 'error'). With 'timeout', the agent kills its commands on the
+    target after that many seconds; the local connection is dropped
+    DEADLINE_GRACE seconds later if the target does not answer. Never
+    raises; the outcome is in the returned RemoteResult.
+    """
+    result = RemoteResult(transport.name)
+    started = time.monotonic()
+    try:
+        document, payloads = compile_plan(plan.load_plan(template_dir), mapping, names)
+        bundle = build_bundle(document, payloads)
+    except (OSError, ValueError, KeyError, RemoteError) as e:
+        result.error = str(e)
+        return result
+    result.bundle_bytes = len(bundle)
+
+    remote_argv = (["sudo", "-n"] if sudo else []) + ["python3", "-c", _BOOTSTRAP, "--workers", str(workers)] \
+        + (["--dry-run"] if dry_run else []) + (["--deadline", f"{timeout:g}"] if timeout else [])
+    try:
+        # A session of its own, so giving up on the target kills everything started here
+        process = subprocess.Popen(transport.command(remote_argv), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, start_new_session=True)
+    except OSError as e:
+        result.error = f"cannot reach {transport.name}: {e}"
+        return result
+
+    def upload() -> None:
+        try:
+            process.stdin.write(bundle)
+            process.stdin.close()
+        except OSError:
+            pass    # The target hung up; its exit status and stderr say why
+
+    stderr = []
+    timed_out = threading.Event()
+    threads = [threading.Thread(target=upload, daemon=True),
+               threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)]
+    if timeout:
+        def expire() -> None:
+            timed_out.set()
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout + DEADLINE_GRACE, expire)
+        timer.daemon = True
+        threads.append(timer)
+    for thread in threads:
+        thread.start()
+
+    finished = False
+    for raw_line in process.stdout:
+        line = raw_line.decode(errors="replace").strip()
+        try:
+            event = json.loads(line)
+        except ValueError:
+            if line:
+                result.log.append(line)
+            continue
+        kind = event.get("event")
+        if kind == "start":
+            result.remote_host = event.get("host", "")
+            result.started = True
+        elif kind == "op":
+            result.results.append({key: value for key, value in event.items() if key != "event"})
+        elif kind == "done":
+            finished = True
+        elif kind == "error":
+            result.error = event.get("error", "")
+        if progress:
+            progress(event)
+    process.wait()
+    for thread in threads:
+        if isinstance(thread, threading.Timer):
+            thread.cancel()
+        else:
+            thread.join(5)
+    result.elapsed = time.monotonic() - started
+
+    # Results arrive as operations finish; report them in plan order
+    order = {entry["id"]: index for index, entry in enumerate(document["operations"])}
+    result.results.sort(key=lambda r: order.get(r["id"], len(order)))
+    failed = [r for r in result.results if r["status"] in ("failed", "blocked")]
+    if timed_out.is_set():
+        result.error = f"timed out after {timeout:.0f}s, and the target did not answer for {DEADLINE_GRACE}s more"
+    elif not result.error and not finished:
+        message = b"".join(stderr).decode(errors="replace").strip()
+        result.error = message or f"the target exited with code {process.returncode} before finishing"
+    elif not result.error and failed:
+        result.error = f"{len(failed)} operation(s) failed, the first: {failed[0]['id']}"
+    result.ok = not result.error
+    return result
+
+
+# --- Agent (the target) ---
+
+_emit_lock = threading.Lock()
+
+
+def _emit(event: dict) -> None:
+    with _emit_lock:
+        print(json.dumps(event), flush=True)
+
+
+def _kill_process_group() -> None:
+    """Kills every other process in the agent's process group (the commands the plan started)."""
+    group, own = os.getpgrp(), os.getpid()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == own:
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # pid (comm) state ppid pgrp ...; comm may contain spaces and parentheses
+                fields = f.read().rsplit(")", 1)[1].split()
+            if int(fields[2]) == group:
+                os.kill(int(entry), signal.SIGKILL)
+        except (OSError, IndexError, ValueError):
+            continue
+
+
+def _expire(bundle_dir: str, deadline: float) -> None:
+    _kill_process_group()
+    _emit({"event": "error", "error": f"deadline of {deadline:g}s passed on the target, its commands were killed"})
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os._exit(124)
+
+
+def agent_main(bundle_dir: str, args: list[str]) -> int:
+    """Runs an unpacked bundle and streams JSON progress lines to stdout. Returns the exit code."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="os_installer-agent")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--deadline", type=float, default=None, help="seconds before all commands are killed")
+    options = parser.parse_args(args)
+
+    if options.deadline:
+        try:
+            os.setpgid(0, 0)    # Only this agent and its commands, not sudo or sshd
+        except OSError:
+            pass                # Already a session leader: the group is ours anyway
+        timer = threading.Timer(options.deadline, _expire, (bundle_dir, options.deadline))
+        timer.daemon = True
+        timer.start()
+
+    plan_path = os.path.join(bundle_dir, plan.PLAN_FILE)
+    with open(plan_path) as f:
+        text = f.read()
+    with open(plan_path, "w") as f:
+        f.write(text.replace(BUNDLE_PLACEHOLDER, bundle_dir))
+    operations = plan.load_plan(bundle_dir)
+    if os.geteuid() == 0:
+        # Already root (sudo on the outside, or a root login): run the tools directly
+        for op in operations:
+            op.argv = op.argv[1:] if op.argv[:1] == ["sudo"] else op.argv
+            op.after = [argv[1:] if argv[:1] == ["sudo"] else argv for argv in op.after]
+    _emit({"event": "start", "host": socket.gethostname(), "operations": len(operations)})
+
+    if options.dry_run:
+        for op in operations:
+            _emit({"event": "op", "id": op.id, "command": op.command_line(), "status": "planned",
+                   "elapsed": 0.0, "error": ""})
+        _emit({"event": "done"})
+        return 0
+    results = plan.execute(operations, bundle_dir, options.workers, force=True,
+                           progress=lambda result: _emit({"event": "op", **result}))
+    _emit({"event": "done"})
+    return 0 if all(r["status"] not in ("failed", "blocked") for r in results) else 1
+
+
+def format_result(result: RemoteResult) -> list[str]:
+    """Describes a finished remote install."""
+    lines = [f"{result.host}{f' ({result.remote_host})' if result.remote_host else ''}: "
+             f"{'OK' if result.ok else 'FAILED'} in {result.elapsed:.1f}s, bundle {result.bundle_bytes / 1e3:,.0f} kB"]
+    for r in result.results:
+        lines.append(f"  {r['status']:<10} {r['id']:<28} {r['elapsed']:6.2f}s {r['error']}")
+    if result.error:
+        lines.append(f"  {result.error}")
+    lines += [f"  | {line}" for line in result.log[-10:]]
+    return lines
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Install a template on another machine over SSH.")
+    parser.add_argument("template_dir")
+    parser.add_argument("destination", help="user@host[:port], or 'local' to run the bundle here")
+    parser.add_argument("--identity", help="SSH private key")
+    parser.add_argument("--map", action="append", default=[], metavar="LOCAL=REMOTE",
+                        help="device name on the target, e.g. /dev/sdb=/dev/nvme0n1")
+    parser.add_argument("--no-sudo", action="store_true", help="the target login is root already")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="ship the plan and list it, run nothing")
+    args = parser.parse_args()
+
+    mapping = dict(entry.split("=", 1) for entry in args.map)
+    if args.destination == "local":
+        transport = LocalTransport()
+    else:
+        host, port = parse_destination(args.destination)
+        transport = SSHTransport(host, port, args.identity)
+
+    def progress(event: dict) -> None:
+        if event.get("event") == "op":
+            print(f"{event['status']:<10} {event['id']:<28} {event['elapsed']:6.2f}s {event['error']}", flush=True)
+
+    try:
+        result = install(transport, args.template_dir, mapping, not args.no_sudo, args.workers, args.dry_run,
+                         progress, args.timeout)
+    finally:
+        transport.close()
+    lines = format_result(result)
+    # The per-operation lines were printed as they arrived
+    print("\n".join([lines[0]] + lines[1 + len(result.results):]))
+    sys.exit(0 if result.ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+
+from . import privileged_helper
+
+# Runs independent per-disk pipelines (label -> partition -> wipe ->
+# luksFormat -> mkfs) concurrently on a bounded worker pool.
+# Steps on the same disk are serialized by a per-device lock, and steps that
+# touch a shared resource (a volume group, the udev queue) declare it so
+# only one pipeline uses that resource at a time.
+
+
+class StepError(Exception):
+    """Raised by a step to stop its pipeline with a readable message."""
+
+
+@dataclass
+class Step:
+    name: str
+    action: object              # Callable taking the device path
+    resources: tuple = ()       # Shared resources held while the step runs
+
+
+@dataclass
+class PipelineStatus:
+    device: str
+    steps: list[str]
+    state: str = "queued"       # queued, running, done, failed
+    current: str = ""
+    completed: int = 0
+    error: str = ""
+    started: float = 0.0
+    finished: float = 0.0
+    step_times: dict = field(default_factory=dict)
+
+    @property
+    def elapsed(self) -> float:
+        if not self.started:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+
+def print_finished(status: PipelineStatus) -> None:
+    """Prints one line with a finished pipeline's outcome; for ProvisioningScheduler.watch()."""
+    result = "OK" if status.state == "done" else f"FAILED ({status.error})"
+    print(f"  {status.device}: {result} in {status.elapsed:.1f}s")
+
+
+def run_command(command: list[str], input: str | bytes | None = None) -> str:
+    """Runs a command for a step, raising StepError with its stderr on failure."""
+    # Text commands run as root go through the privileged helper
+    runner = privileged_helper.run if command[:1] == ["sudo"] and not isinstance(input, bytes) else subprocess.run
+    try:
+        result = runner(command, input=input, check=True, capture_output=True, text=not isinstance(input, bytes))
+    except FileNotFoundError as e:
+        raise StepError(f"{command[0]} not found: {e}")
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode(errors="replace") if isinstance(e.stderr, bytes) else e.stderr
+        raise StepError(f"'{' '.join(command)}' failed: {(stderr or '').strip()}")
+    return result.stdout if isinstance(result.stdout, str) else result.stdout.decode(errors="replace")
+
+
+class ProvisioningScheduler:
+    """
+    Collects one pipeline per device and runs them on at most 'max_workers'
+    threads. Progress is kept in PipelineStatus objects; 'changed' is set
+    whenever one of them is updated so a UI can redraw.
+    """
+
+    def __init__(self, max_workers: int | None = None):
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self.changed = threading.Event()
+        self._pipelines = []
+        self._status = {}
+        self._lock = threading.Lock()
+        self._device_locks = {}
+        self._resource_locks = {}
+        self._executor = None
+        self._futures = []
+
+    def _named_lock(self, table: dict, name: str) -> threading.Lock:
+        with self._lock:
+            return table.setdefault(name, threading.Lock())
+
+    def device_lock(self, device: str) -> threading.Lock:
+        """Returns the lock that serializes all work on one device."""
+        return self._named_lock(self._device_locks, os.path.realpath(device))
+
+    def resource_lock(self, resource: str) -> threading.Lock:
+        """Returns the lock for a shared resource such as 'udev' or 'vg:vg_data'."""
+        return self._named_lock(self._resource_locks, resource)
+
+    def add_pipeline(self, device: str, steps: list[Step]) -> None:
+        """Queues the steps to run, in order, against 'device' (one pipeline per device)."""
+        if device in self._status:
+            raise ValueError(f"A pipeline for {device} is already queued")
+        self._pipelines.append((device, steps))
+        self._status[device] = PipelineStatus(device, [step.name for step in steps])
+
+    def status(self) -> list[PipelineStatus]:
+        """Returns the pipeline states in the order they were added."""
+        with self._lock:
+            return [replace(s, step_times=dict(s.step_times)) for s in self._status.values()]
+
+    def _update(self, device: str, **changes) -> None:
+        with self._lock:
+            status = self._status[device]
+            for key, value in changes.items():
+                setattr(status, key, value)
+        self.changed.set()
+
+    def _run_pipeline(self, device: str, steps: list[Step]) -> bool:
+        with self.device_lock(device):
+            self._update(device, state="running", started=time.monotonic())
+            for index, step in enumerate(steps):
+                self._update(device, current=step.name)
+                step_start = time.monotonic()
+                # Sorted acquisition order keeps two pipelines from deadlocking
+                locks = [self.resource_lock(name) for name in sorted(step.resources)]
+                acquired = []
+                try:
+                    for lock in locks:
+                        lock.acquire()
+                        acquired.append(lock)
+                    step.action(device)
+                except Exception as e:  # A failed step must never take down the other pipelines
+                    self._update(device, state="failed", error=f"{step.name}: {e}", finished=time.monotonic())
+                    return False
+                finally:
+                    for lock in reversed(acquired):
+                        lock.release()
+                with self._lock:
+                    self._status[device].step_times[step.name] = time.monotonic() - step_start
+                self._update(device, completed=index + 1)
+        self._update(device, state="done", current="", finished=time.monotonic())
+        return True
+
+    def start(self) -> None:
+        """Starts all queued pipelines in the background."""
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="provision")
+        self._futures = [self._executor.submit(self._run_pipeline, device, steps)
+                         for device, steps in self._pipelines]
+        self._executor.shutdown(wait=False)
+
+    def done(self) -> bool:
+        """Returns True when every pipeline has finished (successfully or not)."""
+        return all(future.done() for future in self._futures)
+
+    def wait(self) -> bool:
+        """Blocks until all pipelines are finished. Returns True if all succeeded."""
+        return all(future.result() for future in self._futures)
+
+    def watch(self, on_finished) -> None:
+        """
+        Blocks until all pipelines are finished, calling 'on_finished(status)'
+        once for each pipeline as it ends.
+        """
+        reported = set()
+        while True:
+            finished = self.done()
+            for status in self.status():
+                if status.state in ("done", "failed") and status.device not in reported:
+                    reported.add(status.device)
+                    on_finished(status)
+            if finished:
+                return
+            self.changed.wait(0.5)
+            self.changed.clear()
+
+    def run(self) -> bool:
+        """Runs all pipelines and blocks until they are finished."""
+        self.start()
+        return self.wait()
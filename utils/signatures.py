@@ -0,0 +1,70 @@
+import sys
+
+# On-disk magics of the formats this tool creates or has to recognise.
+# Each entry is (fstype, byte offset from the start of the device, magic).
+# The order matters: containers (LUKS, LVM) are checked before filesystems
+# since a filesystem magic can survive inside an old container header.
+SIGNATURES = [
+    ("crypto_LUKS", 0x0, b"LUKS\xba\xbe"),
+    ("LVM2_member", 0x218, b"LVM2 001"),
+    ("LVM2_member", 0x018, b"LVM2 001"),
+    ("LVM2_member", 0x418, b"LVM2 001"),
+    ("LVM2_member", 0x618, b"LVM2 001"),
+    ("xfs", 0x0, b"XFSB"),
+    ("btrfs", 0x10040, b"_BHRfS_M"),
+    ("ext4", 0x438, b"\x53\xef"),
+    ("swap", 0xff6, b"SWAPSPACE2"),
+    ("swap", 0xff6, b"SWAP-SPACE"),
+    ("swap", 0xfff6, b"SWAPSPACE2"),
+    ("iso9660", 0x8001, b"CD001"),
+    ("ntfs", 0x3, b"NTFS    "),
+    ("vfat", 0x52, b"FAT32   "),
+    ("vfat", 0x36, b"FAT16   "),
+    ("vfat", 0x36, b"FAT12   "),
+]
+
+# Enough bytes to cover the furthest offset in SIGNATURES.
+PROBE_SIZE = 0x10048
+
+# ext2/3/4 feature flags used to tell the variants apart.
+_EXT_COMPAT_HAS_JOURNAL = 0x4
+_EXT_INCOMPAT_EXT4 = 0x40 | 0x80 | 0x200  # extents, 64bit, flex_bg
+
+
+def _ext_variant(head: bytes) -> str:
+    """Returns 'ext2', 'ext3' or 'ext4' based on the superblock feature flags."""
+    compat = int.from_bytes(head[0x45C:0x460], "little")
+    incompat = int.from_bytes(head[0x460:0x464], "little")
+    if incompat & _EXT_INCOMPAT_EXT4:
+        return "ext4"
+    if compat & _EXT_COMPAT_HAS_JOURNAL:
+        return "ext3"
+    return "ext2"
+
+
+def probe_bytes(head: bytes) -> str | None:
+    """
+    Identifies the format from the first PROBE_SIZE bytes of a device.
+    Returns an lsblk-style FSTYPE string (e.g. 'ext4', 'crypto_LUKS') or None.
+    """
+    for fstype, offset, magic in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            if fstype == "ext4":
+                return _ext_variant(head)
+            return fstype
+    return None
+
+
+def probe_device(device_path: str) -> str | None:
+    """
+    Reads the start of a device or image file and identifies its format.
+    Returns None if nothing is recognised or the device cannot be read.
+    """
+    try:
+        with open(device_path, "rb", buffering=0) as f:
+            head = f.read(PROBE_SIZE)
+    except OSError as e:
+        if not isinstance(e, (PermissionError, FileNotFoundError)):
+            print(f"Error probing {device_path}: {e}", file=sys.stderr)
+        return None
+    return probe_bytes(head)
@@ -0,0 +1,272 @@
+import os
+import sys
+
+from . import signatures
+
+# Pure-Python replacement for 'lsblk -o NAME,SIZE,TYPE,FSTYPE,MOUNTPOINT --json'.
+# Everything is read from sysfs, procfs and the udev database, so building
+# the device tree does not fork a single process.
+
+SECTOR_SIZE = 512  # sysfs 'size' is always in 512-byte units
+_SIZE_UNITS = "BKMGTPE"
+
+# Major numbers lsblk hides by default (ram disks).
+_HIDDEN_MAJORS = {1}
+
+
+def _read_attr(path: str, default: str | None = None) -> str | None:
+    """Reads a single sysfs attribute and strips the trailing newline."""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def _list_dir(path: str) -> list[str]:
+    """Lists a directory, returning an empty list if it does not exist."""
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+
+def human_size(size_bytes: int) -> str:
+    """Formats a byte count the way lsblk does (e.g. '931.5G', '512M')."""
+    value = float(size_bytes)
+    unit = 0
+    while value >= 1024 and unit < len(_SIZE_UNITS) - 1:
+        value /= 1024
+        unit += 1
+    if unit == 0:
+        return f"{size_bytes}B"
+    text = f"{value:.1f}".rstrip("0").rstrip(".")
+    return f"{text}{_SIZE_UNITS[unit]}"
+
+
+def _unescape_mount_path(path: str) -> str:
+    """Decodes the octal escapes (\\040 etc.) used in /proc/self/mountinfo."""
+    if "\\" not in path:
+        return path
+    return path.encode().decode("unicode_escape").encode("latin-1").decode()
+
+
+def read_mountpoints(proc_root: str = "/proc") -> dict[str, str]:
+    """
+    Maps 'major:minor' to the first mount point of that device, read from
+    mountinfo. Active swap devices are reported as '[SWAP]', like lsblk.
+    """
+    mounts = {}
+    try:
+        with open(os.path.join(proc_root, "self", "mountinfo")) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 4:
+                    mounts.setdefault(fields[2], _unescape_mount_path(fields[4]))
+    except OSError as e:
+        print(f"Error reading mountinfo: {e}", file=sys.stderr)
+
+    try:
+        with open(os.path.join(proc_root, "swaps")) as f:
+            next(f, None)  # header line
+            swap_paths = {line.split()[0] for line in f if line.strip()}
+    except OSError:
+        swap_paths = set()
+    for swap_path in swap_paths:
+        try:
+            st = os.stat(swap_path)
+        except OSError:
+            continue
+        if st.st_rdev:
+            mounts.setdefault(f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}", "[SWAP]")
+    return mounts
+
+
+def _udev_fstype(udev_root: str, devno: str) -> tuple[bool, str | None]:
+    """
+    Looks up ID_FS_TYPE in the udev database. Returns (found, fstype) where
+    'found' tells whether udev has a record for the device at all.
+    """
+    try:
+        with open(os.path.join(udev_root, "data", f"b{devno}")) as f:
+            for line in f:
+                if line.startswith("E:ID_FS_TYPE="):
+                    return True, line.strip().split("=", 1)[1] or None
+    except OSError:
+        return False, None
+    return True, None
+
+
+def _device_type(sys_dir: str, kname: str, is_partition: bool) -> str:
+    """Derives the lsblk TYPE column from sysfs attributes."""
+    if is_partition:
+        return "part"
+    dm_uuid = _read_attr(os.path.join(sys_dir, "dm", "uuid"))
+    if dm_uuid is not None:
+        prefix = dm_uuid.split("-", 1)[0]
+        return {"CRYPT": "crypt", "LVM": "lvm", "mpath": "mpath"}.get(prefix, "dm")
+    md_level = _read_attr(os.path.join(sys_dir, "md", "level"))
+    if md_level:
+        return md_level
+    if kname.startswith("loop"):
+        return "loop"
+    if kname.startswith("sr"):
+        return "rom"
+    return "disk"
+
+
+def read_device(sys_dir: str, mounts: dict[str, str], dev_root: str = "/dev",
+                udev_root: str = "/run/udev") -> dict | None:
+    """
+    Builds the lsblk-style record (without children) for one sysfs block
+    device directory. Returns None for devices lsblk would hide.
+    """
+    kname = os.path.basename(sys_dir)
+    devno = _read_attr(os.path.join(sys_dir, "dev"))
+    sectors = _read_attr(os.path.join(sys_dir, "size"))
+    if devno is None or sectors is None:
+        return None
+    size_bytes = int(sectors) * SECTOR_SIZE
+    if size_bytes == 0 or int(devno.split(":")[0]) in _HIDDEN_MAJORS:
+        return None
+
+    is_partition = os.path.exists(os.path.join(sys_dir, "partition"))
+    name = _read_attr(os.path.join(sys_dir, "dm", "name")) or kname
+
+    found, fstype = _udev_fstype(udev_root, devno)
+    if not found:
+        # No udev record (e.g. inside a container): look at the device itself
+        fstype = signatures.probe_device(os.path.join(dev_root, kname))
+
+    return {
+        "name": name,
+        "kname": kname,
+        "size": human_size(size_bytes),
+        "type": _device_type(sys_dir, kname, is_partition),
+        "fstype": fstype,
+        "mountpoint": mounts.get(devno),
+    }
+
+
+def read_block_devices(sys_root: str = "/sys", proc_root: str = "/proc",
+                       dev_root: str = "/dev", udev_root: str = "/run/udev") -> dict | None:
+    """
+    Reads the block device tree from sysfs and returns it in the same
+    structure as 'lsblk --json': {'blockdevices': [...]} where partitions and
+    holders (LUKS mappings, LVs) are nested under 'children'. Each record
+    also carries 'kname', the kernel name (lsblk's KNAME column).
+    Returns None if sysfs is not available.
+    """
+    block_dir = os.path.join(sys_root, "block")
+    if not os.path.isdir(block_dir):
+        print(f"Error getting disk info: {block_dir} not found", file=sys.stderr)
+        return None
+
+    mounts = read_mountpoints(proc_root)
+    records = {}      # kname -> device record
+    children = {}     # kname -> list of child knames
+    top_level = []
+
+    for kname in _list_dir(block_dir):
+        disk_dir = os.path.join(block_dir, kname)
+        record = read_device(disk_dir, mounts, dev_root, udev_root)
+        if record is None:
+            continue
+        records[kname] = record
+        children[kname] = _list_dir(os.path.join(disk_dir, "holders"))
+        if not _list_dir(os.path.join(disk_dir, "slaves")):
+            top_level.append(kname)
+
+        for entry in _list_dir(disk_dir):
+            part_dir = os.path.join(disk_dir, entry)
+            if not entry.startswith(kname) or not os.path.exists(os.path.join(part_dir, "partition")):
+                continue
+            part = read_device(part_dir, mounts, dev_root, udev_root)
+            if part is None:
+                continue
+            records[entry] = part
+            children[kname].append(entry)
+            children[entry] = _list_dir(os.path.join(part_dir, "holders"))
+
+    def build(kname: str, depth: int = 0) -> dict:
+        node = dict(records[kname])
+        # Guard against holder loops in a corrupt or synthetic tree
+        child_nodes = [build(c, depth + 1) for c in children.get(kname, []) if c in records and depth < 16]
+        if child_nodes:
+            node["children"] = child_nodes
+        return node
+
+    return {"blockdevices": [build(kname) for kname in top_level]}
+
+
+def _walk(nodes: list, parent: dict | None = None):
+    """Yields (node, sibling list, parent node) for every node in a device tree."""
+    for node in nodes:
+        yield node, nodes, parent
+        yield from _walk(node.get("children", []), node)
+
+
+def _node_kname(node: dict) -> str:
+    return node.get("kname", node.get("name"))
+
+
+def patch_tree(tree: dict, action: str, kname: str, sys_root: str = "/sys",
+               proc_root: str = "/proc", dev_root: str = "/dev",
+               udev_root: str = "/run/udev") -> set[str]:
+    """
+    Applies a single kernel event ('add', 'remove' or 'change' for the
+    device 'kname') to a tree returned by read_block_devices(), in place.
+    Only the affected device and its parents are read from sysfs.
+    Returns the set of knames whose rows changed.
+    """
+    devices = tree.setdefault("blockdevices", [])
+    changed = set()
+
+    if action == "remove":
+        for node, siblings, parent in list(_walk(devices)):
+            if _node_kname(node) == kname:
+                siblings.remove(node)
+                if parent is not None and not siblings:
+                    parent.pop("children", None)
+                changed.add(kname)
+        return changed
+
+    sys_dir = os.path.realpath(os.path.join(sys_root, "class", "block", kname))
+    if not os.path.isdir(sys_dir):
+        sys_dir = os.path.join(sys_root, "block", kname)
+    record = read_device(sys_dir, read_mountpoints(proc_root), dev_root, udev_root)
+    if record is None:
+        return changed
+
+    existing = [node for node, _, _ in _walk(devices) if _node_kname(node) == kname]
+    if existing:
+        # 'change' (or a repeated 'add'): refresh the columns, keep the children
+        for node in existing:
+            if any(node.get(key) != value for key, value in record.items()):
+                node.update(record)
+                changed.add(kname)
+        return changed
+
+    if os.path.exists(os.path.join(sys_dir, "partition")):
+        parents = [os.path.basename(os.path.dirname(sys_dir))]
+    else:
+        parents = _list_dir(os.path.join(sys_dir, "slaves"))
+
+    if not parents:
+        devices.append(record)
+        devices.sort(key=_node_kname)
+        changed.add(kname)
+        return changed
+
+    for node, _, _ in list(_walk(devices)):
+        if _node_kname(node) in parents:
+            siblings = node.setdefault("children", [])
+            siblings.append(dict(record))
+            siblings.sort(key=_node_kname)
+            changed.update({kname, _node_kname(node)})
+    return changed
+
+
+if __name__ == "__main__":
+    import json
+    print(json.dumps(read_block_devices(), indent=2))
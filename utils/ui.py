@@ -152,3 +152,166 @@ def get_menu_choice(stdscr: 'curses._CursesWindow', title: str, options: dict) -
             current_row_idx += 1
         elif key == curses.KEY_ENTER or key in [10, 13]:
             return option_values[current_row_idx]
+
+def display_live_text_viewer(stdscr: 'curses._CursesWindow', title: str, build_lines, watcher=None):
+    """
+    Scrollable text viewer like display_text_viewer, but the lines come from
+    'build_lines()' and are rebuilt whenever the hotplug watcher reports a
+    device change. Only rows whose text actually changed are redrawn.
+    """
+    curses.curs_set(0)
+    h, w = stdscr.getmaxyx()
+    page = h - 5
+    top_line = 0
+    text_lines = build_lines()
+    shown = None  # The rows currently on screen
+    stdscr.timeout(200)  # Return from getch regularly to check for device changes
+
+    try:
+        while True:
+            visible = text_lines[top_line:top_line + page]
+            if shown is None:
+                stdscr.clear()
+                stdscr.addstr(1, 2, f"{title} (Scroll with arrows, 'q' to quit)")
+                stdscr.addstr(2, 2, "=" * (w - 4))
+                for i, line in enumerate(visible):
+                    stdscr.addstr(4 + i, 2, line[:w-3])
+            else:
+                for i in range(max(len(visible), len(shown))):
+                    new = visible[i] if i < len(visible) else ""
+                    old = shown[i] if i < len(shown) else ""
+                    if new != old:
+                        stdscr.move(4 + i, 0)
+                        stdscr.clrtoeol()
+                        stdscr.addstr(4 + i, 2, new[:w-3])
+            shown = visible
+            stdscr.refresh()
+
+            key = stdscr.getch()
+            if watcher is not None and watcher.wake.is_set():
+                watcher.take_changes()
+                text_lines = build_lines()
+                top_line = min(top_line, max(0, len(text_lines) - page))
+
+            if key == curses.KEY_UP and top_line > 0:
+                top_line -= 1
+            elif key == curses.KEY_DOWN and top_line < len(text_lines) - page:
+                top_line += 1
+            elif key == ord('q'):
+                break
+    finally:
+        stdscr.timeout(-1)
+
+def get_multi_choice(stdscr: 'curses._CursesWindow', title: str, options: dict) -> list[str]:
+    """
+    Displays a curses checklist. Space toggles an option, Enter confirms.
+    Returns the keys of the selected options (empty list on 'q').
+    """
+    curses.curs_set(0)
+    keys = list(options.keys())
+    selected = set()
+    current_row_idx = 0
+
+    while True:
+        stdscr.clear()
+        stdscr.addstr(1, 2, title)
+        stdscr.addstr(2, 2, "Space: select, Enter: confirm, q: cancel")
+        for idx, key in enumerate(keys):
+            mark = "[x]" if key in selected else "[ ]"
+            if idx == current_row_idx:
+                stdscr.attron(curses.A_REVERSE)
+                stdscr.addstr(4 + idx, 2, f"> {mark} {options[key]}")
+                stdscr.attroff(curses.A_REVERSE)
+            else:
+                stdscr.addstr(4 + idx, 2, f"  {mark} {options[key]}")
+        stdscr.refresh()
+
+        key = stdscr.getch()
+        if key == curses.KEY_UP and current_row_idx > 0:
+            current_row_idx -= 1
+        elif key == curses.KEY_DOWN and current_row_idx < len(keys) - 1:
+            current_row_idx += 1
+        elif key == ord(' ') and keys:
+            selected ^= {keys[current_row_idx]}
+        elif key == curses.KEY_ENTER or key in [10, 13]:
+            return [k for k in keys if k in selected]
+        elif key == ord('q'):
+            return []
+
+def get_text_input(stdscr: 'curses._CursesWindow', prompt: str) -> str:
+    """Asks for a line of text at the bottom of the screen and returns it."""
+    h, w = stdscr.getmaxyx()
+    prompt_y = h - 2
+    stdscr.move(prompt_y, 0)
+    stdscr.clrtoeol()
+    stdscr.addstr(prompt_y, 2, f"{prompt} ")
+    stdscr.refresh()
+    curses.echo()
+    curses.curs_set(1)
+    text = stdscr.getstr(prompt_y, 3 + len(prompt), max(1, w - len(prompt) - 5))
+    curses.noecho()
+    curses.curs_set(0)
+    stdscr.move(prompt_y, 0)
+    stdscr.clrtoeol()
+    return text.decode(errors="replace").strip()
+
+def display_progress(stdscr: 'curses._CursesWindow', title: str, scheduler) -> None:
+    """
+    Shows live per-device progress of a ProvisioningScheduler until all
+    pipelines are finished, then waits for a key press.
+    """
+    curses.curs_set(0)
+    stdscr.timeout(250)
+    try:
+        while True:
+            h, w = stdscr.getmaxyx()
+            stdscr.erase()
+            stdscr.addstr(1, 2, title)
+            stdscr.addstr(2, 2, "=" * len(title))
+            for idx, status in enumerate(scheduler.status()[:h - 7]):
+                bar_width = 20
+                filled = bar_width * status.completed // max(1, len(status.steps))
+                bar = "#" * filled + "." * (bar_width - filled)
+                detail = status.error if status.state == "failed" else status.current
+                line = f"{status.device:<18} [{bar}] {status.state:<8} {status.elapsed:6.1f}s  {detail}"
+                stdscr.addstr(4 + idx, 2, line[:w - 3])
+
+            finished = scheduler.done()
+            if finished:
+                stdscr.addstr(h - 2, 2, "All pipelines finished. Press any key to continue.")
+            stdscr.refresh()
+
+            scheduler.changed.clear()
+            key = stdscr.getch()
+            if finished and key != -1:
+                break
+    finally:
+        stdscr.timeout(-1)
+
+def display_transfer(stdscr: 'curses._CursesWindow', title: str, progress, format_lines) -> None:
+    """
+    Shows a running transfer (e.g. an image deploy) until it has finished,
+    then waits for a key press. 'format_lines(progress)' builds the text;
+    'progress' needs 'state' and a 'changed' event.
+    """
+    curses.curs_set(0)
+    stdscr.timeout(250)
+    try:
+        while True:
+            h, w = stdscr.getmaxyx()
+            stdscr.erase()
+            stdscr.addstr(1, 2, title)
+            stdscr.addstr(2, 2, "=" * len(title))
+            for idx, line in enumerate(format_lines(progress)[:h - 7]):
+                stdscr.addstr(4 + idx, 2, line[:w - 3])
+            finished = progress.state != "running"
+            if finished:
+                stdscr.addstr(h - 2, 2, "Finished. Press any key to continue.")
+            stdscr.refresh()
+
+            progress.changed.clear()
+            key = stdscr.getch()
+            if finished and key != -1:
+                break
+    finally:
+        stdscr.timeout(-1)
@@ -0,0 +1,357 @@
+import errno
+import functools
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import sys
+import threading
+import time
+import zlib
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, asdict
+
+from . import chunk_store
+from .image_deploy import DeployError, detect_compression, iter_image, run_module_as_root
+
+# Post-write verification. What landed on a partition, LV or image file is
+# read back and checked against per-chunk sha256 checksums: the index of a
+# captured image, a chunk store manifest, or (for raw and compressed images)
+# the image itself. Every chunk of every device is a task on one thread
+# pool, fed by one thread per device as its source is read, so all disks
+# are kept busy at once and a raw or compressed image is decoded while the
+# device is already being read; its pieces are hashed on the pool next to
+# the device ranges they are compared with. hashlib releases the GIL, so
+# hashing runs in parallel with the reads and a large verify is bound by
+# the disks.
+#
+# Reads use O_DIRECT into page-aligned buffers, so they come from the device
+# and not from the page cache (which would still hold what was just written
+# and hide a bad write). Where O_DIRECT is refused (tmpfs, some FUSE
+# filesystems) the cached pages of a range are dropped before it is read.
+
+ALIGN = 4096
+READ_SIZE = 4 * 1024 * 1024
+# Raw and compressed images are checked in pieces of this size
+CHECK_CHUNK = 4 * 1024 * 1024
+# Outstanding chunk reads per worker thread
+_QUEUE_PER_WORKER = 2
+
+
+@dataclass
+class VerifyReport:
+    device: str
+    source: str
+    ok: bool = False
+    done: bool = False
+    chunks: int = 0
+    total: int = 0                      # Bytes to check
+    bytes_checked: int = 0
+    mismatches: int = 0
+    first_mismatch: int | None = None   # Offset of the first chunk that differs
+    direct: bool = False                # Read with O_DIRECT
+    elapsed: float = 0.0
+    error: str = ""
+
+
+@dataclass
+class VerifyProgress:
+    reports: list[VerifyReport]
+    state: str = "running"      # running, done, failed
+    error: str = ""
+    started: float = field(default_factory=time.monotonic)
+    finished: float = 0.0
+    changed: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def total(self) -> int:
+        return sum(report.total for report in self.reports)
+
+    @property
+    def bytes_checked(self) -> int:
+        return sum(report.bytes_checked for report in self.reports)
+
+    def to_dict(self) -> dict:
+        return {"state": self.state, "error": self.error, "reports": [asdict(report) for report in self.reports]}
+
+    def update(self, **changes) -> None:
+        if "reports" in changes:
+            changes["reports"] = [report if isinstance(report, VerifyReport) else VerifyReport(**report)
+                                  for report in changes["reports"]]
+        for key, value in changes.items():
+            setattr(self, key, value)
+        self.changed.set()
+
+    def finish(self, error: str = "") -> None:
+        self.update(state="failed" if error else "done", error=error, finished=time.monotonic())
+
+
+@functools.lru_cache(maxsize=16)
+def _zero_digest(length: int) -> str:
+    return hashlib.sha256(bytes(length)).hexdigest()
+
+
+def expected_chunks(source: str) -> tuple[int | None, Iterator[tuple[int, int, str | bytes]]]:
+    """
+    Returns the size of what a device should hold after 'source' was written
+    to it (None if it is only known at the end) and an iterator of its
+    (offset, length, expected) chunks. 'source' is a chunk store manifest
+    (.json) or a captured image, whose chunks come with a sha256 digest, or
+    a raw or compressed image, whose chunks come as the image's own bytes,
+    decoded as the iterator is consumed. Raises DeployError or OSError if
+    'source' cannot be read; decoding errors are raised by the iterator.
+    """
+    if source.endswith(".json"):
+        manifest = chunk_store.load_manifest(source)
+        chunks = [(offset, length, digest or _zero_digest(length)) for offset, length, digest in manifest["chunks"]]
+    elif detect_compression(source) == "chunked":
+        from .image_capture import read_index
+        with open(source, "rb") as f:
+            chunks = [(entry[0], entry[1], entry[4]) for entry in read_index(f)["chunks"]]
+    else:
+        total = os.path.getsize(source) if detect_compression(source) is None else None
+        return total, _image_pieces(source)
+    chunks.sort()
+    return sum(length for _, length, _ in chunks), iter(chunks)
+
+
+def _image_pieces(source: str) -> Iterator[tuple[int, int, bytes]]:
+    pending = bytearray()
+    start = 0
+    for offset, data in iter_image(source):
+        if not pending:
+            start = offset
+        pending += data
+        while len(pending) >= CHECK_CHUNK:
+            yield start, CHECK_CHUNK, bytes(pending[:CHECK_CHUNK])
+            del pending[:CHECK_CHUNK]
+            start += CHECK_CHUNK
+    if pending:
+        yield start, len(pending), bytes(pending)
+
+
+_buffers = threading.local()
+
+
+def _buffer() -> mmap.mmap:
+    """A page-aligned read buffer for the calling thread (anonymous mappings are page-aligned)."""
+    buf = getattr(_buffers, "buf", None)
+    if buf is None:
+        buf = _buffers.buf = mmap.mmap(-1, READ_SIZE + 2 * ALIGN)
+    return buf
+
+
+class _Device:
+    """A device opened for reading, with O_DIRECT where the kernel allows it."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self.fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            self.direct = True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            self.fd = os.open(path, os.O_RDONLY)
+            self.direct = False
+        self._fds = [self.fd]
+
+    def _fall_back(self) -> None:
+        with self._lock:
+            if self.direct:
+                self.fd = os.open(self.path, os.O_RDONLY)
+                self._fds.append(self.fd)
+                self.direct = False
+
+    def read(self, offset: int, length: int):
+        """Reads up to 'length' (at most READ_SIZE) bytes at 'offset'; shorter only at the end of the device."""
+        if self.direct:
+            start = offset - offset % ALIGN
+            end = -(-(offset + length) // ALIGN) * ALIGN
+            view = memoryview(_buffer())[:end - start]
+            try:
+                got = os.preadv(self.fd, [view], start)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # Opened with O_DIRECT but the filesystem refuses direct reads
+                self._fall_back()
+            else:
+                return view[offset - start:max(offset - start, min(got, offset - start + length))]
+        os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_DONTNEED)
+        return os.pread(self.fd, length, offset)
+
+    def close(self) -> None:
+        for fd in self._fds:
+            os.close(fd)
+
+
+def _check_chunk(device: _Device, offset: int, length: int, digest: str) -> tuple[bool, int]:
+    """Hashes one chunk of a device. Returns (matches, bytes read)."""
+    hasher = hashlib.sha256()
+    position = offset
+    while position < offset + length:
+        data = device.read(position, min(READ_SIZE, offset + length - position))
+        if not len(data):
+            break
+        hasher.update(data)
+        position += len(data)
+    return position == offset + length and hasher.hexdigest() == digest, position - offset
+
+
+def verify(jobs: list[tuple[str, str]], progress: VerifyProgress | None = None,
+           workers: int | None = None) -> VerifyProgress:
+    """
+    Verifies each (device, source) pair: every chunk of 'source' is read back
+    from 'device' and compared. All devices are checked at the same time on
+    one thread pool. Returns the finished progress record with one report
+    per device; it is 'failed' if any device did not verify.
+    """
+    progress = progress or VerifyProgress([VerifyReport(device, source) for device, source in jobs])
+    reports = progress.reports
+    # One thread per device feeds its chunks to the others
+    workers = workers or min(32, 4 * len(jobs))
+    workers = max(workers, len(jobs) + 1)
+    queue_per_device = max(2, workers * _QUEUE_PER_WORKER // len(jobs))
+    lock = threading.Lock()
+    devices: list[_Device | None] = [None] * len(jobs)
+
+    def check(index: int, offset: int, length: int, expected: str | bytes) -> None:
+        report = reports[index]
+        try:
+            digest = expected if isinstance(expected, str) else hashlib.sha256(expected).hexdigest()
+            same, read = _check_chunk(devices[index], offset, length, digest)
+            error = "" if read == length else "the device is smaller than the image"
+        except Exception as e:  # Not only OSError: an exception left in the future would pass as a match
+            same, read, error = False, 0, str(e)
+        with lock:
+            report.bytes_checked += length
+            if not same:
+                report.mismatches += 1
+                if report.first_mismatch is None or offset < report.first_mismatch:
+                    report.first_mismatch = offset
+                report.error = report.error or error
+            report.elapsed = time.monotonic() - progress.started
+        progress.changed.set()
+
+    def feed(pool: ThreadPoolExecutor, index: int) -> None:
+        # Hands out the device's chunks as they are read from the source, so the device
+        # is read (and the image hashed) while the rest of the image is still being decoded
+        report = reports[index]
+        slots = threading.Semaphore(queue_per_device)
+        try:
+            total, chunks = expected_chunks(report.source)
+            devices[index] = _Device(report.device)
+            report.total, report.direct = total or 0, devices[index].direct
+            progress.changed.set()
+            for offset, length, expected in chunks:
+                slots.acquire()
+                with lock:
+                    report.chunks += 1
+                    if total is None:
+                        report.total += length
+                pool.submit(check, index, offset, length, expected).add_done_callback(lambda _: slots.release())
+        except (OSError, EOFError, lzma.LZMAError, zlib.error, DeployError) as e:
+            with lock:
+                report.error = report.error or str(e)
+        except Exception as e:  # A bug must still fail this device, or it would pass unchecked
+            with lock:
+                report.error = report.error or f"unexpected error: {type(e).__name__}: {e}"
+        progress.changed.set()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify") as pool:
+            # Every chunk is submitted before the pool shuts down
+            wait([pool.submit(feed, pool, index) for index in range(len(jobs))])
+    except Exception as e:  # A bug must still end the run, or the UI waits forever
+        for report in reports:
+            report.error = report.error or f"unexpected error: {type(e).__name__}: {e}"
+    finally:
+        for device in devices:
+            if device is not None:
+                device.close()
+
+    for report in reports:
+        report.done = True
+        report.ok = not report.error and not report.mismatches
+    failed = [report.device for report in reports if not report.ok]
+    progress.finish(f"{', '.join(failed)} did not verify" if failed else "")
+    return progress
+
+
+def start_verify(jobs: list[tuple[str, str]]) -> VerifyProgress:
+    """
+    Starts verifying (device, source) pairs in the background. Devices this
+    process cannot read are verified by a root child process.
+    """
+    progress = VerifyProgress([VerifyReport(device, source) for device, source in jobs])
+    if all(os.access(device, os.R_OK) for device, _ in jobs):
+        worker = threading.Thread(target=verify, args=(jobs, progress), daemon=True)
+    else:
+        args = [arg for device, source in jobs for arg in ("--check", device, os.path.abspath(source))]
+        worker = threading.Thread(target=run_module_as_root, args=(progress, "utils.verify", args), daemon=True)
+    worker.start()
+    return progress
+
+
+def format_report(report: VerifyReport) -> str:
+    if report.ok:
+        return (f"OK, {report.chunks} chunks ({report.total / 1e6:,.0f} MB) match"
+                f"{'' if report.direct else ' (page cache dropped, O_DIRECT unavailable)'}")
+    if report.mismatches:
+        where = f"the first in the chunk at offset {report.first_mismatch} ({report.first_mismatch:#x})"
+        return f"MISMATCH: {report.mismatches} of {report.chunks} chunks differ, {where}" \
+               + (f"; {report.error}" if report.error else "")
+    if report.error:
+        return f"ERROR: {report.error}"
+    fraction = report.bytes_checked / report.total if report.total else 0.0
+    return f"{fraction * 100:5.1f}% of {report.total / 1e6:,.0f} MB checked"
+
+
+def format_progress(progress: VerifyProgress) -> list[str]:
+    """Returns the lines of a verify display: totals, then one line per device."""
+    rate = progress.bytes_checked / max(progress.elapsed, 1e-6) / 1e6
+    lines = [f"{progress.bytes_checked / 1e6:,.0f} of {progress.total / 1e6:,.0f} MB checked on "
+             f"{len(progress.reports)} device(s) in {progress.elapsed:.1f}s, {rate:,.1f} MB/s", ""]
+    for report in progress.reports:
+        lines += [f"{report.device}  <-  {report.source}", f"    {format_report(report)}"]
+    if progress.state == "failed":
+        lines += ["", f"FAILED: {progress.error}"]
+    elif progress.state == "done":
+        lines += ["", "All devices verified."]
+    return lines
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Check devices against the images written to them.")
+    parser.add_argument("--json-progress", action="store_true", help="print progress as JSON lines")
+    parser.add_argument("--check", nargs=2, action="append", required=True, metavar=("DEVICE", "SOURCE"),
+                        help="a device and the image, captured image or manifest written to it")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    jobs = [tuple(pair) for pair in args.check]
+    progress = VerifyProgress([VerifyReport(device, source) for device, source in jobs])
+    worker = threading.Thread(target=verify, args=(jobs, progress, args.workers), daemon=True)
+    worker.start()
+    while worker.is_alive():
+        progress.changed.wait(0.5)
+        progress.changed.clear()
+        if args.json_progress:
+            print(json.dumps(progress.to_dict() | {"state": "running"}), flush=True)
+    if args.json_progress:
+        print(json.dumps(progress.to_dict()), flush=True)
+    else:
+        print("\n".join(format_progress(progress)))
+    sys.exit(0 if progress.state == "done" else 1)
+
+
+if __name__ == "__main__":
+    main()
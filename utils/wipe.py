@@ -0,0 +1,279 @@
+import errno
+import fcntl
+import json
+import os
+import stat
+import struct
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+
+from . import luks, partition_table, privileged_helper, signatures
+from .partition_table import BLKSSZGET
+
+# Disk reset engine. Instead of zeroing a whole disk (or leaving old headers
+# behind, as 'mklabel' alone does), 'signatures' mode overwrites only the
+# byte ranges where partition tables, containers and filesystems keep their
+# magics and headers: a few dozen KiB per device, plus the LUKS keyslot area
+# when a LUKS header is found. 'discard' additionally tells the device all
+# blocks are unused (BLKDISCARD), and 'zero' writes zeros over the whole
+# device with BLKZEROOUT, which the kernel offloads to WRITE ZEROES/WRITE SAME
+# where the device supports it. Disks are processed in parallel. The
+# partition table is read before it is cleared, and the same signature
+# ranges are cleared inside every partition, so a new table with the same
+# layout does not bring the old filesystems and LUKS headers back.
+
+BLKRRPART = 0x125F          # ioctl: re-read the partition table
+BLKGETSIZE64 = 0x80081272   # ioctl: device size in bytes
+BLKDISCARD = 0x1277         # ioctl: discard a byte range
+BLKZEROOUT = 0x127F         # ioctl: zero a byte range
+
+MODES = ("signatures", "discard", "zero")
+
+KIB = 1024
+MIB = 1024 * KIB
+GIB = 1024 * MIB
+
+# GPT entry array size used by every common partitioner (128 entries x 128 bytes)
+_GPT_ENTRIES_BYTES = 16 * KIB
+# btrfs keeps superblock copies at 64 KiB, 64 MiB and 256 GiB
+_BTRFS_SUPERBLOCKS = [64 * KIB, 64 * MIB, 256 * GIB]
+# Where a LUKS2 secondary header can start (same list as utils.luks)
+_LUKS2_SECONDARY_OFFSETS = [0x4000 << i for i in range(9)]
+# Never clear more than this for a LUKS header and keyslot area
+_MAX_LUKS_AREA = 64 * MIB
+# Discard/zero in pieces so progress is visible and a device is not monopolised
+_CHUNK = 1 * GIB
+
+
+class WipeError(Exception):
+    """Raised when a device cannot be wiped (busy, not a block device, unsupported)."""
+
+
+@dataclass
+class WipeResult:
+    device: str
+    mode: str
+    ok: bool = False
+    found: str | None = None        # Format detected before the wipe
+    bytes_cleared: int = 0
+    ranges: int = 0
+    elapsed: float = 0.0
+    error: str = ""
+    notes: list[str] = field(default_factory=list)
+
+
+def signature_ranges(size: int, sector_size: int = 512, luks_area: int = 0) -> list[tuple[int, int]]:
+    """
+    Returns the (offset, length) ranges that hold on-disk signatures of a
+    device of 'size' bytes, merged and clipped to the device:
+    MBR and primary GPT, backup GPT, LVM2 label and first metadata area
+    header, ext superblock, XFS superblock, swap signature (4 KiB and 64 KiB
+    pages), btrfs superblocks, LUKS2 secondary header candidates and, if
+    'luks_area' is set, the LUKS header and keyslot area up to that offset.
+    """
+    ranges = [
+        (0, 2 * sector_size + _GPT_ENTRIES_BYTES),          # MBR, GPT header and entries
+        (size - sector_size - _GPT_ENTRIES_BYTES, sector_size + _GPT_ENTRIES_BYTES),  # Backup GPT
+        (0, 8 * KIB),                                       # LVM2 label, mda header, XFS, ext, swap (4K pages)
+        (0xFFF6, 10),                                       # swap with 64 KiB pages
+    ]
+    ranges += [(offset, 4 * KIB) for offset in _BTRFS_SUPERBLOCKS]
+    ranges += [(offset, 4 * KIB) for offset in _LUKS2_SECONDARY_OFFSETS]
+    if luks_area:
+        ranges.append((0, min(luks_area, _MAX_LUKS_AREA)))
+
+    clipped = []
+    for offset, length in ranges:
+        offset = max(0, offset)
+        end = min(size, offset + length)
+        if end > offset:
+            clipped.append((offset, end))
+    merged = []
+    for start, end in sorted(clipped):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return [(start, end - start) for start, end in merged]
+
+
+def _device_size(fd: int, st: os.stat_result) -> int:
+    if not stat.S_ISBLK(st.st_mode):
+        return st.st_size
+    buf = bytearray(8)
+    fcntl.ioctl(fd, BLKGETSIZE64, buf)
+    return int.from_bytes(buf, sys.byteorder)
+
+
+def _sector_size(fd: int, st: os.stat_result) -> int:
+    if not stat.S_ISBLK(st.st_mode):
+        return 512
+    buf = bytearray(4)
+    fcntl.ioctl(fd, BLKSSZGET, buf)
+    return int.from_bytes(buf, sys.byteorder)
+
+
+def _luks_area(device: str) -> int:
+    """Returns the end of the LUKS header and keyslot area, or 0 if the device is not LUKS."""
+    try:
+        info = luks.read_luks_header(device)
+    except OSError:
+        return 0
+    if info is None:
+        return 0
+    # A header whose segment offset cannot be read still gets the usual 16 MiB cleared
+    return info.data_offset or 16 * MIB
+
+
+def _partition_ranges(fd: int, pmap: partition_table.PartitionMap | None,
+                      sector_size: int) -> list[tuple[int, int]]:
+    """Returns the signature ranges inside every partition of 'pmap', as offsets on the whole device."""
+    if pmap is None:
+        return []
+    ranges = []
+    for part in pmap.partitions:
+        start = part.start * pmap.sector_size
+        size = part.sectors * pmap.sector_size
+        # The header cannot be parsed at an offset; clear the usual 16 MiB of a LUKS partition
+        found = signatures.probe_bytes(os.pread(fd, signatures.PROBE_SIZE, start))
+        luks_area = 16 * MIB if found == "crypto_LUKS" else 0
+        ranges += [(start + offset, length) for offset, length in signature_ranges(size, sector_size, luks_area)]
+    return ranges
+
+
+def _range_ioctl(fd: int, request: int, size: int) -> None:
+    """Issues BLKDISCARD/BLKZEROOUT over the whole device, one chunk at a time."""
+    offset = 0
+    while offset < size:
+        length = min(_CHUNK, size - offset)
+        fcntl.ioctl(fd, request, struct.pack("QQ", offset, length))
+        offset += length
+
+
+def _discard_supported(device: str, sys_root: str = "/sys") -> bool:
+    kname = os.path.basename(os.path.realpath(device))
+    queue = os.path.join(sys_root, "class", "block", kname, "queue")
+    if not os.path.isdir(queue):
+        queue = os.path.join(os.path.dirname(os.path.realpath(os.path.join(sys_root, "class", "block", kname))),
+                             "queue")
+    try:
+        with open(os.path.join(queue, "discard_max_bytes")) as f:
+            return int(f.read().strip()) > 0
+    except (OSError, ValueError):
+        return False
+
+
+def wipe_device(device: str, mode: str = "signatures") -> WipeResult:
+    """
+    Wipes one device or image file. Block devices are opened exclusively, so
+    a disk with a mounted partition or an open LUKS/LVM holder is refused
+    (EBUSY) instead of being wiped underneath its user. Never raises; the
+    outcome is in the returned WipeResult.
+    """
+    result = WipeResult(device, mode)
+    started = time.monotonic()
+    try:
+        if mode not in MODES:
+            raise WipeError(f"unknown mode '{mode}'")
+        st = os.stat(device)
+        is_block = stat.S_ISBLK(st.st_mode)
+        if not is_block and not stat.S_ISREG(st.st_mode):
+            raise WipeError("not a block device or image file")
+        if mode != "signatures" and not is_block:
+            raise WipeError(f"'{mode}' needs a block device")
+
+        result.found = signatures.probe_device(device)
+        luks_area = _luks_area(device) if result.found == "crypto_LUKS" else 0
+        pmap = partition_table.read_partition_map(device) if mode != "zero" else None
+        flags = os.O_RDWR | (os.O_EXCL if is_block else 0)
+        try:
+            fd = os.open(device, flags)
+        except OSError as e:
+            if e.errno == errno.EBUSY:
+                raise WipeError("device is in use (mounted, or held by LUKS/LVM/md)")
+            raise
+        try:
+            size = _device_size(fd, st)
+            if mode == "discard":
+                if _discard_supported(device):
+                    _range_ioctl(fd, BLKDISCARD, size)
+                    result.notes.append(f"discarded {size} bytes")
+                else:
+                    result.notes.append("discard not supported, only signatures were cleared")
+            elif mode == "zero":
+                _range_ioctl(fd, BLKZEROOUT, size)
+                result.bytes_cleared = size
+                result.ranges = 1
+            if mode != "zero":
+                # Discarded blocks do not have to read back as zeros, so clear the signatures too
+                sector_size = _sector_size(fd, st)
+                ranges = signature_ranges(size, sector_size, luks_area)
+                partition_ranges = _partition_ranges(fd, pmap, sector_size)
+                if partition_ranges:
+                    result.notes.append(f"cleared signatures in {len(pmap.partitions)} partition(s)")
+                ranges += partition_ranges
+                for offset, length in ranges:
+                    os.pwrite(fd, bytes(length), offset)
+                result.bytes_cleared = sum(length for _, length in ranges)
+                result.ranges = len(ranges)
+            os.fsync(fd)
+            if is_block:
+                try:
+                    fcntl.ioctl(fd, BLKRRPART)
+                except OSError:
+                    pass  # Partitions themselves (and some virtual disks) have no table to re-read
+        finally:
+            os.close(fd)
+        result.ok = True
+    except (OSError, WipeError) as e:
+        result.error = str(e)
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def wipe_devices(devices: list[str], mode: str = "signatures", max_workers: int = 8) -> list[WipeResult]:
+    """Wipes several devices in parallel (one thread per device) and returns their results in order."""
+    if not devices:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(devices)), thread_name_prefix="wipe") as pool:
+        return list(pool.map(lambda device: wipe_device(device, mode), devices))
+
+
+def _from_dict(data: dict) -> WipeResult:
+    return WipeResult(**{key: data[key] for key in WipeResult.__dataclass_fields__ if key in data})
+
+
+def wipe(devices: list[str], mode: str = "signatures") -> list[WipeResult]:
+    """
+    Wipes devices with root privileges: in this process when running as
+    root, through the privileged helper when it runs, otherwise with one
+    'sudo python3 -m utils.wipe' for all devices.
+    """
+    if os.geteuid() == 0:
+        return wipe_devices(devices, mode)
+    reply = privileged_helper.request_wipe(devices, mode)
+    if reply is not None:
+        return [_from_dict(entry) for entry in reply]
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        completed = subprocess.run(["sudo", sys.executable, "-m", "utils.wipe", "--mode", mode, *devices],
+                                   capture_output=True, text=True, cwd=package_root)
+        return [_from_dict(entry) for entry in json.loads(completed.stdout)]
+    except (FileNotFoundError, ValueError) as e:
+        return [WipeResult(device, mode, error=f"could not run the wipe as root: {e}") for device in devices]
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Clear on-disk signatures, or discard/zero whole devices.")
+    parser.add_argument("--mode", choices=MODES, default="signatures")
+    parser.add_argument("devices", nargs="+")
+    args = parser.parse_args()
+    print(json.dumps([asdict(result) for result in wipe_devices(args.devices, args.mode)]))
+
+
+if __name__ == "__main__":
+    main()